@@ -20,7 +20,8 @@ import statistics
 import os
 from oop_duct_model import Duct_Cell
 from bokeh.plotting import show, figure, save
-from bokeh_plotting import run_model_CFTR
+from duct_model_ensemble import run_ensemble_CFTR
+from duct_model_protocol import SimulationError
 from dcw_duct_model import init_cond
 from bokeh.models import Legend
 
@@ -284,6 +285,9 @@ def generateEffectiveCFTRFunction(chrL, chrR, ids, variant_info):
 def generate_graphs_for_df_of_patients(crf_df, cftr_df, patientgroup):
 	# Send all outputs to the same subdirectory
 	path_prefix = 'outputs/'+ patientgroup
+	# Collect every patient / therapy combination first so that all of them
+	# and the WT reference are integrated together in one ensemble run
+	jobs = []
 	# Base Case for one patient
 	for i in range(len(crf_df['ID'])):
 		crf_data = crf_df.iloc[i]
@@ -326,99 +330,110 @@ def generate_graphs_for_df_of_patients(crf_df, cftr_df, patientgroup):
 								cell_sim.add_smoking_influence(5/11)
 							elif smoking_status == "Past":
 								cell_sim.add_smoking_influence(8.5/11)
-					
-
-					# Run model
-					
-					# Instantiate New Cell for Patient
-					wt_cell = Duct_Cell()
-					input_data = wt_cell.input_dict
-
-					init = copy.deepcopy(init_cond)
-
-					# Construct Arrays from Duct Model System Equations
-					def generate_source_array(input_data, key):
-						choice_array = run_model_CFTR(input_data, 20000, 120000, 200000)[0][key]
-						if key == 'time':
-							choice_array /=  20000
-						return choice_array
-
-					# Individual graphing arrays for ColumnDataSource
-					wt_bi_l = generate_source_array(init, 'bl')
-					wt_bi_i = generate_source_array(init, 'bi')
-					pt_bi_l = generate_source_array(cell_sim.input_dict, 'bl')
-					pt_bi_i = generate_source_array(cell_sim.input_dict, 'bi')
-					wt_cl_l = 160 - wt_bi_l
-					wt_cl_i = generate_source_array(init, 'ci')
-					pt_cl_l = 160 - pt_bi_l
-					pt_cl_i = generate_source_array(cell_sim.input_dict, 'ci')
-					time = generate_source_array(input_data, 'time')
-
-					item_title = item
-					if item == 'Ivocaftor':
-						item_title = 'Ivacaftor'
-					title =  'Patient Information for ' + name + ' (' + item_title +') '
-					if item == 'Residual':
-						if alc_ever == "TRUE"  and smoking_ever	== "TRUE":
-							title += '- Alcohol and Tobacco Influences Added'
-						elif alc_ever == "TRUE" and smoking_ever != "TRUE":
-							title += '- Alcohol Influence Added'
-						elif alc_ever != "TRUE" and smoking_ever == "TRUE":
-							title += '- Tobacco Influence Added'
-						elif alc_ever != "TRUE" and smoking_ever != "TRUE":
-							title += '- No Tobacco or Alcohol Use Reported in CRF'
-					else:
-						title += '- In addition to abstaining from Tobacco & Alcohol'
-
-					# Bicarb Plot
-					bi_legend = Legend(items=[])
-					bi_plot = figure(plot_height=800, plot_width=1000,  title=title)
-					bi_plot.add_layout(bi_legend, 'right')
-					bi_plot.legend.click_policy = 'hide'
-					bi_plot.line(time, pt_bi_l, line_width=3, line_color = '#34344A', legend="Patient Luminal HCO3-")
-					bi_plot.line(time, pt_bi_i, line_width=3, line_color = '#7FE0CB', legend="Patient Intra HCO3-")
-					bi_plot.line(time, wt_bi_l, line_width=3, line_color = '#34344A', alpha=0.25, line_dash='dashed', line_cap='round', legend="WT Luminal HCO3-")
-					bi_plot.line(time, wt_bi_i, line_width=3, line_color = '#7FE0CB', alpha=0.25, line_dash='dashed', line_cap='round', legend="WT Intracellular HCO3-")
-					bi_plot.legend.label_text_font = 'gilroy'
-					bi_plot.title.text_font = 'gilroy'
-					bi_plot.title.text_font_style = 'bold'
-					bi_plot.yaxis.axis_label_text_font = 'gilroy'
-					bi_plot.yaxis.axis_label_text_font_style = 'normal'
-					bi_plot.xaxis.axis_label_text_font = 'gilroy'
-					bi_plot.xaxis.axis_label_text_font_style = 'normal'
-
-					bi_plot.yaxis.axis_label = 'Bicarb Conc. (mM)'
-					bi_plot.xaxis.axis_label = 'Time'
-
-					# Chloride Plot
-					cl_legend = Legend(items=[])
-					cl_plot = figure(plot_height=800, plot_width=1000,  title=title)
-					cl_plot.add_layout(cl_legend, 'right')
-					cl_plot.legend.click_policy = 'hide'
-					cl_plot.line(time, pt_cl_l, line_width=3, line_color = '#34344A', legend="Patient Luminal Cl-")
-					cl_plot.line(time, pt_cl_i, line_width=3, line_color = '#7FE0CB', legend="Patient Intra Cl-")
-					cl_plot.line(time, wt_cl_l, line_width=3, line_color = '#34344A', alpha=0.25, line_dash='dashed', line_cap='round', legend="WT Luminal Cl-")
-					cl_plot.line(time, wt_cl_i, line_width=3, line_color = '#7FE0CB', alpha=0.25, line_dash='dashed', line_cap='round', legend="WT Intracellular Cl-")
-					cl_plot.legend.label_text_font = 'gilroy'
-					cl_plot.legend.background_fill_color = '#F4F1E1'
-					cl_plot.legend.background_fill_alpha = 0.25
-					cl_plot.title.text_font = 'gilroy'
-					cl_plot.title.text_font_style = 'bold'
-					cl_plot.yaxis.axis_label_text_font = 'gilroy'
-					cl_plot.yaxis.axis_label_text_font_style = 'normal'
-					cl_plot.xaxis.axis_label_text_font = 'gilroy'
-					cl_plot.xaxis.axis_label_text_font_style = 'normal'
-
-					cl_plot.yaxis.axis_label = 'Chloride Conc. (mM)'
-					cl_plot.xaxis.axis_label = 'Time'
-
-					save(bi_plot, filename= pt_subfolder + path_extension + '_hco3' + '.html')
-					save(cl_plot, filename= pt_subfolder + path_extension + '_cl' + '.html')
 
+					jobs.append({'name': name, 'item': item, 'pt_subfolder': pt_subfolder,
+								 'path_extension': path_extension, 'input_dict': cell_sim.input_dict,
+								 'alc_ever': alc_ever, 'smoking_ever': smoking_ever})
 
 		else:
 			print('Patient ID\'s do not match')
 
+	if not jobs:
+		return
+
+	# Run model for WT and every patient in one batched integration
+	try:
+		results = run_ensemble_CFTR([init_cond] + [job['input_dict'] for job in jobs], 20000, 120000, 200000)
+		failed = set()
+	except SimulationError as error:
+		# Patients whose simulation failed on every fallback are reported and skipped instead of graphed as NaN
+		print(error)
+		results, failed = error.results, set(error.failed)
+		if 0 in failed:
+			return
+
+	# WT arrays are shared by every graph
+	wt_results = results[0][0]
+	time = wt_results['time'] / 20000
+	wt_bi_l = wt_results['bl']
+	wt_bi_i = wt_results['bi']
+	wt_cl_l = 160 - wt_bi_l
+	wt_cl_i = wt_results['ci']
+
+	for position, (job, pt_results) in enumerate(zip(jobs, results[1:]), 1):
+		if position in failed:
+			continue
+		name, item = job['name'], job['item']
+		pt_subfolder, path_extension = job['pt_subfolder'], job['path_extension']
+		alc_ever, smoking_ever = job['alc_ever'], job['smoking_ever']
+
+		# Individual patient arrays
+		pt_bi_l = pt_results[0]['bl']
+		pt_bi_i = pt_results[0]['bi']
+		pt_cl_l = 160 - pt_bi_l
+		pt_cl_i = pt_results[0]['ci']
+
+		item_title = item
+		if item == 'Ivocaftor':
+			item_title = 'Ivacaftor'
+		title =  'Patient Information for ' + name + ' (' + item_title +') '
+		if item == 'Residual':
+			if alc_ever == "TRUE"  and smoking_ever	== "TRUE":
+				title += '- Alcohol and Tobacco Influences Added'
+			elif alc_ever == "TRUE" and smoking_ever != "TRUE":
+				title += '- Alcohol Influence Added'
+			elif alc_ever != "TRUE" and smoking_ever == "TRUE":
+				title += '- Tobacco Influence Added'
+			elif alc_ever != "TRUE" and smoking_ever != "TRUE":
+				title += '- No Tobacco or Alcohol Use Reported in CRF'
+		else:
+			title += '- In addition to abstaining from Tobacco & Alcohol'
+
+		# Bicarb Plot
+		bi_legend = Legend(items=[])
+		bi_plot = figure(plot_height=800, plot_width=1000,  title=title)
+		bi_plot.add_layout(bi_legend, 'right')
+		bi_plot.legend.click_policy = 'hide'
+		bi_plot.line(time, pt_bi_l, line_width=3, line_color = '#34344A', legend="Patient Luminal HCO3-")
+		bi_plot.line(time, pt_bi_i, line_width=3, line_color = '#7FE0CB', legend="Patient Intra HCO3-")
+		bi_plot.line(time, wt_bi_l, line_width=3, line_color = '#34344A', alpha=0.25, line_dash='dashed', line_cap='round', legend="WT Luminal HCO3-")
+		bi_plot.line(time, wt_bi_i, line_width=3, line_color = '#7FE0CB', alpha=0.25, line_dash='dashed', line_cap='round', legend="WT Intracellular HCO3-")
+		bi_plot.legend.label_text_font = 'gilroy'
+		bi_plot.title.text_font = 'gilroy'
+		bi_plot.title.text_font_style = 'bold'
+		bi_plot.yaxis.axis_label_text_font = 'gilroy'
+		bi_plot.yaxis.axis_label_text_font_style = 'normal'
+		bi_plot.xaxis.axis_label_text_font = 'gilroy'
+		bi_plot.xaxis.axis_label_text_font_style = 'normal'
+
+		bi_plot.yaxis.axis_label = 'Bicarb Conc. (mM)'
+		bi_plot.xaxis.axis_label = 'Time'
+
+		# Chloride Plot
+		cl_legend = Legend(items=[])
+		cl_plot = figure(plot_height=800, plot_width=1000,  title=title)
+		cl_plot.add_layout(cl_legend, 'right')
+		cl_plot.legend.click_policy = 'hide'
+		cl_plot.line(time, pt_cl_l, line_width=3, line_color = '#34344A', legend="Patient Luminal Cl-")
+		cl_plot.line(time, pt_cl_i, line_width=3, line_color = '#7FE0CB', legend="Patient Intra Cl-")
+		cl_plot.line(time, wt_cl_l, line_width=3, line_color = '#34344A', alpha=0.25, line_dash='dashed', line_cap='round', legend="WT Luminal Cl-")
+		cl_plot.line(time, wt_cl_i, line_width=3, line_color = '#7FE0CB', alpha=0.25, line_dash='dashed', line_cap='round', legend="WT Intracellular Cl-")
+		cl_plot.legend.label_text_font = 'gilroy'
+		cl_plot.legend.background_fill_color = '#F4F1E1'
+		cl_plot.legend.background_fill_alpha = 0.25
+		cl_plot.title.text_font = 'gilroy'
+		cl_plot.title.text_font_style = 'bold'
+		cl_plot.yaxis.axis_label_text_font = 'gilroy'
+		cl_plot.yaxis.axis_label_text_font_style = 'normal'
+		cl_plot.xaxis.axis_label_text_font = 'gilroy'
+		cl_plot.xaxis.axis_label_text_font_style = 'normal'
+
+		cl_plot.yaxis.axis_label = 'Chloride Conc. (mM)'
+		cl_plot.xaxis.axis_label = 'Time'
+
+		save(bi_plot, filename= pt_subfolder + path_extension + '_hco3' + '.html')
+		save(cl_plot, filename= pt_subfolder + path_extension + '_cl' + '.html')
+
 	return
 
 
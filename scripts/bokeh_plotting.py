@@ -6,78 +6,24 @@ import numpy as np
 import matplotlib.pyplot as plt
 import numpy.random as rnd
 import copy
-from dcw_duct_model import duct_model_system, init_cond
+from dcw_duct_model import init_cond
+from duct_model_protocol import SimulationError, StimulusProtocol, integrate_with_fallbacks
 
 from bokeh.plotting import figure, output_file, show
 from bokeh.layouts import column, row
 from bokeh.models import Legend
 
-import numpy.polynomial.polynomial as poly
-
-# Normalize length for graphing
-def fitting_wrapper_fxn(state):
-	graphing_strings = ['bi', 'bl', 'ci', 'ni']
-	results = dict()
-	new_t = np.linspace(state['t'][0], state['t'][-1], 500)
-	for item in graphing_strings:
-		coefs = poly.polyfit(state['t'], state['y'][graphing_strings.index(item)], 10)
-		ffit = poly.Polynomial(coefs)
-		results[item] = ffit(new_t)
-	results['time'] = new_t
-	return results
-
-def run_model_CFTR(input_dict, t_on, t_off, t_end):
+def run_model_CFTR(input_dict, t_on, t_off, t_end, n_points=500, **solver_options):
 	times = {'t_on': t_on, 't_off': t_off, 't_end': t_end}
-
-	# Wrapper function to pass dictionary parameters through solve_ivp
-	def wrapper_fxn(t, y):
-		return duct_model_system(t, y, cond)
-	# Copy Input Dictionary so Initial Dictionary is Unaltered
-	cond = copy.deepcopy(input_dict)
-	# Period Before gcftr opens
-	cond['gcftr'] = init_cond['gcftrbase']
-	y0_0 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state0 = solve_ivp(wrapper_fxn, [0,t_on], y0_0)
-
-	# Period where gcftr is open
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftron']
-	graphing_strings = ['bi', 'bl', 'ci', 'ni']
-	for variable in graphing_strings:
-		cond[variable] = state0['y'][graphing_strings.index(variable)][-1]
-	
-	y0_1 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state1 = solve_ivp(wrapper_fxn, [t_on,t_off], y0_1)
-
-	# Period where gcftr closes to end
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftrbase']
-	for variable in graphing_strings:
-		cond[variable] = state1['y'][graphing_strings.index(variable)][-1]
-
-	y0_2 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state2 = solve_ivp(wrapper_fxn, [t_off,t_end], y0_2)
-
-	# op1 = fitting_wrapper_fxn(state0)['bl']
-	# op2 = fitting_wrapper_fxn(state1)['bl']
-	# op3 = fitting_wrapper_fxn(state2)['bl']
-	# ops = np.concatenate([op1,op2, op3])
-	# # print(ops)
-	# print(len(ops))
-
-	graphing_dict = dict()
-	s0_res = fitting_wrapper_fxn(state0)
-	s1_res = fitting_wrapper_fxn(state1)
-	s2_res = fitting_wrapper_fxn(state2)
-	graphing_strings.append('time')
-	for item in graphing_strings:
-		graphing_dict[item] = np.concatenate([s0_res[item],s1_res[item], s2_res[item]])
-	# graphing_dict['time'] = np.concatenate([state0['t'], state1['t'], state2['t']])
-
-	# for variable in graphing_strings:
-	# 	graphing_dict[variable] = np.concatenate([state0['y'][graphing_strings.index(variable)], 
-	# 								state1['y'][graphing_strings.index(variable)],
-	# 								state2['y'][graphing_strings.index(variable)]])
+	# Rest / CFTR open / recovery in a single protocol integration
+	protocol = StimulusProtocol.secretin_pulse(t_on, t_off, t_end)
+	# Failed or over-budget runs are retried with the fallback methods; a run failing every one is an error, not a truncated plot
+	state = integrate_with_fallbacks(input_dict, protocol, **solver_options)
+	if not state.success:
+		raise SimulationError('Simulation failed: ' + state.diagnostics(), attempts=[state.attempts])
+	# Dense output evaluated lazily on n_points per phase (use .on(grid) for other grids)
+	graphing_dict = state.trajectory(protocol.sample_grid(n_points))
+	graphing_strings = ['bi', 'bl', 'ci', 'ni', 'time']
 	return [graphing_dict, times, graphing_strings]
 
 def graph_CFTR(model_results, filename, title):
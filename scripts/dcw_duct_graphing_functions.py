@@ -11,12 +11,12 @@ appendix of Whitcomb & Ermentrout's 'A Mathematical Model of the Pancreatic
 Duct Cell Generating High Bicarbonate Concentrations in Pancreatic Juice'
 """
 from math import log
-from scipy.integrate import odeint, solve_ivp
 import numpy as np
 import matplotlib.pyplot as plt
 import numpy.random as rnd
-import copy
-from dcw_duct_model import duct_model_system, init_cond
+from dcw_duct_model import init_cond
+from duct_model_protocol import SimulationError, StimulusProtocol, integrate_with_fallbacks
+from duct_model_sweep import run_sweep, Sweep
 
 def graph_generation(graph_type, input_dict, variant_impact = None, smoking_status = None):
 	filename = None
@@ -36,42 +36,20 @@ def graph_generation(graph_type, input_dict, variant_impact = None, smoking_stat
 		filename = graph_var_smoke_impact(calc_var_smoke_impact(input_dict, 20000, 120000, 200000, variant_impact, smoking_status), 'smoking_and_variant_impact')
 	return filename
 
+def run_protocol(input_dict, t_on, t_off, t_end, **solver_options):
+	# Resting / CFTR open / recovery time course as [t, bi, bl, ci, ni]
+	state = integrate_with_fallbacks(input_dict, StimulusProtocol.secretin_pulse(t_on, t_off, t_end), **solver_options)
+	if not state.success:
+		raise SimulationError('Simulation failed: ' + state.diagnostics(), attempts=[state.attempts])
+	return [state.t] + list(state.y[:4])
+
+def sweep_protocol(input_dict, t_on, t_off, t_end, sweep, **solver_options):
+	# Every run of a sweep over input_dict through the same protocol, as [[t, bi, bl, ci, ni], t_on, t_off, t_end]
+	result = run_sweep(sweep, input_dict, StimulusProtocol.secretin_pulse(t_on, t_off, t_end), **solver_options).check()
+	return [[result.run(i), t_on, t_off, t_end] for i in range(len(result))]
+
 def cftr_calc_HCO3_Cl(input_dict, t_on, t_off, t_end):
-	# Wrapper function to pass dictionary parameters through solve_ivp
-	def wrapper_fxn(t, y):
-		return duct_model_system(t, y, cond)
-	# Copy Input Dictionary so Initial Dictionary is Unaltered
-	cond = copy.deepcopy(input_dict)
-	# Period Before gcftr opens
-	cond['gcftr'] = init_cond['gcftrbase']
-	y0_0 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state0 = solve_ivp(wrapper_fxn, [0,t_on], y0_0)
-	# Period where gcftr is open
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftron']
-	cond['bi'] = state0['y'][0][-1]
-	cond['bl'] = state0['y'][1][-1]
-	cond['ci'] = state0['y'][2][-1]
-	cond['ni'] = state0['y'][3][-1]
-	y0_1 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state1 = solve_ivp(wrapper_fxn, [t_on,t_off], y0_1)
-	# Period where gcftr closes to end
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftrbase']
-	cond['bi'] = state1['y'][0][-1]
-	cond['bl'] = state1['y'][1][-1]
-	cond['ci'] = state1['y'][2][-1]
-	cond['ni'] = state1['y'][3][-1]
-	y0_2 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state2 = solve_ivp(wrapper_fxn, [t_off,t_end], y0_2)
-
-	t_graph = np.concatenate([state0['t'], state1['t'], state2['t']])
-	bi_graph = np.concatenate([state0['y'][0], state1['y'][0], state2['y'][0]])
-	bl_graph = np.concatenate([state0['y'][1], state1['y'][1], state2['y'][1]])
-	ci_graph = np.concatenate([state0['y'][2], state1['y'][2], state2['y'][2]])
-	ni_graph = np.concatenate([state0['y'][3], state1['y'][3], state2['y'][3]])
-
-	return [[t_graph, bi_graph, bl_graph, ci_graph, ni_graph], t_on, t_off, t_end]
+	return sweep_protocol(input_dict, t_on, t_off, t_end, Sweep([{}]))[0]
 
 def graph_CFTR(model_results, filename):
 	# Unpack variables
@@ -111,55 +89,8 @@ def graph_CFTR(model_results, filename):
 	return filename
 
 def vol_rat_calc(input_dict, t_on, t_off, t_end, volumes):
-	# Wrapper function to pass dictionary parameters through solve_ivp
-	def wrapper_fxn(t, y):
-		return duct_model_system(t, y, cond)
-	# Copy Input Dictionary so Initial Dictionary is Unaltered
-	cond = copy.deepcopy(input_dict)
-
-	model_results = []
-
-	def reset_values():
-		cond['bi'] = init_cond['bi']
-		cond['bl'] = init_cond['bl']
-		cond['ci'] = init_cond['ci']
-		cond['ni'] = init_cond['ni']
-		cond['gcftr'] = init_cond['gcftr']
-
-	for volume in volumes:
-		cond['vr'] = volume
-		# Period Before gcftr opens
-		cond['gcftr'] = init_cond['gcftrbase']
-		y0_0 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-		state0 = solve_ivp(wrapper_fxn, [0,t_on], y0_0)
-		# Period where gcftr is open
-		# Turn gcftr 'on' and re-initialize boundary conditions
-		cond['gcftr'] = cond['gcftron']
-		cond['bi'] = state0['y'][0][-1]
-		cond['bl'] = state0['y'][1][-1]
-		cond['ci'] = state0['y'][2][-1]
-		cond['ni'] = state0['y'][3][-1]
-		y0_1 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-		state1 = solve_ivp(wrapper_fxn, [t_on,t_off], y0_1)
-		# Period where gcftr closes to end
-		# Turn gcftr 'on' and re-initialize boundary conditions
-		cond['gcftr'] = cond['gcftrbase']
-		cond['bi'] = state1['y'][0][-1]
-		cond['bl'] = state1['y'][1][-1]
-		cond['ci'] = state1['y'][2][-1]
-		cond['ni'] = state1['y'][3][-1]
-		y0_2 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-		state2 = solve_ivp(wrapper_fxn, [t_off,t_end], y0_2)
-
-		t_graph = np.concatenate([state0['t'], state1['t'], state2['t']])
-		bi_graph = np.concatenate([state0['y'][0], state1['y'][0], state2['y'][0]])
-		bl_graph = np.concatenate([state0['y'][1], state1['y'][1], state2['y'][1]])
-		ci_graph = np.concatenate([state0['y'][2], state1['y'][2], state2['y'][2]])
-		ni_graph = np.concatenate([state0['y'][3], state1['y'][3], state2['y'][3]])
-		model_results.append([[t_graph, bi_graph, bl_graph, ci_graph, ni_graph], t_on, t_off, t_end, volume])
-		reset_values()
-
-	return model_results
+	model_results = sweep_protocol(input_dict, t_on, t_off, t_end, Sweep.zip(vr=volumes))
+	return [result + [volume] for result, volume in zip(model_results, volumes)]
 
 def graph_volume_ratios(model_results, filename):
 	for volume_option in model_results:
@@ -177,57 +108,11 @@ def graph_volume_ratios(model_results, filename):
 	return filename
 
 def antiporters_calc(input_dict, t_on, t_off, t_end):
-	# Wrapper function to pass dictionary parameters through solve_ivp
-	def wrapper_fxn(t, y):
-		return duct_model_system(t, y, cond)
-	# Copy Input Dictionary so Initial Dictionary is Unaltered
-	cond = copy.deepcopy(input_dict)
-	model_results = []
-	def reset_values():
-		cond['bi'] = init_cond['bi']
-		cond['bl'] = init_cond['bl']
-		cond['ci'] = init_cond['ci']
-		cond['ni'] = init_cond['ni']
-		cond['gcftr'] = init_cond['gcftr']
-
 	antiporter_options = [(True, True), (False, False), (True, False)]
-
-	for option in antiporter_options:
-		cond['ap_status'] = option[0]
-		cond['apb_status'] = option[1]
-		
-		# Period Before gcftr opens
-		cond['gcftr'] = init_cond['gcftrbase']
-		y0_0 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-		state0 = solve_ivp(wrapper_fxn, [0,t_on], y0_0)
-		# Period where gcftr is open
-		# Turn gcftr 'on' and re-initialize boundary conditions
-		cond['gcftr'] = cond['gcftron']
-		cond['bi'] = state0['y'][0][-1]
-		cond['bl'] = state0['y'][1][-1]
-		cond['ci'] = state0['y'][2][-1]
-		cond['ni'] = state0['y'][3][-1]
-		y0_1 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-		state1 = solve_ivp(wrapper_fxn, [t_on,t_off], y0_1)
-		# Period where gcftr closes to end
-		# Turn gcftr 'on' and re-initialize boundary conditions
-		cond['gcftr'] = cond['gcftrbase']
-		cond['bi'] = state1['y'][0][-1]
-		cond['bl'] = state1['y'][1][-1]
-		cond['ci'] = state1['y'][2][-1]
-		cond['ni'] = state1['y'][3][-1]
-		y0_2 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-		state2 = solve_ivp(wrapper_fxn, [t_off,t_end], y0_2)
-
-		t_graph = np.concatenate([state0['t'], state1['t'], state2['t']])
-		bi_graph = np.concatenate([state0['y'][0], state1['y'][0], state2['y'][0]])
-		bl_graph = np.concatenate([state0['y'][1], state1['y'][1], state2['y'][1]])
-		ci_graph = np.concatenate([state0['y'][2], state1['y'][2], state2['y'][2]])
-		ni_graph = np.concatenate([state0['y'][3], state1['y'][3], state2['y'][3]])
-		model_results.append([[t_graph, bi_graph, bl_graph, ci_graph, ni_graph], t_on, t_off, t_end, option])
-		reset_values()
-
-	return model_results
+	sweep = Sweep.zip(ap_status=[option[0] for option in antiporter_options],
+					  apb_status=[option[1] for option in antiporter_options])
+	model_results = sweep_protocol(input_dict, t_on, t_off, t_end, sweep)
+	return [result + [option] for result, option in zip(model_results, antiporter_options)]
 
 def graph_antiporters(model_results, filename):
 	for i in range(len(model_results)):
@@ -259,56 +144,16 @@ def graph_antiporters(model_results, filename):
 	return filename
 
 def calc_variant_impact(input_dict, t_on, t_off, t_end, variant_input_dict):
-	# Wrapper function to pass dictionary parameters through solve_ivp
-	def wrapper_fxn(t, y):
-		return duct_model_system(t, y, cond)
-	# Copy Input Dictionary so Initial Dictionary is Unaltered
-	cond = copy.deepcopy(input_dict)
-
-	model_results = []
-
-	model_results.append(cftr_calc_HCO3_Cl(input_dict, t_on, t_off, t_end))
-
 	# Accomodate patient variants
 	variant_wt_func_list = []
 	for key in variant_input_dict:
 		variant_wt_func_list.append(variant_input_dict[key])
 	total_impact = np.mean(variant_wt_func_list)
 
-	# Adjust for change in chloride transport from Cutting Paper
-	cond['variant_adj'] = total_impact / 100
-
-	# Period Before gcftr opens
-	cond['gcftr'] = init_cond['gcftrbase']
-	y0_0 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state0 = solve_ivp(wrapper_fxn, [0,t_on], y0_0)
-
-	# Period where gcftr is open
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftron']
-	cond['bi'] = state0['y'][0][-1]
-	cond['bl'] = state0['y'][1][-1]
-	cond['ci'] = state0['y'][2][-1]
-	cond['ni'] = state0['y'][3][-1]
-	y0_1 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state1 = solve_ivp(wrapper_fxn, [t_on,t_off], y0_1)
-	# Period where gcftr closes to end
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftrbase']
-	cond['bi'] = state1['y'][0][-1]
-	cond['bl'] = state1['y'][1][-1]
-	cond['ci'] = state1['y'][2][-1]
-	cond['ni'] = state1['y'][3][-1]
-	y0_2 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state2 = solve_ivp(wrapper_fxn, [t_off,t_end], y0_2)
-
-	t_graph = np.concatenate([state0['t'], state1['t'], state2['t']])
-	bi_graph = np.concatenate([state0['y'][0], state1['y'][0], state2['y'][0]])
-	bl_graph = np.concatenate([state0['y'][1], state1['y'][1], state2['y'][1]])
-	ci_graph = np.concatenate([state0['y'][2], state1['y'][2], state2['y'][2]])
-	ni_graph = np.concatenate([state0['y'][3], state1['y'][3], state2['y'][3]])
-
-	model_results.append([[t_graph, bi_graph, bl_graph, ci_graph, ni_graph], t_on, t_off, t_end, variant_input_dict])
+	# Baseline and the change in chloride transport from Cutting Paper, integrated together
+	sweep = Sweep([{}, {'variant_adj': total_impact / 100}])
+	model_results = sweep_protocol(input_dict, t_on, t_off, t_end, sweep)
+	model_results[1].append(variant_input_dict)
 
 	return model_results
 
@@ -365,53 +210,14 @@ def graph_variant_impact(model_results, filename):
 	return filename
 
 def calc_smoking_impact(input_dict, t_on, t_off, t_end, smoking_status):
-	# Wrapper function to pass dictionary parameters through solve_ivp
-	def wrapper_fxn(t, y):
-		return duct_model_system(t, y, cond)
-	# Copy Input Dictionary so Initial Dictionary is Unaltered
-	cond = copy.deepcopy(input_dict)
-
-	model_results = []
-
-	model_results.append(cftr_calc_HCO3_Cl(input_dict, t_on, t_off, t_end))
-
-	# Adjust for change in chloride transport from Cutting Paper
+	cond = {}
 	if smoking_status == 'light':
 		# from paper Nicotine (hurts light, protective heavy)
 		# "Inhibition of Pancreatic Secretion in Man by Cigarrette Smoking" - T. Bynum et al.
 		cond['smoke_adj'] = 0.4
 
-	# Period Before gcftr opens
-	cond['gcftr'] = init_cond['gcftrbase']
-	y0_0 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state0 = solve_ivp(wrapper_fxn, [0,t_on], y0_0)
-
-	# Period where gcftr is open
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftron']
-	cond['bi'] = state0['y'][0][-1]
-	cond['bl'] = state0['y'][1][-1]
-	cond['ci'] = state0['y'][2][-1]
-	cond['ni'] = state0['y'][3][-1]
-	y0_1 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state1 = solve_ivp(wrapper_fxn, [t_on,t_off], y0_1)
-	# Period where gcftr closes to end
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftrbase']
-	cond['bi'] = state1['y'][0][-1]
-	cond['bl'] = state1['y'][1][-1]
-	cond['ci'] = state1['y'][2][-1]
-	cond['ni'] = state1['y'][3][-1]
-	y0_2 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state2 = solve_ivp(wrapper_fxn, [t_off,t_end], y0_2)
-
-	t_graph = np.concatenate([state0['t'], state1['t'], state2['t']])
-	bi_graph = np.concatenate([state0['y'][0], state1['y'][0], state2['y'][0]])
-	bl_graph = np.concatenate([state0['y'][1], state1['y'][1], state2['y'][1]])
-	ci_graph = np.concatenate([state0['y'][2], state1['y'][2], state2['y'][2]])
-	ni_graph = np.concatenate([state0['y'][3], state1['y'][3], state2['y'][3]])
-
-	model_results.append([[t_graph, bi_graph, bl_graph, ci_graph, ni_graph], t_on, t_off, t_end, smoking_status])
+	model_results = sweep_protocol(input_dict, t_on, t_off, t_end, Sweep([{}, cond]))
+	model_results[1].append(smoking_status)
 
 	return model_results
 
@@ -468,17 +274,7 @@ def graph_smoking_impact(model_results, filename):
 	return filename
 
 def calc_var_smoke_impact(input_dict, t_on, t_off, t_end, variant_input_dict, smoking_status):
-	# Wrapper function to pass dictionary parameters through solve_ivp
-	def wrapper_fxn(t, y):
-		return duct_model_system(t, y, cond)
-	# Copy Input Dictionary so Initial Dictionary is Unaltered
-	cond = copy.deepcopy(input_dict)
-
-	model_results = []
-
-	model_results.append(cftr_calc_HCO3_Cl(input_dict, t_on, t_off, t_end))
-
-	# Adjust for change in chloride transport from Cutting Paper
+	cond = {}
 	if smoking_status == 'light':
 		# from paper Nicotine (hurts light, protective heavy)
 		# "Inhibition of Pancreatic Secretion in Man by Cigarrette Smoking" - T. Bynum et al.
@@ -491,39 +287,10 @@ def calc_var_smoke_impact(input_dict, t_on, t_off, t_end, variant_input_dict, sm
 	total_impact = np.mean(variant_wt_func_list)
 
 	# Adjust for change in chloride transport from Cutting Paper
-	cond['cond_adj'] = total_impact / 100
-
-	# Period Before gcftr opens
-	cond['gcftr'] = init_cond['gcftrbase']
-	y0_0 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state0 = solve_ivp(wrapper_fxn, [0,t_on], y0_0)
-
-	# Period where gcftr is open
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftron']
-	cond['bi'] = state0['y'][0][-1]
-	cond['bl'] = state0['y'][1][-1]
-	cond['ci'] = state0['y'][2][-1]
-	cond['ni'] = state0['y'][3][-1]
-	y0_1 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state1 = solve_ivp(wrapper_fxn, [t_on,t_off], y0_1)
-	# Period where gcftr closes to end
-	# Turn gcftr 'on' and re-initialize boundary conditions
-	cond['gcftr'] = cond['gcftrbase']
-	cond['bi'] = state1['y'][0][-1]
-	cond['bl'] = state1['y'][1][-1]
-	cond['ci'] = state1['y'][2][-1]
-	cond['ni'] = state1['y'][3][-1]
-	y0_2 = [cond['bi'], cond['bl'], cond['ci'], cond['ni'], cond['gcftr']]
-	state2 = solve_ivp(wrapper_fxn, [t_off,t_end], y0_2)
-
-	t_graph = np.concatenate([state0['t'], state1['t'], state2['t']])
-	bi_graph = np.concatenate([state0['y'][0], state1['y'][0], state2['y'][0]])
-	bl_graph = np.concatenate([state0['y'][1], state1['y'][1], state2['y'][1]])
-	ci_graph = np.concatenate([state0['y'][2], state1['y'][2], state2['y'][2]])
-	ni_graph = np.concatenate([state0['y'][3], state1['y'][3], state2['y'][3]])
-
-	model_results.append([[t_graph, bi_graph, bl_graph, ci_graph, ni_graph], t_on, t_off, t_end, variant_input_dict, smoking_status])
+	cond['variant_adj'] = total_impact / 100
+
+	model_results = sweep_protocol(input_dict, t_on, t_off, t_end, Sweep([{}, cond]))
+	model_results[1] += [variant_input_dict, smoking_status]
 
 	return model_results
 
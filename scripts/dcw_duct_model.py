@@ -16,6 +16,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 import numpy.random as rnd
 import copy
+import duct_model_generated
+import duct_model_kernels
+from duct_model_kernels import safe_log, LOG_FLOOR, EFF_PERM_SERIES
 
 init_cond = {'g_bi': 0.2, 'g_cl': 1, 'zeta': 0.05,
 			  'kbi': 1, 'kcl': 10, 'gnbc': 2, 'gapl': 0.25,
@@ -29,6 +32,27 @@ init_cond = {'g_bi': 0.2, 'g_cl': 1, 'zeta': 0.05,
 			  'ap_status': False, 'gcftr': 0.00007, 'smoke_adj': None,
 			  'alcohol_adj': None}
 
+# Physical Constants
+IDEAL_GAS = 8.31451
+FARADAY_CST = 96485
+BODY_TEMP = 310 #K
+RT_F = IDEAL_GAS*BODY_TEMP/FARADAY_CST
+
+# State vector layout shared by every solver (see duct_model_system)
+STATE_NAMES = ('bi', 'bl', 'ci', 'ni', 'gcftr')
+
+# Parameter vector layout for DuctParams. Keys of init_cond that are not
+# listed here are either state variables (STATE_NAMES) or bookkeeping.
+PARAM_NAMES = ('g_bi', 'g_cl', 'zeta', 'kbi', 'kcl', 'gnbc', 'gapl',
+			   'gapbl', 'nb', 'bb', 'cb', 'bi0', 'buf', 'chi', 'gcftron',
+			   'gcftrbase', 'ek', 'gk', 'cap', 'gnak', 'np0', 'epump',
+			   'ionstr', 'gnaleak', 'jac', 'rat', 'vr', 'apb_status',
+			   'ap_status', 'variant_adj', 'smoke_adj', 'alcohol_adj')
+PARAM_INDEX = {name: i for i, name in enumerate(PARAM_NAMES)}
+
+# Optional influences default to WT behaviour when left as None
+ADJUSTMENT_NAMES = ('variant_adj', 'smoke_adj', 'alcohol_adj')
+
 
 def antiporter(ao,ai,bo,bi,ka,kb):
 	'''
@@ -45,73 +69,77 @@ def antiporter(ao,ai,bo,bi,ka,kb):
 	* that the dissociation constants (ka,kb) for each ion at the intracellular and extracellular faces of the membrane were the same
 
 
+	Every argument may be an array (e.g. (N,) ensemble members); they are broadcast together.
+
 	Parameters
 	----------
-	ao : float
+	ao : float or np.ndarray
 		Molar concentration of ion A outside of cell membrane
-	ai : float
+	ai : float or np.ndarray
 		Molar concentration of ion A inside cell membrane
-	bo : float
+	bo : float or np.ndarray
 		Molar concentration of ion B outside of cell membrane
-	bi : float
+	bi : float or np.ndarray
 		Molar concentration of ion B inside of cell membrane
-	ka : float
+	ka : float or np.ndarray
 		Dissociation constant for ion A
-	kb : float
+	kb : float or np.ndarray
 		Dissociation constant for ion B
 
 	Returns
 	-------
-	ratio : float
+	ratio : float or np.ndarray
 		Fraction of ionic flux moving through antiporter. Multiply with conductance to yield flux through antiporter.
 	'''
-    numerator = ao*bi-bo*ai
-    denominator = (ka*kb*((1+ai/ka+bi/kb)*(ao/ka+bo/kb)+\
-                          (1+ao/ka+bo/kb)*(ai/ka+bi/kb)))
-    ratio = numerator / denominator
-    return ratio
+	numerator = ao*bi-bo*ai
+	denominator = (ka*kb*((1+ai/ka+bi/kb)*(ao/ka+bo/kb)+\
+						  (1+ao/ka+bo/kb)*(ai/ka+bi/kb)))
+	ratio = numerator / denominator
+	return ratio
 
 
 def eff_perm(xi,xo):
 	'''
 	Effective Permeability Function (g(xi,xo) in original).
+
+	xi*xo*log(xi/xo)/(xi-xo), evaluated by its series expansion where xi and xo
+	cross (see duct_model_kernels.eff_perm) so it stays finite and smooth there.
 	
 	Parameters
 	----------
-	xi : float
+	xi : float or np.ndarray
 		Molar concentration of ion X inside of the cell membrane
-	xo : float
+	xo : float or np.ndarray
 		Molar concentration of ion X outside of the cell membrane
 
 	Returns
 	-------
-	float
+	float or np.ndarray
 		Coefficient found by linearizing the constant field equation around the equilibrium potential
 
 	'''
-    return (xi*xo*np.log(xi/xo)/(xi-xo))
+	return duct_model_kernels.eff_perm(xi, xo)
 
 def nernst_potential(a,b):
 	'''
 	Nernst Potential Function
 
+	The log argument is clipped to duct_model_kernels.LOG_FLOOR, so trial
+	solver steps through negative concentrations stay finite.
+
 	Parameters
 	----------
-	a : float
+	a : float or np.ndarray
 		Concentration inside cell
-	b : float
+	b : float or np.ndarray
 		Concentration outside cell
 
 	Returns
 	-------
-	float
+	float or np.ndarray
 		Nernst potential in volts (V)
 	'''
-    # Physical Constants
-    ideal_gas = 8.31451
-    faraday_cst = 96485
-    body_temp = 310 #K
-    return (ideal_gas*body_temp/faraday_cst)*np.log(a/b)
+	return RT_F*safe_log(a/b)
 
 def duct_model_system(t, y, cond):
 	'''
@@ -243,3 +271,275 @@ def duct_model_system(t, y, cond):
 
 
 
+
+
+class DuctParams():
+	'''
+	Frozen, hashable, array-backed parameter set for duct_model_rhs.
+
+	Built once from a parameter dictionary (init_cond, Duct_Cell.input_dict)
+	so the right-hand side never touches a dict during integration. The
+	None sentinels of the optional influences are resolved to 1, the
+	antiporter flags are stored as 1.0/0.0 and RT/F is precomputed.
+
+	Attributes
+	----------
+	values : np.ndarray
+		Read-only parameter vector ordered as PARAM_NAMES
+	y0 : np.ndarray
+		Read-only initial state ordered as STATE_NAMES
+	constants : tuple
+		values as Python floats, the form unpacked by duct_model_rhs
+	'''
+	__slots__ = ('values', 'y0', 'constants', '_hash')
+
+	def __init__(self, values, y0):
+		# Adding 0.0 turns -0.0 into 0.0, so equal objects hash their bytes equally
+		values = np.array(values, dtype=float) + 0.0
+		y0 = np.array(y0, dtype=float) + 0.0
+		if values.shape != (len(PARAM_NAMES),):
+			raise ValueError('Expected %d parameters, got shape %s' % (len(PARAM_NAMES), values.shape))
+		if y0.shape != (len(STATE_NAMES),):
+			raise ValueError('Expected %d state values, got shape %s' % (len(STATE_NAMES), y0.shape))
+		# NaN is never equal to itself, so an object holding one could not be found again by hash
+		if np.isnan(values).any() or np.isnan(y0).any():
+			raise ValueError('NaN parameter or state values: %s' %
+							 [name for name, value in zip(PARAM_NAMES + STATE_NAMES, np.append(values, y0))
+							  if np.isnan(value)])
+		values.setflags(write=False)
+		y0.setflags(write=False)
+		object.__setattr__(self, 'values', values)
+		object.__setattr__(self, 'y0', y0)
+		object.__setattr__(self, 'constants', tuple(values.tolist()))
+		object.__setattr__(self, '_hash', hash((values.tobytes(), y0.tobytes())))
+
+	@classmethod
+	def from_dict(cls, cond):
+		'''
+		Compile a parameter dictionary into a DuctParams instance
+
+		Parameters
+		----------
+		cond : dict
+			Dictionary shaped like init_cond. Extra keys (e.g. 'therapeutics') are ignored
+			and missing variant/smoking/alcohol adjustments default to WT.
+
+		Returns
+		-------
+		DuctParams
+		'''
+		values = []
+		for name in PARAM_NAMES:
+			if name in ADJUSTMENT_NAMES:
+				# Older dictionaries predate the optional influences
+				value = cond.get(name)
+				if value is None:
+					value = 1
+			else:
+				value = cond[name]
+			values.append(float(value))
+		y0 = [cond[name] for name in STATE_NAMES]
+		return cls(values, y0)
+
+	def __getattr__(self, name):
+		if name in PARAM_INDEX:
+			return self.constants[PARAM_INDEX[name]]
+		raise AttributeError(name)
+
+	def __setattr__(self, name, value):
+		raise AttributeError('DuctParams is immutable, use replace()')
+
+	def __hash__(self):
+		return self._hash
+
+	def __eq__(self, other):
+		if not isinstance(other, DuctParams):
+			return NotImplemented
+		return (np.array_equal(self.values, other.values) and
+				np.array_equal(self.y0, other.y0))
+
+	def __repr__(self):
+		return 'DuctParams(%s)' % ', '.join('%s=%r' % item for item in zip(PARAM_NAMES, self.constants))
+
+	@property
+	def rtf(self):
+		return RT_F
+
+	def replace(self, **changes):
+		'''
+		Return a new DuctParams with some parameters or initial states changed
+
+		Parameters
+		----------
+		**changes
+			Parameter (PARAM_NAMES) or state (STATE_NAMES) names mapped to their new values.
+
+		Returns
+		-------
+		DuctParams
+		'''
+		values = self.values.copy()
+		y0 = self.y0.copy()
+		for name, value in changes.items():
+			if value is None and name in ADJUSTMENT_NAMES:
+				value = 1
+			if name in PARAM_INDEX:
+				values[PARAM_INDEX[name]] = value
+			elif name in STATE_NAMES:
+				y0[STATE_NAMES.index(name)] = value
+			else:
+				raise KeyError(name)
+		return DuctParams(values, y0)
+
+	def as_dict(self):
+		'''
+		Expand back into a parameter dictionary usable by duct_model_system
+		'''
+		cond = dict(zip(PARAM_NAMES, self.constants))
+		cond.update(zip(STATE_NAMES, self.y0.tolist()))
+		cond['ap_status'] = bool(cond['ap_status'])
+		cond['apb_status'] = bool(cond['apb_status'])
+		return cond
+
+
+def compile_params(cond):
+	'''
+	Compile a parameter dictionary once so it can be reused across RHS calls.
+	Already compiled parameters are passed through unchanged.
+	'''
+	if isinstance(cond, DuctParams):
+		return cond
+	return DuctParams.from_dict(cond)
+
+
+def duct_model_rhs(t, y, params, out=None):
+	'''
+	Allocation-free form of duct_model_system operating on DuctParams.
+
+	Evaluates exactly the same floating-point operations, in the same order,
+	as the dictionary-based duct_model_system so results are bit-identical.
+
+	Parameters
+	----------
+	t : float
+		Current time (the system is autonomous, kept for solver signatures)
+	y : array
+		State vector ordered as STATE_NAMES
+	params : DuctParams
+		Compiled parameters (see compile_params)
+	out : np.ndarray, optional
+		Preallocated length-5 array receiving the derivatives. Solvers such as
+		solve_ivp keep references to returned arrays, so only pass a reused
+		buffer when the caller owns it for the lifetime of the result.
+
+	Returns
+	-------
+	np.ndarray
+		out, filled with [dbi, dbl, dci, dni, dgcftr]
+	'''
+	if out is None:
+		out = np.empty(5)
+	state = y.tolist() if isinstance(y, np.ndarray) else y
+	try:
+		return _rhs_terms(params.constants, *state, out)
+	except ArithmeticError:
+		# Python floats raise on overflow and division by zero where the numpy
+		# floats of duct_model_system give inf or nan; repeat the evaluation on
+		# numpy scalars so a wild trial state yields non-finite derivatives the
+		# solver rejects instead of an exception
+		with np.errstate(all='ignore'):
+			return _rhs_terms(params.constants, *np.asarray(state, dtype=float), out)
+
+
+def _rhs_terms(constants, bi, bl, ci, ni, gcftr, out):
+	# Body of duct_model_rhs on unpacked states (Python floats, or numpy scalars after an ArithmeticError)
+	(g_bi, g_cl, zeta, kbi, kcl, gnbc, gapl, gapbl, nb, bb, cb, bi0, buf,
+	 chi, gcftron, gcftrbase, ek, gk, cap, gnak, np0, epump, ionstr, gnaleak,
+	 jac, rat, vr, apb_status, ap_status, variant_adj, smoke_adj,
+	 alcohol_adj) = constants
+	cl = 160 - bl
+
+	# Logarithms clipped as in safe_log (np.log keeps rounding identical to
+	# nernst_potential and eff_perm; casting back to float keeps the remaining
+	# arithmetic off numpy scalars)
+	ratio_b = bi/bl
+	ratio_nbc = (bi**2*ni)/(bb**2*nb)
+	ratio_c = ci/cl
+	ratio_na = nb/ni
+	log_b = float(np.log(LOG_FLOOR if ratio_b < LOG_FLOOR else ratio_b))
+	log_c = float(np.log(LOG_FLOOR if ratio_c < LOG_FLOOR else ratio_c))
+
+	# Nernst Potentials
+	eb = RT_F*log_b
+	enbc = RT_F*float(np.log(LOG_FLOOR if ratio_nbc < LOG_FLOOR else ratio_nbc))
+	ec = RT_F*log_c
+	ena = RT_F*float(np.log(LOG_FLOOR if ratio_na < LOG_FLOOR else ratio_na))
+
+	# Permeabilities (eff_perm reusing the logarithms above, except near a crossing)
+	if -EFF_PERM_SERIES < ratio_c - 1 < EFF_PERM_SERIES:
+		kccf = float(duct_model_kernels.eff_perm(ci, cl))*gcftr*g_cl
+	else:
+		kccf = ci*cl*log_c/(ci-cl)*gcftr*g_cl
+	if -EFF_PERM_SERIES < ratio_b - 1 < EFF_PERM_SERIES:
+		kbcf = float(duct_model_kernels.eff_perm(bi, bl))*gcftr*g_bi
+	else:
+		kbcf = bi*bl*log_b/(bi-bl)*gcftr*g_bi
+	knbc = gnbc
+
+	# Voltage Potential
+	v = (knbc*enbc+kbcf*eb+kccf*ec+gk*ek+gnaleak*ena)/(knbc+kbcf+kccf+gk)
+
+	# Flux Calculations
+	jnbc = knbc*(v-enbc)
+	jbcftr = kbcf*(v-eb) * smoke_adj
+	jccftr = (kccf*(v-ec) * variant_adj) * alcohol_adj
+
+	# Antiporter Status (1.0 = open, 0.0 = closed)
+	if ap_status:
+		japl = antiporter(bl, bi, cl, ci, kbi, kcl)*gapl
+	else:
+		japl = 0
+	if apb_status:
+		japbl = antiporter(bb, bi, cb, ci, kbi, kcl)*gapbl
+	else:
+		japbl = 0
+
+	jbl = (-jbcftr-japl)/vr+jac*rat
+	jci = jccftr-japl-japbl
+	jcl = ((-jccftr+japl)/vr+jac)
+	jlum = (jcl+jbl)/ionstr
+	jnak = gnak*(v-epump)*(ni/np0)**3
+	jnaleak = gnaleak*(v-ena)
+
+	# Differential Equations
+	out[0] = zeta*chi*(jbcftr+japl+japbl+buf*(bi0-bi)+2*jnbc)
+	out[1] = (jbl-jlum*bl)*zeta
+	out[2] = jci*zeta
+	out[3] = zeta*(jnbc-jnak-jnaleak)
+	out[4] = 0
+	return out
+
+
+def duct_model_jacobian(t, y, params):
+	'''
+	Exact Jacobian of duct_model_rhs with respect to the state.
+
+	Derived symbolically in duct_model_symbolic.py and emitted to
+	duct_model_generated.py; pass it as `jac` to the implicit solve_ivp
+	methods (BDF, Radau, LSODA) instead of letting them difference the RHS.
+
+	Parameters
+	----------
+	t : float
+		Current time
+	y : array
+		State vector ordered as STATE_NAMES
+	params : DuctParams
+		Compiled parameters
+
+	Returns
+	-------
+	np.ndarray
+		(5, 5) matrix d(rhs)/dy
+	'''
+	return duct_model_generated.jacobian(t, y, params.values)
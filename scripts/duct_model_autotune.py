@@ -0,0 +1,220 @@
+# duct_model_autotune.py
+
+'''
+Accuracy-versus-cost tuning of the duct model integrator.
+
+High-precision reference runs are computed for a representative set of
+parameter sets (WT, severe variants, antiporters on/off, extreme volume
+ratios, smoking and alcohol). Every candidate configuration (backend,
+tolerances or fixed-step mesh) is then run on the same cases and scored on
+the two numbers the clinical report uses, peak luminal HCO3- and the
+luminal Cl- plateau at t_off, and on the whole time course (so the plots do
+not visibly change). The cheapest configuration whose worst errors stay
+below the targets is saved as the deployment's solver profile
+(duct_model_backends.PROFILE_FILE), separately for single runs and for
+batched ensembles.
+
+Run using:
+	python3 duct_model_autotune.py [target error in mM]
+
+Developed by Ariel Precision Medicine
+'''
+
+import sys
+import time
+import numpy as np
+
+from dcw_duct_model import init_cond
+from duct_model_backends import PROFILE_FILE, save_profile
+from duct_model_ensemble import DuctEnsemble, solve_ensemble
+from duct_model_protocol import report_metrics, StimulusProtocol, integrate_protocol
+
+# Overrides of init_cond spanning the behaviours the solver has to resolve
+REFERENCE_CASES = {
+	'WT': {},
+	'WT, antiporters on': {'ap_status': True, 'apb_status': True},
+	'WT, luminal antiporter only': {'ap_status': True, 'apb_status': False},
+	'severe variant': {'variant_adj': 0.05},
+	'severe variant, antiporters on': {'variant_adj': 0.05, 'ap_status': True, 'apb_status': True},
+	'severe variant, smoking and alcohol': {'variant_adj': 0.05, 'smoke_adj': 0.4, 'alcohol_adj': 0.8},
+	'vr 0.01': {'vr': 0.01},
+	'vr 10': {'vr': 10},
+	'vr 0.01, antiporters on': {'vr': 0.01, 'ap_status': True, 'apb_status': True},
+}
+
+TOLERANCES = (1e-2, 1e-3, 1e-4, 1e-5, 1e-6, 1e-7)
+MESHES = ((25, 100.0), (50, 100.0), (100, 10.0), (100, 100.0), (200, 10.0), (400, 10.0))
+SINGLE_METHODS = ('RK45', 'LSODA', 'BDF', 'Radau', 'odeint')
+ENSEMBLE_METHODS = ('DP5', 'LSODA', 'BDF', 'odeint')
+
+# Samples per protocol segment used to locate the peak and compare time courses
+PEAK_SAMPLES = 2000
+
+
+def default_protocol():
+	return StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+
+
+def default_candidates(ensemble=False):
+	'''
+	Configurations swept by autotune
+
+	Returns
+	-------
+	list of dict
+		Runner options (method with rtol/atol, or rodas3 with n_steps/first_step)
+	'''
+	candidates = []
+	for method in (ENSEMBLE_METHODS if ensemble else SINGLE_METHODS):
+		for rtol in TOLERANCES:
+			candidates.append({'method': method, 'rtol': rtol, 'atol': rtol*1e-3})
+	for n_steps, first_step in MESHES:
+		candidates.append({'method': 'rodas3', 'n_steps': n_steps, 'first_step': first_step})
+	return candidates
+
+
+def metric_grid(protocol):
+	'''Sorted output times the metrics are read from (protocol boundaries included)'''
+	return np.unique(protocol.sample_grid(PEAK_SAMPLES))
+
+
+def case_conditions(cases=REFERENCE_CASES):
+	return [dict(init_cond, **overrides) for overrides in cases.values()]
+
+
+def reference_metrics(cases=REFERENCE_CASES, protocol=None, rtol=1e-10, atol=1e-12):
+	'''
+	High-precision metrics for every case, cross-checked between two methods
+
+	Returns
+	-------
+	dict
+		report_metrics entries stacked over cases, plus 'disagreement', the
+		largest difference between the Radau and DOP853 references
+	'''
+	protocol = protocol or default_protocol()
+	grid = metric_grid(protocol)
+	metrics = []
+	disagreement = 0.0
+	for cond in case_conditions(cases):
+		radau = integrate_protocol(cond, protocol, method='Radau', rtol=rtol, atol=atol).sol(grid)
+		dop853 = integrate_protocol(cond, protocol, method='DOP853', rtol=rtol, atol=atol).sol(grid)
+		disagreement = max(disagreement, np.abs(radau[:4] - dop853[:4]).max())
+		metrics.append(report_metrics(radau, grid, protocol))
+	reference = {key: np.array([case[key] for case in metrics]) for key in metrics[0]}
+	reference['disagreement'] = float(disagreement)
+	return reference
+
+
+def _run_candidate(candidate, conditions, protocol, ensemble):
+	# Metrics of every case (stacked like reference_metrics) for one configuration, or None when a run fails
+	grid = metric_grid(protocol)
+	if ensemble:
+		result = solve_ensemble(DuctEnsemble(conditions), protocol, grid, **candidate)
+		if not result.success:
+			return None
+		metrics = report_metrics(result.y, grid, protocol)
+		metrics['trajectory'] = np.moveaxis(metrics['trajectory'], 1, 0)
+		return metrics
+	metrics = []
+	for cond in conditions:
+		# Timed runs integrate every segment (repeats would otherwise hit the resting-phase cache)
+		result = integrate_protocol(cond, protocol, rest_cache=None, **candidate)
+		if not result.success:
+			return None
+		metrics.append(report_metrics(result.sol(grid), grid, protocol))
+	return {key: np.array([case[key] for case in metrics]) for key in metrics[0]}
+
+
+def autotune(target_error=0.1, ensemble=False, cases=REFERENCE_CASES, candidates=None,
+			 protocol=None, repeats=3, reference=None, plot_error=0.5):
+	'''
+	Find the cheapest solver configuration meeting an error target
+
+	Parameters
+	----------
+	target_error : float
+		Largest acceptable error (mM) on peak luminal HCO3- and plateau luminal Cl- over all cases
+	plot_error : float
+		Largest acceptable error (mM) anywhere on the time courses
+	ensemble : bool
+		Tune solve_ensemble (all cases as one batch) instead of single runs
+	cases : dict
+		Named init_cond overrides (defaults to REFERENCE_CASES)
+	candidates : list of dict, optional
+		Runner options to compare (defaults to default_candidates(ensemble))
+	protocol : StimulusProtocol, optional
+		Defaults to the 20000 / 120000 / 200000 secretin pulse
+	repeats : int
+		Timed runs per candidate; the median is its cost
+	reference : dict, optional
+		Output of reference_metrics for the same cases, to avoid recomputing it
+
+	Returns
+	-------
+	dict
+		'best' (the chosen runner options, or None if nothing met the target),
+		'rows' (one dict per candidate with its errors and cost) and 'target_error'
+	'''
+	protocol = protocol or default_protocol()
+	reference = reference or reference_metrics(cases, protocol)
+	conditions = case_conditions(cases)
+	rows = []
+	for candidate in (candidates or default_candidates(ensemble)):
+		timings = []
+		metrics = None
+		with np.errstate(all='ignore'):
+			for _ in range(repeats):
+				start = time.perf_counter()
+				metrics = _run_candidate(candidate, conditions, protocol, ensemble)
+				timings.append(time.perf_counter() - start)
+				if metrics is None:
+					break
+		row = dict(candidate, seconds=float(np.median(timings)))
+		for key in ('peak_hco3', 'plateau_cl', 'trajectory'):
+			error = np.inf if metrics is None else np.max(np.abs(metrics[key] - reference[key]))
+			row[key + '_error'] = float(error)
+		row['max_error'] = max(row['peak_hco3_error'], row['plateau_cl_error'])
+		row['passed'] = bool(row['max_error'] <= target_error and row['trajectory_error'] <= plot_error)
+		rows.append(row)
+	passing = [row for row in rows if row['passed']]
+	best = None
+	if passing:
+		cheapest = min(passing, key=lambda row: row['seconds'])
+		best = {key: cheapest[key] for key in ('method', 'rtol', 'atol', 'n_steps', 'first_step') if key in cheapest}
+	return {'best': best, 'rows': rows, 'target_error': target_error}
+
+
+def tune_profile(target_error=0.1, path=PROFILE_FILE, save=True, **autotune_options):
+	'''
+	Tune single runs and ensembles and save the result as the solver profile
+
+	Returns
+	-------
+	dict
+		The profile: per runner kind, the chosen options with their measured error and cost
+	'''
+	cases = autotune_options.pop('cases', REFERENCE_CASES)
+	protocol = autotune_options.pop('protocol', None) or default_protocol()
+	reference = reference_metrics(cases, protocol)
+	profile = {'target_error': target_error, 'cases': list(cases),
+			   'reference_disagreement': reference['disagreement']}
+	for kind, ensemble in (('single', False), ('ensemble', True)):
+		result = autotune(target_error, ensemble, cases, protocol=protocol, reference=reference, **autotune_options)
+		if result['best'] is None:
+			raise RuntimeError('No %s configuration reached an error of %g mM' % (kind, target_error))
+		chosen = [row for row in result['rows'] if all(row.get(key) == value for key, value in result['best'].items())][0]
+		profile[kind] = {'options': result['best'], 'max_error': chosen['max_error'],
+						 'trajectory_error': chosen['trajectory_error'], 'seconds': chosen['seconds']}
+	if save:
+		save_profile(profile, path)
+	return profile
+
+
+if __name__ == '__main__':
+	target = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+	profile = tune_profile(target)
+	for kind in ('single', 'ensemble'):
+		print('%s: %s (max error %.3g mM, %.3f s for %d cases)' % (kind, profile[kind]['options'],
+			  profile[kind]['max_error'], profile[kind]['seconds'], len(profile['cases'])))
+	print('Saved ' + PROFILE_FILE)
@@ -0,0 +1,712 @@
+# duct_model_backends.py
+
+'''
+Integrator backends for the duct model.
+
+Every model runner (integrate_protocol for single runs, solve_ensemble for
+batches) targets the same set of backends and returns the same result object
+whichever one runs:
+
+	RK45, RK23, DOP853, BDF, Radau, LSODA
+		scipy.integrate.solve_ivp (the implicit methods get the exact Jacobian)
+	odeint
+		scipy.integrate.odeint, i.e. the Fortran LSODA code, with the exact
+		(banded, for ensembles) Jacobian
+	rodas3
+		A NumPy fixed-step Rosenbrock method (Rodas3: L-stable, order 3, one
+		Jacobian and three right-hand side evaluations per step) that advances
+		a whole (5, N) ensemble in lockstep on a mesh graded away from every
+		switch of the CFTR conductance, with preallocated stage buffers
+	DP5
+		The per-member adaptive Dormand-Prince stepper (ensembles only)
+
+The method is selectable per call (method=...) and per deployment: the
+defaults come from the solver profile written by duct_model_autotune.py
+(solver_profile.json, or the file named by DUCT_MODEL_PROFILE), can be
+overridden with the DUCT_MODEL_METHOD / DUCT_MODEL_ENSEMBLE_METHOD
+environment variables and changed at run time with set_default_method().
+
+A run can be given a SolveBudget (right-hand side evaluations and wall-clock
+seconds). The budget is checked on every right-hand side evaluation, so a
+stiff or diverging run stops within one evaluation of running out, whatever
+the backend, and comes back with BUDGET_STATUS instead of holding a worker.
+FALLBACK_METHODS is the order in which fault-tolerant runners
+(duct_model_protocol.integrate_with_fallbacks) retry a failed run.
+
+Developed by Ariel Precision Medicine
+'''
+
+import os
+import json
+import time
+import numpy as np
+from scipy.integrate import solve_ivp, odeint
+try:
+	# Private SciPy class whose pieces pack into one polynomial table; without it
+	# solve_ivp solutions are wrapped piece by piece
+	from scipy.integrate._ivp.rk import RkDenseOutput
+except ImportError:
+	RkDenseOutput = None
+
+from duct_model_log_form import ConcentrationOutput, concentration_rates, from_log, log_system, log_tolerances, to_log
+
+SCIPY_METHODS = ('RK45', 'RK23', 'DOP853', 'BDF', 'Radau', 'LSODA')
+# Methods that benefit from the exact Jacobian
+IMPLICIT_METHODS = ('BDF', 'Radau', 'LSODA')
+SINGLE_METHODS = SCIPY_METHODS + ('odeint', 'rodas3')
+ENSEMBLE_METHODS = ('DP5',) + SINGLE_METHODS
+
+# Status of a run stopped by its SolveBudget (solver failures are -1)
+BUDGET_STATUS = -2
+
+# Retry order of fault-tolerant runs: the explicit default first, then the stiff integrators
+FALLBACK_METHODS = ('RK45', 'LSODA', 'BDF')
+
+# Rodas3 (Sandu et al. 1997) in the form
+# (I/(h*gamma) - J) k_i = f(y + sum_j a_ij k_j) + sum_j (c_ij/h) k_j,  y_new = y + sum_i m_i k_i
+RODAS3_GAMMA = 0.5
+RODAS3_A = np.array([[0, 0, 0], [0, 0, 0], [2, 0, 0], [2, 0, 1]])
+RODAS3_C = np.array([[0, 0, 0], [4, 0, 0], [1, -1, 0], [1, -1, -8/3]])
+RODAS3_M = np.array([2, 0, 1, 1])
+# Stage 2 has no a_2j and reuses the stage 1 right-hand side
+RODAS3_NEW_F = (True, False, True, True)
+
+# Mesh used by the fixed-step and output-grid backends for every protocol segment
+FIXED_STEP_DEFAULTS = {'n_steps': 100, 'first_step': 10.0}
+
+# Equal-time chunks of a segment the fixed-step and output-grid backends integrate
+# between steady-state checks (each chunk restarts odeint)
+STEADY_CHUNKS = 4
+
+# Settings used when no solver profile has been saved
+BUILTIN_OPTIONS = {'single': dict(method='RK45', rtol=1e-3, atol=1e-6, **FIXED_STEP_DEFAULTS),
+				   'ensemble': dict(method='DP5', rtol=1e-3, atol=1e-6, **FIXED_STEP_DEFAULTS)}
+
+# Saved by duct_model_autotune.py; DUCT_MODEL_PROFILE points a deployment at another file
+PROFILE_FILE = os.environ.get('DUCT_MODEL_PROFILE',
+							  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'solver_profile.json'))
+
+
+def load_profile(path=PROFILE_FILE):
+	'''
+	Solver settings saved by the auto-tuner
+
+	Returns
+	-------
+	dict
+		Empty when no profile exists, otherwise {'single': {'options': {...}, ...},
+		'ensemble': {'options': {...}, ...}} with the runner options chosen for each kind
+	'''
+	if not os.path.exists(path):
+		return {}
+	with open(path) as handle:
+		return json.load(handle)
+
+
+def save_profile(profile, path=PROFILE_FILE):
+	'''Write solver settings (in the load_profile layout) for every later run'''
+	with open(path, 'w') as handle:
+		json.dump(profile, handle, indent=4, sort_keys=True)
+		handle.write('\n')
+	return path
+
+
+def _initial_options():
+	profile = load_profile()
+	options = {kind: dict(BUILTIN_OPTIONS[kind], **profile.get(kind, {}).get('options', {}))
+			   for kind in BUILTIN_OPTIONS}
+	# Environment variables override the saved profile's backend
+	for kind, variable in (('single', 'DUCT_MODEL_METHOD'), ('ensemble', 'DUCT_MODEL_ENSEMBLE_METHOD')):
+		if variable in os.environ:
+			options[kind]['method'] = os.environ[variable]
+	return options
+
+_DEFAULT_OPTIONS = _initial_options()
+
+
+def available_methods(ensemble=False):
+	'''Backend names accepted by solve_ensemble (ensemble=True) or integrate_protocol'''
+	return ENSEMBLE_METHODS if ensemble else SINGLE_METHODS
+
+
+def default_options(ensemble=False):
+	'''Deployment-wide runner options (method, rtol, atol, n_steps, first_step)'''
+	return dict(_DEFAULT_OPTIONS['ensemble' if ensemble else 'single'])
+
+
+def default_method(ensemble=False):
+	'''Backend used when a runner is called without a method'''
+	return _DEFAULT_OPTIONS['ensemble' if ensemble else 'single']['method']
+
+
+def set_default_method(method, ensemble=False, **options):
+	'''
+	Change the deployment-wide backend for single runs or ensembles
+
+	Parameters
+	----------
+	method : str
+		One of available_methods(ensemble)
+	ensemble : bool
+		Whether to set the ensemble default instead of the single-run default
+	**options
+		rtol, atol, n_steps or first_step to use with it
+	'''
+	if method not in available_methods(ensemble):
+		raise ValueError('Unknown integrator backend %r' % method)
+	unknown = set(options) - set(BUILTIN_OPTIONS['single'])
+	if unknown:
+		raise TypeError('Unknown solver options %s' % sorted(unknown))
+	_DEFAULT_OPTIONS['ensemble' if ensemble else 'single'].update(options, method=method)
+
+
+def resolve_options(ensemble=False, **options):
+	'''Runner options with every None replaced by the deployment default'''
+	resolved = default_options(ensemble)
+	resolved.update((key, value) for key, value in options.items() if value is not None)
+	return resolved
+
+
+class DenseOutput():
+	'''
+	Continuous solution stitched from solver interpolants
+
+	Behaves like scipy's OdeSolution (a time on a knot takes the earlier
+	piece). Polynomial pieces, i.e. Runge-Kutta interpolants and cubic
+	Hermite pieces y_old + h*Q.[x, x**2, ...] with x = (t - t_old)/h, are
+	packed into arrays so a whole grid is evaluated at once; other scipy
+	interpolants are called piece by piece. States may have any shape
+	((5,) for single runs, (5, N) for ensembles); time is the last axis of
+	the output.
+
+	Parameters
+	----------
+	ts : array
+		Increasing knots, one more than there are pieces
+	y_old : np.ndarray, optional
+		(n_pieces, ...) states at the start of every polynomial piece
+	Q : np.ndarray, optional
+		(n_pieces, ..., order) polynomial coefficients
+	pieces : list, optional
+		Callables (e.g. scipy DenseOutput objects) used instead of y_old and Q
+	'''
+	def __init__(self, ts, y_old=None, Q=None, pieces=None):
+		self.ts = np.asarray(ts, dtype=float)
+		self.t_min, self.t_max = self.ts[0], self.ts[-1]
+		self.y_old = y_old
+		self.Q = Q
+		self.pieces = pieces
+		self.h = np.diff(self.ts)
+
+	@classmethod
+	def from_interpolants(cls, ts, interpolants):
+		'''Wrap the interpolants of a solve_ivp solution (state.sol.ts, state.sol.interpolants)'''
+		if RkDenseOutput is not None and all(isinstance(piece, RkDenseOutput) for piece in interpolants):
+			return cls(ts, np.array([piece.y_old for piece in interpolants]),
+					   np.array([piece.Q for piece in interpolants]))
+		return cls(ts, pieces=list(interpolants))
+
+	@classmethod
+	def hermite(cls, t, y, f):
+		'''
+		Piecewise cubic Hermite interpolant through states y with derivatives f
+
+		Parameters
+		----------
+		t : array
+			(T,) increasing times
+		y, f : np.ndarray
+			(..., T) states and right-hand sides at t
+		'''
+		y = np.moveaxis(y, -1, 0)
+		f = np.moveaxis(f, -1, 0)
+		h = np.diff(t).reshape((-1,) + (1,)*(y.ndim - 1))
+		slope = (y[1:] - y[:-1])/h
+		Q = np.stack([f[:-1], 3*slope - 2*f[:-1] - f[1:], f[:-1] + f[1:] - 2*slope], axis=-1)
+		return cls(t, y[:-1], Q)
+
+	@classmethod
+	def constant(cls, t_start, t_end, y, order=1):
+		'''State held at y from t_start to t_end (packed like a polynomial piece of the given order)'''
+		y = np.asarray(y, dtype=float)
+		return cls([t_start, t_end], y[None], np.zeros((1,) + y.shape + (order,)))
+
+	@classmethod
+	def concatenate(cls, outputs):
+		'''Join dense outputs of consecutive time intervals into one'''
+		outputs = [output for output in outputs if output is not None]
+		ts = np.concatenate([outputs[0].ts] + [output.ts[1:] for output in outputs[1:]])
+		if all(output.Q is not None for output in outputs):
+			orders = {output.Q.shape[-1] for output in outputs}
+			if len(orders) == 1:
+				return cls(ts, np.concatenate([output.y_old for output in outputs]),
+						   np.concatenate([output.Q for output in outputs]))
+		# Mixed or non-polynomial pieces: each output becomes one piece
+		knots = [outputs[0].t_min] + [output.t_max for output in outputs]
+		return cls(knots, pieces=outputs)
+
+	def __call__(self, t):
+		'''
+		States at time(s) t, with time as the last axis for an array of times
+		'''
+		t = np.asarray(t, dtype=float)
+		scalar = t.ndim == 0
+		t = np.atleast_1d(t)
+		n_pieces = self.ts.size - 1
+		piece = np.clip(np.searchsorted(self.ts, t, side='left') - 1, 0, n_pieces - 1)
+		if self.Q is not None:
+			x = (t - self.ts[piece])/self.h[piece]
+			powers = np.cumprod(np.tile(x, (self.Q.shape[-1], 1)), axis=0)
+			y = np.einsum('t...k,kt->...t', self.Q[piece], powers)
+			y *= self.h[piece]
+			y += np.moveaxis(self.y_old[piece], 0, -1)
+		else:
+			y = None
+			for index in np.unique(piece):
+				chosen = piece == index
+				values = self.pieces[index](t[chosen])
+				if y is None:
+					y = np.empty(values.shape[:-1] + t.shape)
+				y[..., chosen] = values
+		return y[..., 0] if scalar else y
+
+
+class BudgetExhausted(RuntimeError):
+	'''Raised from a right-hand side evaluation once its SolveBudget has run out'''
+
+
+class SolveBudget():
+	'''
+	Right-hand side evaluations and wall-clock time a run may spend
+
+	Parameters
+	----------
+	max_nfev : int, optional
+		Right-hand side evaluations allowed over all segments (None: unlimited)
+	time_limit : float, optional
+		Seconds from now the run may take (None: unlimited)
+	'''
+	def __init__(self, max_nfev=None, time_limit=None):
+		self.max_nfev = max_nfev
+		self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+		self.nfev = 0
+
+	@property
+	def expired(self):
+		if self.max_nfev is not None and self.nfev > self.max_nfev:
+			return True
+		return self.deadline is not None and time.perf_counter() > self.deadline
+
+	def check(self):
+		'''Raise BudgetExhausted if the budget has run out'''
+		if self.max_nfev is not None and self.nfev > self.max_nfev:
+			raise BudgetExhausted('Budget of %d right-hand side evaluations exhausted.' % self.max_nfev)
+		if self.deadline is not None and time.perf_counter() > self.deadline:
+			raise BudgetExhausted('Time limit exhausted.')
+
+	def wrap(self, fun):
+		'''fun counting its evaluations against the budget'''
+		def budgeted(*args):
+			self.nfev += 1
+			self.check()
+			return fun(*args)
+		return budgeted
+
+
+class SegmentSolution():
+	'''
+	One protocol segment integrated by a backend
+
+	Attributes
+	----------
+	t : np.ndarray
+		(T,) time points the backend stepped to (the mesh for fixed-step backends)
+	y : np.ndarray
+		(5, T) states at t
+	sol : DenseOutput or None
+		Continuous solution over the segment
+	nfev, njev : int
+		Right-hand side and Jacobian evaluations
+	status : int
+		0 on success, -1 on failure, BUDGET_STATUS if the budget ran out
+		(t and y then hold only the starting point)
+	message : str
+		Backend message
+	t_steady : float or None
+		Time the segment was found settled, after which the state is held
+		constant up to the segment end (None when it was integrated throughout)
+	'''
+	def __init__(self, t, y, sol, nfev, njev, status, message, t_steady=None):
+		self.t = t
+		self.y = y
+		self.sol = sol
+		self.nfev = nfev
+		self.njev = njev
+		self.status = status
+		self.message = message
+		self.t_steady = t_steady
+
+
+class SteadyStateEvent():
+	'''
+	Terminal event for a segment whose ion concentrations have settled
+
+	The segment counts as settled once the change its remaining time could
+	still add to bi, bl, ci and ni (drift(): the rate projected along an
+	exponential relaxation, or over the last sign change where the rate
+	oscillates about a plateau) has stayed below tol for window time units.
+	A fixed threshold on the right-hand side alone does not fit this model:
+	the recovery phase still drifts at ~1e-4 mM per time unit at t_end while
+	the resting phase sits near 1e-6, so any single value either never fires
+	or holds a plateau too early.
+
+	It pays off on segments that reach a plateau well before they end; 0.05
+	mM is the recommended tol. On a 20000 / 1000000 / 1100000 secretin pulse
+	RK45 at the profile tolerances stops the stimulated segment at
+	t = 183000 and takes 3372 instead of 14658 right-hand side evaluations
+	(0.02 mM from a Radau reference; 3096 instead of 14880 with the
+	antiporters on, 7374 instead of 13164 for variant_adj = 0.05). LSODA
+	already takes long steps on a plateau and saves only a few percent. The
+	standard 20000 / 120000 / 200000 pulse has no plateau to stop on (its
+	stimulated segment still moves 6 mM at t = 72000 and its recovery 40 mM
+	at t = 140000), so there the event fires at most on the resting segment
+	and saves 1-5% of the evaluations.
+
+	Used as a solve_ivp event (terminal, direction -1; the root lies at the
+	end of the window), where the rate is the secant between accepted steps
+	so no extra right-hand side evaluations are spent, and through advance()
+	on the output mesh of the fixed-step backends.
+
+	Parameters
+	----------
+	t_end : float
+		End of the segment
+	tol : float
+		Tolerated drift in mM
+	window : float
+		Time the criterion has to hold before the segment is stopped
+	log_form : bool
+		Whether the solver passes log coordinates (duct_model_log_form) to __call__
+	'''
+	terminal = True
+	direction = -1
+
+	def __init__(self, t_end, tol, window, log_form=False):
+		self.t_end = t_end
+		self.tol = tol
+		self.window = window
+		self.log_form = log_form
+		self.since = None
+		self.last_t = None
+		self.last_y = None
+		self.rate_t = None
+		self.rate = None
+		# Times of the last two sign changes of each state's rate
+		self.flips = np.full((2, 4), np.nan)
+
+	def advance(self, t, f):
+		'''
+		Record the rate of change f of the state at a new time t
+
+		Returns
+		-------
+		bool
+			Whether the criterion has now held for the whole window
+		'''
+		if self.drift(t, f) < self.tol:
+			if self.since is None:
+				self.since = t
+		else:
+			self.since = None
+		return self.since is not None and t - self.since >= self.window
+
+	def drift(self, t, f):
+		'''
+		Largest change the rest of the segment could still add to bi, bl, ci or ni
+
+		A state whose rate keeps changing sign, the step-size-limited noise of
+		an explicit method on a stiff plateau, oscillates about its plateau:
+		once it has flipped twice and the current run of one sign is at most
+		twice the previous one, it is bounded by |f| times the time since its
+		last flip (at least one step). A state whose rate has the same sign and
+		a smaller magnitude than at the previous call is taken to relax
+		exponentially with the time constant tau the two rates imply, and can
+		still move |f|*tau*(1 - exp(-remaining/tau)). Any other state is
+		bounded by |f|*remaining.
+		'''
+		remaining = self.t_end - t
+		rate = np.abs(f[:4])
+		horizon = np.full(4, remaining)
+		if self.rate is not None and t > self.rate_t:
+			previous = np.abs(self.rate)
+			flipped = np.sign(self.rate) == -np.sign(f[:4])
+			self.flips[0, flipped] = self.flips[1, flipped]
+			self.flips[1, flipped] = t
+			decaying = (np.sign(self.rate) == np.sign(f[:4])) & (rate < previous) & (rate > 0)
+			tau = (t - self.rate_t)/np.log(previous[decaying]/rate[decaying])
+			horizon[decaying] = -tau*np.expm1(-remaining/tau)
+			earlier, last = self.flips
+			oscillating = t - last <= 2*(last - earlier)
+			horizon[oscillating] = np.minimum(np.maximum(t - last[oscillating], t - self.rate_t), remaining)
+		self.rate_t, self.rate = t, np.array(f[:4], dtype=float)
+		return (rate*horizon).max()
+
+	def __call__(self, t, y):
+		# solve_ivp evaluates the event at every accepted step, and at earlier
+		# times while locating the root; only the former move the window
+		if self.log_form:
+			y = from_log(y)
+		if self.last_t is None or t > self.last_t:
+			if self.last_t is not None:
+				self.advance(t, (y - self.last_y)/(t - self.last_t))
+			self.last_t, self.last_y = t, np.array(y)
+		if self.since is None:
+			return self.window
+		return self.since + self.window - t
+
+
+def _hold_steady(t, y, sol, t_end):
+	# Extend a segment stopped at t[-1] with its last state held until t_end
+	t = np.append(t, t_end)
+	y = np.column_stack([y, y[:, -1]])
+	if sol is not None:
+		order = sol.Q.shape[-1] if sol.Q is not None else 1
+		sol = DenseOutput.concatenate([sol, DenseOutput.constant(t[-2], t_end, y[:, -1], order)])
+	return t, y, sol
+
+
+def graded_mesh(t_start, t_end, n_steps=FIXED_STEP_DEFAULTS['n_steps'], first_step=FIXED_STEP_DEFAULTS['first_step']):
+	'''
+	Step mesh whose steps grow geometrically from first_step
+
+	The transients after every switch of the CFTR conductance are much faster
+	than the approach to the plateau, so a fixed number of steps is spent
+	where it matters. Falls back to a uniform mesh when first_step is large.
+
+	Returns
+	-------
+	np.ndarray
+		(n_steps + 1,) times from t_start to t_end
+	'''
+	span = t_end - t_start
+	if first_step*n_steps >= span:
+		return np.linspace(t_start, t_end, n_steps + 1)
+	# Bisection for the growth ratio r with first_step*(r**n - 1)/(r - 1) = span
+	low, high = 1.0, 2.0**(600/n_steps)
+	for _ in range(200):
+		ratio = 0.5*(low + high)
+		if first_step*(ratio**n_steps - 1)/(ratio - 1) > span:
+			high = ratio
+		else:
+			low = ratio
+	mesh = t_start + first_step*(ratio**np.arange(n_steps + 1) - 1)/(ratio - 1)
+	mesh[-1] = t_end
+	return mesh
+
+
+def rodas3_steps(fun, jac, y0, mesh, positive=True):
+	'''
+	Advance (5, N) states through a fixed mesh with Rodas3
+
+	Parameters
+	----------
+	fun : callable
+		fun(y) -> (5, N) right-hand side (autonomous)
+	jac : callable
+		jac(y) -> (5, 5, N) Jacobian
+	y0 : np.ndarray
+		(5, N) initial states
+	mesh : np.ndarray
+		(T,) step times
+	positive : bool
+		Count members whose ion states turn negative as failed (off for log coordinates)
+
+	Returns
+	-------
+	states, derivatives : np.ndarray
+		(5, N, T) states and right-hand sides at the mesh times
+	healthy : np.ndarray
+		(N,) False for members that left the finite (or positive) range
+	'''
+	n = y0.shape[1]
+	states = np.empty(y0.shape + mesh.shape)
+	derivatives = np.empty(y0.shape + mesh.shape)
+	stages = np.empty((4,) + y0.shape)
+	stage_state = np.empty(y0.shape)
+	stage_rhs = np.empty(y0.shape)
+	identity = np.eye(5)
+	y = y0.copy()
+	states[:, :, 0] = y
+	f = None
+	with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+		for step in range(mesh.size - 1):
+			h = mesh[step + 1] - mesh[step]
+			# One batched inverse of (I/(h*gamma) - J) per step, shared by all stages
+			matrix = np.linalg.inv(identity/(h*RODAS3_GAMMA) - np.moveaxis(jac(y), 2, 0))
+			for i in range(4):
+				if RODAS3_NEW_F[i]:
+					np.copyto(stage_state, y)
+					for j in range(i):
+						if RODAS3_A[i, j]:
+							stage_state += RODAS3_A[i, j]*stages[j]
+					f = fun(stage_state)
+					if i == 0:
+						derivatives[:, :, step] = f
+				np.copyto(stage_rhs, f)
+				for j in range(i):
+					if RODAS3_C[i, j]:
+						stage_rhs += (RODAS3_C[i, j]/h)*stages[j]
+				np.einsum('nij,jn->in', matrix, stage_rhs, out=stages[i])
+			for i in range(4):
+				if RODAS3_M[i]:
+					y += RODAS3_M[i]*stages[i]
+			states[:, :, step + 1] = y
+		derivatives[:, :, -1] = fun(y)
+	healthy = np.all(np.isfinite(states), axis=(0, 2))
+	if positive:
+		healthy &= np.all(states[:4] > 0, axis=(0, 2))
+	return states, derivatives, healthy
+
+
+def _mesh_steps(fun, jac, mesh, y0, method, rtol, atol, max_step, h0=0.0, positive=True):
+	# States, right-hand sides, counters, outcome and last step size of odeint or rodas3 on one mesh
+	if method == 'odeint':
+		hmax = 0.0 if np.isinf(max_step) else max_step
+		y, info = odeint(fun, y0, mesh, Dfun=jac, tfirst=True, rtol=rtol, atol=atol, hmax=hmax, h0=h0,
+						 full_output=True)
+		y = y.T
+		derivatives = np.column_stack([fun(t, y[:, i]) for i, t in enumerate(mesh)])
+		success = info['message'] == 'Integration successful.'
+		return (y, derivatives, int(info['nfe'][-1]) + mesh.size, int(info['nje'][-1]), success, info['message'],
+				float(info['hu'][-1]))
+	t0 = mesh[0]
+	states, derivatives, healthy = rodas3_steps(lambda y: fun(t0, y[:, 0])[:, None],
+												lambda y: jac(t0, y[:, 0])[:, :, None], y0[:, None], mesh, positive)
+	success = bool(healthy[0])
+	n_steps = mesh.size - 1
+	return (states[:, 0], derivatives[:, 0], 3*n_steps + 1, n_steps, success,
+			'Fixed-step integration finished.' if success else 'Left the physical region.', mesh[-1] - mesh[-2])
+
+
+def solve_segment(fun, jac, t_span, y0, method, rtol=1e-3, atol=1e-6, max_step=np.inf, dense_output=True,
+				  n_steps=FIXED_STEP_DEFAULTS['n_steps'], first_step=FIXED_STEP_DEFAULTS['first_step'],
+				  steady_tol=None, steady_window=0.0, log_form=False, budget=None):
+	'''
+	Integrate one protocol segment of a single run with the chosen backend
+
+	Parameters
+	----------
+	fun : callable
+		fun(t, y) -> (5,) right-hand side
+	jac : callable
+		jac(t, y) -> (5, 5) Jacobian
+	t_span : tuple
+		(t_start, t_end)
+	y0 : np.ndarray
+		(5,) initial state
+	method : str
+		One of SINGLE_METHODS
+	rtol, atol, max_step : float
+		Tolerances and step bound (ignored by the fixed-step backend)
+	dense_output : bool
+		Whether to build the continuous solution
+	n_steps, first_step : int, float
+		Mesh of the fixed-step backend, and the output mesh of odeint
+	steady_tol, steady_window : float, optional
+		Stop once the segment has settled (see SteadyStateEvent) and hold the
+		state constant until t_end; None integrates the whole segment
+	log_form : bool
+		Integrate log concentrations (see duct_model_log_form) with fun and jac
+		transformed to match and rtol bounding the relative error of every
+		concentration; the solution is converted back, so the result is in
+		concentrations either way
+	budget : SolveBudget, optional
+		Evaluation and time allowance, shared with the run's other segments
+
+	Returns
+	-------
+	SegmentSolution
+	'''
+	start = y0
+	if budget is not None:
+		fun = budget.wrap(fun)
+		spent = budget.nfev
+	if log_form:
+		fun, jac = log_system(fun, jac)
+		y0 = to_log(y0)
+		rtol, atol = log_tolerances(rtol, atol)
+	t_end = t_span[1]
+	event = SteadyStateEvent(t_end, steady_tol, steady_window, log_form) if steady_tol is not None else None
+	try:
+		state = _solve_segment(fun, jac, t_span, y0, method, rtol, atol, max_step, dense_output, n_steps, first_step,
+							   event, log_form)
+	except BudgetExhausted as error:
+		return SegmentSolution(np.array([float(t_span[0])]), np.array(start, dtype=float)[:, None], None,
+							   budget.nfev - spent, 0, BUDGET_STATUS, str(error))
+	if log_form:
+		state.y = from_log(state.y)
+		state.sol = ConcentrationOutput(state.sol) if state.sol is not None else None
+	return state
+
+
+def _solve_segment(fun, jac, t_span, y0, method, rtol, atol, max_step, dense_output, n_steps, first_step,
+				   event, log_form):
+	# solve_segment in the solver's coordinates
+	t_end = t_span[1]
+	if method in SCIPY_METHODS:
+		options = {'rtol': rtol, 'atol': atol, 'max_step': max_step, 'dense_output': dense_output}
+		if method in IMPLICIT_METHODS:
+			options['jac'] = jac
+		if event is not None:
+			options['events'] = event
+		state = solve_ivp(fun, t_span, y0, method=method, **options)
+		sol = DenseOutput.from_interpolants(state.sol.ts, state.sol.interpolants) if state.sol is not None else None
+		t, y, t_steady = state.t, state.y, None
+		if state.status == 1:
+			t_steady = float(t[-1])
+			t, y, sol = _hold_steady(t, y, sol, t_end)
+		return SegmentSolution(t, y, sol, state.nfev, state.njev, 0 if state.status >= 0 else -1, state.message, t_steady)
+	if method not in ('odeint', 'rodas3'):
+		raise ValueError('Unknown integrator backend %r' % method)
+
+	mesh = graded_mesh(t_span[0], t_end, n_steps, first_step)
+	if event is None:
+		y, derivatives, nfev, njev, success, message, _ = _mesh_steps(fun, jac, mesh, y0, method, rtol, atol, max_step,
+																	  positive=not log_form)
+		sol = DenseOutput.hermite(mesh, y, derivatives) if dense_output and success else None
+		return SegmentSolution(mesh, y, sol, nfev, njev, 0 if success else -1, message)
+
+	# Integrate the mesh a chunk at a time so the run can stop once it has settled;
+	# odeint resumes with its last step size instead of restarting from a tiny one
+	ts, ys, fs = [], [], []
+	nfev = njev = 0
+	t_steady = None
+	y_start, h0 = y0, 0.0
+	bounds = np.unique(np.searchsorted(mesh, np.linspace(t_span[0], t_end, STEADY_CHUNKS + 1)[1:]))
+	for start, stop in zip(np.append(0, bounds[:-1]), bounds):
+		chunk = mesh[start:stop + 1]
+		y, derivatives, chunk_nfev, chunk_njev, success, message, h0 = _mesh_steps(
+			fun, jac, chunk, y_start, method, rtol, atol, max_step, h0, not log_form)
+		nfev += chunk_nfev
+		njev += chunk_njev
+		# Every chunk after the first repeats the previous chunk's last point
+		first = 1 if start else 0
+		end = chunk.size
+		if success:
+			rates = concentration_rates(y, derivatives) if log_form else derivatives
+			for i in range(first, chunk.size):
+				if event.advance(chunk[i], rates[:, i]):
+					end = i + 1
+					t_steady = float(chunk[i])
+					break
+		ts.append(chunk[first:end])
+		ys.append(y[:, first:end])
+		fs.append(derivatives[:, first:end])
+		if not success or t_steady is not None:
+			break
+		y_start = y[:, -1]
+	t, y = np.concatenate(ts), np.concatenate(ys, axis=1)
+	sol = DenseOutput.hermite(t, y, np.concatenate(fs, axis=1)) if dense_output and success else None
+	if t_steady is not None and t_steady < t_end:
+		t, y, sol = _hold_steady(t, y, sol, t_end)
+	return SegmentSolution(t, y, sol, nfev, njev, 0 if success else -1, message, t_steady)
@@ -0,0 +1,436 @@
+# duct_model_calibration.py
+
+'''
+Calibration of duct model parameters against measured secretin tests.
+
+A secretin test gives luminal (pancreatic juice) HCO3- at a few times after
+stimulation. calibrate fits selected parameters of a patient - typically
+the effective CFTR function variant_adj, optionally transporter strengths -
+by weighted least squares,
+
+	minimise 1/2 sum_j ((bl(t_j; p) - hco3_j)/sigma_j)**2,
+
+with scipy.optimize.least_squares (trust region reflective, within bounds).
+Parameters are fitted on a log scale, so they stay positive and parameters
+of very different magnitude are equally well conditioned. The Jacobian is
+exact: one forward sensitivity solve (duct_model_sensitivity) gives the
+residuals and their derivatives together.
+
+Least squares on a nonlinear model can stop in a local minimum, so every
+fit starts from the base value and from further points spread over the
+bounds (a scrambled Sobol' sequence in log space), and keeps the best. The
+starts run in a process pool; calibrate_cohort fits many patients in the
+same pool, one job.
+
+Profile-likelihood intervals: each fitted parameter is moved away from the
+optimum in both directions, the others re-fitted at every step, until the
+increase in the sum of squares reaches the chi-squared quantile of the
+confidence level (scaled by the residual variance when the measurement
+errors are unknown). Unlike the Hessian-based interval this follows the
+nonlinearity of the model and shows parameters that the data cannot
+identify (the interval then reaches the bound).
+
+Developed by Ariel Precision Medicine
+'''
+
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import least_squares
+from scipy.stats import chi2, qmc
+
+from dcw_duct_model import compile_params, init_cond, DuctParams, PARAM_NAMES
+from duct_model_protocol import StimulusProtocol
+from duct_model_sensitivity import integrate_sensitivities
+
+# Model time units per minute of a secretin test (the graphs plot time/20000)
+TIME_UNITS_PER_MINUTE = 20000
+
+# Fitted by default: the patient's effective CFTR function
+CALIBRATION_PARAMS = ('variant_adj',)
+
+# Search box of a parameter without explicit bounds: base value divided / multiplied by BOUND_FACTOR
+BOUND_FACTOR = 10.0
+DEFAULT_BOUNDS = {'variant_adj': (1e-3, 1.5)}
+
+# Solver settings of the residual and Jacobian solves
+CALIBRATION_OPTIONS = {'method': 'LSODA', 'rtol': 1e-6, 'atol': 1e-8}
+
+# Starting points per patient (the base value plus N_STARTS - 1 Sobol' points)
+N_STARTS = 8
+
+# Weighted residual of a failed solve; large enough for the trust region to back off
+FAILED_RESIDUAL = 1e3
+
+# Profile walk: first log step, its growth while inside the interval, steps per side
+# and bisections locating the threshold crossing
+PROFILE_STEP = 0.02
+PROFILE_GROWTH = 2.0
+PROFILE_STEPS = 12
+PROFILE_BISECTIONS = 4
+CONFIDENCE = 0.95
+
+
+class SecretinData():
+	'''
+	Measured luminal HCO3- of one secretin test
+
+	Parameters
+	----------
+	time : array
+		Sampling times, minutes after the start of the protocol
+	hco3 : array
+		Luminal HCO3- (mM)
+	sigma : float or array, optional
+		Measurement standard deviations (mM). If omitted they are taken as
+		equal and estimated from the residuals of the fit.
+	'''
+	def __init__(self, time, hco3, sigma=None):
+		order = np.argsort(np.asarray(time, dtype=float))
+		self.time = np.asarray(time, dtype=float)[order]
+		self.hco3 = np.asarray(hco3, dtype=float)[order]
+		if sigma is not None:
+			sigma = np.broadcast_to(np.asarray(sigma, dtype=float), self.time.shape)[order]
+		self.sigma = sigma
+		if self.time.shape != self.hco3.shape:
+			raise ValueError('time and hco3 need the same length')
+
+	@property
+	def t(self):
+		'''Sampling times in model units'''
+		return self.time*TIME_UNITS_PER_MINUTE
+
+	@property
+	def weights(self):
+		return np.ones(self.time.size) if self.sigma is None else 1/self.sigma
+
+
+class CalibrationResult():
+	'''
+	Output of calibrate
+
+	Attributes
+	----------
+	names : tuple of str
+		The fitted parameters
+	values : dict
+		Parameter name -> fitted value
+	params : DuctParams
+		The base parameters with the fitted values
+	cost : float
+		1/2 the weighted sum of squared residuals at the optimum
+	fitted : np.ndarray
+		Model luminal HCO3- at the measurement times (mM)
+	residuals : np.ndarray
+		fitted - measured (mM)
+	data : SecretinData
+		The measurements
+	starts : list of dict
+		One entry per start: 'start' and 'values' (dicts), 'cost', 'status', 'nfev'
+	n_best : int
+		Starts that reached the best cost (within 0.1%); 1 of many suggests a rugged fit
+	intervals : dict
+		Parameter name -> (low, high) profile-likelihood interval (empty unless profiled)
+	profiles : dict
+		Parameter name -> (values, statistic) walked by the profile; the statistic is
+		the increase in the (scaled) sum of squares
+	confidence : float
+		Coverage of the intervals
+	seconds : float
+		Wall-clock time of the fit and profiles
+	'''
+	def __init__(self, names, values, params, cost, fitted, data, starts, n_best, seconds):
+		self.names = names
+		self.values = values
+		self.params = params
+		self.cost = cost
+		self.fitted = fitted
+		self.residuals = fitted - data.hco3
+		self.data = data
+		self.starts = starts
+		self.n_best = n_best
+		self.intervals = {}
+		self.profiles = {}
+		self.confidence = CONFIDENCE
+		self.seconds = seconds
+
+	@property
+	def success(self):
+		return any(start['status'] > 0 for start in self.starts)
+
+	@property
+	def residual_variance(self):
+		'''Weighted sum of squares per degree of freedom'''
+		return 2*self.cost/max(self.residuals.size - len(self.names), 1)
+
+	def threshold(self, confidence=None):
+		'''Profile statistic at the edge of the interval'''
+		return chi2.ppf(self.confidence if confidence is None else confidence, 1)
+
+
+class _Objective():
+	# Weighted residuals of log parameters and their exact Jacobian, sharing one sensitivity solve
+	def __init__(self, base, protocol, names, data, options):
+		self.base = base
+		self.protocol = protocol
+		self.names = names
+		self.data = data
+		self.options = options
+		self.x = None
+		self.nfev = 0
+
+	def _evaluate(self, x):
+		if self.x is not None and np.array_equal(x, self.x):
+			return
+		values = np.exp(x)
+		params = self.base.replace(**dict(zip(self.names, values)))
+		state = integrate_sensitivities(params, self.protocol, self.names, t_eval=self.data.t, **self.options)
+		self.nfev += 1
+		weights = self.data.weights
+		if state.success and np.all(np.isfinite(state.y[1])):
+			self.r = weights*(state.y[1] - self.data.hco3)
+			# d r/d log p = p d r/d p
+			self.J = weights[:, None]*state.sensitivities[1].T*values
+		else:
+			self.r = np.full(self.data.time.size, FAILED_RESIDUAL)
+			self.J = np.zeros((self.data.time.size, len(self.names)))
+		self.x = np.array(x, dtype=float)
+
+	def residuals(self, x):
+		self._evaluate(x)
+		return self.r
+
+	def jacobian(self, x):
+		self._evaluate(x)
+		return self.J
+
+
+def _least_squares(base, protocol, names, data, x0, low, high, options):
+	# One bounded fit in log space
+	objective = _Objective(base, protocol, names, data, options)
+	x0 = np.clip(x0, low, high)
+	if not names:
+		r = objective.residuals(x0)
+		return x0, 0.5*float(r @ r), 1, objective.nfev
+	fit = least_squares(objective.residuals, x0, jac=objective.jacobian, bounds=(low, high), x_scale=1.0,
+						method='trf')
+	return fit.x, float(fit.cost), int(fit.status), objective.nfev
+
+
+def _fit_start(task):
+	# One start of one patient
+	key, values, y0, protocol, names, data, x0, low, high, options = task
+	x, cost, status, nfev = _least_squares(DuctParams(values, y0), protocol, names, data, x0, low, high, options)
+	return key, x0, x, cost, status, nfev
+
+
+def _profile_cost(base, protocol, names, data, i, value, x_guess, low, high, options):
+	# Best cost with parameter i fixed at log value; returns (cost, fitted log values of the others)
+	others = names[:i] + names[i + 1:]
+	keep = np.arange(len(names)) != i
+	fixed = base.replace(**{names[i]: np.exp(value)})
+	x, cost, _, _ = _least_squares(fixed, protocol, others, data, x_guess[keep], low[keep], high[keep], options)
+	return cost, np.insert(x, i, value)
+
+
+def _profile_side(task):
+	# Walk one parameter from the optimum towards one bound until the statistic crosses the threshold
+	key, values, y0, protocol, names, data, i, direction, x_best, cost_best, scale, threshold, low, high, \
+		options = task
+	base = DuctParams(values, y0)
+	limit = high[i] if direction > 0 else low[i]
+	walked = [(x_best[i], 0.0)]
+	inside, guess = x_best[i], x_best
+	step = PROFILE_STEP
+	endpoint = limit
+	for _ in range(PROFILE_STEPS):
+		value = inside + direction*step
+		if direction*(value - limit) >= 0:
+			value = limit
+		cost, x = _profile_cost(base, protocol, names, data, i, value, guess, low, high, options)
+		statistic = 2*(cost - cost_best)/scale
+		walked.append((value, statistic))
+		if statistic >= threshold:
+			outside = value
+			for _ in range(PROFILE_BISECTIONS):
+				middle = 0.5*(inside + outside)
+				cost, x_middle = _profile_cost(base, protocol, names, data, i, middle, guess, low, high, options)
+				statistic_middle = 2*(cost - cost_best)/scale
+				walked.append((middle, statistic_middle))
+				if statistic_middle >= threshold:
+					outside = middle
+				else:
+					inside, guess = middle, x_middle
+			endpoint = 0.5*(inside + outside)
+			break
+		if value == limit:
+			break
+		inside, guess = value, x
+		step *= PROFILE_GROWTH
+	return key, i, direction, float(np.exp(endpoint)), walked
+
+
+def _map(function, tasks, executor):
+	return map(function, tasks) if executor is None else executor.map(function, tasks)
+
+
+def _log_bounds(base, names, bounds):
+	# (low, high) log bounds of the fitted parameters
+	box = []
+	for name in names:
+		if name in bounds:
+			box.append(bounds[name])
+		elif name in DEFAULT_BOUNDS:
+			box.append(DEFAULT_BOUNDS[name])
+		else:
+			value = getattr(base, name)
+			box.append((value/BOUND_FACTOR, value*BOUND_FACTOR))
+	box = np.log(np.array(box, dtype=float).reshape(len(names), 2))
+	return box[:, 0], box[:, 1]
+
+
+def calibrate_cohort(patients, names=CALIBRATION_PARAMS, bounds=None, protocol=None, n_starts=N_STARTS,
+					 profile=True, confidence=CONFIDENCE, workers=None, seed=0, **solver_options):
+	'''
+	Fit every patient of a cohort in one process pool
+
+	Parameters
+	----------
+	patients : dict
+		Patient id -> (params, SecretinData); params is a dict or DuctParams
+		holding the values not fitted and the base values of those fitted
+	names : tuple of str
+		Parameters to fit (any of PARAM_NAMES)
+	bounds : dict, optional
+		Parameter name -> (low, high) search box (default DEFAULT_BOUNDS, or
+		the base value divided and multiplied by BOUND_FACTOR)
+	protocol : StimulusProtocol, optional
+		Stimulus of the tests (default: the 20000 / 120000 / 200000 secretin pulse)
+	n_starts : int
+		Starting points per patient
+	profile : bool
+		Whether to compute profile-likelihood intervals
+	confidence : float
+		Coverage of the intervals
+	workers : int, optional
+		Worker processes (default: one per core; 1 fits in this process)
+	seed : int
+		Scrambling seed of the starting points
+	**solver_options
+		Sensitivity solver settings (default CALIBRATION_OPTIONS)
+
+	Returns
+	-------
+	dict
+		Patient id -> CalibrationResult
+	'''
+	names = tuple(names)
+	unknown = set(names) - set(PARAM_NAMES)
+	if unknown:
+		raise ValueError('Unknown parameters %s' % sorted(unknown))
+	bounds = {} if bounds is None else bounds
+	protocol = protocol or StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+	options = dict(CALIBRATION_OPTIONS, **solver_options)
+	k = len(names)
+	started = time.perf_counter()
+
+	setup, tasks = {}, []
+	for key, (params, data) in patients.items():
+		base = compile_params(params)
+		low, high = _log_bounds(base, names, bounds)
+		x_base = np.log([getattr(base, name) for name in names])
+		starts = [x_base]
+		if n_starts > 1:
+			# Drawn as a whole power of two to keep the sequence balanced, then truncated
+			u = qmc.Sobol(k, scramble=True, seed=seed).random_base2(int(np.ceil(np.log2(n_starts - 1))))
+			starts += list(low + (high - low)*u[:n_starts - 1])
+		setup[key] = (base, data, low, high)
+		tasks += [(key, base.values, base.y0, protocol, names, data, x0, low, high, options) for x0 in starts]
+
+	workers = os.cpu_count() if workers is None else workers
+	executor = None if workers == 1 else ProcessPoolExecutor(max_workers=workers)
+	try:
+		fits = {key: [] for key in patients}
+		for key, x0, x, cost, status, nfev in _map(_fit_start, tasks, executor):
+			fits[key].append((x0, x, cost, status, nfev))
+
+		results = {}
+		for key, (base, data, low, high) in setup.items():
+			best = min(fits[key], key=lambda fit: fit[2])
+			x_best, cost_best = best[1], best[2]
+			values = dict(zip(names, np.exp(x_best)))
+			params = base.replace(**values)
+			objective = _Objective(base, protocol, names, data, options)
+			fitted = objective.residuals(x_best)/data.weights + data.hco3
+			starts = [{'start': dict(zip(names, np.exp(x0))), 'values': dict(zip(names, np.exp(x))), 'cost': cost,
+					   'status': status, 'nfev': nfev} for x0, x, cost, status, nfev in fits[key]]
+			n_best = sum(cost <= cost_best*(1 + 1e-3) + 1e-12 for _, _, cost, _, _ in fits[key])
+			result = CalibrationResult(names, values, params, cost_best, fitted, data, starts, n_best, 0.0)
+			result.confidence = confidence
+			results[key] = result
+
+		if profile:
+			tasks = []
+			for key, (base, data, low, high) in setup.items():
+				result = results[key]
+				x_best = np.log([result.values[name] for name in names])
+				scale = 1.0 if data.sigma is not None else result.residual_variance
+				for i in range(k):
+					for direction in (-1, 1):
+						tasks.append((key, base.values, base.y0, protocol, names, data, i, direction, x_best,
+									  result.cost, scale, result.threshold(), low, high, options))
+			sides = {}
+			for key, i, direction, endpoint, walked in _map(_profile_side, tasks, executor):
+				sides[key, i, direction] = (endpoint, walked)
+			for key, result in results.items():
+				for i, name in enumerate(names):
+					low_end, low_walk = sides[key, i, -1]
+					high_end, high_walk = sides[key, i, 1]
+					result.intervals[name] = (low_end, high_end)
+					walked = sorted(low_walk + high_walk[1:])
+					result.profiles[name] = (np.exp([value for value, _ in walked]),
+											 np.array([statistic for _, statistic in walked]))
+	finally:
+		if executor is not None:
+			executor.shutdown()
+
+	seconds = time.perf_counter() - started
+	for result in results.values():
+		result.seconds = seconds
+	return results
+
+
+def calibrate(params, data, names=CALIBRATION_PARAMS, **options):
+	'''
+	Fit one patient's parameters to a secretin test
+
+	Parameters
+	----------
+	params : dict or DuctParams
+		The patient's parameters (default values of those fitted are the base start)
+	data : SecretinData
+		The measurements
+	names : tuple of str
+		Parameters to fit
+	**options
+		Passed to calibrate_cohort (bounds, protocol, n_starts, profile, workers, ...)
+
+	Returns
+	-------
+	CalibrationResult
+	'''
+	return calibrate_cohort({0: (params, data)}, names, **options)[0]
+
+
+if __name__ == '__main__':
+	# Recover a known CFTR function from a synthetic secretin test with 2 mM noise
+	from duct_model_protocol import integrate_protocol
+	truth = dict(init_cond, variant_adj=0.3)
+	minutes = np.arange(0, 11, 1.0)
+	state = integrate_protocol(truth, StimulusProtocol.secretin_pulse(20000, 120000, 200000))
+	hco3 = state.sol(minutes*TIME_UNITS_PER_MINUTE)[1] + np.random.default_rng(0).normal(0, 2, minutes.size)
+	result = calibrate(init_cond, SecretinData(minutes, hco3, 2.0))
+	print('variant_adj %.3f (true 0.3), 95%% interval %.3f - %.3f, %d/%d starts at the best fit, %.1f s'
+		  % (result.values['variant_adj'], *result.intervals['variant_adj'], result.n_best, len(result.starts),
+			 result.seconds))
@@ -0,0 +1,411 @@
+# duct_model_continuation.py
+
+'''
+Numerical continuation of duct model steady states.
+
+graph_variant_impact and the sweeps answer "how does secretion change with
+CFTR function" by integrating independent runs at a few variant_adj values.
+The equilibria at a fixed CFTR conductance (the resting branch at gcftrbase,
+the stimulated branch at gcftron, see duct_model_steady_state) can instead
+be followed as curves: pseudo-arclength continuation traces the solutions
+of
+
+	F(x, p) = 0,   x = (bi, bl, ci, ni),
+
+as p varies by predicting along the tangent of the curve and correcting
+with Newton's method on F together with the arclength condition
+t . (z - z_pred) = 0, z = (x, p). Parametrising by arclength rather than p
+lets the curve pass folds, where it turns back in p. The state Jacobian and
+dF/dp are exact (duct_model_generated.jacobian and param_jacobian), and
+positive parameters are continued in log(p) so that a range such as
+variant_adj from 0.1% to 150% of WT is covered evenly.
+
+Along the branch the eigenvalues of F_x give the stability of every
+equilibrium, and three test functions mark special points between
+consecutive steps:
+
+	fold          the p component of the tangent changes sign
+	branch point  the determinant of [[F_x, F_p], [t]] changes sign
+	hopf          a complex pair of eigenvalues crosses the imaginary axis
+
+With the antiporters off the chloride flux through CFTR must vanish at
+equilibrium, so neither branch depends on variant_adj (reduced CFTR
+function only slows the approach); the stimulated branch over variant_adj
+is informative with the antiporters on.
+
+Run using:
+	python3 duct_model_continuation.py [parameter] [output csv]
+
+Developed by Ariel Precision Medicine
+'''
+
+import sys
+import numpy as np
+import pandas as pd
+
+import duct_model_generated
+
+from dcw_duct_model import compile_params, PARAM_INDEX, PARAM_NAMES, STATE_NAMES
+from duct_model_steady_state import steady_state
+
+# Continuation range of a parameter without explicit bounds: its value divided / multiplied by RANGE_FACTOR
+RANGE_FACTOR = 10.0
+DEFAULT_BOUNDS = {'variant_adj': (1e-3, 1.5)}
+
+# Conductance level of each branch
+BRANCH_LEVELS = {'resting': 'gcftrbase', 'stimulated': 'gcftron'}
+
+# Arclength steps (in mM and log-parameter units): initial, smallest and largest
+STEP = 0.5
+MIN_STEP = 1e-6
+MAX_STEP = 1.0
+
+# Corrector: Newton iterations per step and tolerance on the Newton update; steps
+# converging within FAST_CORRECTOR iterations grow by STEP_GROWTH
+CORRECTOR_ITERATIONS = 8
+CORRECTOR_TOL = 1e-9
+FAST_CORRECTOR = 3
+STEP_GROWTH = 1.5
+
+# Accepted points per direction
+MAX_POINTS = 500
+
+
+class Branch():
+	'''
+	A continued solution curve of F(x, p) = 0
+
+	Attributes
+	----------
+	parameter : np.ndarray
+		(N,) parameter values along the branch, in the order traced
+	states : np.ndarray
+		(N, n) solutions
+	eigenvalues : np.ndarray
+		(N, n) eigenvalues of F_x (complex)
+	stable : np.ndarray
+		(N,) whether every eigenvalue has negative real part
+	special : list of dict
+		Special points: 'type' ('fold', 'branch point' or 'hopf'), 'index' (the
+		last point before it), 'parameter' and 'state' (interpolated)
+	stop_reasons : tuple of str
+		Why each direction ended ('bounds', 'max_points', 'step size' or
+		'inadmissible', the latter when a solution left the physical region)
+	n_corrector : int
+		Newton iterations spent
+	name : str
+		Parameter name
+	state_names : tuple of str
+		Names of the solution components
+	label : str
+		Branch label ('stimulated', 'resting', ...)
+	'''
+	def __init__(self, parameter, states, eigenvalues, special, stop_reasons, n_corrector, name='p',
+				 state_names=None, label=''):
+		self.parameter = parameter
+		self.states = states
+		self.eigenvalues = eigenvalues
+		self.stable = np.all(eigenvalues.real < 0, axis=1)
+		self.special = special
+		self.stop_reasons = stop_reasons
+		self.n_corrector = n_corrector
+		self.name = name
+		self.state_names = tuple(state_names) if state_names is not None else \
+			tuple('x%d' % i for i in range(states.shape[1]))
+		self.label = label
+
+	def __len__(self):
+		return self.parameter.size
+
+	def __getitem__(self, name):
+		if name == self.name:
+			return self.parameter
+		if name == 'cl':
+			return 160 - self.states[:, self.state_names.index('bl')]
+		return self.states[:, self.state_names.index(name)]
+
+	def folds(self):
+		'''Special points of type fold'''
+		return [point for point in self.special if point['type'] == 'fold']
+
+	def to_frame(self):
+		'''
+		The branch as a table
+
+		Returns
+		-------
+		pd.DataFrame
+			One row per point: the parameter, the states (and luminal Cl- 'cl' for
+			the duct model), 'stable', 'max_real_eigenvalue', 'branch' and 'special'
+			(the type of a special point that follows the row, else '')
+		'''
+		frame = pd.DataFrame({self.name: self.parameter})
+		for i, state in enumerate(self.state_names):
+			frame[state] = self.states[:, i]
+		if 'bl' in self.state_names:
+			frame['cl'] = self['cl']
+		frame['stable'] = self.stable
+		frame['max_real_eigenvalue'] = self.eigenvalues.real.max(axis=1)
+		frame['branch'] = self.label
+		frame['special'] = ''
+		for point in self.special:
+			frame.loc[point['index'], 'special'] = point['type']
+		return frame
+
+
+def _tangent(A, previous):
+	# Unit tangent from the bordered system [[F_x, F_p], [previous]] t = [0, 1]
+	rhs = np.zeros(A.shape[0] + 1)
+	rhs[-1] = 1.0
+	t = np.linalg.solve(np.vstack([A, previous]), rhs)
+	return t/np.linalg.norm(t)
+
+
+def _trace(fun, jac_x, jac_p, z, t, p_bounds, step, max_points, admissible):
+	# Points and tangents of one direction of the branch, starting after z
+	points, tangents = [], []
+	n_corrector = 0
+	reason = 'max_points'
+	rejected = False
+	overshoot = None
+	while len(points) < max_points:
+		if step < MIN_STEP:
+			reason = 'inadmissible' if rejected else 'step size'
+			break
+		prediction = z + step*t
+		# Arclength condition, or p pinned to the bound on the step that reaches it
+		constraint = t
+		outside = prediction[-1] if overshoot is None else overshoot
+		landing = not p_bounds[0] <= outside <= p_bounds[1]
+		if landing:
+			bound = p_bounds[1] if outside > p_bounds[1] else p_bounds[0]
+			if t[-1] == 0 or abs(bound - z[-1]) < 1e-12:
+				reason = 'bounds'
+				break
+			prediction = z + (bound - z[-1])/t[-1]*t
+			constraint = np.zeros(z.size)
+			constraint[-1] = 1.0
+		candidate = prediction.copy()
+		converged = rejected = False
+		with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+			for iteration in range(CORRECTOR_ITERATIONS):
+				n_corrector += 1
+				x, p = candidate[:-1], candidate[-1]
+				A = np.column_stack([jac_x(x, p), jac_p(x, p)])
+				residual = np.append(fun(x, p), constraint @ (candidate - prediction))
+				try:
+					update = np.linalg.solve(np.vstack([A, constraint]), -residual)
+				except np.linalg.LinAlgError:
+					break
+				if not np.all(np.isfinite(update)):
+					break
+				candidate = candidate + update
+				if np.abs(update).max() < CORRECTOR_TOL*(1 + np.abs(candidate).max()):
+					converged = admissible(candidate[:-1])
+					rejected = not converged
+					break
+		if not converged:
+			step /= 2
+			continue
+		if not landing and not p_bounds[0] <= candidate[-1] <= p_bounds[1]:
+			# The corrector crossed the bound: take this step again as the landing step
+			overshoot = candidate[-1]
+			continue
+		A = np.column_stack([jac_x(candidate[:-1], candidate[-1]), jac_p(candidate[:-1], candidate[-1])])
+		t = _tangent(A, t)
+		z = candidate
+		points.append(z)
+		tangents.append(t)
+		if landing:
+			reason = 'bounds'
+			break
+		if iteration < FAST_CORRECTOR:
+			step = min(step*STEP_GROWTH, MAX_STEP)
+	return points, tangents, n_corrector, reason
+
+
+def _crossing(k, before, after, parameter, states):
+	# Linear interpolation of the zero of a test function between points k and k + 1
+	weight = before/(before - after) if before != after else 0.5
+	return parameter[k] + weight*(parameter[k + 1] - parameter[k]), states[k] + weight*(states[k + 1] - states[k])
+
+
+def pseudo_arclength(fun, jac_x, jac_p, x0, p0, p_bounds, step=STEP, max_points=MAX_POINTS, admissible=None,
+					 name='p', state_names=None, label=''):
+	'''
+	Trace the solution curve of F(x, p) = 0 through (x0, p0) in both directions
+
+	Parameters
+	----------
+	fun : callable
+		fun(x, p) -> (n,) residual F
+	jac_x, jac_p : callable
+		jac_x(x, p) -> (n, n) and jac_p(x, p) -> (n,) derivatives of F
+	x0 : array
+		A solution at p0
+	p0 : float
+		Starting parameter value
+	p_bounds : tuple
+		(low, high) range of p the curve is followed in
+	step : float
+		First arclength step
+	max_points : int
+		Points per direction
+	admissible : callable, optional
+		admissible(x) -> bool; the trace ends where it returns False
+	name, state_names, label
+		Labels of the returned Branch
+
+	Returns
+	-------
+	Branch
+		Points ordered along the curve, starting where the trace towards lower p ended
+	'''
+	admissible = admissible or (lambda x: bool(np.all(np.isfinite(x))))
+	z0 = np.append(np.asarray(x0, dtype=float), p0)
+	A = np.column_stack([jac_x(z0[:-1], p0), jac_p(z0[:-1], p0)])
+	# Initial tangent oriented towards increasing p
+	t0 = _tangent(A, np.append(np.zeros(z0.size - 1), 1.0))
+	if t0[-1] < 0:
+		t0 = -t0
+	forward, forward_tangents, n_forward, forward_reason = _trace(fun, jac_x, jac_p, z0, t0, p_bounds, step,
+																   max_points, admissible)
+	backward, backward_tangents, n_backward, backward_reason = _trace(fun, jac_x, jac_p, z0, -t0, p_bounds, step,
+																	  max_points, admissible)
+	# The backward trace reversed, the start, then the forward trace
+	points = np.array(backward[::-1] + [z0] + forward)
+	tangents = np.array([-t for t in backward_tangents[::-1]] + [t0] + forward_tangents)
+	parameter, states = points[:, -1], points[:, :-1]
+
+	eigenvalues = np.array([np.linalg.eigvals(jac_x(x, p)) for x, p in zip(states, parameter)])
+	determinants = np.array([np.linalg.det(np.vstack([np.column_stack([jac_x(x, p), jac_p(x, p)]), t]))
+							 for x, p, t in zip(states, parameter, tangents)])
+	special = []
+	for k in range(len(parameter) - 1):
+		if np.sign(tangents[k, -1]) != np.sign(tangents[k + 1, -1]):
+			p, x = _crossing(k, tangents[k, -1], tangents[k + 1, -1], parameter, states)
+			special.append({'type': 'fold', 'index': k, 'parameter': p, 'state': x})
+		elif np.sign(determinants[k]) != np.sign(determinants[k + 1]):
+			p, x = _crossing(k, determinants[k], determinants[k + 1], parameter, states)
+			special.append({'type': 'branch point', 'index': k, 'parameter': p, 'state': x})
+		complex_before = eigenvalues[k][np.abs(eigenvalues[k].imag) > 0]
+		complex_after = eigenvalues[k + 1][np.abs(eigenvalues[k + 1].imag) > 0]
+		if complex_before.size and complex_after.size and \
+				np.sign(complex_before.real.max()) != np.sign(complex_after.real.max()):
+			p, x = _crossing(k, complex_before.real.max(), complex_after.real.max(), parameter, states)
+			special.append({'type': 'hopf', 'index': k, 'parameter': p, 'state': x})
+	return Branch(parameter, states, eigenvalues, special, (backward_reason, forward_reason),
+				  n_forward + n_backward, name, state_names, label)
+
+
+def _physical(x):
+	# Concentrations stay positive and luminal Cl- (160 - bl) stays positive
+	return bool(np.all(np.isfinite(x)) and np.all(x > 0) and x[1] < 160)
+
+
+def continue_steady_state(params, name='variant_adj', bounds=None, branch='stimulated', log_scale=None,
+						  step=STEP, max_points=MAX_POINTS):
+	'''
+	Follow a steady-state branch of duct_model_system over a parameter
+
+	Parameters
+	----------
+	params : dict or DuctParams
+		Model parameters; the branch starts at their value of name
+	name : str
+		Continuation parameter (any of PARAM_NAMES)
+	bounds : tuple, optional
+		(low, high) range of the parameter (default DEFAULT_BOUNDS, or its value
+		divided and multiplied by RANGE_FACTOR)
+	branch : str
+		'stimulated' (gcftr = gcftron) or 'resting' (gcftr = gcftrbase)
+	log_scale : bool, optional
+		Continue in log(parameter) (default: when the range is positive)
+	step, max_points
+		Passed to pseudo_arclength
+
+	Returns
+	-------
+	Branch
+		Labelled with the branch; parameter values are reported on the linear scale
+	'''
+	if name not in PARAM_NAMES:
+		raise ValueError('Unknown parameter %r' % name)
+	if branch not in BRANCH_LEVELS:
+		raise ValueError('Unknown branch %r (%s)' % (branch, ', '.join(BRANCH_LEVELS)))
+	params = compile_params(params)
+	values = params.values.copy()
+	column = PARAM_INDEX[name]
+	level = PARAM_INDEX[BRANCH_LEVELS[branch]]
+	start = values[column]
+	if bounds is None:
+		bounds = DEFAULT_BOUNDS.get(name, (start/RANGE_FACTOR, start*RANGE_FACTOR))
+	low, high = sorted(bounds)
+	start = min(max(start, low), high)
+	log_scale = low > 0 if log_scale is None else log_scale
+	to_value = np.exp if log_scale else (lambda p: p)
+
+	y = np.zeros(5)
+
+	def prepare(x, p):
+		values[column] = to_value(p)
+		y[:4] = x
+		y[4] = values[level]
+		return y
+
+	def fun(x, p):
+		return duct_model_generated.rhs(0, prepare(x, p), values)[:4]
+
+	def jac_x(x, p):
+		return duct_model_generated.jacobian(0, prepare(x, p), values)[:4, :4]
+
+	def jac_p(x, p):
+		y = prepare(x, p)
+		derivative = duct_model_generated.param_jacobian(0, y, values)[:4, column]
+		if column == level:
+			# The parameter is also this branch's conductance
+			derivative = derivative + duct_model_generated.jacobian(0, y, values)[:4, 4]
+		return derivative*values[column] if log_scale else derivative
+
+	equilibrium = steady_state(params.replace(**{name: start}), BRANCH_LEVELS[branch], cache=None)
+	if not equilibrium.success:
+		raise RuntimeError('No %s steady state at %s = %g' % (branch, name, start))
+	p_bounds = (np.log(low), np.log(high)) if log_scale else (low, high)
+	p0 = np.log(start) if log_scale else start
+	result = pseudo_arclength(fun, jac_x, jac_p, equilibrium.y[:4], p0, p_bounds, step, max_points, _physical,
+							  name, STATE_NAMES[:4], branch)
+	result.parameter = to_value(result.parameter)
+	for point in result.special:
+		point['parameter'] = float(to_value(point['parameter']))
+	return result
+
+
+def steady_state_branches(params, name='variant_adj', bounds=None, **continuation_options):
+	'''
+	Resting and stimulated branches over one parameter
+
+	Returns
+	-------
+	dict
+		{'resting': Branch, 'stimulated': Branch}
+	'''
+	return {branch: continue_steady_state(params, name, bounds, branch, **continuation_options)
+			for branch in BRANCH_LEVELS}
+
+
+def branches_to_frame(branches):
+	'''One table of several branches (a dict or list of Branch), e.g. to write with to_csv'''
+	branches = branches.values() if isinstance(branches, dict) else branches
+	return pd.concat([branch.to_frame() for branch in branches], ignore_index=True)
+
+
+if __name__ == '__main__':
+	from dcw_duct_model import init_cond
+	name = sys.argv[1] if len(sys.argv) > 1 else 'variant_adj'
+	path = sys.argv[2] if len(sys.argv) > 2 else 'steady_state_branches_%s.csv' % name
+	branches = steady_state_branches(dict(init_cond, ap_status=True, apb_status=True), name)
+	for label, branch in branches.items():
+		print('%s: %d points, special points %s' % (label, len(branch),
+													[(point['type'], point['parameter']) for point in branch.special]))
+	branches_to_frame(branches).to_csv(path, index=False)
+	print('Wrote ' + path)
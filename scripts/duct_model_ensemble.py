@@ -0,0 +1,834 @@
+# duct_model_ensemble.py
+
+'''
+Batched (ensemble) integration of the Whitcomb & Ermentrout duct model.
+
+The states of N independent duct cells are stored as one (5, N) array and
+advanced together by a single vectorized right-hand side, so a cohort of
+patients (or the WT + patient pair every report draws) costs one Python-level
+solver loop instead of one solve_ivp call per phase per parameter set.
+
+The default integrator is a vectorized Dormand-Prince 5(4) pair (the same
+scheme as solve_ivp's RK45) where every member keeps its own time, step size
+and error norm. One stiff patient therefore only keeps itself busy; the rest
+of the batch finishes and drops out of the active set. The other backends of
+duct_model_backends (solve_ivp methods, odeint with a banded Jacobian and the
+fixed-step Rodas3 stepper) can be selected per call and fill the same
+EnsembleResult.
+
+With time_limit set, members still running when it expires stop with
+BUDGET_STATUS; retry_failed_members then re-runs failed members one by one
+through integrate_with_fallbacks, so one stiff patient costs a bounded
+amount of time and its failure is visible in result.status.
+
+Developed by Ariel Precision Medicine
+'''
+
+import numpy as np
+from scipy.integrate import solve_ivp, odeint
+from scipy.sparse import csr_matrix, kron, identity
+
+import duct_model_generated
+
+from dcw_duct_model import (antiporter, eff_perm, nernst_potential, compile_params,
+							PARAM_INDEX, STATE_NAMES)
+from duct_model_backends import (BUDGET_STATUS, BudgetExhausted, DenseOutput, SolveBudget, available_methods,
+								 graded_mesh, resolve_options, rodas3_steps)
+from duct_model_log_form import from_log, log_system, log_tolerances, to_log
+from duct_model_protocol import SimulationError, StimulusProtocol, describe_attempts, integrate_with_fallbacks
+from duct_model_reduced import FAST_STATES, project, reduced_system, reduction_error
+
+# solve_ensemble settings passed on to the fallback re-runs of failed members
+RETRY_OPTIONS = ('rtol', 'atol', 'time_limit')
+
+# Dormand-Prince 5(4) tableau with dense output (Hairer, Norsett & Wanner)
+DP5_C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+DP5_A = np.array([
+	[0, 0, 0, 0, 0],
+	[1/5, 0, 0, 0, 0],
+	[3/40, 9/40, 0, 0, 0],
+	[44/45, -56/15, 32/9, 0, 0],
+	[19372/6561, -25360/2187, 64448/6561, -212/729, 0],
+	[9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]])
+DP5_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+DP5_E = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+DP5_P = np.array([
+	[1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+	[0, 0, 0, 0],
+	[0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+	[0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+	[0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+	[0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+	[0, 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+
+# Step size control constants (as in scipy.integrate.RK45)
+SAFETY = 0.9
+MIN_FACTOR = 0.2
+MAX_FACTOR = 10
+ERROR_EXPONENT = -1/5
+
+# Per-member Jacobian pattern derived symbolically: every ion derivative
+# depends on every state (through the membrane voltage), gcftr is constant.
+MEMBER_JAC_SPARSITY = duct_model_generated.JAC_SPARSITY.astype(bool)
+
+
+class DuctEnsemble():
+	'''
+	N compiled parameter sets stacked column-wise for the vectorized RHS
+
+	Attributes
+	----------
+	params : tuple of DuctParams
+		The member parameter sets, in order
+	values : np.ndarray
+		(len(PARAM_NAMES), N) parameter matrix
+	y0 : np.ndarray
+		(5, N) initial states
+	'''
+	def __init__(self, members):
+		self.params = tuple(compile_params(member) for member in members)
+		if not self.params:
+			raise ValueError('An ensemble needs at least one member')
+		self.values = np.column_stack([p.values for p in self.params])
+		self.y0 = np.column_stack([p.y0 for p in self.params])
+
+	def __len__(self):
+		return len(self.params)
+
+	def param(self, name):
+		'''Row of the parameter matrix for one parameter name'''
+		return self.values[PARAM_INDEX[name]]
+
+
+class EnsembleResult():
+	'''
+	Output of solve_ensemble
+
+	Attributes
+	----------
+	t : np.ndarray
+		(T,) output times
+	y : np.ndarray
+		(5, N, T) states of every member at every output time (NaN after a failure)
+	status : np.ndarray
+		(N,) 0 for members that reached the end, -1 for members whose step size
+		collapsed, BUDGET_STATUS (-2) for members stopped by the time limit
+	nfev, nsteps, nrejected : np.ndarray
+		(N,) per-member work counters
+	error_estimate : np.ndarray or None
+		(4, N, T) estimated absolute error of bi, bl, ci, ni against the full
+		model for reduced runs (duct_model_reduced.reduction_error), else None
+	escalated : np.ndarray or None
+		(N,) members screen_cohort re-ran with the full model (zero error
+		estimate), None outside screening
+	attempts : dict or None
+		Member index -> attempt records (see ProtocolResult.attempts) of the
+		members retry_failed_members re-ran, None if it was not called
+	provisional : bool
+		True for the loose first answer of a progressive solve
+		(duct_model_progressive), which a refined result will replace
+	'''
+	def __init__(self, t, y, status, nfev, nsteps, nrejected, error_estimate=None, escalated=None, attempts=None,
+				 provisional=False):
+		self.t = t
+		self.y = y
+		self.status = status
+		self.nfev = nfev
+		self.nsteps = nsteps
+		self.nrejected = nrejected
+		self.error_estimate = error_estimate
+		self.escalated = escalated
+		self.attempts = attempts
+		self.provisional = provisional
+
+	@property
+	def success(self):
+		return bool(np.all(self.status == 0))
+
+	def member(self, i):
+		'''(5, T) trajectory of member i'''
+		return self.y[:, i, :]
+
+	def error_bound(self, states=STATE_NAMES[:4]):
+		'''(N,) largest estimated error of each member over the given states and all times (None for full runs)'''
+		if self.error_estimate is None:
+			return None
+		rows = [STATE_NAMES.index(state) for state in ([states] if isinstance(states, str) else states)]
+		return np.max(self.error_estimate[rows], axis=(0, 2))
+
+
+def _fluxes(y, values):
+	# Membrane and luminal fluxes of duct_model_system for (5, ...) states and (P, ...) parameters
+	p = {name: values[i] for name, i in PARAM_INDEX.items()}
+	bi, bl, ci, ni, gcftr = y
+	cl = 160 - bl
+	bb, nb, vr = p['bb'], p['nb'], p['vr']
+
+	# Nernst Potentials
+	eb = nernst_potential(bi, bl)
+	enbc = nernst_potential(bi**2*ni, bb**2*nb)
+	ec = nernst_potential(ci, cl)
+	ena = nernst_potential(nb, ni)
+
+	# Permeabilities
+	kccf = eff_perm(ci, cl)*gcftr*p['g_cl']
+	kbcf = eff_perm(bi, bl)*gcftr*p['g_bi']
+	knbc = p['gnbc']
+	gk, gnaleak = p['gk'], p['gnaleak']
+
+	# Voltage Potential
+	v = (knbc*enbc+kbcf*eb+kccf*ec+gk*p['ek']+gnaleak*ena)/(knbc+kbcf+kccf+gk)
+
+	# Flux Calculations
+	jnbc = knbc*(v-enbc)
+	jbcftr = kbcf*(v-eb) * p['smoke_adj']
+	jccftr = (kccf*(v-ec) * p['variant_adj']) * p['alcohol_adj']
+
+	# Antiporters only contribute for members where they are switched on
+	japl = np.where(p['ap_status'] != 0, antiporter(bl, bi, cl, ci, p['kbi'], p['kcl'])*p['gapl'], 0.0)
+	japbl = np.where(p['apb_status'] != 0, antiporter(bb, bi, p['cb'], ci, p['kbi'], p['kcl'])*p['gapbl'], 0.0)
+
+	jbl = (-jbcftr-japl)/vr+p['jac']*p['rat']
+	jci = jccftr-japl-japbl
+	jcl = ((-jccftr+japl)/vr+p['jac'])
+	jlum = (jcl+jbl)/p['ionstr']
+	jnak = p['gnak']*(v-p['epump'])*(ni/p['np0'])**3
+	jnaleak = gnaleak*(v-ena)
+	return p, jnbc, jbcftr, japl, japbl, jbl, jci, jlum, jnak, jnaleak
+
+
+def ensemble_rhs(t, y, values, out=None):
+	'''
+	Vectorized duct_model_system for a (5, N) state and (P, N) parameter matrix
+
+	Parameters
+	----------
+	t : float or np.ndarray
+		Time (unused, the system is autonomous)
+	y : np.ndarray
+		(5, N) states ordered as STATE_NAMES
+	values : np.ndarray
+		(P, N) parameter matrix (see DuctEnsemble.values)
+	out : np.ndarray, optional
+		Preallocated (5, N) output
+
+	Returns
+	-------
+	np.ndarray
+		(5, N) derivatives
+	'''
+	if out is None:
+		out = np.empty(y.shape)
+	p, jnbc, jbcftr, japl, japbl, jbl, jci, jlum, jnak, jnaleak = _fluxes(y, values)
+	zeta = p['zeta']
+	bi, bl = y[0], y[1]
+
+	out[0] = zeta*p['chi']*(jbcftr+japl+japbl+p['buf']*(p['bi0']-bi)+2*jnbc)
+	out[1] = (jbl-jlum*bl)*zeta
+	out[2] = jci*zeta
+	out[3] = zeta*(jnbc-jnak-jnaleak)
+	out[4] = 0
+	return out
+
+
+def ensemble_flow(y, values):
+	'''
+	Luminal fluid secretion (flow = jlum*ionstr of duct_model_system)
+
+	Parameters
+	----------
+	y : np.ndarray
+		(5, ...) states, e.g. (5, N) members or (5, T) points of one run
+	values : np.ndarray
+		Parameter matrix broadcasting against y[0]: (P, N), or (P, 1) for a single parameter set
+
+	Returns
+	-------
+	np.ndarray
+		Flow shaped like y[0]
+	'''
+	fluxes = _fluxes(y, values)
+	return fluxes[7]*fluxes[0]['ionstr']
+
+
+def ensemble_jac_sparsity(n_members):
+	'''
+	Jacobian sparsity of the flattened (5, N) ensemble state.
+
+	Members never interact, so the Jacobian is block-diagonal once states are
+	grouped per member; in the state-major flattening used by solve_ensemble
+	each 5x5 member block is spread over diagonal bands (kron(block, I_N)).
+
+	Parameters
+	----------
+	n_members : int
+		Number of ensemble members N
+
+	Returns
+	-------
+	scipy.sparse.csr_matrix
+		(5N, 5N) boolean pattern usable as solve_ivp's jac_sparsity
+	'''
+	return csr_matrix(kron(csr_matrix(MEMBER_JAC_SPARSITY), identity(n_members, dtype=bool, format='csr')), dtype=bool)
+
+
+def ensemble_jacobian(y, values):
+	'''
+	Exact sparse Jacobian of the flattened (5, N) ensemble system
+
+	Parameters
+	----------
+	y : np.ndarray
+		(5, N) states
+	values : np.ndarray
+		(P, N) parameter matrix
+
+	Returns
+	-------
+	scipy.sparse.csr_matrix
+		(5N, 5N) Jacobian with the pattern of ensemble_jac_sparsity
+	'''
+	return _block_matrix(duct_model_generated.jacobian(0, y, values))
+
+
+def ensemble_model(log_form=False, reduced=False):
+	'''
+	Right-hand side and per-member Jacobian blocks integrated by solve_ensemble
+
+	Parameters
+	----------
+	log_form : bool
+		Return the system in log coordinates (duct_model_log_form)
+	reduced : bool
+		Return the quasi-steady-state reduction (duct_model_reduced)
+
+	Returns
+	-------
+	tuple
+		(rhs(t, y, values) -> (5, N), jac(t, y, values) -> (5, 5, N))
+	'''
+	rhs, jac = ensemble_rhs, duct_model_generated.jacobian
+	if reduced:
+		rhs, jac = reduced_system(rhs, jac)
+	return log_system(rhs, jac) if log_form else (rhs, jac)
+
+
+def _block_matrix(blocks):
+	# (5N, 5N) state-major sparse matrix of (5, 5, N) member blocks
+	n = blocks.shape[2]
+	rows, cols = np.nonzero(MEMBER_JAC_SPARSITY)
+	members = np.arange(n)
+	data = blocks[rows, cols].ravel()
+	row_index = (rows[:, None]*n + members).ravel()
+	col_index = (cols[:, None]*n + members).ravel()
+	return csr_matrix((data, (row_index, col_index)), shape=(5*n, 5*n))
+
+
+def _rms(x):
+	return np.sqrt(np.mean(x**2, axis=0))
+
+
+def _initial_step(rhs, values, y0, f0, interval, rtol, atol, max_step):
+	# Vectorized scipy.integrate._ivp.common.select_initial_step (order 4)
+	scale = atol + np.abs(y0)*rtol
+	d0 = _rms(y0/scale)
+	d1 = _rms(f0/scale)
+	small = (d0 < 1e-5) | (d1 < 1e-5)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		h0 = np.where(small, 1e-6, 0.01*d0/d1)
+	h0 = np.minimum(h0, interval)
+	f1 = rhs(0, y0 + h0*f0, values)
+	d2 = _rms((f1 - f0)/scale)/h0
+	flat = (d1 <= 1e-15) & (d2 <= 1e-15)
+	with np.errstate(divide='ignore'):
+		h1 = np.where(flat, np.maximum(1e-6, h0*1e-3), (0.01/np.maximum(d1, d2))**(1/5))
+	return np.minimum.reduce([100*h0, h1, interval, np.full_like(h0, max_step)])
+
+
+def _dp5_segment(model, values, Y, T, t_end, grid, grid_index, out, status, counters, rtol, atol, max_step,
+				 budget=None):
+	'''
+	Advance every healthy member from its current time to t_end with
+	independent adaptive steps, writing dense output at the grid times.
+	'''
+	rhs = model[0]
+	n = Y.shape[1]
+	active = np.flatnonzero((status == 0) & (T < t_end))
+	if active.size == 0:
+		return
+	vals = values[:, active]
+	F = np.zeros_like(Y)
+	F[:, active] = rhs(0, Y[:, active], vals)
+	counters['nfev'][active] += 1
+	H = np.zeros(n)
+	H[active] = _initial_step(rhs, vals, Y[:, active], F[:, active], t_end - T[active], rtol, atol, max_step)
+	counters['nfev'][active] += 1
+	rejected = np.zeros(n, dtype=bool)
+	K = np.empty((7, 5, n))
+
+	while active.size:
+		if budget is not None and budget.expired:
+			status[active] = BUDGET_STATUS
+			return
+		m = active.size
+		if vals.shape[1] != m:
+			vals = values[:, active]
+		t = T[active]
+		y = Y[:, active]
+		k = K[:, :, :m]
+		k[0] = F[:, active]
+
+		# Fresh steps are clamped to [min_step, max_step]; retries may shrink below
+		min_step = 10*np.abs(np.nextafter(t, np.inf) - t)
+		h = H[active]
+		h = np.where(rejected[active], h, np.clip(h, min_step, max_step))
+		collapsed = h < min_step
+		t_new = np.where(t + h > t_end, t_end, t + h)
+		h = t_new - t
+
+		for s in range(1, 6):
+			dy = np.tensordot(DP5_A[s, :s], k[:s], axes=1)*h
+			k[s] = rhs(0, y + dy, vals)
+		y_new = y + h*np.tensordot(DP5_B, k[:6], axes=1)
+		k[6] = rhs(0, y_new, vals)
+		counters['nfev'][active] += 6
+
+		scale = atol + np.maximum(np.abs(y), np.abs(y_new))*rtol
+		error_norm = _rms(h*np.tensordot(DP5_E, k, axes=1)/scale)
+		with np.errstate(divide='ignore'):
+			factor = SAFETY*error_norm**ERROR_EXPONENT
+
+		# Members whose step collapsed below round-off (or blew up) give up
+		failed = collapsed | ~np.isfinite(error_norm)
+		status[active[failed]] = -1
+		accept = (error_norm < 1) & ~failed
+
+		# Rejected members shrink their step and retry
+		retry = ~accept & ~failed
+		H[active[retry]] = h[retry]*np.maximum(MIN_FACTOR, factor[retry])
+		rejected[active[retry]] = True
+		counters['nrejected'][active[retry]] += 1
+
+		if np.any(accept):
+			idx = np.flatnonzero(accept)
+			members = active[idx]
+			grow = np.minimum(MAX_FACTOR, np.where(error_norm[idx] == 0, MAX_FACTOR, factor[idx]))
+			grow = np.where(rejected[members], np.minimum(1, grow), grow)
+			_dense_output(grid, grid_index, out, members, t[idx], t_new[idx], h[idx], y[:, idx], k[:, :, idx])
+			T[members] = t_new[idx]
+			Y[:, members] = y_new[:, idx]
+			F[:, members] = k[6][:, idx]
+			H[members] = h[idx]*grow
+			rejected[members] = False
+			counters['nsteps'][members] += 1
+
+		still = (status[active] == 0) & (T[active] < t_end)
+		if not np.all(still):
+			active = active[still]
+			vals = vals[:, still]
+
+
+def _dense_output(grid, grid_index, out, members, t_old, t_new, h, y_old, k):
+	# Evaluate the DP5 interpolant at every output time inside (t_old, t_new]
+	lo = np.searchsorted(grid, t_old, side='right')
+	hi = np.searchsorted(grid, t_new, side='right')
+	counts = hi - lo
+	if not np.any(counts):
+		return
+	which = np.repeat(np.arange(members.size), counts)
+	offsets = np.cumsum(counts) - counts
+	points = lo[which] + np.arange(which.size) - offsets[which]
+	x = (grid[points] - t_old[which])/h[which]
+	powers = np.cumprod(np.tile(x, (4, 1)), axis=0)
+	Q = np.einsum('svm,sp->vpm', k, DP5_P)
+	values = y_old[:, which] + h[which]*np.einsum('vpn,pn->vn', Q[:, :, which], powers)
+	out[:, members[which], grid_index[points]] = values
+
+
+def _scipy_segment(model, values, Y, T, t_end, grid, grid_index, out, status, counters, method, rtol, atol, max_step,
+				   budget=None):
+	# One flattened solve_ivp call per segment (global error norm across members)
+	rhs, jac = model
+	live = np.flatnonzero(status == 0)
+	if live.size == 0 or np.all(T[live] >= t_end):
+		return
+	vals = values[:, live]
+	m = live.size
+
+	def fun(t, y_flat):
+		return rhs(t, y_flat.reshape(5, m), vals).ravel()
+
+	if budget is not None:
+		fun = budget.wrap(fun)
+
+	options = {'rtol': rtol, 'atol': atol, 'max_step': max_step}
+	if method in ('BDF', 'Radau'):
+		# Exact block Jacobian instead of finite differences over the pattern
+		options['jac'] = lambda t, y_flat: _block_matrix(jac(t, y_flat.reshape(5, m), vals))
+	elif method == 'LSODA':
+		# LSODA only takes dense Jacobians
+		options['jac'] = lambda t, y_flat: _block_matrix(jac(t, y_flat.reshape(5, m), vals)).toarray()
+	t0 = T[live[0]]
+	try:
+		state = solve_ivp(fun, [t0, t_end], Y[:, live].ravel(), method=method, dense_output=True, **options)
+	except BudgetExhausted:
+		status[live] = BUDGET_STATUS
+		return
+	counters['nfev'][live] += state.nfev
+	counters['nsteps'][live] += state.t.size - 1
+	if state.status != 0:
+		status[live] = -1
+		return
+	points = np.flatnonzero((grid > t0) & (grid <= t_end))
+	if points.size:
+		out[:, live[:, None], grid_index[points]] = state.sol(grid[points]).reshape(5, m, points.size)
+	T[live] = t_end
+	Y[:, live] = state.y[:, -1].reshape(5, m)
+	status[live[~np.all(np.isfinite(Y[:, live]), axis=0)]] = -1
+
+
+def _rodas3_segment(model, values, Y, T, t_end, grid, grid_index, out, status, counters, n_steps, first_step,
+					positive=True, budget=None):
+	# Whole ensemble in lockstep on one graded mesh, Hermite interpolation onto the grid
+	live = np.flatnonzero(status == 0)
+	if live.size == 0 or np.all(T[live] >= t_end):
+		return
+	# A fixed mesh costs a known amount of work, so the budget is only checked between segments
+	if budget is not None and budget.expired:
+		status[live] = BUDGET_STATUS
+		return
+	vals = values[:, live]
+	t0 = T[live[0]]
+	mesh = graded_mesh(t0, t_end, n_steps, first_step)
+	rhs, jac = model
+	states, derivatives, healthy = rodas3_steps(lambda y: rhs(0, y, vals), lambda y: jac(0, y, vals), Y[:, live], mesh,
+												positive)
+	counters['nfev'][live] += 3*n_steps + 1
+	counters['nsteps'][live] += n_steps
+	points = np.flatnonzero((grid > t0) & (grid <= t_end))
+	if points.size:
+		out[:, live[:, None], grid_index[points]] = DenseOutput.hermite(mesh, states, derivatives)(grid[points])
+	status[live[~healthy]] = -1
+	T[live] = t_end
+	Y[:, live] = states[:, :, -1]
+
+
+def _odeint_segment(model, values, Y, T, t_end, grid, grid_index, out, status, counters, rtol, atol, max_step,
+					budget=None):
+	# Fortran LSODA on the member-major flattened system, whose Jacobian is banded (ml = mu = 4)
+	rhs, jac = model
+	live = np.flatnonzero(status == 0)
+	if live.size == 0 or np.all(T[live] >= t_end):
+		return
+	vals = values[:, live]
+	m = live.size
+	rows, cols = np.nonzero(MEMBER_JAC_SPARSITY)
+	band_rows = rows - cols + 4
+	band_cols = cols[:, None] + 5*np.arange(m)
+
+	def fun(t, y_flat):
+		return rhs(t, y_flat.reshape(m, 5).T, vals).T.ravel()
+
+	if budget is not None:
+		fun = budget.wrap(fun)
+
+	def band_jac(t, y_flat):
+		blocks = jac(t, y_flat.reshape(m, 5).T, vals)
+		band = np.zeros((9, 5*m))
+		band[band_rows[:, None], band_cols] = blocks[rows, cols]
+		return band
+
+	t0 = T[live[0]]
+	points = np.flatnonzero((grid > t0) & (grid < t_end))
+	times = np.concatenate([[t0], grid[points], [t_end]])
+	hmax = 0.0 if np.isinf(max_step) else max_step
+	try:
+		y, info = odeint(fun, Y[:, live].T.ravel(), times, Dfun=band_jac, ml=4, mu=4, tfirst=True,
+						 rtol=rtol, atol=atol, hmax=hmax, full_output=True)
+	except BudgetExhausted:
+		status[live] = BUDGET_STATUS
+		return
+	counters['nfev'][live] += info['nfe'][-1]
+	counters['nsteps'][live] += info['nst'][-1]
+	if info['message'] != 'Integration successful.':
+		status[live] = -1
+		return
+	y = y.reshape(times.size, m, 5).transpose(2, 1, 0)
+	points = np.flatnonzero((grid > t0) & (grid <= t_end))
+	if points.size:
+		out[:, live[:, None], grid_index[points]] = y[:, :, 1:1 + points.size]
+	T[live] = t_end
+	Y[:, live] = y[:, :, -1]
+	status[live[~np.all(np.isfinite(Y[:, live]), axis=0)]] = -1
+
+
+def solve_ensemble(ensemble, segments, t_eval, method=None, rtol=None, atol=None, max_step=np.inf,
+				   n_steps=None, first_step=None, log_form=False, reduced=False, time_limit=None):
+	'''
+	Integrate every member of an ensemble through a piecewise-constant gcftr schedule
+
+	Parameters
+	----------
+	ensemble : DuctEnsemble or list of dict/DuctParams
+		Parameter sets to integrate together
+	segments : list of tuple or StimulusProtocol
+		(t_start, t_end, gcftr) phases in order. gcftr is a parameter name
+		('gcftrbase', 'gcftron'), a float or an (N,) array. A piecewise-constant
+		StimulusProtocol is accepted as well.
+	t_eval : array
+		Sorted output times. A time equal to a segment start is reported at the start of that segment.
+	method : str, optional
+		'DP5' for the per-member adaptive stepper, 'rodas3' for the fixed-step
+		Rosenbrock stepper, 'odeint', or any solve_ivp method ('BDF', 'Radau',
+		'LSODA', ...) to integrate the flattened system in one call per segment
+		with the exact block Jacobian (one global error norm).
+	rtol, atol, max_step : float, optional
+		Tolerances and step bound, as in solve_ivp (ignored by 'rodas3')
+	n_steps, first_step : int, float, optional
+		Per-segment mesh of 'rodas3'
+	log_form : bool
+		Integrate log concentrations (duct_model_log_form), so no member can
+		step through a zero concentration; rtol then bounds the relative error
+		of every concentration. result.y is in concentrations either way.
+	reduced : bool
+		Integrate the quasi-steady-state reduction (duct_model_reduced): bi
+		and ni are kept on the slow manifold, so the system is no longer
+		stiff. result.error_estimate then holds the a posteriori error
+		estimate against the full model.
+	time_limit : float, optional
+		Wall-clock seconds the call may take; members not finished by then
+		stop with status BUDGET_STATUS (NaN trajectories). None: unlimited.
+
+	Settings left as None come from the deployment's ensemble solver profile
+	(duct_model_backends.default_options(ensemble=True)).
+
+	Returns
+	-------
+	EnsembleResult
+	'''
+	if not isinstance(ensemble, DuctEnsemble):
+		ensemble = DuctEnsemble(ensemble)
+	if isinstance(segments, StimulusProtocol):
+		segments = segments.constant_segments()
+	options = resolve_options(ensemble=True, method=method, rtol=rtol, atol=atol, n_steps=n_steps, first_step=first_step)
+	method, rtol, atol = options['method'], options['rtol'], options['atol']
+	n_steps, first_step = options['n_steps'], options['first_step']
+	if method not in available_methods(ensemble=True):
+		raise ValueError('Unknown integrator backend %r' % method)
+	n = len(ensemble)
+	values = ensemble.values
+	t_eval = np.asarray(t_eval, dtype=float)
+	out = np.full((5, n, t_eval.size), np.nan)
+	model = ensemble_model(log_form, reduced)
+	if log_form:
+		rtol, atol = log_tolerances(rtol, atol)
+	Y = to_log(ensemble.y0) if log_form else ensemble.y0.copy()
+	T = np.full(n, float(segments[0][0]))
+	status = np.zeros(n, dtype=int)
+	counters = {key: np.zeros(n, dtype=int) for key in ('nfev', 'nsteps', 'nrejected')}
+	layers = []
+	budget = SolveBudget(time_limit=time_limit) if time_limit is not None else None
+
+	cursor = 0
+	for t_start, t_end, gcftr in segments:
+		if isinstance(gcftr, str):
+			gcftr = ensemble.param(gcftr)
+		T[status == 0] = t_start
+		Y[4] = gcftr
+		if reduced:
+			# The fast states jump onto the new slow manifold; the jump is a switch layer of the full model
+			y = from_log(Y) if log_form else Y
+			entering = y[FAST_STATES]
+			y = project(ensemble_rhs, duct_model_generated.jacobian, 0, y, values)[0]
+			layers.append((cursor, entering - y[FAST_STATES]))
+			Y = to_log(y) if log_form else y
+			status[(status == 0) & ~np.all(np.isfinite(Y), axis=0)] = -1
+		stop = np.searchsorted(t_eval, t_end, side='right')
+		grid_index = np.arange(cursor, stop)
+		grid = t_eval[cursor:stop]
+		# Output times at the segment start take the freshly switched state
+		at_start = grid_index[grid == t_start]
+		out[:, :, at_start] = Y[:, :, None]
+		if method == 'DP5':
+			_dp5_segment(model, values, Y, T, t_end, grid, grid_index, out, status, counters, rtol, atol, max_step,
+						 budget)
+		elif method == 'rodas3':
+			_rodas3_segment(model, values, Y, T, t_end, grid, grid_index, out, status, counters, n_steps, first_step,
+							not log_form, budget)
+		elif method == 'odeint':
+			_odeint_segment(model, values, Y, T, t_end, grid, grid_index, out, status, counters, rtol, atol, max_step,
+							budget)
+		else:
+			_scipy_segment(model, values, Y, T, t_end, grid, grid_index, out, status, counters, method, rtol, atol,
+						   max_step, budget)
+		out[:, status != 0, cursor:stop] = np.nan
+		cursor = stop
+
+	if log_form:
+		out = from_log(out)
+	error_estimate = reduction_error(t_eval, out, values, layers) if reduced else None
+	return EnsembleResult(t_eval, out, status, counters['nfev'], counters['nsteps'], counters['nrejected'],
+						  error_estimate)
+
+
+def screen_cohort(members, segments, t_eval, threshold=1.0, states=('bl',), **solver_options):
+	'''
+	Screen a cohort with the reduced model and escalate uncertain members to the full model
+
+	Every member is integrated with the quasi-steady-state reduction first;
+	members whose estimated error on the given states exceeds threshold
+	anywhere (or whose reduced run failed) are integrated again, together,
+	with the full model.
+
+	Parameters
+	----------
+	members : DuctEnsemble or list of dict/DuctParams
+		The cohort
+	segments, t_eval : list or StimulusProtocol, array
+		As in solve_ensemble
+	threshold : float
+		Largest accepted estimated error (mM)
+	states : tuple of str
+		States the threshold applies to (luminal HCO3- by default, which also
+		bounds the error of luminal Cl- = 160 - bl)
+	**solver_options
+		Passed to both solve_ensemble calls
+
+	Returns
+	-------
+	EnsembleResult
+		Reduced trajectories and error estimates for the screened members,
+		full-model trajectories (and zero estimates) for the escalated ones,
+		with result.escalated marking the latter
+	'''
+	if not isinstance(members, DuctEnsemble):
+		members = DuctEnsemble(members)
+	result = solve_ensemble(members, segments, t_eval, reduced=True, **solver_options)
+	escalated = ~(result.error_bound(states) <= threshold)
+	result.escalated = escalated
+	if not np.any(escalated):
+		return result
+	chosen = np.flatnonzero(escalated)
+	if not isinstance(segments, StimulusProtocol):
+		# Per-member conductance levels follow their members
+		segments = [(t_start, t_end, gcftr[chosen] if np.ndim(gcftr) else gcftr) for t_start, t_end, gcftr in segments]
+	full = solve_ensemble([members.params[i] for i in chosen], segments, t_eval, **solver_options)
+	result.y[:, chosen] = full.y
+	result.status[chosen] = full.status
+	result.error_estimate[:, chosen] = 0
+	for key in ('nfev', 'nsteps', 'nrejected'):
+		getattr(result, key)[chosen] += getattr(full, key)
+	return result
+
+
+def fallback_options(solver_options):
+	'''
+	The solve_ensemble settings that also apply to retry_failed_members
+
+	Parameters
+	----------
+	solver_options : dict
+		Settings of a solve_ensemble call
+
+	Returns
+	-------
+	dict
+		Its tolerances and time limit (RETRY_OPTIONS), so re-run members are
+		held to what the caller asked of the batch
+	'''
+	return {key: solver_options[key] for key in RETRY_OPTIONS if solver_options.get(key) is not None}
+
+
+def retry_failed_members(result, ensemble, protocol, **fallback_options):
+	'''
+	Re-run the failed members of an ensemble result one by one with solver fallbacks
+
+	Parameters
+	----------
+	result : EnsembleResult
+		Output of solve_ensemble for ensemble and protocol; updated in place
+	ensemble : DuctEnsemble or list of dict/DuctParams
+		The members result was computed for
+	protocol : StimulusProtocol
+		The schedule result was computed for
+	**fallback_options
+		Passed to duct_model_protocol.integrate_with_fallbacks (method, fallbacks,
+		max_nfev, time_limit per member, rtol, ...)
+
+	Returns
+	-------
+	EnsembleResult
+		result, with the trajectories and status of recovered members
+		replaced, their evaluations added to nfev and result.attempts holding
+		the attempt records of every re-run member
+	'''
+	if not isinstance(ensemble, DuctEnsemble):
+		ensemble = DuctEnsemble(ensemble)
+	result.attempts = {} if result.attempts is None else result.attempts
+	for i in np.flatnonzero(result.status != 0):
+		params = ensemble.params[i]
+		state = integrate_with_fallbacks(params, protocol, **fallback_options)
+		result.attempts[int(i)] = state.attempts
+		result.status[i] = state.status
+		result.nfev[i] += state.nfev
+		if state.success:
+			# Like solve_ensemble, the dense output reports a breakpoint with the state before the switch
+			result.y[:, i] = state.sol(result.t)
+	return result
+
+
+def run_ensemble_CFTR(input_dicts, t_on, t_off, t_end, n_points=500, **solver_options):
+	'''
+	Ensemble counterpart of bokeh_plotting.run_model_CFTR
+
+	Runs the resting / CFTR open / recovery protocol for every parameter set
+	in a single batched integration.
+
+	Parameters
+	----------
+	input_dicts : list of dict
+		Model parameter dictionaries (e.g. [init_cond, patient_dict])
+	t_on, t_off, t_end : float
+		Time CFTR opens, closes and the simulation ends
+	n_points : int
+		Output samples per phase (matches the 500 samples drawn for Bokeh)
+	**solver_options
+		Passed to solve_ensemble (time_limit bounds the batched run; members
+		it fails are re-run with retry_failed_members)
+
+	Returns
+	-------
+	list
+		One [graphing_dict, times, graphing_strings] entry per input, shaped like run_model_CFTR's output
+
+	Raises
+	------
+	SimulationError
+		If members still fail on every fallback; error.results holds the
+		list above with NaN traces for them and error.failed their positions
+	'''
+	times = {'t_on': t_on, 't_off': t_off, 't_end': t_end}
+	protocol = StimulusProtocol.secretin_pulse(t_on, t_off, t_end)
+	time_grid = protocol.sample_grid(n_points)
+	ensemble = DuctEnsemble(input_dicts)
+	results = []
+	# Neighbouring phase grids share their boundary time; sample each time once
+	t_unique = np.unique(time_grid)
+	solution = solve_ensemble(ensemble, protocol, t_unique, **solver_options)
+	if not solution.success:
+		# The retries of each failed member get the tolerances and allowance of the batch
+		retry_failed_members(solution, ensemble, protocol, **fallback_options(solver_options))
+	positions = np.searchsorted(t_unique, time_grid)
+	graphing_strings = ['bi', 'bl', 'ci', 'ni', 'time']
+	for i in range(len(ensemble)):
+		graphing_dict = dict()
+		for j, item in enumerate(STATE_NAMES[:4]):
+			graphing_dict[item] = solution.y[j, i, positions]
+		graphing_dict['time'] = time_grid.copy()
+		results.append([graphing_dict, times, list(graphing_strings)])
+	failed = np.flatnonzero(solution.status != 0)
+	if failed.size:
+		attempts = [solution.attempts[i] for i in failed]
+		message = '\n'.join('Simulation failed for input %d: %s' % (i, describe_attempts(a)) for i, a in zip(failed, attempts))
+		raise SimulationError(message, failed, attempts, results)
+	return results
@@ -0,0 +1,570 @@
+# duct_model_generated.py
+
+'''
+Generated by duct_model_symbolic.py from the symbolic duct model -- do not edit.
+
+Functions take (t, y, p) with y ordered as STATE_NAMES and p as PARAM_NAMES
+(DuctParams.values). Both also accept (5, N) states with (P, N) parameters
+and then return (5, N) derivatives, (5, 5, N) Jacobians and (5, P, N)
+parameter Jacobians.
+'''
+
+import numpy as np
+
+from duct_model_kernels import safe_log, eff_perm, eff_perm_dxi, eff_perm_dxo
+
+STATE_NAMES = ('bi', 'bl', 'ci', 'ni', 'gcftr')
+PARAM_NAMES = ('g_bi', 'g_cl', 'zeta', 'kbi', 'kcl', 'gnbc', 'gapl', 'gapbl', 'nb', 'bb', 'cb', 'bi0', 'buf', 'chi', 'gcftron', 'gcftrbase', 'ek', 'gk', 'cap', 'gnak', 'np0', 'epump', 'ionstr', 'gnaleak', 'jac', 'rat', 'vr', 'apb_status', 'ap_status', 'variant_adj', 'smoke_adj', 'alcohol_adj')
+RT_F = 0.026713977302171326
+
+JAC_SPARSITY = np.array([[1, 1, 1, 1, 1], [1, 1, 1, 1, 1], [1, 1, 1, 1, 1], [1, 1, 1, 1, 1], [0, 0, 0, 0, 0]])
+
+
+def rhs(t, y, p):
+	'''Right-hand side of the duct model'''
+	bi = y[0]
+	bl = y[1]
+	ci = y[2]
+	ni = y[3]
+	gcftr = y[4]
+	g_bi = p[0]
+	g_cl = p[1]
+	zeta = p[2]
+	kbi = p[3]
+	kcl = p[4]
+	gnbc = p[5]
+	gapl = p[6]
+	gapbl = p[7]
+	nb = p[8]
+	bb = p[9]
+	cb = p[10]
+	bi0 = p[11]
+	buf = p[12]
+	chi = p[13]
+	ek = p[16]
+	gk = p[17]
+	gnak = p[19]
+	np0 = p[20]
+	epump = p[21]
+	ionstr = p[22]
+	gnaleak = p[23]
+	jac = p[24]
+	rat = p[25]
+	vr = p[26]
+	apb_status = p[27]
+	ap_status = p[28]
+	variant_adj = p[29]
+	smoke_adj = p[30]
+	alcohol_adj = p[31]
+	out = np.zeros((5,) + np.broadcast_shapes(np.shape(y[0]), np.shape(p[0])))
+	x0 = kbi**(-1.0)
+	x1 = kcl**(-1.0)
+	x2 = bb*x0 + cb*x1
+	x3 = bi*x0 + ci*x1
+	x4 = x3 + 1
+	x5 = x0*x1
+	x6 = apb_status*gapbl*x5*(bb*ci - bi*cb)/(x2*x4 + x3*(x2 + 1))
+	x7 = bl*x0
+	x8 = bl - 160
+	x9 = -x1*x8 + x7
+	x10 = -x8
+	x11 = bi*x10 - bl*ci
+	x12 = ap_status*gapl*x5
+	x13 = x11*x12/(x3*(x9 + 1) + x4*x9)
+	x14 = RT_F*safe_log(bi/bl)
+	x15 = g_bi*gcftr*eff_perm(bi, bl)
+	x16 = g_cl*gcftr*eff_perm(ci, x10)
+	x17 = RT_F*safe_log(nb/ni)
+	x18 = RT_F*safe_log(bi**2*ni/(bb**2*nb))
+	x19 = RT_F*safe_log(ci/x10)
+	x20 = -(ek*gk + gnaleak*x17 + gnbc*x18 + x14*x15 + x16*x19)/(gk + gnbc + x15 + x16)
+	x21 = x14 + x20
+	x22 = smoke_adj*x15
+	x23 = x18 + x20
+	x24 = jac*rat
+	x25 = vr**(-1.0)
+	x26 = x1*x10 + x7
+	x27 = -x11*x12/(x26*x4 + x3*(x26 + 1))
+	x28 = x25*(-x21*x22 + x27)
+	x29 = x19 + x20
+	x30 = alcohol_adj*variant_adj*x16
+	out[0] = -chi*zeta*(buf*(bi - bi0) + 2*gnbc*x23 + x13 + x21*x22 - x6)
+	out[1] = -zeta*(bl*(jac + x24 - x25*(-x27 - x29*x30) - x28)/ionstr - x24 + x28)
+	out[2] = -zeta*(-x13 + x29*x30 + x6)
+	out[3] = -zeta*(-gnak*ni**3*(epump + x20)/np0**3 - gnaleak*(x17 + x20) + gnbc*x23)
+	return out
+
+
+def jacobian(t, y, p):
+	'''Exact Jacobian d(rhs)/dy'''
+	bi = y[0]
+	bl = y[1]
+	ci = y[2]
+	ni = y[3]
+	gcftr = y[4]
+	g_bi = p[0]
+	g_cl = p[1]
+	zeta = p[2]
+	kbi = p[3]
+	kcl = p[4]
+	gnbc = p[5]
+	gapl = p[6]
+	gapbl = p[7]
+	nb = p[8]
+	bb = p[9]
+	cb = p[10]
+	buf = p[12]
+	chi = p[13]
+	ek = p[16]
+	gk = p[17]
+	gnak = p[19]
+	np0 = p[20]
+	epump = p[21]
+	ionstr = p[22]
+	gnaleak = p[23]
+	jac = p[24]
+	rat = p[25]
+	vr = p[26]
+	apb_status = p[27]
+	ap_status = p[28]
+	variant_adj = p[29]
+	smoke_adj = p[30]
+	alcohol_adj = p[31]
+	out = np.zeros((5, 5) + np.broadcast_shapes(np.shape(y[0]), np.shape(p[0])))
+	x0 = kbi**(-1.0)
+	x1 = kcl**(-1.0)
+	x2 = cb*x1
+	x3 = bb*x0
+	x4 = x2 + x3
+	x5 = bi*x0
+	x6 = ci*x1
+	x7 = x5 + x6
+	x8 = x7 + 1
+	x9 = x4*x8 + x7*(x4 + 1)
+	x10 = x9**(-1.0)
+	x11 = apb_status*gapbl
+	x12 = x10*x11
+	x13 = x0*x12*x2
+	x14 = bl - 160
+	x15 = x1*x14
+	x16 = bl*x0
+	x17 = -x15 + x16
+	x18 = x17*x8 + x7*(x17 + 1)
+	x19 = x18**(-1.0)
+	x20 = ap_status*gapl
+	x21 = x19*x20
+	x22 = x0*x21
+	x23 = x15*x22
+	x24 = kbi**(-2.0)
+	x25 = x1*x24
+	x26 = x11*(bb*ci - bi*cb)*(2*x2 + 2*x3 + 1)/x9**2
+	x27 = x25*x26
+	x28 = -x14
+	x29 = x1*x28
+	x30 = 2*x16 + 1
+	x31 = 2*x29 + x30
+	x32 = bl*ci
+	x33 = bi*x28 - x32
+	x34 = x18**(-2.0)
+	x35 = x20*x34
+	x36 = x31*x33*x35
+	x37 = x25*x36
+	x38 = bl**(-1.0)
+	x39 = safe_log(bi*x38)
+	x40 = RT_F*x39
+	x41 = eff_perm(bi, bl)
+	x42 = g_bi*x41
+	x43 = gcftr*x42
+	x44 = eff_perm(ci, x28)
+	x45 = g_cl*x44
+	x46 = gcftr*x45
+	x47 = gk + gnbc + x43 + x46
+	x48 = x47**(-1.0)
+	x49 = x28**(-1.0)
+	x50 = safe_log(ci*x49)
+	x51 = RT_F*x50
+	x52 = ni**(-1.0)
+	x53 = RT_F*gnaleak*safe_log(nb*x52) + RT_F*gnbc*safe_log(bi**2*ni/(bb**2*nb)) + ek*gk + x40*x43
+	x54 = x46*x51 + x53
+	x55 = x48*x54
+	x56 = -x55
+	x57 = x40 + x56
+	x58 = eff_perm_dxi(bi, bl)
+	x59 = g_bi*gcftr*x58
+	x60 = smoke_adj*x59
+	x61 = bi**(-1.0)
+	x62 = RT_F*x61
+	x63 = 2*gnbc
+	x64 = RT_F*(x39*x59 + x43*x61 + x61*x63)
+	x65 = x47**(-2.0)
+	x66 = -x48*x64 + x54*x59*x65
+	x67 = 2*x62 + x66
+	x68 = x62 + x66
+	x69 = smoke_adj*x43
+	x70 = chi*zeta
+	x71 = bi + ci
+	x72 = x1*x71
+	x73 = -x0 + x1
+	x74 = x35*(bi*x14 + x32)
+	x75 = 2*x5 + 2*x6 + 1
+	x76 = x0*x75
+	x77 = x14**(-1.0)
+	x78 = safe_log(-ci*x77)
+	x79 = RT_F*x78
+	x80 = x46*x79 + x53
+	x81 = -x48*x80
+	x82 = x40 + x81
+	x83 = eff_perm_dxo(bi, bl)
+	x84 = g_bi*x83
+	x85 = gcftr*smoke_adj*x84
+	x86 = x38*x42
+	x87 = g_cl*eff_perm_dxo(ci, x28)
+	x88 = -g_bi*x39*x83 + x45*x77 + x78*x87 + x86
+	x89 = -RT_F*x88
+	x90 = x84 - x87
+	x91 = -x48*x80*x90 + x89
+	x92 = gcftr*x48
+	x93 = x63*x92
+	x94 = RT_F*x92
+	x95 = gcftr*x65
+	x96 = x80*x90*x95
+	x97 = x0/kcl**2
+	x98 = x26*x97
+	x99 = ci**(-1.0)
+	x100 = x44*x99
+	x101 = eff_perm_dxi(ci, x28)
+	x102 = g_cl*(-RT_F*(x100 + x101*x78) + x101*x48*x80)
+	x103 = smoke_adj*x42
+	x104 = gcftr**2*x103*x48
+	x105 = gnaleak - gnbc
+	x106 = -x105
+	x107 = -x106*x48 + 1
+	x108 = x105*x48
+	x109 = RT_F*x52
+	x110 = x39*x42
+	x111 = x42 + x45
+	x112 = RT_F*(x110 + x45*x78) - x111*x48*x80
+	x113 = -x112
+	x114 = x113*x48
+	x115 = x16 + x29
+	x116 = x115*x8 + x7*(x115 + 1)
+	x117 = x20/x116
+	x118 = x0*x117
+	x119 = x118*x15
+	x120 = -x33
+	x121 = x1*x120
+	x122 = x116**(-2.0)
+	x123 = x122*x20*x31
+	x124 = x121*x123*x24
+	x125 = -x57
+	x126 = x125*x60
+	x127 = -x68*x69
+	x128 = x48*(g_bi*gcftr*x48*x54*x58 - x64)
+	x129 = alcohol_adj*variant_adj
+	x130 = x129*x46
+	x131 = x128*x130 + x23 + x37
+	x132 = ionstr**(-1.0)
+	x133 = bl*x132
+	x134 = vr**(-1.0)
+	x135 = x134*zeta
+	x136 = x118*x121
+	x137 = x51 + x56
+	x138 = -x137
+	x139 = -x73
+	x140 = x54*x95
+	x141 = x118*x72 - x121*x122*x139*x20*x76 + x125*x85 + x69*(RT_F*x38 - x140*x90 + x94*(x39*x84 + x45*x49 - x50*x87 - x86))
+	x142 = gcftr*x129
+	x143 = x137*x142
+	x144 = -ap_status*gapl*x0*x1*x139*x33*x34*x75 - ap_status*gapl*x0*x1*x19*x71 + x130*(RT_F*x77 + x89*x92 - x96) + x143*x87
+	x145 = x1*x16
+	x146 = x100 + x101*x50
+	x147 = RT_F*x146 - x101*x55
+	x148 = g_cl*x104*x147
+	x149 = g_cl*x101
+	x150 = -RT_F*g_cl*gcftr*x146*x48 + RT_F*x99 + x140*x149
+	x151 = x129*x45
+	x152 = x55 + x92*(RT_F*(x110 + x45*x50) - x111*x55)
+	x153 = x152 - x40
+	x154 = gnak/np0**3
+	x155 = ni**3*x154
+	x156 = x105 + x155
+	x157 = x156*zeta
+	x158 = ni**2*x154
+	out[0, 0] = -x70*(buf + 2*gnbc*x67 + x13 - x23 + x27 - x37 + x57*x60 + x68*x69)
+	out[0, 1] = x70*(x1*x73*x74*x76 + x22*x72 + x69*(RT_F*x38 - x88*x94 - x96) - x82*x85 + x91*x93)
+	out[0, 2] = x70*(ap_status*bl*gapl*x0*x1*x19 + apb_status*bb*gapbl*x0*x1*x10 - x102*x104 - x102*x93 - x74*x97*(-2*x15 + x30) - x98)
+	out[0, 3] = -x109*x70*(x107*x63 + x108*x69)
+	out[0, 4] = -x70*(x103*x82 + x114*x63 + x114*x69)
+	out[1, 0] = -x135*(x119 - x124 + x126 + x127 + x133*(-x119 + x124 - x126 - x127 + x131))
+	out[1, 1] = -zeta*(x132*(jac*rat + jac - x134*(x125*x69 + x136) - x134*(x130*x138 - x136)) + x133*x134*(-x141 - x144) + x134*x141)
+	out[1, 2] = -x135*(x117*x145 - x120*x123*x97 - x133*(-x130*x150 + x138*x142*x149 + x148) + x148)
+	out[1, 3] = x135*x52*x94*(x103*x105 + x106*x133*(x103 + x151))
+	out[1, 4] = -x135*(g_bi*smoke_adj*x153*x41 - x133*(x103*x153 + x151*(x152 - x51)))
+	out[2, 0] = -zeta*(-x13 + x131 - x27)
+	out[2, 1] = x144*zeta
+	out[2, 2] = -zeta*(x1*x12*x3 + x130*x150 + x143*x149 + x145*x21 + x36*x97 - x98)
+	out[2, 3] = -x108*x109*x130*zeta
+	out[2, 4] = -x151*zeta*(x113*x92 + x79 + x81)
+	out[3, 0] = -zeta*(-gnaleak*x128 + gnbc*x67 - x128*x155)
+	out[3, 1] = -x157*x91*x92
+	out[3, 2] = -g_cl*x147*x156*x92*zeta
+	out[3, 3] = -zeta*(RT_F*gnaleak*x52*(1 - x108) + RT_F*gnbc*x107*x52 - RT_F*x108*x158 - 3*x158*(epump + x56))
+	out[3, 4] = -x112*x157*x48
+	return out
+
+
+def param_jacobian(t, y, p):
+	'''Exact parameter Jacobian d(rhs)/dp'''
+	bi = y[0]
+	bl = y[1]
+	ci = y[2]
+	ni = y[3]
+	gcftr = y[4]
+	g_bi = p[0]
+	g_cl = p[1]
+	zeta = p[2]
+	kbi = p[3]
+	kcl = p[4]
+	gnbc = p[5]
+	gapl = p[6]
+	gapbl = p[7]
+	nb = p[8]
+	bb = p[9]
+	cb = p[10]
+	bi0 = p[11]
+	buf = p[12]
+	chi = p[13]
+	ek = p[16]
+	gk = p[17]
+	gnak = p[19]
+	np0 = p[20]
+	epump = p[21]
+	ionstr = p[22]
+	gnaleak = p[23]
+	jac = p[24]
+	rat = p[25]
+	vr = p[26]
+	apb_status = p[27]
+	ap_status = p[28]
+	variant_adj = p[29]
+	smoke_adj = p[30]
+	alcohol_adj = p[31]
+	out = np.zeros((5, 32) + np.broadcast_shapes(np.shape(y[0]), np.shape(p[0])))
+	x0 = eff_perm(bi, bl)
+	x1 = g_bi*x0
+	x2 = gcftr*x1
+	x3 = bl - 160
+	x4 = -x3
+	x5 = eff_perm(ci, x4)
+	x6 = g_cl*x5
+	x7 = gcftr*x6
+	x8 = (gk + gnbc + x2 + x7)**(-1.0)
+	x9 = 2*gnbc
+	x10 = x8*x9
+	x11 = smoke_adj*x2
+	x12 = x11*x8
+	x13 = gcftr*x0
+	x14 = RT_F*safe_log(bi/bl)
+	x15 = RT_F*safe_log(-ci/x3)
+	x16 = RT_F*safe_log(nb/ni)
+	x17 = nb**(-1.0)
+	x18 = RT_F*safe_log(bi**2*ni*x17/bb**2)
+	x19 = ek*gk + gnaleak*x16 + gnbc*x18 + x14*x2
+	x20 = x8*(x15*x7 + x19)
+	x21 = -x20
+	x22 = x14 + x21
+	x23 = chi*zeta
+	x24 = x22*x23
+	x25 = x23*(x11 + x9)
+	x26 = x25*x8
+	x27 = x15 + x21
+	x28 = gcftr*x5
+	x29 = x27*x28
+	x30 = bi - bi0
+	x31 = RT_F*safe_log(ci/x4)
+	x32 = x8*(x19 + x31*x7)
+	x33 = -x32
+	x34 = x18 + x33
+	x35 = kbi**(-1.0)
+	x36 = kcl**(-1.0)
+	x37 = bb*x35 + cb*x36
+	x38 = bi*x35
+	x39 = ci*x36
+	x40 = x38 + x39
+	x41 = x40 + 1
+	x42 = x37 + 1
+	x43 = x37*x41 + x40*x42
+	x44 = x43**(-1.0)
+	x45 = bb*ci - bi*cb
+	x46 = x44*x45
+	x47 = apb_status*gapbl
+	x48 = x35*x36
+	x49 = x46*x47*x48
+	x50 = bl*ci
+	x51 = bi*x4 - x50
+	x52 = ap_status*gapl
+	x53 = bl*x35
+	x54 = -x3*x36 + x53
+	x55 = x54 + 1
+	x56 = x40*x55 + x41*x54
+	x57 = x56**(-1.0)
+	x58 = x35*x57
+	x59 = x36*x58
+	x60 = x14 + x33
+	x61 = x11*x60 + x51*x52*x59
+	x62 = buf*x30 + x34*x9 - x49 + x61
+	x63 = x35*x47
+	x64 = x45/x43**2
+	x65 = x56**(-2.0)
+	x66 = bl*x40 + bl*x41
+	x67 = bi*x54 + bi*x55 + x66
+	x68 = -apb_status*gapbl*x44*x45 + x51*x52*x57
+	x69 = -ap_status*gapl*x35*x51*x65*x67 + x63*x64*(bb*x40 + bb*x41 + bi*x37 + bi*x42) + x68
+	x70 = x36/kbi**2
+	x71 = x47*x64
+	x72 = ci*x54 + ci*x55 - x3*x40 - x3*x41
+	x73 = -ap_status*gapl*x36*x51*x65*x72 + x36*x71*(cb*x40 + cb*x41 + ci*x37 + ci*x42) + x68
+	x74 = x35/kcl**2
+	x75 = x18 + x21
+	x76 = x59*(bi*x3 + x50)
+	x77 = x23*x76
+	x78 = x36*x46
+	x79 = x35*x78
+	x80 = x23*x79
+	x81 = gnaleak - gnbc
+	x82 = x8*x81
+	x83 = x82 + 1
+	x84 = RT_F*x17
+	x85 = gnbc*x8
+	x86 = RT_F/bb
+	x87 = x10*x86
+	x88 = x39*x44*x63
+	x89 = 2*x38 + 2*x39 + 1
+	x90 = x70*x71*x89
+	x91 = x44*x47*x48*(bi + x78*x89)
+	x92 = gk*x8
+	x93 = ek + x21
+	x94 = x8*x93
+	x95 = x2*x60
+	x96 = -x14 + x32 + x8*x95
+	x97 = alcohol_adj*variant_adj
+	x98 = x7*x8
+	x99 = x97*x98
+	x100 = bl/ionstr
+	x101 = vr**(-1.0)
+	x102 = x101*zeta
+	x103 = x31 + x33
+	x104 = gcftr*x102
+	x105 = -x51
+	x106 = x36*x4 + x53
+	x107 = x106 + 1
+	x108 = (x106*x41 + x107*x40)**(-1.0)
+	x109 = x105*x108*x35*x36*x52
+	x110 = -x11*x60
+	x111 = x109 + x110
+	x112 = x101*x111
+	x113 = x7*x97
+	x114 = -x103*x113
+	x115 = jac*rat + jac
+	x116 = x105*x108
+	x117 = x116*(x108*x35*(bi*x106 + bi*x107 + x66) - 1)
+	x118 = x70*zeta
+	x119 = x101*x52
+	x120 = x116*(x108*x36*(ci*x106 + ci*x107 + x4*x40 + x4*x41) - 1)
+	x121 = x74*zeta
+	x122 = x6*x97
+	x123 = x100*(smoke_adj*x1 + x122)
+	x124 = x104*x8
+	x125 = x102*x76
+	x126 = g_bi*smoke_adj*x0 - x123
+	x127 = x84*zeta
+	x128 = x127*x82
+	x129 = x104*x126
+	x130 = -ap_status*gapl*x35*x36*x51*x57 + x103*x113
+	x131 = zeta*(x100 - 1)
+	x132 = x100*x102*x27*x7
+	x133 = x27*zeta
+	x134 = x99*zeta
+	x135 = x76*zeta
+	x136 = x79*zeta
+	x137 = x133*x7
+	x138 = np0**(-3.0)
+	x139 = ni**3
+	x140 = x138*x139
+	x141 = gnak*x140
+	x142 = zeta*(x141 + x81)
+	x143 = x142*x8
+	x144 = gnaleak*x8
+	x145 = x141*x8
+	x146 = zeta*(epump + x21)
+	out[0, 0] = x13*x24*(-smoke_adj + x10 + x12)
+	out[0, 1] = x26*x29
+	out[0, 2] = -chi*x62
+	out[0, 3] = x23*x69*x70
+	out[0, 4] = x23*x73*x74
+	out[0, 5] = x23*(x10*x75 + x12*x75 - 2*x18 + 2*x20)
+	out[0, 6] = ap_status*x77
+	out[0, 7] = apb_status*x80
+	out[0, 8] = x23*x84*(x11*x82 + x83*x9)
+	out[0, 9] = -x23*(4*gnbc*x86*(x85 - 1) + x11*x87 - x88 + x90)
+	out[0, 10] = -x23*x91
+	out[0, 11] = buf*x23
+	out[0, 12] = -x23*x30
+	out[0, 13] = -x62*zeta
+	out[0, 16] = x25*x92
+	out[0, 17] = x25*x94
+	out[0, 23] = x16*x26
+	out[0, 27] = gapbl*x80
+	out[0, 28] = gapl*x77
+	out[0, 30] = -x2*x24
+	out[1, 0] = -x102*x13*(smoke_adj*x96 - x100*(smoke_adj*x96 + x60*x99))
+	out[1, 1] = -x104*x5*(g_bi*gcftr*smoke_adj*x0*x27*x8 - x100*(x103*x12 + x97*(x103*x98 - x31 + x32)))
+	out[1, 2] = jac*rat - x100*(-x101*(-x109 + x114) - x112 + x115) - x112
+	out[1, 3] = -x118*x119*(x100*(-x117 + x51*x57*(-x58*x67 + 1)) + x117)
+	out[1, 4] = -x119*x121*(x100*(-x120 + x51*x57*(-x36*x57*x72 + 1)) + x120)
+	out[1, 5] = -x124*(g_bi*smoke_adj*x0*x75 - x123*x34)
+	out[1, 6] = -ap_status*x125
+	out[1, 8] = -gcftr*x101*x126*x128
+	out[1, 9] = x129*x87
+	out[1, 16] = -x129*x92
+	out[1, 17] = -x124*(g_bi*smoke_adj*x0*x93 - x123*(ek + x33))
+	out[1, 22] = bl*zeta*(x101*x130 + x101*x61 + x115)/ionstr**2
+	out[1, 23] = -x124*x126*x16
+	out[1, 24] = -zeta*(-rat + x100*(rat + 1))
+	out[1, 25] = -jac*x131
+	out[1, 26] = zeta*(x100*(-x110 - x114) + x111)/vr**2
+	out[1, 28] = -gapl*x125
+	out[1, 29] = -alcohol_adj*x132
+	out[1, 30] = -x101*x131*x95
+	out[1, 31] = -variant_adj*x132
+	out[2, 0] = gcftr**2*x0*x122*x22*x8*zeta
+	out[2, 1] = x133*x28*x97*(x98 - 1)
+	out[2, 2] = -x130 - x49
+	out[2, 3] = -x118*x69
+	out[2, 4] = -x121*x73
+	out[2, 5] = x134*x75
+	out[2, 6] = -ap_status*x135
+	out[2, 7] = -apb_status*x136
+	out[2, 8] = x113*x128
+	out[2, 9] = -zeta*(x113*x87 + x88 - x90)
+	out[2, 10] = x91*zeta
+	out[2, 16] = gk*x134
+	out[2, 17] = x134*x93
+	out[2, 23] = x134*x16
+	out[2, 27] = -gapbl*x136
+	out[2, 28] = -gapl*x135
+	out[2, 29] = -alcohol_adj*x137
+	out[2, 31] = -variant_adj*x137
+	out[3, 0] = -x13*x143*x22
+	out[3, 1] = -x143*x29
+	out[3, 2] = gnaleak*(x16 + x33) - gnbc*x34 + x141*(epump + x33)
+	out[3, 5] = -zeta*(x144*x75 + x145*x75 - x75*x85 + x75)
+	out[3, 8] = -x127*(gnak*x138*x139*x8*x81 - gnaleak*(1 - x82) - gnbc*x83)
+	out[3, 9] = x86*x9*zeta*(x144 + x145 - x85 + 1)
+	out[3, 16] = -x142*x92
+	out[3, 17] = -x142*x94
+	out[3, 19] = x140*x146
+	out[3, 20] = -3*gnak*x139*x146/np0**4
+	out[3, 21] = x141*zeta
+	out[3, 23] = -zeta*(x144*x16 + x145*x16 - x16*x85 - x16 + x20)
+	return out
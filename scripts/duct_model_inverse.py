@@ -0,0 +1,217 @@
+# duct_model_inverse.py
+
+'''
+Inverse problem: the CFTR function a patient needs to reach a target secretion.
+
+Peak luminal HCO3- rises monotonically with variant_adj (and the luminal
+Cl- plateau falls), with every other influence - smoking, alcohol,
+antiporters, geometry - held at the patient's values. The required function
+is therefore the root of
+
+	g(v) = metric(v) - target
+
+on a bracket of variant_adj. A first batched solve evaluates the metric at
+BRACKET_POINTS values spaced evenly in log(variant_adj) and takes the
+interval where g changes sign; the Illinois variant of regula falsi then
+refines it in log(variant_adj). The method keeps the root bracketed like
+bisection but converges superlinearly, and on the narrow first interval a
+query needs about four further solves.
+
+Queries are vectorized: every patient/target pair still searching is
+integrated in the same batched solve_ensemble call, so a cohort costs as
+many solves as its slowest query, not one loop per patient.
+
+Developed by Ariel Precision Medicine
+'''
+
+import numpy as np
+
+from dcw_duct_model import compile_params, DuctParams
+from duct_model_ensemble import DuctEnsemble, solve_ensemble
+from duct_model_protocol import report_metrics, StimulusProtocol
+
+# Search bracket of variant_adj (fraction of WT function; the Cutting table reaches 1.39)
+VARIANT_BOUNDS = (1e-3, 1.5)
+
+# Values of variant_adj in the first, bracketing solve (log spaced over the bounds)
+BRACKET_POINTS = 9
+
+# Output samples per protocol segment the metric is read from
+PEAK_POINTS = 500
+
+# Stop when the metric is this close to the target (mM) or the bracket this narrow (relative)
+METRIC_TOL = 0.01
+BRACKET_TOL = 1e-6
+MAX_ITERATIONS = 30
+
+# Solver settings resolving the metric well below METRIC_TOL; at the deployment profile's looser
+# tolerances step-size noise between batch compositions stalls the root-finding near the target
+INVERSE_OPTIONS = {'rtol': 1e-7, 'atol': 1e-9}
+
+# Query status codes of InverseResult.status
+REACHED = 0
+BELOW_RANGE = 1
+UNREACHABLE = -1
+FAILED = -2
+SEARCHING = 2
+
+
+class InverseResult():
+	'''
+	Output of required_cftr_function
+
+	Attributes
+	----------
+	variant_adj : np.ndarray
+		(n,) required fraction of WT CFTR function; the lower bound where the
+		target is met even there (BELOW_RANGE), NaN where it cannot be reached
+	achieved : np.ndarray
+		(n,) metric at variant_adj (mM)
+	targets : np.ndarray
+		(n,) requested metric values
+	status : np.ndarray
+		(n,) REACHED, BELOW_RANGE, UNREACHABLE (beyond the upper bound) or
+		FAILED (a forward solve failed or max_iter was reached)
+	metric : str
+		'peak_hco3' or 'plateau_cl'
+	n_solves : int
+		Batched forward solves, the bracket included
+	iterations : np.ndarray
+		(n,) root-finding iterations per query
+	'''
+	def __init__(self, variant_adj, achieved, targets, status, metric, n_solves, iterations):
+		self.variant_adj = variant_adj
+		self.achieved = achieved
+		self.targets = targets
+		self.status = status
+		self.metric = metric
+		self.n_solves = n_solves
+		self.iterations = iterations
+
+	@property
+	def percent_function(self):
+		'''(n,) required function as % of wild type, the unit of the Cutting table'''
+		return 100*self.variant_adj
+
+	@property
+	def success(self):
+		return np.all((self.status == REACHED) | (self.status == BELOW_RANGE))
+
+
+def _patients(patients, n_targets):
+	# List of DuctParams broadcast against the targets
+	if isinstance(patients, DuctEnsemble):
+		patients = patients.params
+	elif isinstance(patients, (dict, DuctParams)):
+		patients = [patients]
+	patients = [compile_params(patient) for patient in patients]
+	if len(patients) == 1:
+		patients = patients*n_targets
+	return patients
+
+
+def required_cftr_function(patients, targets, metric='peak_hco3', bounds=VARIANT_BOUNDS, protocol=None,
+						   n_points=PEAK_POINTS, metric_tol=METRIC_TOL, max_iter=MAX_ITERATIONS, **solver_options):
+	'''
+	Fraction of WT CFTR function at which each patient reaches a target
+
+	Parameters
+	----------
+	patients : dict, DuctParams, list of them or DuctEnsemble
+		Patient parameters (input dictionaries of the app); their
+		variant_adj is ignored. One patient is broadcast against all targets.
+	targets : float or array
+		Target metric (mM), one per patient or broadcast to all
+	metric : str
+		'peak_hco3' (peak luminal HCO3-) or 'plateau_cl' (luminal Cl- at t_off),
+		as in duct_model_protocol.report_metrics
+	bounds : tuple
+		(low, high) bracket of variant_adj
+	protocol : StimulusProtocol, optional
+		Piecewise-constant schedule (default: the 20000 / 120000 / 200000 secretin pulse)
+	n_points : int
+		Output samples per protocol segment the metric is read from
+	metric_tol : float
+		Convergence tolerance on the metric (mM)
+	max_iter : int
+		Root-finding iteration limit
+	**solver_options
+		Passed to solve_ensemble (default INVERSE_OPTIONS)
+
+	Returns
+	-------
+	InverseResult
+	'''
+	if metric not in ('peak_hco3', 'plateau_cl'):
+		raise ValueError('Unknown metric %r (peak_hco3 or plateau_cl)' % metric)
+	targets = np.atleast_1d(np.asarray(targets, dtype=float))
+	patients = _patients(patients, targets.size)
+	if targets.size == 1:
+		targets = np.repeat(targets, len(patients))
+	if targets.size != len(patients):
+		raise ValueError('%d targets for %d patients' % (targets.size, len(patients)))
+	protocol = protocol or StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+	options = dict(INVERSE_OPTIONS, **solver_options)
+	grid = np.unique(protocol.sample_grid(n_points))
+	n = targets.size
+	n_solves = 0
+
+	def evaluate(indices, x):
+		# g at log variant_adj x for the queries indices, NaN where the solve failed
+		nonlocal n_solves
+		n_solves += 1
+		members = [patients[i].replace(variant_adj=value) for i, value in zip(indices, np.exp(x))]
+		result = solve_ensemble(members, protocol, grid, **options)
+		values = report_metrics(result.y, grid, protocol)[metric]
+		return np.where(result.status == 0, values - targets[indices], np.nan)
+
+	# Orient every query so that g rises from the low to the high bound
+	sign = -1.0 if metric == 'plateau_cl' else 1.0
+	nodes = np.linspace(np.log(bounds[0]), np.log(bounds[1]), BRACKET_POINTS)
+	g_nodes = sign*evaluate(np.repeat(np.arange(n), nodes.size), np.tile(nodes, n)).reshape(n, nodes.size)
+	status = np.full(n, SEARCHING)
+	status[np.any(np.isnan(g_nodes), axis=1)] = FAILED
+	status[(status == SEARCHING) & (g_nodes[:, 0] >= 0)] = BELOW_RANGE
+	status[(status == SEARCHING) & (g_nodes[:, -1] < 0)] = UNREACHABLE
+	# First node at or above the target (the metric is monotone, so g changes sign once)
+	above = np.clip(np.argmax(g_nodes >= 0, axis=1), 1, nodes.size - 1)
+	rows = np.arange(n)
+	x_lo, x_hi = nodes[above - 1], nodes[above]
+	g_lo, g_hi = g_nodes[rows, above - 1], g_nodes[rows, above]
+	x = np.where(status == BELOW_RANGE, nodes[0], np.nan)
+	g = np.where(status == BELOW_RANGE, g_nodes[:, 0], np.nan)
+	# Side of the bracket replaced last (-1 low, 1 high), for the Illinois halving
+	side = np.zeros(n)
+	iterations = np.zeros(n, dtype=int)
+
+	for _ in range(max_iter):
+		active = np.flatnonzero(status == SEARCHING)
+		if active.size == 0:
+			break
+		lo, hi, f_lo, f_hi = x_lo[active], x_hi[active], g_lo[active], g_hi[active]
+		x_new = (lo*f_hi - hi*f_lo)/(f_hi - f_lo)
+		g_new = sign*evaluate(active, x_new)
+		iterations[active] += 1
+		x[active], g[active] = x_new, g_new
+
+		failed = np.isnan(g_new)
+		done = ~failed & ((np.abs(g_new) <= metric_tol) | (hi - lo <= BRACKET_TOL))
+		status[active[failed]] = FAILED
+		status[active[done]] = REACHED
+		upper = ~failed & (g_new >= 0)
+		lower = ~failed & (g_new < 0)
+		# Illinois: halve the retained end when the same end is replaced twice in a row
+		g_lo[active[upper & (side[active] == 1)]] /= 2
+		g_hi[active[lower & (side[active] == -1)]] /= 2
+		x_hi[active[upper]], g_hi[active[upper]] = x_new[upper], g_new[upper]
+		x_lo[active[lower]], g_lo[active[lower]] = x_new[lower], g_new[lower]
+		side[active[upper]] = 1
+		side[active[lower]] = -1
+
+	# Queries still searching after max_iter did not converge
+	status[status == SEARCHING] = FAILED
+	variant_adj = np.exp(x)
+	variant_adj[(status == UNREACHABLE) | (status == FAILED)] = np.nan
+	achieved = targets + sign*g
+	achieved[status == UNREACHABLE] = np.nan
+	return InverseResult(variant_adj, achieved, targets, status, metric, n_solves, iterations)
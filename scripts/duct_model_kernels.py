@@ -0,0 +1,128 @@
+# duct_model_kernels.py
+
+'''
+Numerically stable flux kernels of the duct model.
+
+eff_perm(xi, xo) = xi*xo*log(xi/xo)/(xi - xo) is 0/0 where the intracellular
+and outside concentrations cross, which happens in every stimulated run once
+luminal Cl- (160 - bl) falls through intracellular Cl-. Close to the crossing
+the closed form loses accuracy (and is NaN exactly on it), so solvers see a
+noisy right-hand side there and reject steps. Writing d = xi/xo - 1,
+
+	eff_perm = xi*L(d),  L(d) = log(1 + d)/d = 1 - d/2 + d**2/3 - ...
+
+and the series is used for |d| < EFF_PERM_SERIES. The same expansion gives
+the partial derivatives used by the generated Jacobian. Logarithm arguments
+are clipped to LOG_FLOOR, so a trial step through a negative concentration
+yields a large finite value (and is rejected by the solver's error control)
+instead of NaN and a RuntimeWarning.
+
+Every kernel takes scalars or arrays of any broadcastable shape, so the
+single-run right-hand side, the (5, N) ensemble right-hand side and the
+generated module share them. NumPy only, so duct_model_generated.py can
+import it.
+
+Developed by Ariel Precision Medicine
+'''
+
+import numpy as np
+
+# Smallest argument passed to a logarithm
+LOG_FLOOR = np.finfo(float).tiny
+
+# |xi/xo - 1| below which eff_perm and its partials use their series
+EFF_PERM_SERIES = 1e-2
+
+# Taylor coefficients (lowest order first) of L(d) = log(1 + d)/d and of L'(d),
+# truncated where the remainder is below double precision for |d| < EFF_PERM_SERIES
+L_SERIES = tuple((-1)**k/(k + 1) for k in range(9))
+DL_SERIES = tuple((-1)**k*k/(k + 1) for k in range(1, 10))
+
+
+def _polynomial(coefficients, x):
+	# Horner evaluation for scalars and arrays
+	total = coefficients[-1]
+	for coefficient in coefficients[-2::-1]:
+		total = total*x + coefficient
+	return total
+
+
+def safe_log(x):
+	'''
+	Natural logarithm with the argument clipped to LOG_FLOOR
+
+	Identical to np.log for positive arguments; NaN stays NaN.
+	'''
+	if isinstance(x, np.ndarray):
+		return np.log(np.maximum(x, LOG_FLOOR))
+	return np.log(LOG_FLOOR if x < LOG_FLOOR else x)
+
+
+def eff_perm(xi, xo):
+	'''
+	Effective permeability xi*xo*log(xi/xo)/(xi - xo), finite where xi = xo
+
+	Parameters
+	----------
+	xi, xo : float or np.ndarray
+		Concentrations inside and outside the membrane (broadcast together)
+
+	Returns
+	-------
+	float or np.ndarray
+		Identical to the closed form away from the crossing; its limit xi on it
+	'''
+	ratio = xi/xo
+	d = ratio - 1
+	if not isinstance(ratio, np.ndarray):
+		if -EFF_PERM_SERIES < d < EFF_PERM_SERIES:
+			return xi*_polynomial(L_SERIES, d)
+		return xi*xo*safe_log(ratio)/(xi - xo)
+	near = np.abs(d) < EFF_PERM_SERIES
+	if not near.any():
+		return xi*xo*safe_log(ratio)/(xi - xo)
+	# Series where the concentrations are close (the closed form's denominator is replaced there)
+	xi = np.broadcast_to(xi, near.shape)
+	closed = xi*xo*safe_log(ratio)/np.where(near, 1.0, xi - xo)
+	return np.where(near, xi*_polynomial(L_SERIES, d), closed)
+
+
+def eff_perm_partials(xi, xo):
+	'''
+	Partial derivatives of eff_perm with respect to xi and xo
+
+	With ratio = xi/xo: d/dxi = L + ratio*L'(d) and d/dxo = -ratio**2*L'(d).
+
+	Returns
+	-------
+	tuple
+		(d eff_perm/d xi, d eff_perm/d xo), shaped like the broadcast inputs
+	'''
+	ratio = xi/xo
+	d = ratio - 1
+	if not isinstance(ratio, np.ndarray):
+		if -EFF_PERM_SERIES < d < EFF_PERM_SERIES:
+			series, slope = _polynomial(L_SERIES, d), _polynomial(DL_SERIES, d)
+		else:
+			log_ratio = safe_log(ratio)
+			series, slope = log_ratio/d, (d/ratio - log_ratio)/d**2
+	else:
+		near = np.abs(d) < EFF_PERM_SERIES
+		log_ratio = safe_log(ratio)
+		if near.any():
+			safe_d = np.where(near, 1.0, d)
+			series = np.where(near, _polynomial(L_SERIES, d), log_ratio/safe_d)
+			slope = np.where(near, _polynomial(DL_SERIES, d), (d/ratio - log_ratio)/safe_d**2)
+		else:
+			series, slope = log_ratio/d, (d/ratio - log_ratio)/d**2
+	return series + ratio*slope, -ratio**2*slope
+
+
+def eff_perm_dxi(xi, xo):
+	'''d eff_perm/d xi (see eff_perm_partials)'''
+	return eff_perm_partials(xi, xo)[0]
+
+
+def eff_perm_dxo(xi, xo):
+	'''d eff_perm/d xo (see eff_perm_partials)'''
+	return eff_perm_partials(xi, xo)[1]
@@ -0,0 +1,191 @@
+# duct_model_log_form.py
+
+'''
+Positivity-preserving (log-concentration) coordinates of the duct model.
+
+bi, ci and ni are integrated as u = log(y), and bl as the logit
+u = log(bl/(160 - bl)), so both luminal HCO3- and luminal Cl- (160 - bl)
+stay inside (0, 160) for any finite u. gcftr is left as it is. With
+s_i = dy_i/du_i (y for the logarithms, bl*(160 - bl)/160 for the logit, 1
+for gcftr) the transformed system is
+
+	du_i/dt = f_i(y)/s_i
+	d(du_i/dt)/du_j = J_ij*s_j/s_i - delta_ij*s_i'(y_i)*f_i/s_i
+
+so a solver overshoot changes u by a finite amount instead of sending a
+concentration through zero into the model's logarithms. An absolute error
+on u is a relative error on the concentration, so runners hand the solver
+log_tolerances(rtol, atol): the requested rtol as the absolute tolerance
+on u. (A relative tolerance on u would let the allowed error grow with |u|,
+and a loose one lets a run drift off to the clipping bounds.)
+
+What the form buys is runs that stay alive and fixed meshes that are more
+accurate, not cheaper loose adaptive solves. On the 20000 / 120000 / 200000
+secretin pulse, against tight references, over the nine reference cases of
+duct_model_autotune:
+
+	default rodas3 mesh (903 evaluations either way)   worst error 0.015 -> 0.0007 mM
+	10-step rodas3 mesh                                2 of 9 members fail -> none
+	DP5 at rtol 0.1                                    2 of 9 members fail -> none
+	RK45 at rtol 0.1 (WT)                              28.0 mM in 3426 evaluations -> 35.7 mM in 4692
+	RK45 at rtol 1e-2 (WT)                             0.44 -> 1.71 mM
+
+(LSODA and BDF at rtol 1e-2 move by a few tenths of a mM either way.) Use it
+with the fixed-step backend or to keep a coarse batch from failing, not to
+loosen the tolerances of an adaptive method.
+
+Every function takes a single (5,) state or a (5, N) ensemble; Jacobians are
+(5, 5) or (5, 5, N) blocks.
+
+Developed by Ariel Precision Medicine
+'''
+
+import numpy as np
+
+# bl + luminal Cl-, the bound of the logit coordinate
+LUMINAL_TOTAL = 160.0
+
+# States integrated as logarithms, and the one integrated as a logit
+LOG_STATES = [0, 2, 3]
+LOGIT_STATE = 1
+
+# Bounds applied to u before converting back, so a wild trial step still maps
+# to a finite, non-zero concentration (whose cube, as in the Na+ pump flux, is
+# finite too) and a luminal Cl- above zero, which the
+# solver's error control can reject
+LOG_BOUND = 50.0
+LOGIT_BOUND = 30.0
+
+# Relative tolerance on u itself; the error control is carried by the absolute tolerance
+LOG_RTOL = 1e-12
+
+
+def to_log(y):
+	'''
+	Log coordinates u of concentrations y
+
+	Parameters
+	----------
+	y : np.ndarray
+		(5,) or (5, N) states (bi, bl, ci, ni, gcftr)
+
+	Returns
+	-------
+	np.ndarray
+		u, shaped like y (NaN where a concentration is outside its range)
+	'''
+	y = np.asarray(y, dtype=float)
+	u = y.copy()
+	with np.errstate(divide='ignore', invalid='ignore'):
+		u[LOG_STATES] = np.log(y[LOG_STATES])
+		u[LOGIT_STATE] = np.log(y[LOGIT_STATE]/(LUMINAL_TOTAL - y[LOGIT_STATE]))
+	return u
+
+
+def from_log(u):
+	'''
+	Concentrations y of log coordinates u (inverse of to_log, any trailing axes)
+
+	u is clipped to LOG_BOUND and LOGIT_BOUND first, so every concentration
+	is finite and inside its range; NaN stays NaN.
+	'''
+	u = np.asarray(u, dtype=float)
+	y = u.copy()
+	y[LOG_STATES] = np.exp(np.clip(u[LOG_STATES], -LOG_BOUND, LOG_BOUND))
+	y[LOGIT_STATE] = LUMINAL_TOTAL/(1 + np.exp(-np.clip(u[LOGIT_STATE], -LOGIT_BOUND, LOGIT_BOUND)))
+	return y
+
+
+def log_tolerances(rtol, atol):
+	'''
+	Solver (rtol, atol) in log coordinates for a requested concentration rtol and atol
+
+	Every concentration then gets a relative error bound of rtol; atol is
+	not needed since no concentration can reach zero.
+	'''
+	return LOG_RTOL, rtol
+
+
+def _scale(y):
+	# dy/du per state, and its derivative d(dy/du)/dy
+	s = np.ones_like(y)
+	ds = np.zeros_like(y)
+	s[LOG_STATES] = y[LOG_STATES]
+	ds[LOG_STATES] = 1
+	bl = y[LOGIT_STATE]
+	s[LOGIT_STATE] = bl*(LUMINAL_TOTAL - bl)/LUMINAL_TOTAL
+	ds[LOGIT_STATE] = (LUMINAL_TOTAL - 2*bl)/LUMINAL_TOTAL
+	return s, ds
+
+
+def log_rhs(f, y):
+	'''du/dt of the right-hand side f evaluated at concentrations y'''
+	return f/_scale(y)[0]
+
+
+def log_jacobian(J, f, y):
+	'''
+	d(du/dt)/du from the concentration Jacobian J and right-hand side f at y
+
+	Parameters
+	----------
+	J : np.ndarray
+		(5, 5) or (5, 5, N) Jacobian blocks
+	f, y : np.ndarray
+		(5,) or (5, N) right-hand side and states
+	'''
+	s, ds = _scale(y)
+	J_u = J*s[None]/s[:, None]
+	diagonal = np.arange(5)
+	J_u[diagonal, diagonal] -= ds*f/s
+	return J_u
+
+
+def concentration_rates(u, g):
+	'''dy/dt from log coordinates u and their rates g = du/dt'''
+	return g*_scale(from_log(u))[0]
+
+
+def log_system(fun, jac):
+	'''
+	Wrap a right-hand side and Jacobian of the concentrations for log coordinates
+
+	Parameters
+	----------
+	fun : callable
+		fun(t, y, *args) -> (5,) or (5, N) right-hand side
+	jac : callable or None
+		jac(t, y, *args) -> (5, 5) or (5, 5, N) Jacobian
+
+	Returns
+	-------
+	tuple
+		(fun(t, u, *args), jac(t, u, *args)) of the transformed system (jac None if jac is)
+	'''
+	def log_fun(t, u, *args):
+		y = from_log(u)
+		return log_rhs(fun(t, y, *args), y)
+
+	def log_jac(t, u, *args):
+		y = from_log(u)
+		return log_jacobian(jac(t, y, *args), fun(t, y, *args), y)
+
+	return log_fun, (log_jac if jac is not None else None)
+
+
+class ConcentrationOutput():
+	'''
+	Dense output of a log-coordinate solve, evaluated as concentrations
+
+	Has the attributes DenseOutput.concatenate reads, so segments solved in
+	log coordinates join other segments' dense outputs.
+	'''
+	Q = None
+
+	def __init__(self, sol):
+		self.sol = sol
+		self.ts = sol.ts
+		self.t_min, self.t_max = sol.t_min, sol.t_max
+
+	def __call__(self, t):
+		return from_log(self.sol(t))
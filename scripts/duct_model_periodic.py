@@ -0,0 +1,191 @@
+# duct_model_periodic.py
+
+'''
+Periodic steady state of the duct model under a repeated stimulus.
+
+Over a day of meals the duct settles onto a periodic orbit: the state at the
+start of one meal cycle is the state at the start of the next. Simulating
+there cycle by cycle converges only as fast as the slowest mode decays per
+cycle (the chloride mode relaxes over millions of time units at rest), so
+instead the fixed point of the cycle map
+
+	F(x) = Phi_T(x) - x = 0
+
+is solved by shooting, where Phi_T integrates bi, bl, ci, ni over one period T
+of the schedule. Newton's method needs the monodromy matrix M = dPhi_T/dx;
+with only four unknowns it is formed by finite differences, integrating the
+base point and the four perturbed starts together as one solve_ensemble
+batch, so each Newton iteration costs a single batched one-period solve
+(a Newton-Krylov iteration would need as many solves and no fewer). Steps
+are damped until the residual decreases. The eigenvalues of M at the
+solution (the Floquet multipliers) show whether the orbit is stable.
+
+The result holds one representative cycle and its cycle averages of
+luminal HCO3-, of the fluid flow (jlum*ionstr, duct_model_ensemble.ensemble_flow)
+and of the HCO3- output flow*bl.
+
+Developed by Ariel Precision Medicine
+'''
+
+import numpy as np
+
+from dcw_duct_model import compile_params, STATE_NAMES
+from duct_model_ensemble import ensemble_flow, solve_ensemble
+from duct_model_protocol import integrate_protocol
+from duct_model_steady_state import steady_state
+
+# Solver settings of the cycle map; finite differences need tight tolerances
+PERIODIC_OPTIONS = {'method': 'odeint', 'rtol': 1e-10, 'atol': 1e-12}
+
+# Relative finite-difference step of the monodromy matrix
+FD_STEP = 1e-5
+
+# Output times per segment of a batched cycle-map solve
+MAP_SAMPLES = 50
+
+# Step halvings tried per Newton iteration before giving up
+MAX_HALVINGS = 10
+
+
+class PeriodicResult():
+	'''
+	Output of periodic_steady_state
+
+	Attributes
+	----------
+	y0 : np.ndarray
+		(5,) state at the start of a cycle on the periodic orbit
+	cycle : ProtocolResult
+		One period integrated from y0
+	t : np.ndarray
+		(T,) sample times over the cycle
+	y : np.ndarray
+		(5, T) states at t
+	flow : np.ndarray
+		(T,) luminal fluid flow at t
+	mean_hco3 : float
+		Cycle-averaged luminal HCO3- (mM)
+	mean_flow : float
+		Cycle-averaged flow
+	hco3_output : float
+		Cycle-averaged HCO3- output, flow*bl
+	multipliers : np.ndarray
+		(4,) Floquet multipliers (eigenvalues of the monodromy matrix); the
+		orbit is stable when all have modulus below 1
+	residual : float
+		max |Phi_T(y0) - y0| (mM)
+	iterations : int
+		Newton iterations
+	success : bool
+		Whether the residual reached the tolerance
+	'''
+	def __init__(self, y0, cycle, t, y, flow, multipliers, residual, iterations, success):
+		self.y0 = y0
+		self.cycle = cycle
+		self.t = t
+		self.y = y
+		self.flow = flow
+		period = t[-1] - t[0]
+		self.mean_hco3 = float(np.trapezoid(y[1], t)/period)
+		self.mean_flow = float(np.trapezoid(flow, t)/period)
+		self.hco3_output = float(np.trapezoid(flow*y[1], t)/period)
+		self.multipliers = multipliers
+		self.residual = residual
+		self.iterations = iterations
+		self.success = success
+
+	def __getitem__(self, name):
+		# Cycle time courses keyed like the graphing dictionaries
+		if name == 'time':
+			return self.t
+		if name == 'flow':
+			return self.flow
+		return self.y[STATE_NAMES.index(name)]
+
+
+def _cycle_map(params, cycle, starts, options):
+	# (4, K) end-of-cycle states of the (4, K) starting states
+	if cycle.is_piecewise_constant:
+		members = [params.replace(**dict(zip(STATE_NAMES[:4], x))) for x in starts.T]
+		# Intermediate output times keep odeint's per-interval step limit out of reach
+		result = solve_ensemble(members, cycle, np.unique(cycle.sample_grid(MAP_SAMPLES)), **options)
+		return result.y[:4, :, -1]
+	ends = np.empty(starts.shape)
+	for k, x in enumerate(starts.T):
+		state = integrate_protocol(params, cycle, y0=x, dense_output=False, **options)
+		ends[:, k] = state.y[:4, -1] if state.success else np.nan
+	return ends
+
+
+def _map_and_monodromy(params, cycle, x, options):
+	# Phi_T(x) and its finite-difference Jacobian from one batch of 5 runs
+	h = FD_STEP*np.maximum(np.abs(x), 1.0)
+	starts = np.column_stack([x] + [x + h[j]*np.eye(4)[j] for j in range(4)])
+	ends = _cycle_map(params, cycle, starts, options)
+	return ends[:, 0], (ends[:, 1:] - ends[:, :1])/h
+
+
+def periodic_steady_state(params, cycle, guess=None, tol=1e-7, max_iter=30, n_points=500, **solver_options):
+	'''
+	Periodic orbit of the duct model under a repeated schedule
+
+	Parameters
+	----------
+	params : dict or DuctParams
+		Model parameters
+	cycle : StimulusProtocol
+		One period of the schedule (e.g. StimulusProtocol.meal_cycle(period, duration));
+		its level at the start is also its level at the end
+	guess : array, optional
+		Initial (bi, bl, ci, ni) at the start of a cycle. Defaults to the
+		resting equilibrium (the orbit of a vanishingly short meal).
+	tol : float
+		Max-norm tolerance (mM) on Phi_T(y0) - y0
+	max_iter : int
+		Newton iteration limit
+	n_points : int
+		Samples per protocol segment of the reported cycle
+	**solver_options
+		Integrator settings of the cycle map (default PERIODIC_OPTIONS)
+
+	Returns
+	-------
+	PeriodicResult
+	'''
+	params = compile_params(params)
+	options = dict(PERIODIC_OPTIONS, **solver_options)
+	if guess is None:
+		rest = steady_state(params, 'gcftrbase')
+		guess = rest.y if rest.success else params.y0
+	x = np.array(guess[:4], dtype=float)
+	end, M = _map_and_monodromy(params, cycle, x, options)
+	residual = end - x
+	norm = np.abs(residual).max()
+	iterations = 0
+	with np.errstate(invalid='ignore', over='ignore'):
+		while norm > tol and iterations < max_iter:
+			iterations += 1
+			step = np.linalg.solve(M - np.eye(4), -residual)
+			for _ in range(MAX_HALVINGS):
+				trial = x + step
+				if np.all(trial > 0) and trial[1] < 160:
+					trial_end, trial_M = _map_and_monodromy(params, cycle, trial, options)
+					trial_residual = trial_end - trial
+					trial_norm = np.abs(trial_residual).max()
+					if trial_norm < norm:
+						break
+				step = step/2
+			else:
+				break
+			x, M, residual, norm = trial, trial_M, trial_residual, trial_norm
+	y0 = np.append(x, 0.0)
+	state = integrate_protocol(params, cycle, y0=x, **options)
+	y0[4] = state.y[4, 0]
+	t = np.unique(cycle.sample_grid(n_points))
+	y = state.sol(t)
+	# The dense output holds gcftr of the segment before a breakpoint; report the schedule instead
+	y[4] = cycle.gcftr(t, params)
+	flow = ensemble_flow(y, params.values[:, None])
+	multipliers = np.linalg.eigvals(M) if np.all(np.isfinite(M)) else np.full(4, np.nan)
+	return PeriodicResult(y0, state, t, y, flow, multipliers, float(norm), iterations,
+						  bool(norm <= tol and state.success))
@@ -0,0 +1,268 @@
+# duct_model_phase_diagram.py
+
+'''
+Adaptive two-parameter phase diagrams of a report metric.
+
+A map of peak luminal HCO3- over, say, CFTR function x smoking penalty is
+flat over most of the plane and changes quickly along a few bands, so a
+uniform grid fine enough for the bands wastes most of its runs. The
+generator here starts from a coarse grid of cells and refines quadtree
+style: a cell whose corner values differ by more than gradient_tol, or
+straddle a clinical threshold (e.g. the 80 mM peak HCO3- cut-off of the
+secretin test), is split into four, down to max_level splits. Cells share
+their corners on a lattice of the finest level, so every point is evaluated
+once, and all points a level needs are integrated together: one batched
+solve_ensemble call per chunk, chunks spread over worker processes.
+
+The result is a heatmap-ready table of leaf cells (bounds, level and the
+mean of the corner values) and of every evaluated point, and
+plot_phase_diagram draws the cells with Bokeh.
+
+Run using:
+	python3 duct_model_phase_diagram.py
+
+Developed by Ariel Precision Medicine
+'''
+
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from bokeh.plotting import figure, output_file, save
+from bokeh.models import ColorBar, ColumnDataSource, HoverTool, LinearColorMapper
+from bokeh.palettes import Viridis256
+
+from dcw_duct_model import compile_params, init_cond, DuctParams, PARAM_NAMES
+from duct_model_ensemble import solve_ensemble
+from duct_model_protocol import report_metrics, StimulusProtocol
+
+# Refinement defaults: coarse cells per side, splits per cell and metric change (mM) across a cell
+INITIAL_CELLS = 8
+MAX_LEVEL = 4
+GRADIENT_TOL = 5.0
+
+# Clinical thresholds a cell is refined across; 80 mM peak HCO3- is the usual secretin test cut-off
+CLINICAL_THRESHOLDS = {'peak_hco3': (80.0,), 'plateau_cl': ()}
+
+# Output samples per protocol segment the metric is read from, and members per batched solve
+# (fixed, so the map does not depend on the number of workers; small enough to spread a level over them)
+METRIC_POINTS = 200
+CHUNK_MEMBERS = 256
+
+
+class PhaseDiagram():
+	'''
+	Output of phase_diagram
+
+	Attributes
+	----------
+	x_name, y_name : str
+		The two parameters
+	metric : str
+		The mapped metric of duct_model_protocol.report_metrics
+	cells : pd.DataFrame
+		One row per leaf cell: left, right, bottom, top (parameter values),
+		x, y (centre), level, value (mean of the corner values), low and high
+		(corner extremes) and refine_reason ('', 'gradient' or 'threshold'
+		when the cell stopped at max_level although it met a criterion)
+	points : pd.DataFrame
+		Every evaluated point: x_name, y_name and the metric
+	thresholds : tuple of float
+		Thresholds the refinement followed
+	log_x, log_y : bool
+		Whether the axes were split in log(parameter)
+	n_evaluations : int
+		Model runs
+	uniform_evaluations : int
+		Runs a uniform grid at the finest resolution would need
+	seconds : float
+		Wall-clock time
+	'''
+	def __init__(self, x_name, y_name, metric, cells, points, thresholds, log_x, log_y, uniform_evaluations,
+				 seconds):
+		self.x_name = x_name
+		self.y_name = y_name
+		self.metric = metric
+		self.cells = cells
+		self.points = points
+		self.thresholds = thresholds
+		self.log_x = log_x
+		self.log_y = log_y
+		self.n_evaluations = len(points)
+		self.uniform_evaluations = uniform_evaluations
+		self.seconds = seconds
+
+
+def _evaluate_points(task):
+	# Metric at every (x, y) of one chunk, NaN where the solve failed
+	values, y0, protocol, x_name, y_name, xs, ys, metric, solver_options = task
+	base = DuctParams(values, y0)
+	members = [base.replace(**{x_name: x, y_name: y}) for x, y in zip(xs, ys)]
+	grid = np.unique(protocol.sample_grid(METRIC_POINTS))
+	result = solve_ensemble(members, protocol, grid, **solver_options)
+	return np.where(result.status == 0, report_metrics(result.y, grid, protocol)[metric], np.nan)
+
+
+def _axis(bounds, log_scale, n):
+	# Parameter value of lattice index k = 0 .. n
+	low, high = bounds
+	if log_scale:
+		return lambda k: np.exp(np.log(low) + (np.log(high) - np.log(low))*np.asarray(k)/n)
+	return lambda k: low + (high - low)*np.asarray(k)/n
+
+
+def phase_diagram(x_name, x_range, y_name, y_range, params=None, metric='peak_hco3', log_x=False, log_y=False,
+				  initial_cells=INITIAL_CELLS, max_level=MAX_LEVEL, gradient_tol=GRADIENT_TOL, thresholds=None,
+				  protocol=None, workers=None, **solver_options):
+	'''
+	Map a report metric over two parameters with adaptive quadtree refinement
+
+	Parameters
+	----------
+	x_name, y_name : str
+		Parameters on the two axes (any of PARAM_NAMES)
+	x_range, y_range : tuple
+		(low, high) of each parameter
+	params : dict or DuctParams, optional
+		Values of every other parameter (default init_cond), e.g. with the antiporters on
+	metric : str
+		'peak_hco3' or 'plateau_cl'
+	log_x, log_y : bool
+		Whether cells are split evenly in log(parameter)
+	initial_cells : int
+		Cells per side of the coarse grid
+	max_level : int
+		Splits a cell may undergo; the finest cells are 2**max_level times smaller per side
+	gradient_tol : float
+		Refine a cell whose corner values differ by more than this (mM)
+	thresholds : tuple of float, optional
+		Refine a cell whose corner values straddle one of these (default CLINICAL_THRESHOLDS)
+	protocol : StimulusProtocol, optional
+		Piecewise-constant schedule (default: the 20000 / 120000 / 200000 secretin pulse)
+	workers : int, optional
+		Worker processes (default: one per core; 1 evaluates in this process)
+	**solver_options
+		Passed to solve_ensemble
+
+	Returns
+	-------
+	PhaseDiagram
+	'''
+	unknown = {x_name, y_name} - set(PARAM_NAMES)
+	if unknown:
+		raise ValueError('Unknown parameters %s' % sorted(unknown))
+	if metric not in CLINICAL_THRESHOLDS:
+		raise ValueError('Unknown metric %r (%s)' % (metric, ', '.join(CLINICAL_THRESHOLDS)))
+	thresholds = tuple(CLINICAL_THRESHOLDS[metric] if thresholds is None else thresholds)
+	base = compile_params(init_cond if params is None else params)
+	protocol = protocol or StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+	n = initial_cells*2**max_level
+	x_of, y_of = _axis(x_range, log_x, n), _axis(y_range, log_y, n)
+	workers = os.cpu_count() if workers is None else workers
+	started = time.perf_counter()
+
+	values = {}
+	size = 2**max_level
+	active = [(0, i*size, j*size) for i in range(initial_cells) for j in range(initial_cells)]
+	leaves = []
+	executor = None if workers == 1 else ProcessPoolExecutor(max_workers=workers)
+	try:
+		for level in range(max_level + 1):
+			size = 2**(max_level - level)
+			corners = {(i + di, j + dj) for _, i, j in active for di in (0, size) for dj in (0, size)}
+			needed = sorted(corners - set(values))
+			if needed:
+				kx, ky = np.array(needed).T
+				xs, ys = x_of(kx), y_of(ky)
+				tasks = [(base.values, base.y0, protocol, x_name, y_name, xs[k:k + CHUNK_MEMBERS], ys[k:k + CHUNK_MEMBERS],
+						  metric, solver_options) for k in range(0, len(needed), CHUNK_MEMBERS)]
+				results = map(_evaluate_points, tasks) if executor is None else executor.map(_evaluate_points, tasks)
+				for point, value in zip(needed, np.concatenate(list(results))):
+					values[point] = value
+
+			refined = []
+			for cell in active:
+				_, i, j = cell
+				corner_values = np.array([values[i + di, j + dj] for di in (0, size) for dj in (0, size)])
+				low, high = np.nanmin(corner_values), np.nanmax(corner_values)
+				reason = ''
+				if np.all(np.isfinite(corner_values)):
+					if any(low < threshold <= high for threshold in thresholds):
+						reason = 'threshold'
+					elif high - low > gradient_tol:
+						reason = 'gradient'
+				if reason and level < max_level:
+					half = size//2
+					refined += [(level + 1, i + di, j + dj) for di in (0, half) for dj in (0, half)]
+				else:
+					leaves.append((cell, size, np.nanmean(corner_values), low, high, reason))
+			active = refined
+	finally:
+		if executor is not None:
+			executor.shutdown()
+
+	rows = []
+	for (level, i, j), size, value, low, high, reason in leaves:
+		left, right = x_of(i), x_of(i + size)
+		bottom, top = y_of(j), y_of(j + size)
+		rows.append({'left': float(left), 'right': float(right), 'bottom': float(bottom), 'top': float(top),
+					 'x': float(x_of(i + size/2)), 'y': float(y_of(j + size/2)), 'level': level, 'value': value,
+					 'low': low, 'high': high, 'refine_reason': reason})
+	cells = pd.DataFrame(rows)
+	kx, ky = np.array(sorted(values)).T
+	points = pd.DataFrame({x_name: x_of(kx), y_name: y_of(ky), metric: [values[point] for point in sorted(values)]})
+	return PhaseDiagram(x_name, y_name, metric, cells, points, thresholds, log_x, log_y, (n + 1)**2,
+						time.perf_counter() - started)
+
+
+def plot_phase_diagram(diagram, filename=None, title=None):
+	'''
+	Draw the leaf cells of a phase diagram as a Bokeh heatmap
+
+	Parameters
+	----------
+	diagram : PhaseDiagram
+	filename : str, optional
+		Also write the plot to outputs/<filename>.html
+	title : str, optional
+		Plot title (default: the metric and the refinement savings)
+
+	Returns
+	-------
+	bokeh.plotting.figure
+	'''
+	labels = {'peak_hco3': 'Peak luminal HCO3- (mM)', 'plateau_cl': 'Luminal Cl- plateau (mM)'}
+	cells = diagram.cells
+	if title is None:
+		title = '%s: %d runs instead of %d' % (labels[diagram.metric], diagram.n_evaluations,
+											   diagram.uniform_evaluations)
+	plot = figure(title=title, x_axis_label=diagram.x_name, y_axis_label=diagram.y_name,
+				  x_axis_type='log' if diagram.log_x else 'linear', y_axis_type='log' if diagram.log_y else 'linear',
+				  width=650, height=550)
+	mapper = LinearColorMapper(palette=Viridis256, low=np.nanmin(cells['value']), high=np.nanmax(cells['value']),
+							   nan_color='lightgray')
+	source = ColumnDataSource(cells)
+	plot.quad(left='left', right='right', bottom='bottom', top='top', source=source, line_color=None,
+			  fill_color={'field': 'value', 'transform': mapper})
+	# Outline the finest cells along each threshold
+	straddling = cells[[any(low < threshold <= high for threshold in diagram.thresholds)
+						for low, high in zip(cells['low'], cells['high'])]]
+	if len(straddling):
+		plot.quad(left='left', right='right', bottom='bottom', top='top', source=ColumnDataSource(straddling),
+				  fill_alpha=0, line_color='red', line_width=1)
+	plot.add_tools(HoverTool(tooltips=[(diagram.x_name, '@x'), (diagram.y_name, '@y'), (diagram.metric, '@value'),
+									   ('level', '@level')]))
+	plot.add_layout(ColorBar(color_mapper=mapper, title=labels[diagram.metric]), 'right')
+	if filename is not None:
+		output_file('outputs/' + filename + '.html')
+		save(plot)
+	return plot
+
+
+if __name__ == '__main__':
+	diagram = phase_diagram('variant_adj', (1e-3, 1.5), 'smoke_adj', (5/11, 1), log_x=True)
+	print('%d runs instead of %d (%d cells) in %.1f s' % (diagram.n_evaluations, diagram.uniform_evaluations,
+														  len(diagram.cells), diagram.seconds))
+	plot_phase_diagram(diagram, 'phase_diagram_variant_smoking')
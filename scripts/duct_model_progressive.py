@@ -0,0 +1,132 @@
+# duct_model_progressive.py
+
+'''
+Coarse-to-fine (progressive) solves for interactive use.
+
+A widget change in the Bokeh app needs a curve on screen at once, while a
+tight-tolerance solve of the WT + patient pair takes a few hundred
+milliseconds. progressive_solve therefore answers twice: it integrates the
+ensemble at loose tolerance on a coarse output grid right away and returns
+that result marked provisional (result.provisional), then integrates it
+again at tight tolerance on the full grid in a background worker and hands
+the refined result to a callback (and to a future). Failed members of the
+refined pass are re-run with solver fallbacks
+(duct_model_ensemble.retry_failed_members) at the same tolerances and time
+limit, so the refinement is the result to trust. A refinement that raises
+still reaches the callback, with the exception in place of the result.
+
+Only one refinement runs at a time on the shared worker; a caller that
+starts a newer solve should cancel the older one, which drops it if it has
+not started yet and suppresses its callback otherwise.
+
+Developed by Ariel Precision Medicine
+'''
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from duct_model_ensemble import DuctEnsemble, fallback_options, retry_failed_members, solve_ensemble
+
+# Loose pass: about 20 ms for a WT + patient pair, within 1 mM of the refined curves
+COARSE_OPTIONS = {'rtol': 1e-2, 'atol': 1e-4}
+COARSE_POINTS = 50
+
+# Refined pass: Fortran LSODA at tolerances well below plotting resolution
+REFINED_OPTIONS = {'method': 'odeint', 'rtol': 1e-8, 'atol': 1e-10}
+
+_EXECUTOR = None
+
+
+def _executor():
+	# One background worker shared by every progressive solve of the process
+	global _EXECUTOR
+	if _EXECUTOR is None:
+		_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='duct-model-refine')
+	return _EXECUTOR
+
+
+class ProgressiveSolve():
+	'''
+	Handle of a progressive solve
+
+	Attributes
+	----------
+	provisional : EnsembleResult
+		Coarse result, available immediately (provisional.provisional is True)
+	future : concurrent.futures.Future
+		Resolves to the refined EnsembleResult (provisional False)
+	'''
+	def __init__(self, provisional, future):
+		self.provisional = provisional
+		self.future = future
+		self.cancelled = False
+
+	def done(self):
+		'''Whether the refined result is ready'''
+		return self.future.done()
+
+	def result(self, timeout=None):
+		'''The refined result, waiting up to timeout seconds for it'''
+		return self.future.result(timeout)
+
+	def cancel(self):
+		'''Drop the refinement if it has not started, and suppress its callback either way'''
+		self.cancelled = True
+		self.future.cancel()
+
+
+def progressive_solve(members, protocol, n_points=500, callback=None, coarse_points=COARSE_POINTS,
+					  coarse_options=None, refined_options=None, executor=None):
+	'''
+	Solve an ensemble coarsely now and accurately in the background
+
+	Parameters
+	----------
+	members : DuctEnsemble or list of dict/DuctParams
+		Parameter sets (compiled here, so later changes to the dicts do not
+		reach the refinement)
+	protocol : StimulusProtocol
+		Piecewise-constant gcftr schedule
+	n_points : int
+		Output samples per protocol segment of the refined result
+	callback : callable, optional
+		callback(handle, result) with this solve's ProgressiveSolve and the
+		refined EnsembleResult, or the exception the refinement raised; called
+		from the worker thread (Bokeh apps hand it on with
+		doc.add_next_tick_callback), or at once if the refinement is already
+		done, unless the solve was cancelled
+	coarse_points : int
+		Output samples per segment of the provisional result
+	coarse_options, refined_options : dict, optional
+		solve_ensemble settings of the two passes (default COARSE_OPTIONS and
+		REFINED_OPTIONS)
+	executor : concurrent.futures.Executor, optional
+		Where the refinement runs (default: a shared single-thread worker)
+
+	Returns
+	-------
+	ProgressiveSolve
+	'''
+	if not isinstance(members, DuctEnsemble):
+		members = DuctEnsemble(members)
+	coarse_options = COARSE_OPTIONS if coarse_options is None else coarse_options
+	refined_options = REFINED_OPTIONS if refined_options is None else refined_options
+	provisional = solve_ensemble(members, protocol, np.unique(protocol.sample_grid(coarse_points)), **coarse_options)
+	provisional.provisional = True
+
+	def refine():
+		result = solve_ensemble(members, protocol, np.unique(protocol.sample_grid(n_points)), **refined_options)
+		if not result.success:
+			retry_failed_members(result, members, protocol, **fallback_options(refined_options))
+		return result
+
+	future = (_executor() if executor is None else executor).submit(refine)
+	handle = ProgressiveSolve(provisional, future)
+	if callback is not None:
+		def deliver(future):
+			if handle.cancelled or future.cancelled():
+				return
+			error = future.exception()
+			callback(handle, future.result() if error is None else error)
+		future.add_done_callback(deliver)
+	return handle
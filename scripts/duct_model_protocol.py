@@ -0,0 +1,563 @@
+# duct_model_protocol.py
+
+'''
+Stimulus protocols for the duct model.
+
+A StimulusProtocol describes the CFTR conductance gcftr(t) as a list of
+contiguous segments that are either constant or linear ramps, so the classic
+rest / secretin / recovery experiment, gradual stimulation and repeated
+secretin meals are all the same kind of object. integrate_protocol runs any
+protocol in one call: the breakpoints are treated as events at which the
+solver is stopped exactly and restarted with the switched conductance (never
+stepping across a discontinuity), and the dense output of every segment is
+stitched into a single interpolant over the whole protocol.
+
+Results keep that interpolant instead of resampled copies: a Trajectory
+evaluates it lazily on whatever grid a consumer asks for (500 points per
+phase for the Bokeh plots, a coarse grid for thumbnails or exact event times
+for metrics), and the Runge-Kutta pieces are evaluated in one vectorized pass.
+
+Each segment is integrated by one of the backends of duct_model_backends
+(solve_ivp methods, odeint or the fixed-step Rosenbrock stepper); the result
+object is the same whichever backend runs.
+
+With steady_tol set, a constant-conductance segment stops as soon as it has
+settled (duct_model_backends.SteadyStateEvent) and the rest of it is filled
+with the settled state; result.t_steady records where each segment stopped.
+
+max_nfev and time_limit bound what one run may spend (duct_model_backends.SolveBudget);
+integrate_with_fallbacks retries a failed or over-budget run with the next
+method of duct_model_backends.FALLBACK_METHODS under one overall time limit
+and records every attempt on the result, so a single pathological parameter
+set can neither hang a batch nor be plotted from a truncated run unnoticed.
+
+report_metrics reads the two numbers of the clinical report, peak luminal
+HCO3- and the luminal Cl- plateau, off the states of any run or ensemble.
+
+gcftr is carried as state y[4] as everywhere else in the model; inside a ramp
+its derivative is the ramp slope, so it is integrated exactly.
+
+Developed by Ariel Precision Medicine
+'''
+
+import time
+import numpy as np
+from collections.abc import Mapping
+
+from dcw_duct_model import compile_params, duct_model_rhs, duct_model_jacobian, PARAM_INDEX, STATE_NAMES
+from duct_model_backends import FALLBACK_METHODS, DenseOutput, default_method, SolveBudget, resolve_options, solve_segment
+from duct_model_reduced import FAST_STATES, project, reduced_system, reduction_error
+from duct_model_steady_state import RESTING_CACHE, resting_key
+
+# Default allowance of integrate_with_fallbacks: evaluations per attempt
+# (about ten times a typical RK45 run of the secretin protocol) and seconds overall
+FALLBACK_MAX_NFEV = 25000
+FALLBACK_TIME_LIMIT = 10.0
+
+# Exceptions an attempt of integrate_with_fallbacks may raise on a bad parameter set
+# (overflow, singular Newton matrices, solver input checks); the next method is tried
+ATTEMPT_ERRORS = (ArithmeticError, np.linalg.LinAlgError, ValueError)
+
+
+def describe_attempts(attempts):
+	'''One clause per attempt record: method, status, evaluations, seconds and solver message'''
+	return '; '.join('%s: status %d after %d evaluations in %.2f s (%s)'
+					 % (a['method'], a['status'], a['nfev'], a['seconds'], a['message']) for a in attempts)
+
+
+class SimulationError(RuntimeError):
+	'''
+	Raised by the graphing runners when a simulation failed on every fallback
+
+	Attributes
+	----------
+	failed : list of int
+		Positions of the failed runs in the request (0 for single runs)
+	attempts : list
+		Per failed run, the attempt records of integrate_with_fallbacks
+	results : object
+		Whatever the runner produced for the runs that did succeed (failed
+		traces are NaN), or None
+	'''
+	def __init__(self, message, failed=(0,), attempts=(), results=None):
+		super().__init__(message)
+		self.failed = list(failed)
+		self.attempts = list(attempts)
+		self.results = results
+
+
+class StimulusProtocol():
+	'''
+	Piecewise-linear CFTR conductance schedule
+
+	Parameters
+	----------
+	segments : list of tuple
+		Contiguous phases in time order, each (t_start, t_end, level) for a
+		constant conductance or (t_start, t_end, level_start, level_end) for a
+		linear ramp. Levels are parameter names ('gcftrbase', 'gcftron') or values.
+	'''
+	def __init__(self, segments):
+		normalized = []
+		for segment in segments:
+			if len(segment) == 3:
+				t_start, t_end, level = segment
+				segment = (t_start, t_end, level, level)
+			t_start, t_end, level_start, level_end = segment
+			if not t_end > t_start:
+				raise ValueError('Protocol segment (%g, %g) has no duration' % (t_start, t_end))
+			if normalized and t_start != normalized[-1][1]:
+				raise ValueError('Protocol segments must be contiguous, gap at t = %g' % normalized[-1][1])
+			normalized.append((float(t_start), float(t_end), level_start, level_end))
+		if not normalized:
+			raise ValueError('A protocol needs at least one segment')
+		self.segments = tuple(normalized)
+
+	@classmethod
+	def secretin_pulse(cls, t_on, t_off, t_end, resting='gcftrbase', stimulated='gcftron'):
+		'''Resting until t_on, CFTR open until t_off, resting again until t_end'''
+		return cls([(0, t_on, resting), (t_on, t_off, stimulated), (t_off, t_end, resting)])
+
+	@classmethod
+	def ramp(cls, t_on, t_peak, t_off, t_end, t_rest=None, resting='gcftrbase', stimulated='gcftron'):
+		'''
+		Gradual stimulation: linear rise from t_on to t_peak, plateau until t_off,
+		then a linear decay reaching rest at t_rest (an instant closure when t_rest is None)
+		'''
+		segments = [(0, t_on, resting), (t_on, t_peak, resting, stimulated), (t_peak, t_off, stimulated)]
+		if t_rest is None:
+			segments.append((t_off, t_end, resting))
+		else:
+			segments += [(t_off, t_rest, stimulated, resting), (t_rest, t_end, resting)]
+		return cls(segments)
+
+	@classmethod
+	def repeated_meals(cls, n_meals, period, duration, t_first=20000, t_end=None,
+					   resting='gcftrbase', stimulated='gcftron'):
+		'''
+		A secretin pulse of the given duration every period, starting at t_first
+
+		t_end defaults to one full period after the first meal of the last cycle.
+		'''
+		if duration >= period:
+			raise ValueError('Meal duration must be shorter than the period')
+		segments = [(0, t_first, resting)]
+		for meal in range(n_meals):
+			t_on = t_first + meal*period
+			segments += [(t_on, t_on + duration, stimulated), (t_on + duration, t_on + period, resting)]
+		if t_end is not None:
+			last_start = segments[-1][0]
+			if t_end <= last_start:
+				raise ValueError('t_end falls inside the last meal')
+			segments[-1] = (last_start, t_end, resting)
+		return cls(segments)
+
+	@classmethod
+	def meal_cycle(cls, period, duration, resting='gcftrbase', stimulated='gcftron'):
+		'''One period of repeated_meals, starting at the meal: CFTR open until duration, resting until period'''
+		if duration >= period:
+			raise ValueError('Meal duration must be shorter than the period')
+		return cls([(0, duration, stimulated), (duration, period, resting)])
+
+	def __len__(self):
+		return len(self.segments)
+
+	def __iter__(self):
+		return iter(self.segments)
+
+	def __repr__(self):
+		return 'StimulusProtocol(%r)' % (list(self.segments),)
+
+	@property
+	def t_span(self):
+		return (self.segments[0][0], self.segments[-1][1])
+
+	@property
+	def breakpoints(self):
+		'''Interior times where the schedule switches or changes slope'''
+		return np.array([segment[0] for segment in self.segments[1:]])
+
+	@property
+	def is_piecewise_constant(self):
+		return all(segment[2] == segment[3] for segment in self.segments)
+
+	def resolve(self, params):
+		'''
+		Segment table with the levels evaluated for one parameter set
+
+		Returns
+		-------
+		np.ndarray
+			(n_segments, 4) array of t_start, t_end, gcftr_start, gcftr_end
+		'''
+		params = compile_params(params)
+		def level(value):
+			return params.constants[PARAM_INDEX[value]] if isinstance(value, str) else float(value)
+		return np.array([(t_start, t_end, level(a), level(b)) for t_start, t_end, a, b in self.segments])
+
+	def gcftr(self, t, params):
+		'''
+		CFTR conductance at time(s) t; a time on a breakpoint takes the new segment's value
+		'''
+		table = self.resolve(params)
+		t = np.asarray(t, dtype=float)
+		index = np.clip(np.searchsorted(table[:, 0], t, side='right') - 1, 0, len(table) - 1)
+		t_start, t_end, a, b = table[index].T
+		return a + (b - a)*(t - t_start)/(t_end - t_start)
+
+	def sample_grid(self, n_points=500):
+		'''
+		Default output grid: n_points evenly spaced times per segment (segment
+		boundaries appear twice, at the end of one segment and the start of the next)
+		'''
+		return np.concatenate([np.linspace(t_start, t_end, n_points) for t_start, t_end, _, _ in self.segments])
+
+	def constant_segments(self):
+		'''
+		(t_start, t_end, level) list for solve_ensemble, which only steps piecewise-constant schedules
+		'''
+		if not self.is_piecewise_constant:
+			raise ValueError('Ramped protocols need integrate_protocol; the ensemble stepper takes constant segments only')
+		return [(t_start, t_end, level) for t_start, t_end, level, _ in self.segments]
+
+
+def report_metrics(states, grid, protocol):
+	'''
+	Peak luminal HCO3-, plateau luminal Cl- (end of the stimulated segment) and the time course
+
+	Parameters
+	----------
+	states : np.ndarray
+		(5, ..., T) states on grid (extra axes for ensemble members)
+	grid : np.ndarray
+		(T,) sorted output times, the end of the stimulated segment included
+		(e.g. duct_model_autotune.metric_grid)
+	protocol : StimulusProtocol
+		Protocol whose second segment is the stimulated phase
+
+	Returns
+	-------
+	dict
+		'peak_hco3', 'plateau_cl' and 'trajectory' (the ion states)
+	'''
+	t_off = np.searchsorted(grid, protocol.segments[1][1])
+	return {'peak_hco3': np.max(states[1], axis=-1), 'plateau_cl': 160 - states[1][..., t_off],
+			'trajectory': states[:4]}
+
+
+class Trajectory(Mapping):
+	'''
+	Lazily evaluated time course of a model run
+
+	Acts as the read-only graphing dictionary ('bi', 'bl', 'ci', 'ni', 'time')
+	on a default grid. Nothing is computed until a state is first looked up,
+	then every state is evaluated once on the grid and kept.
+
+	Parameters
+	----------
+	sol : callable
+		Dense output mapping times to (5, n) states
+	grid : array
+		Default output times
+	'''
+	KEYS = STATE_NAMES[:4] + ('time',)
+
+	def __init__(self, sol, grid):
+		self.sol = sol
+		self.grid = np.asarray(grid, dtype=float)
+		self._values = None
+
+	def __getitem__(self, key):
+		if key == 'time':
+			return self.grid
+		if key not in STATE_NAMES:
+			raise KeyError(key)
+		if self._values is None:
+			self._values = self.sol(self.grid)
+		return self._values[STATE_NAMES.index(key)]
+
+	def __iter__(self):
+		return iter(self.KEYS)
+
+	def __len__(self):
+		return len(self.KEYS)
+
+	def on(self, grid):
+		'''Same trajectory on another grid (still evaluated lazily)'''
+		return Trajectory(self.sol, grid)
+
+	def at(self, t):
+		'''States at the given times as a dictionary of arrays keyed like the graphing dictionary'''
+		return dict(self.on(np.atleast_1d(t)))
+
+
+class ProtocolResult():
+	'''
+	Output of integrate_protocol
+
+	Attributes
+	----------
+	t : np.ndarray
+		Solver time points. Every breakpoint appears twice, once with the state
+		just before the switch and once just after it.
+	y : np.ndarray
+		(5, len(t)) states ordered as STATE_NAMES
+	sol : DenseOutput or None
+		Dense output over the integrated span (a breakpoint itself evaluates to the state before the switch)
+	t_events : np.ndarray
+		Breakpoints the integration passed through
+	segment_slices : list of slice
+		Position of each protocol segment in t and y
+	nfev, njev : int
+		Right-hand side and Jacobian evaluations over all segments
+	status : int
+		0 on success, -1 if a segment failed, BUDGET_STATUS (-2) if the
+		evaluation or time budget ran out (t and y then stop at the failure)
+	message : str
+		Solver message for the last segment integrated
+	t_steady : list
+		Per segment, the time it was found settled and held constant from, or None
+	error_estimate : np.ndarray or None
+		(4, len(t)) estimated absolute error of bi, bl, ci, ni against the full
+		model for reduced runs (duct_model_reduced.reduction_error), else None
+	attempts : list of dict
+		Runs of integrate_with_fallbacks in order, each with method, status,
+		message, nfev and seconds (empty for a plain integrate_protocol call)
+	'''
+	def __init__(self, t, y, sol, t_events, segment_slices, nfev, njev, status, message, t_steady=None,
+				 error_estimate=None, attempts=None):
+		self.t = t
+		self.y = y
+		self.sol = sol
+		self.t_events = t_events
+		self.segment_slices = segment_slices
+		self.nfev = nfev
+		self.njev = njev
+		self.status = status
+		self.message = message
+		self.t_steady = [None]*len(segment_slices) if t_steady is None else t_steady
+		self.error_estimate = error_estimate
+		self.attempts = [] if attempts is None else attempts
+
+	@property
+	def success(self):
+		return self.status == 0
+
+	def diagnostics(self):
+		'''The attempts as text for logs and error reports (see describe_attempts)'''
+		return describe_attempts(self.attempts)
+
+	def error_bound(self, states=STATE_NAMES[:4]):
+		'''Largest estimated error over the given states and all times (None for full runs)'''
+		if self.error_estimate is None:
+			return None
+		rows = [STATE_NAMES.index(state) for state in ([states] if isinstance(states, str) else states)]
+		return float(np.max(self.error_estimate[rows]))
+
+	def __getitem__(self, key):
+		# Keep the solve_ivp style access (state['t'], state['y']) working
+		return getattr(self, key)
+
+	def __call__(self, t):
+		return self.sol(t)
+
+	def trajectory(self, grid):
+		'''Lazily evaluated Trajectory on the given default grid'''
+		return Trajectory(self.sol, grid)
+
+	def segment(self, i):
+		'''(t, y) solver points of protocol segment i'''
+		piece = self.segment_slices[i]
+		return self.t[piece], self.y[:, piece]
+
+
+def integrate_protocol(params, protocol, y0=None, method=None, rtol=None, atol=None, max_step=np.inf,
+					   dense_output=True, n_steps=None, first_step=None, steady_tol=None, steady_window=1000.0,
+					   log_form=False, reduced=False, rest_cache=RESTING_CACHE, max_nfev=None, time_limit=None):
+	'''
+	Integrate the duct model through a stimulus protocol in one call
+
+	Parameters
+	----------
+	params : dict or DuctParams
+		Model parameters (initial ion concentrations are taken from here unless y0 is given)
+	protocol : StimulusProtocol
+		gcftr(t) schedule
+	y0 : array, optional
+		Initial (bi, bl, ci, ni); gcftr always starts at the protocol's first level
+	method : str, optional
+		Integrator backend (see duct_model_backends.available_methods). Implicit
+		methods receive the exact Jacobian.
+	rtol, atol, max_step : float, optional
+		As in solve_ivp
+	dense_output : bool
+		Whether to build the stitched interpolant (result.sol)
+	n_steps, first_step : int, float, optional
+		Per-segment mesh of the fixed-step backend (and the output mesh of odeint)
+	steady_tol : float, optional
+		Stop a constant-conductance segment once the drift its remaining time
+		could add (mM, see duct_model_backends.SteadyStateEvent) has stayed
+		below steady_tol for steady_window time units, and hold the state
+		until the segment ends. None (default) integrates every segment fully;
+		0.05 cuts long plateaus short at about 0.02 mM error.
+	steady_window : float
+		Time the settling criterion has to hold
+	log_form : bool
+		Integrate log concentrations (duct_model_log_form), so no step can
+		take a concentration through zero; rtol then bounds the relative
+		error of every concentration. Results are returned as concentrations.
+	reduced : bool
+		Integrate the quasi-steady-state reduction (duct_model_reduced), with
+		bi and ni on the slow manifold, and attach the a posteriori error
+		estimate against the full model (result.error_estimate)
+	rest_cache : RestingPhaseCache or None
+		Store of integrated first (resting) segments. A run whose first
+		segment matches a stored one in every parameter acting there, the
+		starting state and the solver settings reuses it instead of
+		integrating it again (duct_model_steady_state.resting_key). None
+		disables it.
+	max_nfev, time_limit : int, float, optional
+		Right-hand side evaluations and wall-clock seconds the run may spend
+		over all segments (duct_model_backends.SolveBudget); once either runs
+		out the run stops with status BUDGET_STATUS. None: unlimited.
+
+	Settings left as None come from the deployment's solver profile
+	(duct_model_backends.default_options).
+
+	Returns
+	-------
+	ProtocolResult
+	'''
+	params = compile_params(params)
+	options = resolve_options(method=method, rtol=rtol, atol=atol, n_steps=n_steps, first_step=first_step)
+	method = options.pop('method')
+	options.update(max_step=max_step, dense_output=dense_output, log_form=log_form)
+	table = protocol.resolve(params)
+	y = np.array(params.y0 if y0 is None else np.append(np.asarray(y0, dtype=float)[:4], 0), dtype=float)
+
+	def jac(t, y):
+		return duct_model_jacobian(t, y, params)
+
+	solver_key = (method, tuple(sorted(options.items())), steady_tol, steady_window, reduced)
+	budget = SolveBudget(max_nfev, time_limit) if max_nfev is not None or time_limit is not None else None
+
+	ts, ys, slices, outputs, t_steady, layers, rates = [], [], [], [], [], [], []
+	nfev = njev = 0
+	status, message = 0, ''
+	position = 0
+	for t_start, t_end, level_start, level_end in table:
+		slope = (level_end - level_start)/(t_end - t_start)
+		y[4] = level_start
+
+		def fun(t, y):
+			out = duct_model_rhs(t, y, params)
+			out[4] = slope
+			return out
+
+		segment_fun, segment_jac = fun, jac
+		if reduced:
+			# bi and ni jump onto the new slow manifold; the full model relaxes there in a switch layer
+			entering = y[FAST_STATES].copy()
+			y = project(fun, jac, t_start, y)[0]
+			layers.append((position, (entering - y[FAST_STATES])[:, None]))
+			segment_fun, segment_jac = reduced_system(fun, jac)
+
+		# A ramp keeps moving gcftr, so only constant segments can settle
+		steady = {'steady_tol': steady_tol, 'steady_window': steady_window} if slope == 0 else {}
+		state = key = None
+		if rest_cache is not None and position == 0 and slope == 0:
+			# The resting phase of a repeated request is reused as integrated before
+			key = resting_key(params, y, (t_start, t_end, level_start), solver_key)
+			state = rest_cache.get(key)
+		if state is None:
+			state = solve_segment(segment_fun, segment_jac, (t_start, t_end), y, method, budget=budget, **options, **steady)
+			nfev += state.nfev
+			njev += state.njev
+			if key is not None and state.status == 0 and np.all(np.isfinite(state.y[:, -1])):
+				rest_cache.add(key, state)
+		message = state.message
+		ts.append(state.t)
+		ys.append(state.y)
+		slices.append(slice(position, position + state.t.size))
+		position += state.t.size
+		rates.append(np.full(state.t.size, slope))
+		outputs.append(state.sol)
+		t_steady.append(state.t_steady)
+		# A step through negative concentrations can come back as NaN without a solver error
+		if state.status != 0 or not np.all(np.isfinite(state.y[:, -1])):
+			status = state.status if state.status != 0 else -1
+			message = message if state.status != 0 else 'Non-finite state at t = %g.' % state.t[-1]
+			break
+		y = state.y[:, -1].copy()
+
+	sol = DenseOutput.concatenate(outputs) if dense_output and status == 0 else None
+	t_events = table[1:len(slices), 0]
+	t, y = np.concatenate(ts), np.concatenate(ys, axis=1)
+	error_estimate = None
+	if reduced:
+		error_estimate = reduction_error(t, y[:, None], params.values[:, None], layers, np.concatenate(rates))[:, 0]
+	return ProtocolResult(t, y, sol, t_events, slices, nfev, njev, status, message, t_steady, error_estimate)
+
+
+def _raised_attempt(params, protocol, y0, message):
+	# Failed ProtocolResult of an attempt that raised: the initial state only
+	params = compile_params(params)
+	table = protocol.resolve(params)
+	y = np.array(params.y0 if y0 is None else np.append(np.asarray(y0, dtype=float)[:4], 0), dtype=float)
+	return ProtocolResult(table[:1, 0].astype(float), y[:, None], None, table[1:1, 0], [slice(0, 1)], 0, 0, -1, message)
+
+
+def integrate_with_fallbacks(params, protocol, method=None, fallbacks=FALLBACK_METHODS, max_nfev=FALLBACK_MAX_NFEV,
+							 time_limit=FALLBACK_TIME_LIMIT, **solver_options):
+	'''
+	integrate_protocol that retries failed runs with other methods within a deadline
+
+	method is tried first, then each of fallbacks in turn until one succeeds. Every attempt may spend
+	max_nfev right-hand side evaluations, and all attempts together at most
+	time_limit seconds, so the call returns within about time_limit however
+	badly the parameter set behaves. An attempt raising one of ATTEMPT_ERRORS
+	counts as failed (status -1, the exception as its message).
+
+	Parameters
+	----------
+	params : dict or DuctParams
+		Model parameters
+	protocol : StimulusProtocol
+		gcftr(t) schedule
+	method : str, optional
+		First backend tried (default: the deployment's, see duct_model_backends.default_method)
+	fallbacks : tuple of str
+		Backends tried next, in order (method itself is skipped)
+	max_nfev : int, optional
+		Evaluation budget of each attempt (None: unlimited)
+	time_limit : float, optional
+		Seconds all attempts may take together (None: unlimited)
+	**solver_options
+		Passed to integrate_protocol (rtol and atol apply to every attempt)
+
+	Returns
+	-------
+	ProtocolResult
+		The first successful attempt, or the last one tried; result.attempts
+		records every attempt and result.status whether any succeeded
+	'''
+	first = default_method() if method is None else method
+	methods = (first,) + tuple(fallback for fallback in fallbacks if fallback != first)
+	deadline = None if time_limit is None else time.perf_counter() + time_limit
+	attempts = []
+	for method in methods:
+		remaining = None if deadline is None else deadline - time.perf_counter()
+		if attempts and remaining is not None and remaining <= 0:
+			break
+		started = time.perf_counter()
+		try:
+			result = integrate_protocol(params, protocol, method=method, max_nfev=max_nfev,
+										time_limit=None if remaining is None else max(remaining, 0.0), **solver_options)
+		except ATTEMPT_ERRORS as error:
+			result = _raised_attempt(params, protocol, solver_options.get('y0'), '%s: %s' % (type(error).__name__, error))
+		attempts.append({'method': method, 'status': result.status, 'message': result.message, 'nfev': result.nfev,
+						 'seconds': time.perf_counter() - started})
+		if result.success:
+			break
+	result.attempts = attempts
+	return result
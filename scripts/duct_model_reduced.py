@@ -0,0 +1,209 @@
+# duct_model_reduced.py
+
+'''
+Quasi-steady-state (reduced) mode of the duct model.
+
+The Jacobian of duct_model_system has two fast modes (time constants of
+about 200 and 1000 time units) living on the intracellular HCO3- and Na+
+pools bi and ni, while luminal HCO3- bl and intracellular Cl- ci move on
+10**4 to 10**6 time units. The reduced model treats the fast states as
+algebraic (index-1 elimination): at every right-hand side evaluation bi and
+ni are moved onto the slow manifold f_bi = f_ni = 0 by Newton's method
+(2x2, batched over ensemble members), bl, ci and gcftr evolve with the full
+model's rates there, and bi, ni follow the manifold's tangent
+dx*/dt = M dz/dt, M = -A^-1 B, with A and B the fast rows of the Jacobian.
+The reduced system is not stiff, so the explicit steppers take steps of the
+slow time scale.
+
+reduction_error estimates the difference to the full model a posteriori.
+The reduced trajectory y_r satisfies the full model up to the defect
+d = dy_r/dt - f(y_r) = (M dz/dt on bi and ni, 0 elsewhere), and enters every
+segment with bi, ni moved by delta onto the new manifold, so the error
+e = y - y_r of the full solution y follows the linearized equation
+
+	e' = J(y_r) e - d,  e += delta at every switch
+
+which is integrated by backward Euler along the output grid. Cohort
+screening (duct_model_ensemble.screen_cohort) compares it to a threshold
+before escalating a member to the full model.
+
+The separation of time scales is clean at rest (bi, ni relax in 200-1000
+time units, bl and ci in 10**5 to 10**6) but not with CFTR open, where bl
+and ci relax in 300-1000 time units as well; the reduced model is therefore
+accurate to about 1 mM during stimulation, which the estimate reports.
+
+Every function takes (5,) states of a single run or (5, N) ensembles, like
+the rest of the model.
+
+Developed by Ariel Precision Medicine
+'''
+
+import numpy as np
+
+import duct_model_generated
+
+# Fast (algebraic) and slow (integrated) entries of the state vector
+FAST_STATES = [0, 3]
+SLOW_STATES = [1, 2, 4]
+
+# Newton iterations onto the slow manifold stop after an update below this (mM):
+# convergence is quadratic, so the point is then on the manifold to ~1e-8 mM
+NEWTON_TOL = 1e-4
+NEWTON_ITERATIONS = 20
+
+# Member-time columns per right-hand side and Jacobian evaluation in reduction_error
+ERROR_CHUNK = 20000
+
+
+def _solve_fast(A, b):
+	# Closed-form solution of the 2x2 systems A x = b, A (2, 2, ...), b (2, ...) or (2, k, ...)
+	det = A[0, 0]*A[1, 1] - A[0, 1]*A[1, 0]
+	return np.array([(A[1, 1]*b[0] - A[0, 1]*b[1])/det, (A[0, 0]*b[1] - A[1, 0]*b[0])/det])
+
+
+def _blocks(J):
+	# A = d fast/d fast, B = d fast/d slow, C = d slow/d fast, D = d slow/d slow
+	fast, slow = J[FAST_STATES], J[SLOW_STATES]
+	return fast[:, FAST_STATES], fast[:, SLOW_STATES], slow[:, FAST_STATES], slow[:, SLOW_STATES]
+
+
+def _matmul(X, Y):
+	# Product of stacked matrices whose trailing axes are members
+	return np.einsum('ij...,jk...->ik...', X, Y)
+
+
+def _matvec(X, v):
+	return np.einsum('ij...,j...->i...', X, v)
+
+
+def project(fun, jac, t, y, *args):
+	'''
+	Move the fast states onto the slow manifold f_bi = f_ni = 0
+
+	Parameters
+	----------
+	fun, jac : callable
+		Full model fun(t, y, *args) and jac(t, y, *args)
+	t : float
+		Time
+	y : np.ndarray
+		(5,) or (5, N) states; bi and ni are the Newton starting point
+
+	Returns
+	-------
+	tuple
+		(y on the manifold, fun and jac there, the rates updated to first
+		order and the Jacobian from before the final Newton update). Members
+		whose iteration diverges come back non-finite.
+	'''
+	y = np.array(y, dtype=float)
+	with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+		for _ in range(NEWTON_ITERATIONS):
+			f = fun(t, y, *args)
+			J = jac(t, y, *args)
+			step = _solve_fast(_blocks(J)[0], -f[FAST_STATES])
+			y[FAST_STATES] += step
+			# Diverged (NaN) members stop iterating as well
+			if not np.any(np.abs(step) > NEWTON_TOL):
+				break
+		# First-order update of the rates to the final point instead of another evaluation
+		f = f + _matvec(J[:, FAST_STATES], step)
+	return y, f, J
+
+
+def reduced_system(fun, jac):
+	'''
+	Reduced (quasi-steady-state) right-hand side and Jacobian of a full model
+
+	Parameters
+	----------
+	fun : callable
+		fun(t, y, *args) -> (5,) or (5, N) right-hand side
+	jac : callable
+		jac(t, y, *args) -> (5, 5) or (5, 5, N) Jacobian
+
+	Returns
+	-------
+	tuple
+		(fun(t, y, *args), jac(t, y, *args)) of the reduced system: the slow
+		rows are the full rates on the manifold, the fast rows its tangent
+	'''
+	def reduced_fun(t, y, *args):
+		y, f, J = project(fun, jac, t, y, *args)
+		A, B = _blocks(J)[:2]
+		out = np.empty_like(f)
+		out[SLOW_STATES] = f[SLOW_STATES]
+		out[FAST_STATES] = _matvec(_solve_fast(A, -B), f[SLOW_STATES])
+		return out
+
+	def reduced_jac(t, y, *args):
+		y, f, J = project(fun, jac, t, y, *args)
+		A, B, C, D = _blocks(J)
+		M = _solve_fast(A, -B)
+		R = D + _matmul(C, M)
+		out = np.zeros_like(J)
+		out[np.ix_(SLOW_STATES, SLOW_STATES)] = R
+		out[np.ix_(FAST_STATES, SLOW_STATES)] = _matmul(M, R)
+		return out
+
+	return reduced_fun, reduced_jac
+
+
+def reduction_error(t, y, values, layers, rates=None):
+	'''
+	A posteriori estimate of |full model - reduced model| along a reduced run
+
+	Parameters
+	----------
+	t : np.ndarray
+		(T,) increasing times (the estimate is integrated on this grid; a
+		grid coarser than the fast time scale overestimates the error)
+	y : np.ndarray
+		(5, N, T) reduced states at t (projected onto the manifold)
+	values : np.ndarray
+		(P, N) parameter matrix
+	layers : list of tuple
+		(index, delta) for the run start and every conductance switch, in
+		time order: the first position in t belonging to the new segment and
+		the (2, N) offset of the entering bi, ni from the new manifold
+	rates : np.ndarray, optional
+		(T,) d gcftr/dt at t (zero when omitted, i.e. piecewise-constant protocols)
+
+	Returns
+	-------
+	np.ndarray
+		(4, N, T) estimated absolute errors of bi, bl, ci, ni (mM)
+	'''
+	n = y.shape[1]
+	estimate = np.zeros((4, n, t.size))
+	error = np.zeros((n, 4))
+	pending = list(layers)
+	identity = np.eye(4)
+	chunk = max(1, ERROR_CHUNK//n)
+	with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+		for first in range(0, t.size, chunk):
+			# Rates and Jacobians of a block of output times at once, members x times as columns
+			times = slice(first, min(first + chunk, t.size))
+			m = times.stop - first
+			states = y[:, :, times].reshape(5, n*m)
+			columns = np.repeat(values, m, axis=1)
+			f = duct_model_generated.rhs(0, states, columns)
+			f[4] = 0 if rates is None else np.tile(rates[times], n)
+			J = duct_model_generated.jacobian(0, states, columns)
+			A, B = _blocks(J)[:2]
+			# The reduced solution moves its fast states along the manifold where the full model has f = 0
+			defect = np.zeros((4, n*m))
+			defect[FAST_STATES] = _matvec(_solve_fast(A, -B), f[SLOW_STATES])
+			defect = defect.reshape(4, n, m)
+			matrices = identity - np.moveaxis(J[:4, :4], 2, 0).reshape(n, m, 4, 4)
+			for j in range(m):
+				k = first + j
+				if k:
+					h = t[k] - t[k - 1]
+					matrix = identity + h*(matrices[:, j] - identity)
+					error = np.linalg.solve(matrix, (error - h*defect[:, :, j].T)[:, :, None])[:, :, 0]
+				while pending and pending[0][0] <= k:
+					# The full model enters a segment off the new manifold
+					error[:, FAST_STATES] += pending.pop(0)[1].T
+				estimate[:, :, k] = np.abs(error.T)
+	return estimate
@@ -0,0 +1,405 @@
+# duct_model_rom.py
+
+'''
+Proper orthogonal decomposition (POD) reduced-order model of the duct model.
+
+Population runs only vary the patient influences: variant_adj, smoke_adj,
+alcohol_adj and the two antiporter flags. variant_adj and alcohol_adj enter
+the model only through their product (the CFTR Cl- conductance factor), so
+every trajectory of a protocol is a function of two continuous coordinates,
+
+	x = log(variant_adj*alcohol_adj),  s = smoke_adj
+
+and of the (ap_status, apb_status) pair. Training runs the full model on a
+regular (x, s) grid for every flag pair (one batched solve_ensemble call
+each), stacks the bi, bl, ci, ni time courses as snapshot vectors and keeps
+the leading POD modes until every training snapshot is reproduced to
+pod_tol. A query interpolates the modal coefficients with the local cubic
+(4 x 4 node) Lagrange stencil around (x, s) and expands them in the basis: a
+few small array operations instead of a stiff integration. (A Galerkin
+projection of the 5-state ODE itself could not be cheaper than the ODE, so
+the time dependence lives in the basis instead.)
+
+The full model is also run at the centre of every grid cell, where the
+interpolation error is largest, and the model's error there is stored per
+cell and state. Every query reports the error of its cell as its estimate.
+
+Train and save using:
+	python3 duct_model_rom.py [output file]
+
+Developed by Ariel Precision Medicine
+'''
+
+import os
+import sys
+import json
+import numpy as np
+
+from dcw_duct_model import compile_params, init_cond, DuctParams, PARAM_INDEX, PARAM_NAMES, STATE_NAMES
+from duct_model_ensemble import DuctEnsemble, EnsembleResult, solve_ensemble
+from duct_model_protocol import ProtocolResult, StimulusProtocol, integrate_protocol
+
+ROM_FILE = os.environ.get('DUCT_MODEL_ROM',
+						  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'duct_model_rom.npz'))
+
+# Parameters a trained model may vary; everything else is fixed to its training base
+VARIED_PARAMS = ('variant_adj', 'smoke_adj', 'alcohol_adj', 'ap_status', 'apb_status')
+
+# (ap_status, apb_status) pairs, each with its own basis
+FLAG_PAIRS = ((False, False), (True, False), (False, True), (True, True))
+
+# Training domain: the Cutting residual functions (with alcohol and CFTR modulators) and the smoking penalties
+CL_FACTOR_RANGE = (1e-3, 1.5)
+SMOKE_RANGE = (0.4, 1.0)
+CL_NODES = 41
+SMOKE_NODES = 9
+
+# Largest reconstruction error (mM) of a training snapshot by the truncated basis
+POD_TOL = 0.01
+
+TRAINING_OPTIONS = {'method': 'odeint', 'rtol': 1e-8, 'atol': 1e-10}
+
+
+def lagrange_stencil(nodes, x):
+	'''
+	Local cubic Lagrange interpolation on a uniform grid
+
+	Parameters
+	----------
+	nodes : np.ndarray
+		(n,) uniform grid, n >= 4
+	x : np.ndarray
+		(N,) points inside the grid
+
+	Returns
+	-------
+	tuple
+		((N,) first node of every 4-node stencil, (4, N) weights); the
+		stencil is centred on the cell containing x and shifted inwards at the edges
+	'''
+	h = nodes[1] - nodes[0]
+	position = (np.asarray(x, dtype=float) - nodes[0])/h
+	start = np.clip(np.floor(position).astype(int) - 1, 0, len(nodes) - 4)
+	u = position - start
+	weights = np.array([-(u - 1)*(u - 2)*(u - 3)/6, u*(u - 2)*(u - 3)/2,
+						-u*(u - 1)*(u - 3)/2, u*(u - 1)*(u - 2)/6])
+	return start, weights
+
+
+def _pod_basis(snapshots, pod_tol):
+	# Mean, and the fewest modes reproducing every (column) snapshot to pod_tol
+	mean = snapshots.mean(axis=1)
+	centred = snapshots - mean[:, None]
+	U = np.linalg.svd(centred, full_matrices=False)[0]
+	for r in range(1, U.shape[1] + 1):
+		basis = U[:, :r]
+		if np.abs(centred - basis @ (basis.T @ centred)).max() <= pod_tol:
+			break
+	return mean, basis
+
+
+class ReducedOrderModel():
+	'''
+	Trained POD model of one protocol on one output grid
+
+	Build with ReducedOrderModel.train or ReducedOrderModel.load.
+
+	Attributes
+	----------
+	protocol : StimulusProtocol
+		Piecewise-constant protocol the model was trained for
+	t : np.ndarray
+		(T,) output times (the protocol's sample grid without repeated breakpoints)
+	base : DuctParams
+		Parameters every query must share outside VARIED_PARAMS
+	x_nodes, s_nodes : np.ndarray
+		Training grid in log(variant_adj*alcohol_adj) and smoke_adj
+	mean : np.ndarray
+		(F, 4*T) mean snapshot per flag pair (bi, bl, ci, ni time courses end to end)
+	basis : np.ndarray
+		(F, 4*T, r) POD modes per flag pair (zero-padded to the largest r)
+	coefficients : np.ndarray
+		(F, len(x_nodes), len(s_nodes), r) modal coefficients of the training runs
+	cell_error : np.ndarray
+		(F, len(x_nodes) - 1, len(s_nodes) - 1, 4) largest absolute error of
+		bi, bl, ci, ni at the centre of every training cell (mM)
+	n_modes : np.ndarray
+		(F,) modes kept per flag pair
+	flag_pairs : tuple
+		(ap_status, apb_status) pairs trained, in the order of the first axis above
+	'''
+	def __init__(self, protocol, t, base, x_nodes, s_nodes, mean, basis, coefficients, cell_error, n_modes,
+				 flag_pairs=FLAG_PAIRS):
+		self.protocol = protocol
+		self.t = t
+		self.base = compile_params(base)
+		self.x_nodes = x_nodes
+		self.s_nodes = s_nodes
+		self.mean = mean
+		self.basis = basis
+		self.coefficients = coefficients
+		self.cell_error = cell_error
+		self.n_modes = n_modes
+		self.flag_pairs = tuple(tuple(bool(flag) for flag in pair) for pair in flag_pairs)
+		self.gcftr = protocol.gcftr(t, self.base)
+		# Position of every protocol segment in t (a breakpoint belongs to the segment it starts)
+		edges = np.concatenate([[0], np.searchsorted(t, protocol.breakpoints), [t.size]])
+		self.segment_slices = [slice(a, b) for a, b in zip(edges[:-1], edges[1:])]
+		self._fixed = np.ones(len(PARAM_NAMES), dtype=bool)
+		self._fixed[[PARAM_INDEX[name] for name in VARIED_PARAMS]] = False
+
+	@classmethod
+	def train(cls, base=init_cond, protocol=None, n_points=500, cl_range=CL_FACTOR_RANGE, smoke_range=SMOKE_RANGE,
+			  cl_nodes=CL_NODES, smoke_nodes=SMOKE_NODES, flag_pairs=FLAG_PAIRS, pod_tol=POD_TOL, **solver_options):
+		'''
+		Run the full model over the training grid and build the basis
+
+		Parameters
+		----------
+		base : dict or DuctParams
+			Parameters shared by every run (VARIED_PARAMS are overwritten)
+		protocol : StimulusProtocol, optional
+			Piecewise-constant protocol, defaults to the 20000 / 120000 / 200000 secretin pulse
+		n_points : int
+			Samples per protocol segment (as in StimulusProtocol.sample_grid)
+		cl_range : tuple
+			Range of variant_adj*alcohol_adj covered (log-spaced nodes)
+		smoke_range : tuple
+			Range of smoke_adj covered
+		cl_nodes, smoke_nodes : int
+			Grid nodes per axis (at least 4)
+		flag_pairs : tuple
+			(ap_status, apb_status) pairs to train
+		pod_tol : float
+			Largest reconstruction error (mM) of a training snapshot
+		**solver_options
+			solve_ensemble options of the training runs (default TRAINING_OPTIONS)
+
+		Returns
+		-------
+		ReducedOrderModel
+		'''
+		if min(cl_nodes, smoke_nodes) < 4:
+			raise ValueError('The cubic stencil needs at least 4 nodes per axis')
+		protocol = protocol or StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		options = dict(TRAINING_OPTIONS, **solver_options)
+		base = compile_params(base)
+		t = np.unique(protocol.sample_grid(n_points))
+		x_nodes = np.linspace(np.log(cl_range[0]), np.log(cl_range[1]), cl_nodes)
+		s_nodes = np.linspace(smoke_range[0], smoke_range[1], smoke_nodes)
+		x_centres = (x_nodes[1:] + x_nodes[:-1])/2
+		s_centres = (s_nodes[1:] + s_nodes[:-1])/2
+
+		def snapshots(x, s, flags):
+			# (4*T, len(x)*len(s)) full-model time courses on the (x, s) grid
+			X, S = np.meshgrid(x, s, indexing='ij')
+			members = [base.replace(variant_adj=np.exp(a), alcohol_adj=1, smoke_adj=b,
+									ap_status=float(flags[0]), apb_status=float(flags[1]))
+					   for a, b in zip(X.ravel(), S.ravel())]
+			result = solve_ensemble(members, protocol, t, **options)
+			if not result.success:
+				raise RuntimeError('Training run failed for ap_status=%s, apb_status=%s' % flags)
+			return np.moveaxis(result.y[:4], 1, 0).reshape(len(members), -1).T
+
+		nodes, centres, fits = [], [], []
+		for flags in flag_pairs:
+			nodes.append(snapshots(x_nodes, s_nodes, flags))
+			centres.append(snapshots(x_centres, s_centres, flags))
+			fits.append(_pod_basis(nodes[-1], pod_tol))
+		n_modes = np.array([modes.shape[1] for _, modes in fits])
+		basis = np.zeros((len(flag_pairs), t.size*4, n_modes.max()))
+		for f, (_, modes) in enumerate(fits):
+			basis[f, :, :modes.shape[1]] = modes
+		rom = cls(protocol, t, base, x_nodes, s_nodes, np.array([mean for mean, _ in fits]), basis,
+				  np.zeros((len(flag_pairs), cl_nodes, smoke_nodes, n_modes.max())),
+				  np.zeros((len(flag_pairs), cl_nodes - 1, smoke_nodes - 1, 4)), n_modes, flag_pairs)
+		X, S = np.meshgrid(x_centres, s_centres, indexing='ij')
+		for f in range(len(flag_pairs)):
+			rom.coefficients[f] = rom._project(f, nodes[f]).T.reshape(cl_nodes, smoke_nodes, -1)
+			# Validation against the full model where the interpolation is least accurate
+			error = np.abs(rom._expand(f, rom._interpolate(f, X.ravel(), S.ravel())) - centres[f])
+			rom.cell_error[f] = error.reshape(4, t.size, -1).max(axis=1).T.reshape(cl_nodes - 1, smoke_nodes - 1, 4)
+		return rom
+
+	@classmethod
+	def load(cls, path=ROM_FILE):
+		'''Model written by save'''
+		with np.load(path) as data:
+			arrays = {key: data[key] for key in data.files}
+		protocol = StimulusProtocol(json.loads(str(arrays.pop('protocol'))))
+		base = DuctParams(arrays.pop('base_values'), arrays.pop('base_y0'))
+		return cls(protocol, base=base, **arrays)
+
+	def save(self, path=ROM_FILE):
+		'''Write the model (basis, coefficient tables and validation errors) to an .npz file'''
+		np.savez_compressed(path, protocol=json.dumps(self.protocol.segments), t=self.t,
+							base_values=self.base.values, base_y0=self.base.y0, x_nodes=self.x_nodes,
+							s_nodes=self.s_nodes, mean=self.mean, basis=self.basis, coefficients=self.coefficients,
+							cell_error=self.cell_error, n_modes=self.n_modes, flag_pairs=np.array(self.flag_pairs))
+
+	def _project(self, f, snapshots):
+		# (r, N) modal coefficients of (4*T, N) snapshots
+		return self.basis[f].T @ (snapshots - self.mean[f][:, None])
+
+	def _expand(self, f, coefficients):
+		# (4*T, N) snapshots of (r, N) modal coefficients
+		return self.mean[f][:, None] + self.basis[f] @ coefficients
+
+	def _interpolate(self, f, x, s):
+		# (r, N) modal coefficients at the points (x, s)
+		x_start, x_weights = lagrange_stencil(self.x_nodes, x)
+		s_start, s_weights = lagrange_stencil(self.s_nodes, s)
+		offsets = np.arange(4)
+		block = self.coefficients[f][(x_start[:, None] + offsets)[:, :, None], (s_start[:, None] + offsets)[:, None, :]]
+		return np.einsum('in,jn,nijr->rn', x_weights, s_weights, block)
+
+	def coordinates(self, members):
+		'''
+		Model coordinates of parameter sets
+
+		Parameters
+		----------
+		members : DuctEnsemble or list of dict/DuctParams
+			Parameter sets differing from base in VARIED_PARAMS only
+
+		Returns
+		-------
+		tuple
+			(N,) arrays of log(variant_adj*alcohol_adj), smoke_adj and the index into flag_pairs
+
+		Raises
+		------
+		ValueError
+			For a parameter set outside the trained space
+		'''
+		if not isinstance(members, DuctEnsemble):
+			members = DuctEnsemble(members)
+		values = members.values
+		changed = np.any(values[self._fixed] != self.base.values[self._fixed][:, None], axis=1)
+		if np.any(changed):
+			names = np.array(PARAM_NAMES)[self._fixed][changed]
+			raise ValueError('The reduced-order model was trained with fixed %s' % ', '.join(names))
+		if np.any(members.y0 != self.base.y0[:, None]):
+			raise ValueError('The reduced-order model was trained from fixed initial states')
+		pairs = members.param('ap_status') != 0, members.param('apb_status') != 0
+		flags = np.full(len(members), -1)
+		for f, (ap, apb) in enumerate(self.flag_pairs):
+			flags[(pairs[0] == ap) & (pairs[1] == apb)] = f
+		if np.any(flags < 0):
+			i = np.flatnonzero(flags < 0)[0]
+			raise ValueError('No basis trained for ap_status=%s, apb_status=%s' % (pairs[0][i], pairs[1][i]))
+		x = np.log(members.param('variant_adj')*members.param('alcohol_adj'))
+		s = members.param('smoke_adj')
+		outside = (x < self.x_nodes[0]) | (x > self.x_nodes[-1]) | (s < self.s_nodes[0]) | (s > self.s_nodes[-1])
+		if np.any(outside):
+			i = np.flatnonzero(outside)[0]
+			raise ValueError('variant_adj*alcohol_adj = %g, smoke_adj = %g is outside the trained range '
+							 '[%g, %g] x [%g, %g]' % (np.exp(x[i]), s[i], np.exp(self.x_nodes[0]),
+													 np.exp(self.x_nodes[-1]), self.s_nodes[0], self.s_nodes[-1]))
+		return x, s, flags
+
+	def predict(self, members):
+		'''
+		States and error estimates of parameter sets
+
+		Parameters
+		----------
+		members : DuctEnsemble or list of dict/DuctParams
+			As in coordinates
+
+		Returns
+		-------
+		tuple
+			((5, N, T) states on t, (N, 4) validation errors of bi, bl, ci, ni
+			of every member's training cell)
+		'''
+		x, s, flags = self.coordinates(members)
+		y = np.empty((5, len(members), self.t.size))
+		y[4] = self.gcftr
+		error = np.empty((len(members), 4))
+		for f in np.unique(flags):
+			chosen = np.flatnonzero(flags == f)
+			states = self._expand(f, self._interpolate(f, x[chosen], s[chosen]))
+			y[:4, chosen] = states.reshape(4, self.t.size, -1).transpose(0, 2, 1)
+			x_cell = np.clip(np.searchsorted(self.x_nodes, x[chosen], side='right') - 1, 0, len(self.x_nodes) - 2)
+			s_cell = np.clip(np.searchsorted(self.s_nodes, s[chosen], side='right') - 1, 0, len(self.s_nodes) - 2)
+			error[chosen] = self.cell_error[f, x_cell, s_cell]
+		return y, error
+
+	def simulate(self, params):
+		'''
+		Trajectory of one parameter set
+
+		Parameters
+		----------
+		params : dict or DuctParams
+			Parameter set differing from base in VARIED_PARAMS only
+
+		Returns
+		-------
+		ProtocolResult
+			Shaped like integrate_protocol's result on the model's grid t (sol
+			interpolates linearly between grid points); error_estimate holds
+			the validation error of the query's training cell at every time
+		'''
+		y, error = self.predict([params])
+		y = y[:, 0]
+		estimate = np.broadcast_to(error[0][:, None], (4, self.t.size))
+		return ProtocolResult(self.t, y, GridOutput(self.t, y), self.protocol.breakpoints, list(self.segment_slices),
+							  0, 0, 0, 'Reduced-order model', error_estimate=estimate)
+
+	def simulate_batch(self, members):
+		'''
+		Trajectories of many parameter sets at once
+
+		Returns
+		-------
+		EnsembleResult
+			Shaped like solve_ensemble's result on the model's grid t, with the
+			members' validation errors as error_estimate
+		'''
+		if not isinstance(members, DuctEnsemble):
+			members = DuctEnsemble(members)
+		y, error = self.predict(members)
+		n = len(members)
+		estimate = np.broadcast_to(error.T[:, :, None], (4, n, self.t.size))
+		return EnsembleResult(self.t, y, np.zeros(n, dtype=int), np.zeros(n, dtype=int), np.zeros(n, dtype=int),
+							  np.zeros(n, dtype=int), error_estimate=estimate)
+
+	def validate(self, params, **solver_options):
+		'''
+		Actual error of one query against a full integrate_protocol run
+
+		Returns
+		-------
+		dict
+			Largest absolute difference (mM) per state ('bi', 'bl', 'ci', 'ni') on t
+		'''
+		full = integrate_protocol(params, self.protocol, **dict(TRAINING_OPTIONS, **solver_options)).sol(self.t)
+		predicted = self.simulate(params).y
+		return {name: float(np.abs(predicted[i] - full[i]).max()) for i, name in enumerate(STATE_NAMES[:4])}
+
+
+class GridOutput():
+	'''
+	Piecewise-linear interpolant of states stored on a grid, called like a dense output
+
+	Times on the grid return the stored states exactly.
+	'''
+	def __init__(self, t, y):
+		self.t = t
+		self.y = y
+
+	def __call__(self, t):
+		t = np.asarray(t, dtype=float)
+		return np.array([np.interp(t, self.t, row) for row in self.y])
+
+
+if __name__ == '__main__':
+	path = sys.argv[1] if len(sys.argv) > 1 else ROM_FILE
+	rom = ReducedOrderModel.train()
+	rom.save(path)
+	for pair, modes, error in zip(rom.flag_pairs, rom.n_modes, rom.cell_error):
+		print('ap_status=%s, apb_status=%s: %d modes, validation error %.3g mM (bl %.3g mM)'
+			  % (pair + (modes, error.max(), error[..., 1].max())))
+	print('Saved ' + path)
@@ -0,0 +1,249 @@
+# duct_model_sensitivity.py
+
+'''
+Forward sensitivities of the duct model with respect to its parameters.
+
+For chosen parameters p_1 .. p_k the sensitivities S = dy/dp, a (5, k)
+matrix, obey the forward sensitivity equations
+
+	S' = J(y) S + F_p(y)
+
+where J is the exact state Jacobian and F_p the matching columns of the
+exact parameter Jacobian (both generated by duct_model_symbolic). They are
+integrated together with the state as one 5 + 5k system, so a single run
+returns the trajectory and its derivative with respect to every chosen
+parameter instead of two finite-difference runs per parameter.
+
+The initial concentrations are not parameters, so S starts at zero. gcftr is
+set from a parameter at every conductance switch ('gcftrbase', 'gcftron'),
+so the gcftr row of S is reset to d(level)/dp there, and inside a ramp it
+moves with the derivative of the ramp slope.
+
+The stiff solver's Newton iterations use the block-diagonal matrix with J
+on every block, the usual simplification of simultaneous sensitivity
+solvers (the exact coupling needs second derivatives of the model); this
+only affects the convergence rate of the Newton iterations, not the
+solution.
+
+SensitivityResult turns the sensitivities into gradients of the report
+metrics (peak luminal HCO3-, luminal Cl- plateau at t_off, as in
+duct_model_protocol.report_metrics) and into first-order (delta method)
+uncertainty bands for given parameter standard errors or covariances.
+
+Developed by Ariel Precision Medicine
+'''
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.linalg import block_diag
+
+import duct_model_generated
+
+from dcw_duct_model import compile_params, PARAM_INDEX, PARAM_NAMES, STATE_NAMES
+from duct_model_autotune import metric_grid
+
+# Parameters differentiated by default: the patient influences and the transporter
+# strengths and geometry whose effect the reports discuss
+SENSITIVITY_PARAMS = ('variant_adj', 'smoke_adj', 'alcohol_adj', 'gcftron', 'gnbc', 'gapl', 'gapbl', 'gnak', 'vr')
+
+# Solver settings of the augmented system
+SENSITIVITY_OPTIONS = {'method': 'LSODA', 'rtol': 1e-8, 'atol': 1e-10}
+
+
+class SensitivityResult():
+	'''
+	Output of integrate_sensitivities
+
+	Attributes
+	----------
+	t : np.ndarray
+		(T,) output times
+	y : np.ndarray
+		(5, T) states
+	sensitivities : np.ndarray
+		(5, k, T) derivatives of the states with respect to names
+	names : tuple of str
+		The differentiated parameters, in order
+	protocol : StimulusProtocol
+		The integrated schedule (its second segment is the stimulated phase)
+	nfev, njev : int
+		Evaluations of the augmented right-hand side and Jacobian
+	status : int
+		0 on success, -1 if a segment failed (outputs are NaN after the failure)
+	message : str
+		Solver message of the last segment integrated
+	'''
+	def __init__(self, t, y, sensitivities, names, protocol, nfev, njev, status, message):
+		self.t = t
+		self.y = y
+		self.sensitivities = sensitivities
+		self.names = names
+		self.protocol = protocol
+		self.nfev = nfev
+		self.njev = njev
+		self.status = status
+		self.message = message
+
+	@property
+	def success(self):
+		return self.status == 0
+
+	def __getitem__(self, name):
+		'''(T,) trajectory of a state'''
+		if name == 'time':
+			return self.t
+		return self.y[STATE_NAMES.index(name)]
+
+	def sensitivity(self, state, name):
+		'''(T,) derivative of one state's trajectory with respect to one parameter'''
+		return self.sensitivities[STATE_NAMES.index(state), self.names.index(name)]
+
+	def _metric_index(self, metric):
+		# Output position the metric is read at
+		if metric == 'peak_hco3':
+			return int(np.argmax(self.y[1]))
+		if metric == 'plateau_cl':
+			return int(np.searchsorted(self.t, self.protocol.segments[1][1]))
+		raise ValueError('Unknown metric %r (peak_hco3 or plateau_cl)' % metric)
+
+	def metric(self, metric):
+		'''Peak luminal HCO3- ('peak_hco3') or luminal Cl- plateau at t_off ('plateau_cl'), mM'''
+		value = self.y[1, self._metric_index(metric)]
+		return float(value if metric == 'peak_hco3' else 160 - value)
+
+	def gradient(self, metric):
+		'''
+		(k,) derivative of a report metric with respect to names
+
+		The peak moves with the trajectory at its argmax (the time of the peak
+		shifts only at second order), and luminal Cl- is 160 - bl.
+		'''
+		row = self.sensitivities[1, :, self._metric_index(metric)]
+		return row.copy() if metric == 'peak_hco3' else -row
+
+	def gradients(self):
+		'''Metric -> dict of parameter name -> derivative'''
+		return {metric: dict(zip(self.names, self.gradient(metric))) for metric in ('peak_hco3', 'plateau_cl')}
+
+	def _covariance(self, uncertainty):
+		# (k, k) covariance from standard errors (k,), a covariance (k, k) or a dict of standard errors
+		if isinstance(uncertainty, dict):
+			uncertainty = [uncertainty.get(name, 0.0) for name in self.names]
+		uncertainty = np.asarray(uncertainty, dtype=float)
+		return np.diag(uncertainty**2) if uncertainty.ndim == 1 else uncertainty
+
+	def standard_deviation(self, uncertainty):
+		'''
+		(5, T) delta-method standard deviation of the states
+
+		Parameters
+		----------
+		uncertainty : dict, array
+			Standard errors of the parameters (dict by name, missing names
+			meaning exact, or (k,) in names order) or their (k, k) covariance
+		'''
+		covariance = self._covariance(uncertainty)
+		variance = np.einsum('ikt,kl,ilt->it', self.sensitivities, covariance, self.sensitivities)
+		return np.sqrt(np.maximum(variance, 0))
+
+	def metric_standard_deviation(self, metric, uncertainty):
+		'''Delta-method standard deviation of a report metric (mM)'''
+		gradient = self.gradient(metric)
+		return float(np.sqrt(max(gradient @ self._covariance(uncertainty) @ gradient, 0)))
+
+	def band(self, state, uncertainty, z=1.96):
+		'''
+		(lower, upper) delta-method band of a state's trajectory
+
+		state may also be 'cl' for luminal Cl- (160 - bl). z = 1.96 gives
+		approximate 95% bands for normally distributed parameter errors.
+		'''
+		row = STATE_NAMES.index('bl' if state == 'cl' else state)
+		centre = 160 - self.y[row] if state == 'cl' else self.y[row]
+		spread = z*self.standard_deviation(uncertainty)[row]
+		return centre - spread, centre + spread
+
+
+def _level_gradient(level, names):
+	# d(conductance level)/d(names): one for the named parameter, zero for fixed values
+	gradient = np.zeros(len(names))
+	if isinstance(level, str) and level in names:
+		gradient[names.index(level)] = 1.0
+	return gradient
+
+
+def integrate_sensitivities(params, protocol, names=SENSITIVITY_PARAMS, t_eval=None, y0=None, **solver_options):
+	'''
+	Integrate the duct model and its forward sensitivities through a protocol
+
+	Parameters
+	----------
+	params : dict or DuctParams
+		Model parameters
+	protocol : StimulusProtocol
+		gcftr(t) schedule
+	names : tuple of str
+		Parameters to differentiate with respect to (any of PARAM_NAMES)
+	t_eval : array, optional
+		Sorted output times (default: duct_model_autotune.metric_grid, dense
+		enough to locate the peak). A breakpoint reports the state before the switch.
+	y0 : array, optional
+		Initial (bi, bl, ci, ni), treated as fixed
+	**solver_options
+		solve_ivp method (an implicit one), rtol and atol (default SENSITIVITY_OPTIONS)
+
+	Returns
+	-------
+	SensitivityResult
+	'''
+	params = compile_params(params)
+	names = tuple(names)
+	unknown = set(names) - set(PARAM_NAMES)
+	if unknown:
+		raise ValueError('Unknown parameters %s' % sorted(unknown))
+	options = dict(SENSITIVITY_OPTIONS, **solver_options)
+	columns = [PARAM_INDEX[name] for name in names]
+	values = params.values
+	k = len(names)
+	t_eval = metric_grid(protocol) if t_eval is None else np.asarray(t_eval, dtype=float)
+	table = protocol.resolve(params)
+
+	z = np.zeros(5 + 5*k)
+	z[:4] = params.y0[:4] if y0 is None else np.asarray(y0, dtype=float)[:4]
+	out = np.full((5 + 5*k, t_eval.size), np.nan)
+	nfev = njev = 0
+	status, message = 0, ''
+	for i, ((t_start, t_end, level_start, level_end), segment) in enumerate(zip(table, protocol.segments)):
+		slope = (level_end - level_start)/(t_end - t_start)
+		slope_gradient = (_level_gradient(segment[3], names) - _level_gradient(segment[2], names))/(t_end - t_start)
+		z[4] = level_start
+		z[5 + 4*k:] = _level_gradient(segment[2], names)
+
+		def fun(t, z):
+			y, S = z[:5], z[5:].reshape(5, k)
+			f = duct_model_generated.rhs(t, y, values)
+			f[4] = slope
+			dS = duct_model_generated.jacobian(t, y, values) @ S + duct_model_generated.param_jacobian(t, y, values)[:, columns]
+			dS[4] = slope_gradient
+			return np.concatenate([f, dS.ravel()])
+
+		def jac(t, z):
+			J = duct_model_generated.jacobian(t, z[:5], values)
+			# S is stored row-major, so every parameter column sees J through kron(J, I)
+			return block_diag(J, np.kron(J, np.eye(k)))
+
+		state = solve_ivp(fun, (t_start, t_end), z, jac=jac, dense_output=True, **options)
+		nfev += state.nfev
+		njev += state.njev
+		message = state.message
+		points = (t_eval > t_start) & (t_eval <= t_end)
+		if i == 0:
+			points |= t_eval == t_start
+		if state.status < 0:
+			status = -1
+			break
+		if np.any(points):
+			out[:, points] = state.sol(t_eval[points])
+		z = state.y[:, -1].copy()
+	return SensitivityResult(t_eval, out[:5], out[5:].reshape(5, k, t_eval.size), names, protocol, nfev, njev,
+							 status, message)
@@ -0,0 +1,264 @@
+# duct_model_sobol.py
+
+'''
+Variance-based global sensitivity analysis (Sobol indices) of the duct model.
+
+One-at-a-time sweeps (vol_rat_calc, antiporters_calc) vary a single
+parameter around init_cond; Sobol indices instead apportion the variance of
+a report metric over all declared parameter ranges at once. The first-order
+index S_i is the share of the variance explained by parameter i alone, the
+total index ST_i also counts every interaction it takes part in, so
+parameters with small ST_i can be fixed and those with large ST_i deserve
+better experimental estimates.
+
+The Saltelli scheme draws two base matrices A and B (N rows, one column per
+parameter) from one scrambled Sobol' sequence of dimension 2d and evaluates
+the model on A, B and the d matrices AB_i (A with column i taken from B),
+N(d + 2) runs in all. The estimators are those of Saltelli et al. (2010)
+for S_i and Jansen (1999) for ST_i,
+
+	S_i  = mean(f_B (f_AB_i - f_A)) / V
+	ST_i = mean((f_A - f_AB_i)**2) / (2 V)
+
+with V the variance of f over A and B, and confidence intervals come from
+bootstrapping the N base rows.
+
+Rows are evaluated in chunks of about CHUNK_MEMBERS model runs, each chunk
+one batched solve_ensemble call that regenerates its own rows of the
+sequence (Sobol.fast_forward), so only the scalar metrics of each run are
+kept: memory stays flat however many samples are drawn, and chunks run in
+parallel worker processes.
+
+Run using:
+	python3 duct_model_sobol.py [log2 of the number of base rows]
+
+Developed by Ariel Precision Medicine
+'''
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import qmc
+
+from dcw_duct_model import compile_params, init_cond, DuctParams, PARAM_NAMES
+from duct_model_ensemble import solve_ensemble
+from duct_model_protocol import report_metrics, StimulusProtocol
+
+# Transport, buffering and geometry constants of the Whitcomb-Ermentrout table,
+# each varied by +-50% around init_cond
+TABLE_PARAMS = ('g_bi', 'g_cl', 'kbi', 'kcl', 'gnbc', 'gapl', 'gapbl', 'buf', 'gk', 'gnak', 'gnaleak', 'jac', 'vr')
+DEFAULT_BOUNDS = {name: (0.5*init_cond[name], 1.5*init_cond[name]) for name in TABLE_PARAMS}
+
+# Scalar outputs of duct_model_protocol.report_metrics the indices are computed for
+OUTPUTS = ('peak_hco3', 'plateau_cl')
+
+# Model runs per batched solve_ensemble call (about 6 MB of output at OUTPUT_POINTS)
+CHUNK_MEMBERS = 2048
+
+# Output samples per protocol segment the metrics are read from
+OUTPUT_POINTS = 100
+
+# Bootstrap resamples of the base rows and the confidence level of the intervals
+BOOTSTRAP = 500
+CONFIDENCE = 0.95
+
+
+class SobolResult():
+	'''
+	Output of sobol_indices
+
+	Attributes
+	----------
+	names : tuple of str
+		The varied parameters
+	bounds : dict
+		Parameter name -> (low, high) sampled uniformly
+	outputs : tuple of str
+		The analysed metrics
+	first_order, total : dict
+		Output -> (d,) first-order and total indices in names order
+	first_order_ci, total_ci : dict
+		Output -> (d, 2) bootstrap confidence intervals
+	n_base : int
+		Base rows N (the model ran N*(d + 2) times)
+	n_failed : int
+		Base rows dropped because a run of theirs failed
+	seconds : float
+		Wall-clock time of the evaluation
+	'''
+	def __init__(self, names, bounds, outputs, first_order, total, first_order_ci, total_ci, n_base, n_failed,
+				 seconds):
+		self.names = names
+		self.bounds = bounds
+		self.outputs = outputs
+		self.first_order = first_order
+		self.total = total
+		self.first_order_ci = first_order_ci
+		self.total_ci = total_ci
+		self.n_base = n_base
+		self.n_failed = n_failed
+		self.seconds = seconds
+
+	@property
+	def n_evaluations(self):
+		return self.n_base*(len(self.names) + 2)
+
+	def to_frame(self):
+		'''
+		One row per output and parameter, ranked by total index within each output
+
+		Returns
+		-------
+		pd.DataFrame
+			Columns output, parameter, S1, S1_low, S1_high, ST, ST_low, ST_high
+		'''
+		rows = []
+		for output in self.outputs:
+			for i, name in enumerate(self.names):
+				rows.append({'output': output, 'parameter': name,
+							 'S1': self.first_order[output][i], 'S1_low': self.first_order_ci[output][i, 0],
+							 'S1_high': self.first_order_ci[output][i, 1], 'ST': self.total[output][i],
+							 'ST_low': self.total_ci[output][i, 0], 'ST_high': self.total_ci[output][i, 1]})
+		frame = pd.DataFrame(rows)
+		return frame.sort_values(['output', 'ST'], ascending=[True, False]).reset_index(drop=True)
+
+
+def saltelli_indices(f_a, f_b, f_ab):
+	'''
+	First-order (Saltelli 2010) and total (Jansen) Sobol indices
+
+	Parameters
+	----------
+	f_a, f_b : np.ndarray
+		(N,) outputs on the base matrices A and B
+	f_ab : np.ndarray
+		(N, d) outputs on AB_i
+
+	Returns
+	-------
+	tuple
+		((d,) first-order indices, (d,) total indices)
+	'''
+	# Centring leaves the indices unchanged but removes the mean's (large) contribution to their variance
+	mean = np.mean(np.concatenate([f_a, f_b]))
+	f_a, f_b, f_ab = f_a - mean, f_b - mean, f_ab - mean
+	variance = np.var(np.concatenate([f_a, f_b]))
+	first = np.mean(f_b[:, None]*(f_ab - f_a[:, None]), axis=0)/variance
+	total = 0.5*np.mean((f_a[:, None] - f_ab)**2, axis=0)/variance
+	return first, total
+
+
+def _evaluate_rows(task):
+	# Metrics of the A, B and AB_i runs of base rows [start, start + rows) as (outputs, rows, d + 2)
+	values, y0, protocol, names, low, high, seed, start, rows, outputs, solver_options = task
+	base = DuctParams(values, y0)
+	d = len(names)
+	sampler = qmc.Sobol(2*d, scramble=True, seed=seed)
+	if start:
+		sampler.fast_forward(start)
+	u = sampler.random(rows)
+	a = low + (high - low)*u[:, :d]
+	b = low + (high - low)*u[:, d:]
+	matrices = [a, b]
+	for i in range(d):
+		ab = a.copy()
+		ab[:, i] = b[:, i]
+		matrices.append(ab)
+	members = [base.replace(**dict(zip(names, row))) for matrix in matrices for row in matrix]
+	grid = np.unique(protocol.sample_grid(OUTPUT_POINTS))
+	result = solve_ensemble(members, protocol, grid, **solver_options)
+	metrics = report_metrics(result.y, grid, protocol)
+	return np.array([metrics[output] for output in outputs]).reshape(len(outputs), d + 2, rows).transpose(0, 2, 1)
+
+
+def sobol_indices(bounds=None, n_base=1024, params=None, protocol=None, outputs=OUTPUTS, workers=None, seed=0,
+				  bootstrap=BOOTSTRAP, confidence=CONFIDENCE, **solver_options):
+	'''
+	Sobol indices of report metrics over a box of parameter values
+
+	Parameters
+	----------
+	bounds : dict, optional
+		Parameter name -> (low, high), sampled uniformly (default DEFAULT_BOUNDS)
+	n_base : int
+		Base rows N, rounded up to a power of two (the balance of the Sobol'
+		sequence needs it); the model runs N*(d + 2) times
+	params : dict or DuctParams, optional
+		Values of every parameter not varied (default init_cond)
+	protocol : StimulusProtocol, optional
+		Piecewise-constant schedule (default: the 20000 / 120000 / 200000 secretin pulse)
+	outputs : tuple of str
+		Metrics of duct_model_protocol.report_metrics to analyse
+	workers : int, optional
+		Worker processes (default: one per core; 1 evaluates in this process)
+	seed : int
+		Scrambling seed of the sequence and seed of the bootstrap
+	bootstrap : int
+		Bootstrap resamples for the confidence intervals
+	confidence : float
+		Coverage of the intervals
+	**solver_options
+		Passed to solve_ensemble
+
+	Returns
+	-------
+	SobolResult
+	'''
+	bounds = DEFAULT_BOUNDS if bounds is None else bounds
+	unknown = set(bounds) - set(PARAM_NAMES)
+	if unknown:
+		raise ValueError('Unknown parameters %s' % sorted(unknown))
+	names = tuple(bounds)
+	d = len(names)
+	low = np.array([bounds[name][0] for name in names], dtype=float)
+	high = np.array([bounds[name][1] for name in names], dtype=float)
+	base = compile_params(init_cond if params is None else params)
+	protocol = protocol or StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+	n_base = 1 << int(np.ceil(np.log2(max(n_base, 2))))
+	# Power-of-two chunks keep every chunk of the sequence balanced as well
+	rows = 1 << int(np.floor(np.log2(max(CHUNK_MEMBERS//(d + 2), 1))))
+	rows = min(rows, n_base)
+	tasks = [(base.values, base.y0, protocol, names, low, high, seed, start, rows, tuple(outputs), solver_options)
+			 for start in range(0, n_base, rows)]
+
+	started = time.perf_counter()
+	values = np.empty((len(outputs), n_base, d + 2))
+	workers = os.cpu_count() if workers is None else workers
+	if workers == 1:
+		chunks = map(_evaluate_rows, tasks)
+		for task, chunk in zip(tasks, chunks):
+			values[:, task[7]:task[7] + rows] = chunk
+	else:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			for task, chunk in zip(tasks, executor.map(_evaluate_rows, tasks)):
+				values[:, task[7]:task[7] + rows] = chunk
+	seconds = time.perf_counter() - started
+
+	# A base row is only usable if all of its d + 2 runs succeeded
+	usable = np.all(np.isfinite(values), axis=(0, 2))
+	values = values[:, usable]
+	rng = np.random.default_rng(seed)
+	tail = 100*(1 - confidence)/2
+	first_order, total, first_order_ci, total_ci = {}, {}, {}, {}
+	for k, output in enumerate(outputs):
+		f_a, f_b, f_ab = values[k, :, 0], values[k, :, 1], values[k, :, 2:]
+		first_order[output], total[output] = saltelli_indices(f_a, f_b, f_ab)
+		samples = np.empty((bootstrap, 2, d))
+		for j in range(bootstrap):
+			rows_drawn = rng.integers(0, f_a.size, f_a.size)
+			samples[j] = saltelli_indices(f_a[rows_drawn], f_b[rows_drawn], f_ab[rows_drawn])
+		limits = np.percentile(samples, [tail, 100 - tail], axis=0)
+		first_order_ci[output] = limits[:, 0].T
+		total_ci[output] = limits[:, 1].T
+	return SobolResult(names, dict(bounds), tuple(outputs), first_order, total, first_order_ci, total_ci, n_base,
+					   int(np.sum(~usable)), seconds)
+
+
+if __name__ == '__main__':
+	n_base = 2**int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+	result = sobol_indices(n_base=n_base)
+	print('%d runs in %.1f s (%d base rows dropped)' % (result.n_evaluations, result.seconds, result.n_failed))
+	print(result.to_frame().to_string(index=False, float_format='%.3f'))
@@ -0,0 +1,358 @@
+# duct_model_steady_state.py
+
+'''
+Direct steady-state solver for the duct model.
+
+Instead of integrating for 100,000+ time units to read off a plateau, the
+equilibrium dbi = dbl = dci = dni = 0 is solved for directly at a fixed CFTR
+conductance with a hybrid Powell root-finder using the exact Jacobian from
+duct_model_generated. Every solution is remembered so the next request starts
+from the nearest previously solved parameter set; when the root-finder does
+not converge (or leaves the physical region) the solver falls back to
+pseudo-transient continuation, i.e. implicit Euler with growing time steps.
+
+Note that the resting phase of run_model_CFTR (gcftrbase between t = 0 and
+t_on) does not reach this equilibrium: its slowest (chloride) mode has a time
+constant of roughly 3.6e6 time units, so the state at t_on is still far from
+the true resting steady state. The stimulated plateau is reached to within a
+fraction of a percent by t_off for WT parameters. With the antiporters off the
+chloride flux through CFTR must vanish at equilibrium, so the plateau itself
+does not depend on variant_adj; reduced CFTR function only slows down how fast
+it is approached. Use the full trajectory whenever the time course matters.
+
+Because the resting phase stops short of that equilibrium, what the engine
+reuses between runs is the resting phase itself: RestingPhaseCache keeps
+the integrated first segment of integrate_protocol keyed by the parameters
+that act while gcftr = gcftrbase (resting_key), so a repeated request starts
+the stimulated phase directly from the stored state at t_on with results
+identical to integrating it again.
+
+Developed by Ariel Precision Medicine
+'''
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy.optimize import root
+
+from dcw_duct_model import compile_params, duct_model_rhs, duct_model_jacobian, PARAM_INDEX, PARAM_NAMES, STATE_NAMES
+
+
+class SteadyStateResult():
+	'''
+	Output of steady_state
+
+	Attributes
+	----------
+	y : np.ndarray
+		(5,) equilibrium state ordered as STATE_NAMES (y[4] is the gcftr used)
+	success : bool
+		Whether the residual tolerance was met inside the physical region
+	method : str
+		'newton' or 'pseudo-transient'
+	nfev : int
+		Right-hand side evaluations spent
+	residual : float
+		Max-norm of the right-hand side at y
+	warm_start : bool
+		Whether the initial guess came from a previously solved parameter set
+	'''
+	def __init__(self, y, success, method, nfev, residual, warm_start):
+		self.y = y
+		self.success = success
+		self.method = method
+		self.nfev = nfev
+		self.residual = residual
+		self.warm_start = warm_start
+
+	def __getitem__(self, name):
+		# Allow result['bl'] style access like the graphing dictionaries
+		return self.y[STATE_NAMES.index(name)]
+
+
+# Conductance scale of the cache key log1p(gcftr/GCFTR_SCALE): logarithmic well above it,
+# linear below it down to zero CFTR function (1% of the resting gcftrbase)
+GCFTR_SCALE = 7e-7
+
+
+class SteadyStateCache():
+	'''
+	Solved equilibria keyed by parameter vector and CFTR conductance
+
+	The nearest entry is found with a relative distance over all parameters
+	(and log-distance in gcftr, which spans several orders of magnitude; the
+	key log1p(gcftr/GCFTR_SCALE) keeps gcftr = 0 finite).
+
+	Parameters
+	----------
+	maxsize : int
+		Oldest entries are dropped beyond this many solutions
+	'''
+	def __init__(self, maxsize=4096):
+		self.maxsize = maxsize
+		self.keys = []
+		self.states = []
+
+	def __len__(self):
+		return len(self.keys)
+
+	def clear(self):
+		self.keys = []
+		self.states = []
+
+	@staticmethod
+	def _key(params, gcftr):
+		return np.append(params.values, np.log1p(gcftr/GCFTR_SCALE))
+
+	def add(self, params, gcftr, y):
+		self.keys.append(self._key(params, gcftr))
+		self.states.append(np.array(y[:4]))
+		if len(self.keys) > self.maxsize:
+			del self.keys[0]
+			del self.states[0]
+
+	def nearest(self, params, gcftr):
+		'''
+		Closest stored equilibrium, or None when the cache is empty
+
+		Returns
+		-------
+		tuple
+			(state, distance) with distance 0 for an exact hit
+		'''
+		if not self.keys:
+			return None
+		key = self._key(params, gcftr)
+		keys = np.array(self.keys)
+		distance = np.sum(np.abs(keys - key)/(np.abs(keys) + np.abs(key) + 1e-12), axis=1)
+		best = int(np.argmin(distance))
+		return self.states[best], distance[best]
+
+
+STEADY_STATE_CACHE = SteadyStateCache()
+
+
+# Parameters that cannot act during a constant-conductance segment: the CFTR levels
+# (the segment's resolved level is keyed instead) and the antiporter constants
+# while the antiporters they belong to are switched off
+CONDUCTANCE_LEVELS = ('gcftron', 'gcftrbase')
+LUMINAL_ANTIPORTER = ('gapl',)
+BASOLATERAL_ANTIPORTER = ('gapbl', 'cb')
+ANTIPORTER_AFFINITIES = ('kbi', 'kcl')
+
+
+def resting_parameters(params):
+	'''
+	Parameters the right-hand side depends on at a fixed CFTR conductance
+
+	Parameters
+	----------
+	params : dict or DuctParams
+		Model parameters (the antiporter flags decide which constants act)
+
+	Returns
+	-------
+	np.ndarray
+		Boolean mask over PARAM_NAMES
+	'''
+	params = compile_params(params)
+	unused = list(CONDUCTANCE_LEVELS)
+	if not params.ap_status:
+		unused += LUMINAL_ANTIPORTER
+	if not params.apb_status:
+		unused += BASOLATERAL_ANTIPORTER
+	if not (params.ap_status or params.apb_status):
+		unused += ANTIPORTER_AFFINITIES
+	mask = np.ones(len(PARAM_NAMES), dtype=bool)
+	mask[[PARAM_INDEX[name] for name in unused]] = False
+	return mask
+
+
+def resting_key(params, y0, segment, solver_key):
+	'''
+	Cache key of a constant-conductance segment
+
+	Parameters
+	----------
+	params : DuctParams
+		Model parameters
+	y0 : np.ndarray
+		State the segment starts from
+	segment : tuple
+		(t_start, t_end, gcftr) with the level resolved to a value
+	solver_key : tuple
+		Hashable description of the integrator settings
+
+	Returns
+	-------
+	tuple
+		Equal for runs whose segment integration is identical
+	'''
+	return (params.values[resting_parameters(params)].tobytes(), np.asarray(y0, dtype=float)[:4].tobytes(),
+			tuple(float(value) for value in segment), solver_key)
+
+
+class RestingPhaseCache():
+	'''
+	Integrated resting (first) segments of integrate_protocol, least recently used dropped first
+
+	Parameters
+	----------
+	maxsize : int
+		Segments kept
+
+	Attributes
+	----------
+	hits, misses : int
+		Lookups answered from the cache and lookups that integrated
+	'''
+	def __init__(self, maxsize=256):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def clear(self):
+		self.entries.clear()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		'''Stored segment state for key, or None'''
+		state = self.entries.get(key)
+		if state is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.entries.move_to_end(key)
+		return state
+
+	def add(self, key, state):
+		self.entries[key] = state
+		self.entries.move_to_end(key)
+		if len(self.entries) > self.maxsize:
+			self.entries.popitem(last=False)
+
+
+RESTING_CACHE = RestingPhaseCache()
+
+
+def _physical(x):
+	# Concentrations stay positive and luminal Cl- (160 - bl) stays positive
+	return bool(np.all(np.isfinite(x)) and np.all(x > 0) and x[1] < 160)
+
+
+def _pseudo_transient(fun, jac, x0, tol, max_iter):
+	'''
+	Pseudo-transient continuation with switched evolution relaxation:
+	(I/dt - J) dx = F, dt grown by the residual reduction so the iteration
+	turns into Newton's method near the solution.
+	'''
+	x = x0.copy()
+	f = fun(x)
+	norm = np.abs(f).max()
+	dt = 1/max(np.abs(np.diag(jac(x))).max(), 1e-12)
+	for _ in range(max_iter):
+		if norm < tol:
+			return x, True
+		step = np.linalg.solve(np.eye(x.size)/dt - jac(x), f)
+		x_new = x + step
+		if not _physical(x_new):
+			dt *= 0.5
+			continue
+		f_new = fun(x_new)
+		norm_new = np.abs(f_new).max()
+		dt = min(dt*norm/max(norm_new, 1e-300), 1e15)
+		x, f, norm = x_new, f_new, norm_new
+	return x, norm < tol
+
+
+def steady_state(params, gcftr='gcftron', guess=None, cache=STEADY_STATE_CACHE, tol=1e-12, max_iter=500):
+	'''
+	Solve dbi = dbl = dci = dni = 0 for a fixed CFTR conductance
+
+	Parameters
+	----------
+	params : dict or DuctParams
+		Model parameters
+	gcftr : str or float
+		CFTR conductance, either a parameter name ('gcftron', 'gcftrbase') or a value
+	guess : array, optional
+		Initial (bi, bl, ci, ni). Defaults to the nearest cached solution, then to the
+		initial conditions stored in params.
+	cache : SteadyStateCache or None
+		Store of previous solutions used for warm starts (None disables it)
+	tol : float
+		Max-norm tolerance on the right-hand side
+	max_iter : int
+		Iteration limit for the pseudo-transient fallback
+
+	Returns
+	-------
+	SteadyStateResult
+	'''
+	params = compile_params(params)
+	if isinstance(gcftr, str):
+		gcftr = params.constants[PARAM_INDEX[gcftr]]
+	warm_start = False
+	if guess is None:
+		hit = cache.nearest(params, gcftr) if cache is not None else None
+		if hit is not None:
+			guess = hit[0]
+			warm_start = True
+		else:
+			guess = params.y0[:4]
+	x0 = np.array(guess[:4], dtype=float)
+
+	y = np.empty(5)
+	y[4] = gcftr
+	out = np.empty(5)
+	counter = [0]
+
+	def fun(x):
+		counter[0] += 1
+		y[:4] = x
+		return duct_model_rhs(0, y, params, out)[:4].copy()
+
+	def jac(x):
+		y[:4] = x
+		return duct_model_jacobian(0, y, params)[:4, :4]
+
+	method = 'newton'
+	with np.errstate(invalid='ignore', divide='ignore'):
+		solution = root(fun, x0, jac=jac, method='hybr', options={'xtol': 1e-13})
+		x = solution.x
+		converged = _physical(x) and np.abs(fun(x)).max() < tol
+		if not converged:
+			method = 'pseudo-transient'
+			start = x0 if _physical(x0) else params.y0[:4]
+			x, converged = _pseudo_transient(fun, jac, np.array(start, dtype=float), tol, max_iter)
+
+	y_final = np.append(x, gcftr)
+	residual = float(np.abs(fun(x)).max())
+	if converged and cache is not None:
+		cache.add(params, gcftr, y_final)
+	return SteadyStateResult(y_final, bool(converged), method, counter[0], residual, warm_start)
+
+
+def plateau_summary(params, cache=STEADY_STATE_CACHE):
+	'''
+	Resting and CFTR-open equilibria for summary-only reports
+
+	Parameters
+	----------
+	params : dict or DuctParams
+		Model parameters
+
+	Returns
+	-------
+	dict
+		{'resting': SteadyStateResult at gcftrbase, 'stimulated': SteadyStateResult at gcftron}
+	'''
+	params = compile_params(params)
+	resting = steady_state(params, 'gcftrbase', cache=cache)
+	stimulated = steady_state(params, 'gcftron', cache=cache)
+	return {'resting': resting, 'stimulated': stimulated}
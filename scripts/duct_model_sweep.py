@@ -0,0 +1,324 @@
+# duct_model_sweep.py
+
+'''
+Declarative parameter sweeps of the duct model.
+
+A Sweep is an ordered list of runs, each a dict of parameter overrides
+applied to a base parameter set. Designs are built from
+
+	Sweep.grid(vr=[10, 1, 0.1], ap_status=[True, False])     factorial
+	Sweep.zip(ap_status=[True, False], apb_status=[True, False])   paired
+	Sweep.random(200, gnbc=(1, 3), ap_status=[True, False])  random
+	Sweep([{}, {'variant_adj': 0.2}])                         explicit
+
+and combined with * (every run of one with every run of the other) and +
+(one design after the other). Any model parameter, flag (ap_status,
+apb_status) or initial concentration (bi, bl, ci, ni) can be swept.
+
+run_sweep integrates every run of a design through one protocol, either as
+batched solve_ensemble calls (mode='ensemble', failed members re-run with
+solver fallbacks at the same tolerances and time limit) or one
+integrate_with_fallbacks run per design point in a process pool
+(mode='pool'). The base parameters are never modified. The SweepResult
+holds the design and the trajectories on a common time grid, as a tidy
+table (one row per run and time) and as per-run summaries of the report
+metrics. The graph types of dcw_duct_graphing_functions are built on it.
+
+Developed by Ariel Precision Medicine
+'''
+
+import itertools
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from dcw_duct_model import compile_params, init_cond, DuctParams, PARAM_NAMES, STATE_NAMES
+from duct_model_ensemble import DuctEnsemble, fallback_options, retry_failed_members, solve_ensemble
+from duct_model_protocol import describe_attempts, integrate_with_fallbacks, report_metrics, SimulationError, StimulusProtocol
+
+# Parameters, flags and initial concentrations a sweep may set
+SWEEP_NAMES = PARAM_NAMES + STATE_NAMES[:4]
+
+# Members per batched solve_ensemble call in ensemble mode
+CHUNK_MEMBERS = 1024
+
+SWEEP_MODES = ('ensemble', 'pool')
+
+
+class Sweep():
+	'''
+	An ordered design of model runs
+
+	Parameters
+	----------
+	runs : list of dict
+		Parameter overrides of every run ({} runs the base parameters)
+	'''
+	def __init__(self, runs):
+		self.runs = [dict(run) for run in runs]
+
+	@classmethod
+	def grid(cls, **axes):
+		'''Full factorial design; the first axis varies slowest'''
+		names = list(axes)
+		return cls(dict(zip(names, values)) for values in itertools.product(*(axes[name] for name in names)))
+
+	@classmethod
+	def zip(cls, **axes):
+		'''The i-th run takes the i-th value of every axis (all of one length)'''
+		lengths = {len(values) for values in axes.values()}
+		if len(lengths) > 1:
+			raise ValueError('Zipped axes need equal lengths, got %s' % {name: len(v) for name, v in axes.items()})
+		names = list(axes)
+		return cls(dict(zip(names, values)) for values in zip(*(axes[name] for name in names)))
+
+	@classmethod
+	def random(cls, n_samples, seed=None, log=(), **axes):
+		'''
+		Random design
+
+		Parameters
+		----------
+		n_samples : int
+			Number of runs
+		seed : int, optional
+			Seed of the draws
+		log : tuple of str
+			Axes drawn log-uniformly
+		**axes
+			name=(low, high) draws uniformly from the range, name=[a, b, ...]
+			draws uniformly from the listed values (e.g. flags)
+		'''
+		rng = np.random.default_rng(seed)
+		columns = {}
+		for name, axis in axes.items():
+			if isinstance(axis, tuple):
+				low, high = axis
+				if name in log:
+					columns[name] = np.exp(rng.uniform(np.log(low), np.log(high), n_samples))
+				else:
+					columns[name] = rng.uniform(low, high, n_samples)
+			else:
+				columns[name] = [axis[k] for k in rng.integers(0, len(axis), n_samples)]
+		return cls({name: columns[name][i] for name in axes} for i in range(n_samples))
+
+	@property
+	def names(self):
+		'''Swept names in order of first appearance'''
+		return tuple(dict.fromkeys(name for run in self.runs for name in run))
+
+	def __len__(self):
+		return len(self.runs)
+
+	def __iter__(self):
+		return iter(self.runs)
+
+	def __add__(self, other):
+		return Sweep(self.runs + other.runs)
+
+	def __mul__(self, other):
+		return Sweep(dict(a, **b) for a in self.runs for b in other.runs)
+
+	def __repr__(self):
+		return 'Sweep(%d runs over %s)' % (len(self), ', '.join(self.names) or 'no parameters')
+
+
+class SweepResult():
+	'''
+	Output of run_sweep
+
+	Attributes
+	----------
+	design : pd.DataFrame
+		One row per run (index 'run'), one column per swept name; names a run
+		does not set hold the base value
+	t : np.ndarray
+		(T,) output times
+	y : np.ndarray
+		(5, N, T) states of every run (a breakpoint reports the state before the switch)
+	status : np.ndarray
+		(N,) 0 for successful runs
+	attempts : dict
+		Run -> solver attempt records of runs that needed fallbacks
+	protocol : StimulusProtocol
+		The integrated schedule
+	mode : str
+		'ensemble' or 'pool'
+	seconds : float
+		Wall-clock time of the integration
+	'''
+	def __init__(self, design, t, y, status, attempts, protocol, mode, seconds):
+		self.design = design
+		self.t = t
+		self.y = y
+		self.status = status
+		self.attempts = attempts
+		self.protocol = protocol
+		self.mode = mode
+		self.seconds = seconds
+
+	@property
+	def success(self):
+		return bool(np.all(self.status == 0))
+
+	def __len__(self):
+		return len(self.design)
+
+	def run(self, i):
+		'''[t, bi, bl, ci, ni] of one run, the layout of dcw_duct_graphing_functions.run_protocol'''
+		return [self.t] + list(self.y[:4, i])
+
+	def trajectory(self, i):
+		'''State name -> (T,) trajectory of one run, plus 'time' and luminal Cl- 'cl' '''
+		trajectory = dict(zip(STATE_NAMES, self.y[:, i]))
+		trajectory['cl'] = 160 - trajectory['bl']
+		trajectory['time'] = self.t
+		return trajectory
+
+	def to_frame(self):
+		'''
+		Tidy table of every run
+
+		Returns
+		-------
+		pd.DataFrame
+			One row per run and output time: run, the swept names, time, bi, bl, ci, ni and cl
+		'''
+		n, steps = len(self.design), self.t.size
+		frame = self.design.reset_index().loc[np.repeat(np.arange(n), steps)].reset_index(drop=True)
+		frame['time'] = np.tile(self.t, n)
+		for j, name in enumerate(STATE_NAMES[:4]):
+			frame[name] = self.y[j].ravel()
+		frame['cl'] = 160 - frame['bl']
+		return frame
+
+	def summary(self):
+		'''
+		Report metrics of every run
+
+		Returns
+		-------
+		pd.DataFrame
+			The design with peak_hco3, plateau_cl (duct_model_protocol.report_metrics) and status columns
+		'''
+		metrics = report_metrics(self.y, self.t, self.protocol)
+		frame = self.design.copy()
+		frame['peak_hco3'] = metrics['peak_hco3']
+		frame['plateau_cl'] = metrics['plateau_cl']
+		frame['status'] = self.status
+		return frame
+
+	def check(self):
+		'''
+		Raise if any run failed
+
+		Raises
+		------
+		SimulationError
+			With the failed run positions, their attempts and this result
+		'''
+		failed = np.flatnonzero(self.status != 0)
+		if failed.size:
+			attempts = [self.attempts.get(int(i), []) for i in failed]
+			message = '\n'.join('Simulation failed for run %d: %s' % (i, describe_attempts(a))
+								for i, a in zip(failed, attempts))
+			raise SimulationError(message, failed, attempts, self)
+		return self
+
+
+def _base_value(params, base, name):
+	# Value of name in the base parameters, as given when they came as a dict
+	if isinstance(params, dict) and name in params:
+		return params[name]
+	if name in STATE_NAMES[:4]:
+		return base.y0[STATE_NAMES.index(name)]
+	return getattr(base, name)
+
+
+def _run_point(task):
+	# One design point integrated with solver fallbacks: ((5, T) states, status, attempts)
+	values, y0, overrides, protocol, t, solver_options = task
+	state = integrate_with_fallbacks(DuctParams(values, y0).replace(**overrides), protocol, **solver_options)
+	if not state.success:
+		return np.full((5, t.size), np.nan), state.status, state.attempts
+	# Like solve_ensemble, the dense output reports a breakpoint with the state before the switch
+	return state.sol(t), 0, state.attempts
+
+
+def run_sweep(sweep, params=None, protocol=None, n_points=500, mode='ensemble', workers=None, **solver_options):
+	'''
+	Integrate every run of a sweep
+
+	Parameters
+	----------
+	sweep : Sweep
+		The design
+	params : dict or DuctParams, optional
+		Base parameters the runs override (default init_cond); not modified
+	protocol : StimulusProtocol, optional
+		Piecewise-constant schedule (default: the 20000 / 120000 / 200000 secretin pulse)
+	n_points : int
+		Output samples per protocol segment
+	mode : str
+		'ensemble' integrates the runs as batched solve_ensemble calls in this
+		process; 'pool' integrates each run with integrate_with_fallbacks in
+		worker processes
+	workers : int, optional
+		Worker processes of pool mode (default: one per core; 1 runs in this process)
+	**solver_options
+		Passed to solve_ensemble (ensemble mode) or integrate_with_fallbacks (pool mode)
+
+	Returns
+	-------
+	SweepResult
+		Failed runs have status != 0 and NaN trajectories (SweepResult.check raises for them)
+	'''
+	if mode not in SWEEP_MODES:
+		raise ValueError('Unknown mode %r (%s)' % (mode, ', '.join(SWEEP_MODES)))
+	unknown = set(sweep.names) - set(SWEEP_NAMES)
+	if unknown:
+		raise ValueError('Unknown parameters %s' % sorted(unknown))
+	params = init_cond if params is None else params
+	base = compile_params(params)
+	protocol = protocol or StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+	t = np.unique(protocol.sample_grid(n_points))
+	n = len(sweep)
+	y = np.full((5, n, t.size), np.nan)
+	status = np.zeros(n, dtype=int)
+	attempts = {}
+	started = time.perf_counter()
+
+	if mode == 'ensemble':
+		for start in range(0, n, CHUNK_MEMBERS):
+			members = DuctEnsemble([base.replace(**run) for run in sweep.runs[start:start + CHUNK_MEMBERS]])
+			result = solve_ensemble(members, protocol, t, **solver_options)
+			if not result.success:
+				retry_failed_members(result, members, protocol, **fallback_options(solver_options))
+				attempts.update({start + i: records for i, records in result.attempts.items()})
+			y[:, start:start + len(members)] = result.y
+			status[start:start + len(members)] = result.status
+	else:
+		tasks = [(base.values, base.y0, run, protocol, t, solver_options) for run in sweep.runs]
+		workers = os.cpu_count() if workers is None else workers
+		if workers == 1:
+			outputs = map(_run_point, tasks)
+		else:
+			executor = ProcessPoolExecutor(max_workers=workers)
+			outputs = executor.map(_run_point, tasks, chunksize=max(1, n//(4*workers)))
+		try:
+			for i, (states, code, records) in enumerate(outputs):
+				y[:, i], status[i] = states, code
+				if len(records) > 1 or code != 0:
+					attempts[i] = records
+		finally:
+			if workers != 1:
+				executor.shutdown()
+	seconds = time.perf_counter() - started
+
+	names = sweep.names
+	design = pd.DataFrame([{name: run.get(name, _base_value(params, base, name)) for name in names}
+						   for run in sweep.runs], columns=list(names))
+	design.index.name = 'run'
+	return SweepResult(design, t, y, status, attempts, protocol, mode, seconds)
@@ -0,0 +1,298 @@
+# duct_model_symbolic.py
+
+'''
+Symbolic definition of the Whitcomb & Ermentrout duct model.
+
+The equations of dcw_duct_model.duct_model_system (together with antiporter,
+eff_perm and nernst_potential) are rebuilt here with SymPy so that the exact
+Jacobian can be derived instead of approximated by finite differences.
+generate_module() writes duct_model_generated.py, a NumPy-only module with a
+common-subexpression-eliminated right-hand side, the analytic Jacobian and
+its sparsity pattern, and the analytic derivative of the right-hand side
+with respect to every parameter (for the forward sensitivity equations of
+duct_model_sensitivity). SymPy is only needed to regenerate that file.
+
+eff_perm is kept as an opaque function (EffPerm) whose derivatives are
+EffPermDxi / EffPermDxo, and logarithms are printed as safe_log, so the
+generated code calls the stable kernels of duct_model_kernels instead of
+expanding xi*xo*log(xi/xo)/(xi - xo), which is 0/0 where the concentrations cross.
+
+Run using:
+	python3 duct_model_symbolic.py
+
+Developed by Ariel Precision Medicine
+'''
+
+import os
+import numpy as np
+import sympy as sp
+
+from dcw_duct_model import (compile_params, duct_model_rhs, init_cond,
+							PARAM_NAMES, STATE_NAMES, RT_F)
+
+GENERATED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'duct_model_generated.py')
+
+
+def sym_antiporter(ao, ai, bo, bi, ka, kb):
+	'''Symbolic counterpart of dcw_duct_model.antiporter'''
+	numerator = ao*bi-bo*ai
+	denominator = (ka*kb*((1+ai/ka+bi/kb)*(ao/ka+bo/kb)+
+						  (1+ao/ka+bo/kb)*(ai/ka+bi/kb)))
+	return numerator / denominator
+
+
+class EffPermDxi(sp.Function):
+	'''d eff_perm/d xi, printed as duct_model_kernels.eff_perm_dxi'''
+	nargs = 2
+
+
+class EffPermDxo(sp.Function):
+	'''d eff_perm/d xo, printed as duct_model_kernels.eff_perm_dxo'''
+	nargs = 2
+
+
+class EffPerm(sp.Function):
+	'''eff_perm(xi, xo), printed as duct_model_kernels.eff_perm'''
+	nargs = 2
+
+	def fdiff(self, argindex=1):
+		return (EffPermDxi, EffPermDxo)[argindex - 1](*self.args)
+
+
+class KernelPrinter(sp.printing.numpy.NumPyPrinter):
+	'''NumPy printer that routes logarithms and eff_perm to duct_model_kernels'''
+	def _print_log(self, expr):
+		return 'safe_log(%s)' % self._print(expr.args[0])
+
+	def _print_kernel(self, name, expr):
+		return '%s(%s)' % (name, ', '.join(self._print(arg) for arg in expr.args))
+
+	def _print_EffPerm(self, expr):
+		return self._print_kernel('eff_perm', expr)
+
+	def _print_EffPermDxi(self, expr):
+		return self._print_kernel('eff_perm_dxi', expr)
+
+	def _print_EffPermDxo(self, expr):
+		return self._print_kernel('eff_perm_dxo', expr)
+
+
+def sym_eff_perm(xi, xo):
+	'''Symbolic counterpart of dcw_duct_model.eff_perm'''
+	return EffPerm(xi, xo)
+
+
+def sym_nernst_potential(a, b, rtf):
+	'''Symbolic counterpart of dcw_duct_model.nernst_potential'''
+	return rtf*sp.log(a/b)
+
+
+def build_system():
+	'''
+	Build the duct model right-hand side symbolically
+
+	Antiporter on/off flags enter as 0/1 multipliers and the optional
+	influences as plain factors, matching the compiled DuctParams values.
+
+	Returns
+	-------
+	states : list of sympy.Symbol
+		Symbols ordered as STATE_NAMES
+	params : list of sympy.Symbol
+		Symbols ordered as PARAM_NAMES
+	rhs : sympy.Matrix
+		(5, 1) right-hand side
+	'''
+	states = sp.symbols(STATE_NAMES, positive=True)
+	params = sp.symbols(PARAM_NAMES, real=True)
+	rtf = sp.Symbol('RT_F', positive=True)
+	bi, bl, ci, ni, gcftr = states
+	p = dict(zip(PARAM_NAMES, params))
+	cl = 160 - bl
+
+	# Nernst Potentials
+	eb = sym_nernst_potential(bi, bl, rtf)
+	enbc = sym_nernst_potential(bi**2*ni, p['bb']**2*p['nb'], rtf)
+	ec = sym_nernst_potential(ci, cl, rtf)
+	ena = sym_nernst_potential(p['nb'], ni, rtf)
+
+	# Permeabilities
+	kccf = sym_eff_perm(ci, cl)*gcftr*p['g_cl']
+	kbcf = sym_eff_perm(bi, bl)*gcftr*p['g_bi']
+	knbc = p['gnbc']
+
+	# Voltage Potential
+	v = (knbc*enbc+kbcf*eb+kccf*ec+p['gk']*p['ek']+p['gnaleak']*ena)/(knbc+kbcf+kccf+p['gk'])
+
+	# Flux Calculations
+	jnbc = knbc*(v-enbc)
+	jbcftr = kbcf*(v-eb)*p['smoke_adj']
+	jccftr = kccf*(v-ec)*p['variant_adj']*p['alcohol_adj']
+	japl = p['ap_status']*sym_antiporter(bl, bi, cl, ci, p['kbi'], p['kcl'])*p['gapl']
+	japbl = p['apb_status']*sym_antiporter(p['bb'], bi, p['cb'], ci, p['kbi'], p['kcl'])*p['gapbl']
+
+	jbl = (-jbcftr-japl)/p['vr']+p['jac']*p['rat']
+	jci = jccftr-japl-japbl
+	jcl = (-jccftr+japl)/p['vr']+p['jac']
+	jlum = (jcl+jbl)/p['ionstr']
+	jnak = p['gnak']*(v-p['epump'])*(ni/p['np0'])**3
+	jnaleak = p['gnaleak']*(v-ena)
+
+	zeta = p['zeta']
+	rhs = sp.Matrix([
+		zeta*p['chi']*(jbcftr+japl+japbl+p['buf']*(p['bi0']-bi)+2*jnbc),
+		(jbl-jlum*bl)*zeta,
+		jci*zeta,
+		zeta*(jnbc-jnak-jnaleak),
+		0])
+	return list(states), list(params), rhs
+
+
+def jacobian_sparsity(jac):
+	'''Boolean structural non-zero pattern of a symbolic Jacobian'''
+	return np.array([[entry != 0 for entry in row] for row in jac.tolist()], dtype=bool)
+
+
+def _emit_function(name, doc, exprs, shape, states, params, printer):
+	# Emit one CSE-optimized NumPy function filling an array of the given shape
+	used = set().union(*[expr.free_symbols for expr in exprs])
+	replacements, reduced = sp.cse(exprs, symbols=sp.numbered_symbols('x'), optimizations='basic')
+	lines = ['def %s(t, y, p):' % name, "\t'''%s'''" % doc]
+	for i, state in enumerate(states):
+		if state in used:
+			lines.append('\t%s = y[%d]' % (state.name, i))
+	for i, param in enumerate(params):
+		if param in used:
+			lines.append('\t%s = p[%d]' % (param.name, i))
+	lines.append('\tout = np.zeros(%s + np.broadcast_shapes(np.shape(y[0]), np.shape(p[0])))' % (shape,))
+	for symbol, expr in replacements:
+		lines.append('\t%s = %s' % (symbol, printer.doprint(expr)))
+	flat_index = np.ndindex(*shape)
+	for index, expr in zip(flat_index, reduced):
+		if expr != 0:
+			lines.append('\tout[%s] = %s' % (', '.join(str(i) for i in index), printer.doprint(expr)))
+	lines.append('\treturn out')
+	return '\n'.join(lines).replace('numpy.', 'np.')
+
+
+def generate_module(path=GENERATED_FILE):
+	'''
+	Write the NumPy right-hand side, analytic Jacobian and sparsity pattern
+
+	Parameters
+	----------
+	path : str
+		Output file (defaults to duct_model_generated.py next to this script)
+
+	Returns
+	-------
+	str
+		Path of the written module
+	'''
+	states, params, rhs = build_system()
+	jac = rhs.jacobian(states)
+	param_jac = rhs.jacobian(params)
+	printer = KernelPrinter()
+	sparsity = jacobian_sparsity(jac)
+	source = [
+		'# duct_model_generated.py',
+		'',
+		"'''",
+		'Generated by duct_model_symbolic.py from the symbolic duct model -- do not edit.',
+		'',
+		'Functions take (t, y, p) with y ordered as STATE_NAMES and p as PARAM_NAMES',
+		'(DuctParams.values). Both also accept (5, N) states with (P, N) parameters',
+		'and then return (5, N) derivatives, (5, 5, N) Jacobians and (5, P, N)',
+		'parameter Jacobians.',
+		"'''",
+		'',
+		'import numpy as np',
+		'',
+		'from duct_model_kernels import safe_log, eff_perm, eff_perm_dxi, eff_perm_dxo',
+		'',
+		'STATE_NAMES = %r' % (tuple(STATE_NAMES),),
+		'PARAM_NAMES = %r' % (tuple(PARAM_NAMES),),
+		'RT_F = %r' % RT_F,
+		'',
+		'JAC_SPARSITY = np.array(%r)' % sparsity.astype(int).tolist(),
+		'',
+		'',
+		_emit_function('rhs', 'Right-hand side of the duct model', list(rhs), (5,), states, params, printer),
+		'',
+		'',
+		_emit_function('jacobian', 'Exact Jacobian d(rhs)/dy', list(jac), (5, 5), states, params, printer),
+		'',
+		'',
+		_emit_function('param_jacobian', 'Exact parameter Jacobian d(rhs)/dp', list(param_jac), (5, len(params)),
+					   states, params, printer),
+		'']
+	with open(path, 'w') as handle:
+		handle.write('\n'.join(source))
+	return path
+
+
+def verify_generated(n_samples=500, seed=0, rtol=1e-10):
+	'''
+	Check the generated module against duct_model_rhs and finite-difference Jacobians
+
+	Parameters
+	----------
+	n_samples : int
+		Number of random states (with random antiporter/adjustment settings) to compare
+	seed : int
+		Random seed
+	rtol : float
+		Relative tolerance for the right-hand side comparison
+
+	Returns
+	-------
+	dict
+		Worst relative errors found for 'rhs', 'jacobian' and 'param_jacobian'
+	'''
+	import duct_model_generated as generated
+	assert tuple(generated.PARAM_NAMES) == tuple(PARAM_NAMES), 'Regenerate duct_model_generated.py'
+	rng = np.random.default_rng(seed)
+	worst = {'rhs': 0.0, 'jacobian': 0.0, 'param_jacobian': 0.0}
+	for _ in range(n_samples):
+		cond = dict(init_cond, ap_status=bool(rng.integers(2)), apb_status=bool(rng.integers(2)),
+					variant_adj=rng.uniform(0, 1), smoke_adj=rng.uniform(0.3, 1), vr=10**rng.uniform(-2, 1))
+		params = compile_params(cond)
+		y = np.array([rng.uniform(1, 40), rng.uniform(1, 150), rng.uniform(1, 80),
+					  rng.uniform(5, 30), rng.choice([params.gcftrbase, params.gcftron])])
+		expected = duct_model_rhs(0, y, params)
+		scale = np.abs(expected).max() + 1e-300
+		worst['rhs'] = max(worst['rhs'], np.abs(generated.rhs(0, y, params.values) - expected).max()/scale)
+		# Central differences on the hand-written RHS
+		jac = generated.jacobian(0, y, params.values)
+		fd = np.empty((5, 5))
+		for j in range(5):
+			step = 1e-6*max(1, abs(y[j]))
+			up, down = y.copy(), y.copy()
+			up[j] += step
+			down[j] -= step
+			fd[:, j] = (duct_model_rhs(0, up, params) - duct_model_rhs(0, down, params))/(2*step)
+		worst['jacobian'] = max(worst['jacobian'], np.abs(jac - fd).max()/(np.abs(fd).max() + 1e-300))
+		# Central differences over the compiled parameter vector; the parameters differ in scale by
+		# orders of magnitude, so errors are compared as changes of the rhs per relative parameter change
+		param_jac = generated.param_jacobian(0, y, params.values)
+		for j in range(len(PARAM_NAMES)):
+			step = 1e-6*max(1, abs(params.values[j]))
+			up, down = params.values.copy(), params.values.copy()
+			up[j] += step
+			down[j] -= step
+			fd = (generated.rhs(0, y, up) - generated.rhs(0, y, down))/(2*step)
+			error = np.abs(param_jac[:, j] - fd).max()*max(1, abs(params.values[j]))/scale
+			worst['param_jacobian'] = max(worst['param_jacobian'], error)
+	if worst['rhs'] > rtol:
+		raise AssertionError('Generated RHS deviates from duct_model_rhs by %g' % worst['rhs'])
+	if worst['jacobian'] > 1e-5:
+		raise AssertionError('Generated Jacobian deviates from finite differences by %g' % worst['jacobian'])
+	if worst['param_jacobian'] > 1e-5:
+		raise AssertionError('Generated parameter Jacobian deviates from finite differences by %g'
+							 % worst['param_jacobian'])
+	return worst
+
+
+if __name__ == '__main__':
+	print('Wrote ' + generate_module())
+	print(verify_generated())
@@ -0,0 +1,266 @@
+# duct_model_uncertainty.py
+
+'''
+Monte Carlo propagation of the measurement uncertainty of CFTR variant function.
+
+Every entry of cutting_variant_data.csv is a mean and a standard error
+("3.9 ± 0.41", % of wild-type function). The reports use the mean alone;
+here the % function of each allele is drawn instead from a normal
+distribution with that mean and standard error, truncated at zero (function
+cannot be negative), independently for the two alleles, and the patient's
+variant_adj is their average / 100 as in serverductmodel.process_var_impact.
+Wild Type (or no variant) is exactly 100%.
+
+All samples of a patient are integrated together as one batched
+solve_ensemble call (a few hundred members take well under a second), and
+the result holds percentile bands of the HCO3- and Cl- trajectories and the
+distribution of the report metrics of duct_model_protocol.report_metrics
+(peak luminal HCO3-, luminal Cl- plateau at t_off).
+
+Run using:
+	python3 duct_model_uncertainty.py VARIANT1 VARIANT2 [therapy column] [samples]
+
+Developed by Ariel Precision Medicine
+'''
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy.stats import truncnorm
+
+from dcw_duct_model import compile_params, init_cond
+from duct_model_ensemble import solve_ensemble
+from duct_model_protocol import report_metrics, StimulusProtocol
+
+CUTTING_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cutting_variant_data.csv')
+
+# Therapy columns of the Cutting table, and the labels the Bokeh apps use for them
+THERAPY_COLUMNS = ('Residual', 'Ivocaftor', 'Lumacaftor', 'Ivocaftor and Lumacaftor')
+THERAPY_LABELS = {'None': 'Residual', '10uM Ivocaftor': 'Ivocaftor', '6uM Lumacaftor': 'Lumacaftor',
+				  '10uM Ivocaftor + 6uM Lumacaftor': 'Ivocaftor and Lumacaftor',
+				  'Combination Therapy': 'Ivocaftor and Lumacaftor'}
+
+# Default number of samples per patient and the reported percentiles (median and 95% band)
+N_SAMPLES = 500
+PERCENTILES = (2.5, 50, 97.5)
+
+# Members per batched solve_ensemble call
+CHUNK_MEMBERS = 1024
+
+# Trajectories the bands are computed for; 'cl' is luminal Cl- (160 - bl)
+BAND_STATES = ('bi', 'bl', 'ci', 'ni', 'cl')
+METRICS = ('peak_hco3', 'plateau_cl')
+
+_TABLE = None
+
+
+def parse_measurement(text):
+	'''
+	Mean and standard error of a Cutting table entry
+
+	Parameters
+	----------
+	text : str
+		Example -> "132.4 ± 4.5" (a bare number has standard error 0)
+
+	Returns
+	-------
+	tuple
+		(mean, standard error) as floats
+	'''
+	mean, _, error = str(text).partition(u'±')
+	return float(mean.strip()), float(error.strip()) if error.strip() else 0.0
+
+
+def load_variant_table(path=CUTTING_FILE):
+	'''
+	Cutting et al. variant function with standard errors
+
+	Returns
+	-------
+	dict
+		Variant -> therapy column (THERAPY_COLUMNS) -> (mean, standard error), % of wild type
+	'''
+	frame = pd.read_csv(path)
+	return {row['Variant']: {column: parse_measurement(row[column]) for column in THERAPY_COLUMNS}
+			for _, row in frame.iterrows()}
+
+
+def _default_table():
+	# The bundled table, read once per process
+	global _TABLE
+	if _TABLE is None:
+		_TABLE = load_variant_table()
+	return _TABLE
+
+
+def allele_function(variant, therapy='Residual', table=None):
+	'''(mean, standard error) % function of one allele; Wild Type and None are exactly 100'''
+	if variant is None or variant == 'Wild Type':
+		return 100.0, 0.0
+	table = _default_table() if table is None else table
+	column = THERAPY_LABELS.get(therapy, therapy)
+	if column not in THERAPY_COLUMNS:
+		raise ValueError('Unknown therapy %r (one of %s)' % (therapy, ', '.join(THERAPY_COLUMNS)))
+	if variant not in table:
+		raise ValueError('Variant %r is not in the Cutting table' % variant)
+	return table[variant][column]
+
+
+def sample_allele_function(mean, error, n_samples, rng):
+	'''(n_samples,) % function drawn from a normal distribution truncated at zero'''
+	if error <= 0:
+		return np.full(n_samples, float(mean))
+	return truncnorm.rvs(-mean/error, np.inf, loc=mean, scale=error, size=n_samples, random_state=rng)
+
+
+def sample_variant_adj(variant1, variant2, therapy='Residual', n_samples=N_SAMPLES, seed=None, table=None):
+	'''
+	Samples of variant_adj for a genotype
+
+	Parameters
+	----------
+	variant1, variant2 : str
+		Variants of the two alleles (names of the Cutting table, 'Wild Type' or None)
+	therapy : str
+		Therapy column of the table, or the app label of the therapy ('None', '10uM Ivocaftor', ...)
+	n_samples : int
+		Number of samples
+	seed : int or np.random.Generator, optional
+		Seed of the draws
+	table : dict, optional
+		Output of load_variant_table (default: the bundled cutting_variant_data.csv)
+
+	Returns
+	-------
+	np.ndarray
+		(n_samples,) mean of the two alleles' % function / 100
+	'''
+	rng = np.random.default_rng(seed)
+	alleles = [sample_allele_function(*allele_function(variant, therapy, table), n_samples, rng)
+			   for variant in (variant1, variant2)]
+	return (alleles[0] + alleles[1])/200
+
+
+class UncertaintyResult():
+	'''
+	Output of propagate_variant_uncertainty
+
+	Attributes
+	----------
+	t : np.ndarray
+		(T,) output times
+	percentiles : tuple of float
+		The reported percentiles
+	bands : dict
+		BAND_STATES name -> (len(percentiles), T) percentiles of the trajectory over the samples
+	variant_adj : np.ndarray
+		(n,) sampled variant_adj values
+	metrics : dict
+		METRICS name -> (n,) metric of every sample (NaN where the solve failed)
+	n_failed : int
+		Samples whose solve failed (left out of the bands)
+	seconds : float
+		Wall-clock time of the sampling and solves
+	'''
+	def __init__(self, t, percentiles, bands, variant_adj, metrics, n_failed, seconds):
+		self.t = t
+		self.percentiles = percentiles
+		self.bands = bands
+		self.variant_adj = variant_adj
+		self.metrics = metrics
+		self.n_failed = n_failed
+		self.seconds = seconds
+
+	def __getitem__(self, name):
+		if name == 'time':
+			return self.t
+		return self.bands[name]
+
+	def band(self, name):
+		'''(lower, upper) outermost percentiles of a trajectory'''
+		return self.bands[name][0], self.bands[name][-1]
+
+	def metric_percentiles(self, metric):
+		'''(len(percentiles),) percentiles of a report metric over the successful samples'''
+		values = self.metrics[metric]
+		return np.percentile(values[np.isfinite(values)], self.percentiles)
+
+	def to_frame(self):
+		'''
+		Metric percentiles as a table
+
+		Returns
+		-------
+		pd.DataFrame
+			One row per metric, one column per percentile (e.g. 'p2.5', 'p50', 'p97.5')
+		'''
+		columns = ['p%g' % q for q in self.percentiles]
+		return pd.DataFrame([self.metric_percentiles(metric) for metric in METRICS], index=list(METRICS),
+							columns=columns)
+
+
+def propagate_variant_uncertainty(variant1, variant2, therapy='Residual', params=None, n_samples=N_SAMPLES,
+								  protocol=None, n_points=500, percentiles=PERCENTILES, seed=None, table=None,
+								  **solver_options):
+	'''
+	Percentile bands of a patient's time courses under variant function uncertainty
+
+	Parameters
+	----------
+	variant1, variant2 : str
+		Variants of the two alleles (names of the Cutting table, 'Wild Type' or None)
+	therapy : str
+		Therapy column of the table, or the app label of the therapy
+	params : dict or DuctParams, optional
+		The patient's other parameters (default init_cond); variant_adj is replaced by the samples
+	n_samples : int
+		Monte Carlo samples
+	protocol : StimulusProtocol, optional
+		Piecewise-constant schedule (default: the 20000 / 120000 / 200000 secretin pulse)
+	n_points : int
+		Output samples per protocol segment
+	percentiles : tuple of float
+		Percentiles reported for the trajectories and metrics
+	seed : int, optional
+		Seed of the draws
+	table : dict, optional
+		Output of load_variant_table
+	**solver_options
+		Passed to solve_ensemble
+
+	Returns
+	-------
+	UncertaintyResult
+	'''
+	started = time.perf_counter()
+	base = compile_params(init_cond if params is None else params)
+	protocol = protocol or StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+	variant_adj = sample_variant_adj(variant1, variant2, therapy, n_samples, seed, table)
+	grid = np.unique(protocol.sample_grid(n_points))
+	states = np.full((4, n_samples, grid.size), np.nan)
+	for start in range(0, n_samples, CHUNK_MEMBERS):
+		chunk = variant_adj[start:start + CHUNK_MEMBERS]
+		result = solve_ensemble([base.replace(variant_adj=value) for value in chunk], protocol, grid, **solver_options)
+		ok = result.status == 0
+		states[:, start:start + chunk.size][:, ok] = result.y[:4, ok]
+
+	finished = np.all(np.isfinite(states[:, :, -1]), axis=0)
+	metrics = report_metrics(states, grid, protocol)
+	metrics = {name: np.where(finished, metrics[name], np.nan) for name in METRICS}
+	trajectories = dict(zip(('bi', 'bl', 'ci', 'ni'), states[:, finished]))
+	trajectories['cl'] = 160 - trajectories['bl']
+	bands = {name: np.percentile(trajectories[name], percentiles, axis=0) for name in BAND_STATES}
+	return UncertaintyResult(grid, tuple(percentiles), bands, variant_adj, metrics, int(np.sum(~finished)),
+							 time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+	variant1, variant2 = sys.argv[1], sys.argv[2]
+	therapy = sys.argv[3] if len(sys.argv) > 3 else 'Residual'
+	n_samples = int(sys.argv[4]) if len(sys.argv) > 4 else N_SAMPLES
+	result = propagate_variant_uncertainty(variant1, variant2, therapy, n_samples=n_samples)
+	print('%d samples in %.2f s (%d failed)' % (n_samples, result.seconds, result.n_failed))
+	print(result.to_frame().to_string(float_format='%.2f'))
@@ -3,14 +3,16 @@ from bokeh.io import curdoc, export_png
 from bokeh.plotting import show, figure
 from bokeh.resources import CDN
 from bokeh.embed import file_html
-from bokeh_plotting import run_model_CFTR
+from duct_model_progressive import REFINED_OPTIONS, progressive_solve
+from duct_model_protocol import StimulusProtocol
 from bokeh.models import ColumnDataSource, Legend, Tabs, Panel
 from bokeh.models.widgets import Dropdown, CheckboxButtonGroup, Select, Button, Div, RadioButtonGroup, TextInput
 import pandas as pd
 import numpy as np
 from dcw_duct_model import init_cond
-from bokeh.layouts import row
+from bokeh.layouts import column, row
 import copy
+from functools import partial
 
 # Script to generate duct model instance via server
 # Callbacks connect to Python logic and return
@@ -22,48 +24,44 @@ input_data = wt_cell.input_dict
 
 init = copy.deepcopy(init_cond)
 
-def generate_source_array(input_data, key):
+# Seconds a widget change may spend simulating before the previous graphs are kept
+SERVER_TIME_LIMIT = 5.0
+
+# Rest / secretin / recovery protocol drawn by the app
+PROTOCOL = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+
+def generate_source_data(result):
 	'''
-	Construct Arrays from Duct Model System Equations to pass along to Bokeh's ColumnDataSource
+	Construct Arrays from Duct Model System Equations to pass along to Bokeh's ColumnDataSource.
+	The WT reference and the patient are integrated together as one two-member ensemble.
 
 	Parameters
 	----------
-	input_data : dict
-		Basic model parameters. New cell class with parameters instantiated each time function is called.
-	key : str
-		String referring to ion concentration in question. Used as a key to pull from generated nested arrays.
+	result : EnsembleResult
+		Provisional or refined solve of [WT, patient] (see duct_model_progressive)
 
 	Returns
 	-------
-	choice_array : array
-		Selected array denoted by key provided of length len(time)
+	dict
+		Column name -> array of length len(time) for the WT and patient traces
 	'''
-	choice_array = run_model_CFTR(input_data, 20000, 120000, 200000)[0][key]
-	if key == 'time':
-		choice_array /=  20000
-	return choice_array
-
-# Individual graphing arrays for ColumnDataSource
-wt_bi_l = generate_source_array(init, 'bl')
-wt_bi_i = generate_source_array(init, 'bi')
-pt_bi_l = generate_source_array(input_data, 'bl')
-pt_bi_i = generate_source_array(input_data, 'bi')
-wt_cl_l = 160 - wt_bi_l
-wt_cl_i = generate_source_array(init, 'ci')
-pt_cl_l = 160 - pt_bi_l
-pt_cl_i = generate_source_array(input_data, 'ci')
-time = generate_source_array(input_data, 'time')
-
-# Construct CDS to store data in server
-source = ColumnDataSource(data=dict(wt_bi_l = wt_bi_l,
-									wt_bi_i = wt_bi_i,
-									pt_bi_l = pt_bi_l,
-									pt_bi_i = pt_bi_i,
-									wt_cl_l = wt_cl_l,
-									wt_cl_i = wt_cl_i,
-									pt_cl_l = pt_cl_l,
-									pt_cl_i = pt_cl_i,
-									time = time))
+	wt, pt = result.member(0), result.member(1)
+	return dict(wt_bi_l = wt[1],
+				wt_bi_i = wt[0],
+				pt_bi_l = pt[1],
+				pt_bi_i = pt[0],
+				wt_cl_l = 160 - wt[1],
+				wt_cl_i = wt[2],
+				pt_cl_l = 160 - pt[1],
+				pt_cl_i = pt[2],
+				time = result.t / 20000)
+
+# Construct CDS to store data in server; update_data fills it once the layout exists
+source = ColumnDataSource(data=dict(wt_bi_l=[], wt_bi_i=[], pt_bi_l=[], pt_bi_i=[], wt_cl_l=[], wt_cl_i=[],
+									pt_cl_l=[], pt_cl_i=[], time=[]))
+status_div = Div(text='')
+doc = curdoc()
+pending = None
 
 # Build User Input Column Widgets
 input_column, widgets = wt_cell.process_widgets(wt_cell.gen_var_menu())
@@ -270,26 +268,33 @@ def callback_var2(attr, old, new):
 	input_data['variant_adj'] = process_var_impact(var1, var2, therapeutic)
 	update_data()
 
+def show_refined(handle, result):
+	# Only the refinement of the latest selection may replace the curves
+	if handle is not pending:
+		return
+	if not isinstance(result, Exception) and result.success:
+		source.data = generate_source_data(result)
+		status_div.text = ''
+		return
+	if isinstance(result, Exception):
+		print('Refinement failed: %r' % (result,))
+	# Keep the graphs on screen and say why they did not update
+	if handle.provisional.success:
+		status_div.text = 'The model could not be solved accurately for this selection; showing the provisional result.'
+	else:
+		status_div.text = 'The model could not be solved for this selection; showing the previous result.'
+
 def update_data():
-	pt_bi_l = generate_source_array(input_data, 'bl')
-	pt_bi_i = generate_source_array(input_data, 'bi')
-	wt_bi_l = generate_source_array(init, 'bl')
-	wt_bi_i = generate_source_array(init, 'bi')
-	wt_cl_l = (160 - wt_bi_l)
-	wt_cl_i = generate_source_array(init, 'ci')
-	pt_cl_l = 160 - pt_bi_l
-	pt_cl_i = generate_source_array(input_data, 'ci')
-	time = generate_source_array(input_data, 'time')
-
-	source.data = dict( wt_bi_l = wt_bi_l,
-						wt_bi_i = wt_bi_i,
-						pt_bi_l = pt_bi_l,
-						pt_bi_i = pt_bi_i,
-						wt_cl_l = wt_cl_l,
-						wt_cl_i = wt_cl_i,
-						pt_cl_l = pt_cl_l,
-						pt_cl_i = pt_cl_i,
-						time = time)
+	# Loose curves right away, tight-tolerance curves from the background worker a moment later
+	global pending
+	if pending is not None:
+		pending.cancel()
+	handle = progressive_solve([init, input_data], PROTOCOL, refined_options=dict(REFINED_OPTIONS, time_limit=SERVER_TIME_LIMIT),
+							   callback=lambda handle, result: doc.add_next_tick_callback(partial(show_refined, handle, result)))
+	pending = handle
+	if handle.provisional.success:
+		source.data = generate_source_data(handle.provisional)
+		status_div.text = 'Refining...'
 
 # Event Calls
 widgets['Variant1'].on_change('value', callback_var1)
@@ -345,9 +350,10 @@ cl_plot.xaxis.axis_label_text_font_style = 'normal'
 
 
 tabs = Tabs(tabs=[Panel(child=bi_plot, title='Bicarbonate Transport'), Panel(child=cl_plot, title='Chloride Transport')])
-layout = row(input_column, tabs)
+layout = row(input_column, column(tabs, status_div))
 
-curdoc().add_root(layout)
+doc.add_root(layout)
+update_data()
 
 
 
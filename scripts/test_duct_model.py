@@ -7,8 +7,35 @@ graphing logic, and variant logic.
 Developed by Ariel Precision Medicine. 
 '''
 import unittest, math
-from DCW_duct_model import *
-from DCW_duct_graphing_functions import *
+import numpy as np
+from dcw_duct_model import *
+from dcw_duct_graphing_functions import *
+from duct_model_ensemble import solve_ensemble, ensemble_jac_sparsity, screen_cohort, retry_failed_members
+import duct_model_ensemble
+import duct_model_generated
+import duct_model_kernels
+import duct_model_log_form
+from duct_model_steady_state import steady_state, SteadyStateCache, RestingPhaseCache
+from duct_model_protocol import StimulusProtocol, integrate_protocol, integrate_with_fallbacks, SimulationError
+import duct_model_backends
+from duct_model_autotune import autotune
+from duct_model_rom import ReducedOrderModel
+from duct_model_periodic import periodic_steady_state
+from duct_model_progressive import progressive_solve
+from duct_model_sensitivity import integrate_sensitivities
+from duct_model_sobol import saltelli_indices, sobol_indices
+from duct_model_calibration import SecretinData, calibrate, calibrate_cohort, TIME_UNITS_PER_MINUTE
+from duct_model_inverse import required_cftr_function, REACHED, BELOW_RANGE, UNREACHABLE
+from duct_model_continuation import pseudo_arclength, continue_steady_state, steady_state_branches, branches_to_frame
+from duct_model_phase_diagram import phase_diagram, plot_phase_diagram
+from duct_model_sweep import run_sweep, Sweep
+from duct_model_uncertainty import parse_measurement, sample_variant_adj, propagate_variant_uncertainty
+from duct_model_autotune import metric_grid
+from duct_model_protocol import report_metrics
+try:
+	import sympy
+except ImportError:
+	sympy = None
 # TODO: Need to add test cases for GUI logic and UI
 
 init_cond = {'g_bi': 0.2, 'g_cl': 1, 'zeta': 0.05,
@@ -60,6 +87,922 @@ class TestDuctModelLogic(unittest.TestCase):
 	def test_duct_model_system(self):
 		pass
 
+class TestDuctParams(unittest.TestCase):
+	'''
+		Compiled parameter object and dictionary-free right-hand side
+	'''
+	def test_compile_resolves_sentinels(self):
+		params = compile_params(init_cond)
+		self.assertEqual(params.variant_adj, 1)
+		self.assertEqual(params.ap_status, 1)
+		self.assertEqual(params.rtf, 8.31451*310/96485)
+		self.assertEqual(hash(params), hash(compile_params(dict(init_cond))))
+		self.assertEqual(params.replace(vr=1).vr, 1)
+		with self.assertRaises(AttributeError):
+			params.vr = 1
+
+	def test_hash_agrees_with_equality(self):
+		params = compile_params(dict(init_cond, ek=0.0))
+		negative = params.replace(ek=-0.0)
+		self.assertEqual(params, negative)
+		self.assertEqual(hash(params), hash(negative))
+		self.assertEqual(len({params, negative}), 1)
+		with self.assertRaises(ValueError):
+			params.replace(vr=float('nan'))
+
+	def test_rhs_bit_identical(self):
+		rng = np.random.default_rng(0)
+		for ap_status, smoke_adj in [(True, None), (False, 5/11)]:
+			cond = dict(init_cond, ap_status=ap_status, apb_status=ap_status,
+						variant_adj=None, smoke_adj=smoke_adj, alcohol_adj=None)
+			params = compile_params(cond)
+			out = np.empty(5)
+			for _ in range(200):
+				y = np.array([rng.uniform(1, 40), rng.uniform(1, 150),
+							  rng.uniform(1, 80), rng.uniform(5, 30), rng.choice([0.00007, 1])])
+				expected = np.array(duct_model_system(0, y, cond))
+				self.assertTrue(np.array_equal(expected, duct_model_rhs(0, y, params, out)))
+
+	def test_rhs_extreme_states(self):
+		# Overflow and division by zero give inf/nan like the dictionary path, not an exception
+		cond = dict(init_cond, variant_adj=None, smoke_adj=None, alcohol_adj=None)
+		params = compile_params(cond)
+		for y in ([15, 32, 60, 1e120, 0.00007], [15, 0, 60, 20, 0.00007], [1e200, 32, 60, 20, 1]):
+			with np.errstate(all='ignore'):
+				expected = np.array(duct_model_system(0, np.array(y, dtype=float), cond), dtype=float)
+			self.assertTrue(np.array_equal(duct_model_rhs(0, np.array(y, dtype=float), params), expected, equal_nan=True))
+		with np.errstate(all='ignore'):
+			state = integrate_with_fallbacks(dict(init_cond, variant_adj=0.01), StimulusProtocol.secretin_pulse(20000, 120000, 200000),
+											 method='RK45', rtol=0.1, atol=1e-4, rest_cache=None)
+		self.assertTrue(state.success)
+
+class TestDuctEnsemble(unittest.TestCase):
+	'''
+		Batched integration of several parameter sets
+	'''
+	def test_single_member_matches_rk45(self):
+		from scipy.integrate import solve_ivp
+		params = compile_params(init_cond)
+		y0 = params.y0.copy()
+		y0[4] = params.gcftron
+		t_eval = np.linspace(0, 50000, 20)
+		state = solve_ivp(lambda t, y: duct_model_rhs(t, y, params), [0, 50000], y0, t_eval=t_eval)
+		result = solve_ensemble([init_cond], [(0, 50000, 'gcftron')], t_eval, method='DP5', rtol=1e-3, atol=1e-6)
+		self.assertTrue(np.allclose(result.member(0), state.y, rtol=1e-9, atol=1e-9))
+		self.assertEqual(result.nfev[0], state.nfev)
+
+	def test_members_are_independent(self):
+		stiff = dict(init_cond, vr=0.01, variant_adj=0.05, ap_status=True)
+		segments = [(0, 20000, 'gcftrbase'), (20000, 60000, 'gcftron')]
+		t_eval = np.linspace(0, 60000, 30)
+		# Per-member step control is a property of the DP5 stepper
+		alone = solve_ensemble([init_cond], segments, t_eval, method='DP5')
+		batch = solve_ensemble([init_cond, stiff], segments, t_eval, method='DP5')
+		self.assertTrue(batch.success)
+		self.assertTrue(np.allclose(alone.member(0), batch.member(0), rtol=1e-10, atol=1e-10))
+		self.assertLess(batch.nsteps[0], batch.nsteps[1])
+
+	def test_jac_sparsity_is_block_pattern(self):
+		pattern = ensemble_jac_sparsity(3)
+		self.assertEqual(pattern.shape, (15, 15))
+		self.assertEqual(pattern.nnz, 3*20)
+
+class TestGeneratedModel(unittest.TestCase):
+	'''
+		Code generated from the symbolic model against the hand-written RHS
+	'''
+	def test_generated_rhs_matches(self):
+		params = compile_params(dict(init_cond, ap_status=True, apb_status=True, variant_adj=0.4))
+		y = np.array([14.0, 120.0, 20.0, 15.0, 1.0])
+		self.assertTrue(np.allclose(duct_model_generated.rhs(0, y, params.values),
+									duct_model_rhs(0, y, params), rtol=1e-12, atol=1e-15))
+
+	@unittest.skipIf(sympy is None, 'SymPy is only needed to regenerate the model')
+	def test_verify_generated(self):
+		from duct_model_symbolic import verify_generated
+		worst = verify_generated(n_samples=50)
+		self.assertLess(worst['jacobian'], 1e-5)
+		self.assertLess(worst['param_jacobian'], 1e-5)
+
+	def test_exact_jacobian_in_ensemble(self):
+		segments = [(0, 20000, 'gcftrbase'), (20000, 60000, 'gcftron')]
+		t_eval = np.linspace(0, 60000, 7)
+		conds = [init_cond, dict(init_cond, variant_adj=0.2)]
+		stiff = solve_ensemble(conds, segments, t_eval, method='BDF', rtol=1e-8, atol=1e-10)
+		explicit = solve_ensemble(conds, segments, t_eval, rtol=1e-8, atol=1e-10)
+		self.assertTrue(np.allclose(stiff.y[:4], explicit.y[:4], rtol=1e-4))
+
+class TestStableKernels(unittest.TestCase):
+	'''
+		Flux kernels stay finite and smooth where concentrations cross
+	'''
+	def test_eff_perm_across_crossing(self):
+		xo = 60.0
+		d = np.array([-0.5, -1e-2, -1e-6, -1e-13, 0, 1e-13, 1e-6, 1e-2, 0.5])
+		xi = xo*(1 + d)
+		limit = xi*np.log1p(d)/np.where(d == 0, 1, d)
+		limit[d == 0] = xi[d == 0]
+		self.assertTrue(np.allclose(eff_perm(xi, xo), limit, rtol=1e-13))
+		self.assertTrue(np.allclose([eff_perm(a, xo) for a in xi], limit, rtol=1e-13))
+		self.assertEqual(eff_perm(np.ones((3, 4)), np.full(4, 2.0)).shape, (3, 4))
+		step = 1e-5
+		dxi, dxo = duct_model_kernels.eff_perm_partials(xi, xo)
+		self.assertTrue(np.allclose(dxi, (eff_perm(xi + step, xo) - eff_perm(xi - step, xo))/(2*step), rtol=1e-6))
+		self.assertTrue(np.allclose(dxo, (eff_perm(xi, xo + step) - eff_perm(xi, xo - step))/(2*step), rtol=1e-6))
+
+	def test_guarded_logs(self):
+		with np.errstate(all='raise'):
+			self.assertTrue(np.isfinite(nernst_potential(-1.0, 5.0)))
+			self.assertTrue(np.all(np.isfinite(nernst_potential(np.array([-1.0, 0.0, 2.0]), 5.0))))
+		self.assertEqual(nernst_potential(3.0, 5.0), RT_F*np.log(3.0/5.0))
+
+	def test_run_starting_on_crossing(self):
+		# Luminal Cl- (160 - bl) equals intracellular Cl- at t = 0
+		cond = dict(init_cond, bl=100.0)
+		protocol = StimulusProtocol.secretin_pulse(20000, 60000, 80000)
+		for method in ('RK45', 'BDF', 'LSODA'):
+			self.assertTrue(integrate_protocol(cond, protocol, method=method).success, method)
+		self.assertTrue(solve_ensemble([cond, init_cond], protocol, np.linspace(0, 80000, 5), method='DP5').success)
+		self.assertTrue(np.all(np.isfinite(duct_model_generated.jacobian(0, compile_params(cond).y0,
+																		  compile_params(cond).values))))
+
+class TestLogForm(unittest.TestCase):
+	'''
+		Log-concentration formulation keeps every run positive
+	'''
+	def test_transformed_jacobian(self):
+		params = compile_params(dict(init_cond, bl=100.0))
+		y = params.y0.copy()
+		y[4] = params.gcftron
+		fun, jac = duct_model_log_form.log_system(lambda t, y: duct_model_rhs(t, y, params),
+												  lambda t, y: duct_model_jacobian(t, y, params))
+		u = duct_model_log_form.to_log(y)
+		self.assertTrue(np.allclose(duct_model_log_form.from_log(u), y, rtol=1e-14))
+		step = 1e-7
+		numeric = np.column_stack([(fun(0, u + step*e) - fun(0, u - step*e))/(2*step) for e in np.eye(5)])
+		self.assertTrue(np.allclose(jac(0, u), numeric, rtol=1e-5, atol=1e-10))
+
+	def test_matches_concentration_form(self):
+		protocol = StimulusProtocol.secretin_pulse(20000, 60000, 80000)
+		grid = protocol.sample_grid(50)
+		standard = integrate_protocol(init_cond, protocol, method='RK45', rtol=1e-7, atol=1e-10)
+		log_form = integrate_protocol(init_cond, protocol, method='RK45', rtol=1e-7, atol=1e-10, log_form=True)
+		self.assertTrue(log_form.success)
+		self.assertTrue(np.allclose(log_form.sol(grid), standard.sol(grid), atol=1e-4))
+		self.assertTrue(np.allclose(log_form.y[:, -1], standard.y[:, -1], atol=1e-4))
+
+	def test_coarse_batch_stays_positive(self):
+		# Ten Rodas3 steps per phase take the small-lumen members through zero concentrations
+		members = [dict(init_cond, vr=0.01), dict(init_cond, vr=0.01, ap_status=False), init_cond]
+		protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		grid = np.linspace(0, 200000, 41)
+		options = {'method': 'rodas3', 'n_steps': 10, 'first_step': 100.0}
+		with np.errstate(all='ignore'):
+			standard = solve_ensemble(members, protocol, grid, **options)
+		log_form = solve_ensemble(members, protocol, grid, log_form=True, **options)
+		self.assertFalse(standard.success)
+		self.assertTrue(log_form.success)
+		self.assertTrue(np.all(log_form.y[:4] > 0) and np.all(log_form.y[1] < 160))
+		reference = solve_ensemble(members, protocol, grid, method='DP5', rtol=1e-8, atol=1e-10)
+		self.assertLess(np.abs(log_form.y - reference.y).max(), 5.0)
+
+	def test_more_accurate_on_fixed_mesh(self):
+		# Same Rodas3 mesh and cost, an order of magnitude closer to the reference
+		members = [init_cond, dict(init_cond, vr=0.01), dict(init_cond, variant_adj=0.05)]
+		protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		grid = np.unique(protocol.sample_grid(100))
+		reference = solve_ensemble(members, protocol, grid, method='DP5', rtol=1e-9, atol=1e-11)
+		standard = solve_ensemble(members, protocol, grid, method='rodas3')
+		log_form = solve_ensemble(members, protocol, grid, method='rodas3', log_form=True)
+		self.assertTrue(np.array_equal(standard.nfev, log_form.nfev))
+		self.assertLess(np.abs(log_form.y[:4] - reference.y[:4]).max(), np.abs(standard.y[:4] - reference.y[:4]).max()/5)
+
+class TestReducedModel(unittest.TestCase):
+	'''
+		Quasi-steady-state mode and its a posteriori error estimate
+	'''
+	def setUp(self):
+		self.protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+
+	def test_estimate_tracks_full_model(self):
+		for cond in (init_cond, dict(init_cond, vr=0.01, ap_status=False)):
+			reference = integrate_protocol(cond, self.protocol, method='Radau', rtol=1e-10, atol=1e-12)
+			reduced = integrate_protocol(cond, self.protocol, method='LSODA', rtol=1e-6, atol=1e-9, reduced=True)
+			self.assertTrue(reduced.success)
+			actual = np.abs(reference.sol(reduced.t) - reduced.y)[:4].max(axis=1)
+			estimate = reduced.error_estimate.max(axis=1)
+			self.assertTrue(np.all(actual < 2.5))
+			self.assertTrue(np.all(estimate > 0.8*actual) and np.all(estimate < 1.5*actual + 0.01), (actual, estimate))
+		self.assertIsNone(integrate_protocol(init_cond, self.protocol).error_bound())
+
+	def test_screening_escalates_to_full_model(self):
+		members = [dict(init_cond, vr=10), dict(init_cond, vr=0.01, ap_status=False)]
+		grid = np.unique(self.protocol.sample_grid(100))
+		screened = screen_cohort(members, self.protocol, grid, threshold=0.2, method='odeint')
+		self.assertTrue(screened.success)
+		self.assertEqual(list(screened.escalated), [False, True])
+		escalated = solve_ensemble(members[1:], self.protocol, grid, method='odeint')
+		self.assertTrue(np.array_equal(screened.y[:, 1], escalated.y[:, 0]))
+		full = solve_ensemble(members[:1], self.protocol, grid, method='odeint')
+		self.assertLess(np.abs(screened.y[:4, 0] - full.y[:4, 0]).max(), 2.0)
+		self.assertLess(screened.error_bound('bl')[0], 0.2)
+
+class TestSteadyState(unittest.TestCase):
+	'''
+		Direct equilibrium solves against long integrations
+	'''
+	def test_matches_long_integration(self):
+		from scipy.integrate import solve_ivp
+		params = compile_params(dict(init_cond, ap_status=True))
+		result = steady_state(params, 'gcftron', cache=None)
+		self.assertTrue(result.success)
+		y0 = params.y0.copy()
+		y0[4] = params.gcftron
+		state = solve_ivp(lambda t, y: duct_model_rhs(t, y, params), [0, 1e6], y0, method='BDF',
+						  jac=lambda t, y: duct_model_jacobian(t, y, params), rtol=1e-10, atol=1e-12)
+		self.assertTrue(np.allclose(state.y[:, -1], result.y, rtol=1e-7))
+
+	def test_warm_start_from_cache(self):
+		cache = SteadyStateCache()
+		first = steady_state(dict(init_cond, variant_adj=0.5), 'gcftron', cache=cache)
+		second = steady_state(dict(init_cond, variant_adj=0.45), 'gcftron', cache=cache)
+		self.assertFalse(first.warm_start)
+		self.assertTrue(second.warm_start)
+		self.assertTrue(second.success)
+		self.assertLess(second.nfev, first.nfev)
+
+	def test_zero_cftr_function(self):
+		import warnings
+		cache = SteadyStateCache()
+		params = compile_params(init_cond)
+		with warnings.catch_warnings():
+			warnings.simplefilter('error')
+			first = steady_state(params, gcftr=0.0, cache=cache)
+			steady_state(params, gcftr=1e-3, cache=cache)
+			state, distance = cache.nearest(params, 0.0)
+			second = steady_state(params, gcftr=0.0, cache=cache)
+		self.assertTrue(first.success and second.success)
+		self.assertEqual(distance, 0)
+		self.assertTrue(np.array_equal(state, first.y[:4]))
+		self.assertTrue(second.warm_start)
+
+class TestRestingPhaseCache(unittest.TestCase):
+	'''
+		Repeated requests reuse the integrated resting phase without changing results
+	'''
+	def setUp(self):
+		self.protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		self.cond = dict(init_cond, ap_status=False, apb_status=False)
+		self.grid = self.protocol.sample_grid(100)
+
+	def test_cached_runs_are_identical(self):
+		cache = RestingPhaseCache()
+		reference = integrate_protocol(self.cond, self.protocol, rest_cache=None)
+		first = integrate_protocol(self.cond, self.protocol, rest_cache=cache)
+		second = integrate_protocol(self.cond, self.protocol, rest_cache=cache)
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+		self.assertTrue(np.array_equal(second.y, reference.y))
+		self.assertTrue(np.array_equal(second.sol(self.grid), reference.sol(self.grid)))
+		self.assertLess(second.nfev, first.nfev)
+
+	def test_key_covers_resting_parameters_only(self):
+		cache = RestingPhaseCache()
+		integrate_protocol(self.cond, self.protocol, rest_cache=cache)
+		# Neither the stimulated level nor switched-off antiporter constants act at rest
+		integrate_protocol(dict(self.cond, gcftron=0.5, gapl=1.0, kbi=2.0), self.protocol, rest_cache=cache)
+		self.assertEqual(cache.hits, 1)
+		for change in ({'variant_adj': 0.5}, {'ap_status': True}, {'vr': 0.2}, {'bl': 30}):
+			integrate_protocol(dict(self.cond, **change), self.protocol, rest_cache=cache)
+		integrate_protocol(self.cond, self.protocol, rest_cache=cache, rtol=1e-8)
+		self.assertEqual((cache.hits, cache.misses), (1, 6))
+
+class TestStimulusProtocol(unittest.TestCase):
+	'''
+		gcftr(t) schedules integrated in a single call
+	'''
+	def test_pulse_matches_restarted_phases(self):
+		from scipy.integrate import solve_ivp
+		params = compile_params(init_cond)
+		y = params.y0.copy()
+		expected = []
+		for t_start, t_end, gcftr in [(0, 20000, params.gcftrbase), (20000, 120000, params.gcftron),
+									  (120000, 200000, params.gcftrbase)]:
+			y[4] = gcftr
+			state = solve_ivp(lambda t, y: duct_model_rhs(t, y, params), [t_start, t_end], y)
+			expected.append(state.y)
+			y = state.y[:, -1].copy()
+		result = integrate_protocol(params, StimulusProtocol.secretin_pulse(20000, 120000, 200000),
+									method='RK45', rtol=1e-3, atol=1e-6)
+		self.assertTrue(result.success)
+		self.assertTrue(np.array_equal(result.y, np.concatenate(expected, axis=1)))
+		self.assertTrue(np.array_equal(result.t_events, [20000, 120000]))
+		self.assertTrue(np.allclose(result.sol(60000), result(np.array([60000]))[:, 0]))
+
+	def test_repeated_meals_and_ramps(self):
+		protocol = StimulusProtocol.repeated_meals(3, 60000, 20000)
+		self.assertEqual(protocol.t_span, (0, 200000))
+		self.assertTrue(np.allclose(protocol.gcftr([10000, 30000, 50000, 90000], init_cond),
+									[0.00007, 1, 0.00007, 1]))
+		ramp = StimulusProtocol.ramp(20000, 40000, 120000, 200000, t_rest=140000)
+		result = integrate_protocol(init_cond, ramp)
+		self.assertTrue(result.success)
+		self.assertTrue(np.allclose(result.y[4], ramp.gcftr(result.t, init_cond)))
+		with self.assertRaises(ValueError):
+			ramp.constant_segments()
+
+	def test_trajectory_evaluates_lazily(self):
+		protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		result = integrate_protocol(init_cond, protocol)
+		trajectory = result.trajectory(protocol.sample_grid(500))
+		self.assertIsNone(trajectory._values)
+		self.assertEqual(len(trajectory['time']), 1500)
+		self.assertIsNone(trajectory._values)
+		self.assertEqual(len(trajectory['bl']), 1500)
+		# Solver points are reproduced exactly by the interpolant
+		inside = result.segment(1)[0][1:-1]
+		self.assertTrue(np.allclose(trajectory.at(inside)['ci'], result.segment(1)[1][2, 1:-1], rtol=1e-12))
+		coarse = trajectory.on(np.linspace(0, 200000, 11))
+		self.assertEqual(len(coarse['ni']), 11)
+
+	def test_steady_state_event_holds_plateau(self):
+		protocol = StimulusProtocol.secretin_pulse(20000, 1000000, 1100000)
+		full = integrate_protocol(init_cond, protocol, method='RK45', rtol=1e-5, atol=1e-8)
+		early = integrate_protocol(init_cond, protocol, method='RK45', rtol=1e-5, atol=1e-8, steady_tol=0.05)
+		self.assertTrue(early.success)
+		self.assertLess(early.t_steady[1], 1000000)
+		self.assertLess(early.nfev, full.nfev/2)
+		t, y = early.segment(1)
+		self.assertEqual(t[-1], 1000000)
+		held = early.sol(np.linspace(early.t_steady[1], 1000000, 5)[1:])
+		self.assertTrue(np.all(held == held[:, :1]))
+		grid = protocol.sample_grid(200)
+		self.assertTrue(np.allclose(early.sol(grid)[:4], full.sol(grid)[:4], atol=0.05))
+		# At the profile tolerances the noisy RK45 plateau still settles
+		full = integrate_protocol(init_cond, protocol, method='RK45', rest_cache=None)
+		early = integrate_protocol(init_cond, protocol, method='RK45', steady_tol=0.05, rest_cache=None)
+		self.assertLess(early.t_steady[1], 300000)
+		self.assertLess(early.nfev, full.nfev/2)
+		self.assertTrue(np.allclose(early.sol(grid)[:4], full.sol(grid)[:4], atol=0.05))
+		fixed_step = integrate_protocol(init_cond, protocol, method='rodas3', steady_tol=0.05)
+		self.assertIsNotNone(fixed_step.t_steady[1])
+		self.assertTrue(np.allclose(fixed_step.sol(grid)[:4], full.sol(grid)[:4], atol=0.1))
+
+	def test_ensemble_accepts_protocol(self):
+		protocol = StimulusProtocol.secretin_pulse(20000, 60000, 80000)
+		t_eval = np.linspace(0, 80000, 9)
+		result = solve_ensemble([init_cond], protocol, t_eval)
+		single = integrate_protocol(init_cond, protocol, rtol=1e-8, atol=1e-10)
+		self.assertTrue(np.allclose(result.member(0)[:4], single.sol(t_eval)[:4], rtol=1e-2))
+
+class TestSensitivities(unittest.TestCase):
+	'''
+		Forward sensitivities against finite differences of the model itself
+	'''
+	def setUp(self):
+		self.params = compile_params(dict(init_cond, variant_adj=0.5, ap_status=False, apb_status=False))
+		self.names = ('variant_adj', 'vr', 'gcftron')
+
+	def finite_differences(self, protocol, name, step=1e-5):
+		grid = metric_grid(protocol)
+		metrics = []
+		for sign in (1, -1):
+			changed = self.params.replace(**{name: getattr(self.params, name)*(1 + sign*step)})
+			state = integrate_protocol(changed, protocol, method='DOP853', rtol=1e-12, atol=1e-12, rest_cache=None)
+			metrics.append(report_metrics(state.sol(grid), grid, protocol))
+		h = 2*step*getattr(self.params, name)
+		return {key: (metrics[0][key] - metrics[1][key])/h for key in ('peak_hco3', 'plateau_cl')}
+
+	def test_gradients_match_finite_differences(self):
+		protocols = [StimulusProtocol.secretin_pulse(20000, 120000, 200000),
+					 StimulusProtocol.ramp(20000, 60000, 120000, 200000)]
+		for protocol in protocols:
+			result = integrate_sensitivities(self.params, protocol, self.names)
+			self.assertTrue(result.success)
+			gradients = result.gradients()
+			for name in self.names:
+				expected = self.finite_differences(protocol, name)
+				for metric in ('peak_hco3', 'plateau_cl'):
+					self.assertAlmostEqual(gradients[metric][name], expected[metric],
+										   delta=1e-5*max(1, abs(expected[metric])))
+
+	def test_delta_method_band(self):
+		protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		result = integrate_sensitivities(self.params, protocol, self.names)
+		gradient = result.gradient('plateau_cl')[0]
+		self.assertAlmostEqual(result.metric_standard_deviation('plateau_cl', {'variant_adj': 0.05}), abs(gradient)*0.05)
+		lower, upper = result.band('cl', {'variant_adj': 0.05})
+		t_off = np.searchsorted(result.t, 120000)
+		self.assertAlmostEqual((upper - lower)[t_off]/2, 1.96*abs(gradient)*0.05)
+		self.assertAlmostEqual((upper + lower)[t_off]/2, result.metric('plateau_cl'))
+
+class TestSobolIndices(unittest.TestCase):
+	'''
+		Variance-based global sensitivity with chunked, parallel evaluation
+	'''
+	def test_estimators_on_linear_function(self):
+		from scipy.stats import qmc
+		weights = np.array([3.0, 2.0, 1.0])
+		u = qmc.Sobol(6, scramble=True, seed=1).random(4096)
+		a, b = u[:, :3], u[:, 3:]
+		ab = np.repeat(a[:, :, None], 3, axis=2)
+		ab[:, np.arange(3), np.arange(3)] = b
+		first, total = saltelli_indices(a @ weights, b @ weights, np.einsum('nij,i->nj', ab, weights))
+		# Additive model: S_i = ST_i = w_i**2/sum(w**2)
+		expected = weights**2/np.sum(weights**2)
+		self.assertTrue(np.allclose(first, expected, atol=0.02))
+		self.assertTrue(np.allclose(total, expected, atol=0.02))
+
+	def test_parallel_matches_serial(self):
+		bounds = {'gnbc': (1.0, 3.0), 'vr': (0.05, 0.15), 'kcl': (5, 15)}
+		serial = sobol_indices(bounds, n_base=32, workers=1, bootstrap=50)
+		parallel = sobol_indices(bounds, n_base=32, workers=2, bootstrap=50)
+		self.assertEqual(serial.n_evaluations, 32*5)
+		self.assertEqual(serial.n_failed, 0)
+		for output in ('peak_hco3', 'plateau_cl'):
+			self.assertTrue(np.array_equal(serial.total[output], parallel.total[output]))
+			# kcl only acts through the antiporters, which init_cond switches off
+			self.assertEqual(serial.total[output][2], 0)
+			self.assertTrue(np.all(serial.total_ci[output][:, 0] <= serial.total_ci[output][:, 1]))
+		self.assertEqual(len(serial.to_frame()), 6)
+
+class TestVariantUncertainty(unittest.TestCase):
+	'''
+		Monte Carlo bands from the Cutting standard errors
+	'''
+	def test_parse_measurement(self):
+		self.assertEqual(parse_measurement(u'3.9 \u00b1 0.41'), (3.9, 0.41))
+		self.assertEqual(parse_measurement('100'), (100.0, 0.0))
+
+	def test_sampled_variant_adj(self):
+		samples = sample_variant_adj('F508del', 'Wild Type', n_samples=20000, seed=1)
+		# Only the F508del allele varies, so variant_adj spreads by its standard error / 200
+		self.assertAlmostEqual(np.mean(samples), (0.75 + 100)/200, places=4)
+		self.assertAlmostEqual(np.std(samples)*200, 0.13, places=2)
+		self.assertTrue(np.all(samples >= 0.5))
+		self.assertTrue(np.array_equal(sample_variant_adj('Wild Type', None, n_samples=5), np.ones(5)))
+		self.assertTrue(np.array_equal(samples, sample_variant_adj('F508del', 'Wild Type', n_samples=20000, seed=1)))
+		with self.assertRaises(ValueError):
+			sample_variant_adj('F508del', 'F508del', 'Unknown Therapy')
+
+	def test_bands(self):
+		result = propagate_variant_uncertainty('G551D', 'F508del', '10uM Ivocaftor', n_samples=200, seed=0)
+		self.assertEqual(result.n_failed, 0)
+		self.assertEqual(result['bl'].shape, (3, result.t.size))
+		lower, upper = result.band('cl')
+		self.assertTrue(np.all(lower <= result['cl'][1]) and np.all(result['cl'][1] <= upper))
+		self.assertTrue(np.allclose(result['cl'], 160 - result['bl'][::-1]))
+		peak = result.metric_percentiles('peak_hco3')
+		self.assertTrue(peak[0] < peak[1] < peak[2])
+		# Without uncertainty the band collapses onto the single curve
+		exact = propagate_variant_uncertainty('Wild Type', 'Wild Type', n_samples=4)
+		self.assertTrue(np.allclose(exact['bl'][0], exact['bl'][-1]))
+		self.assertEqual(list(exact.to_frame().index), ['peak_hco3', 'plateau_cl'])
+
+class TestCalibration(unittest.TestCase):
+	'''
+		Multi-start least-squares fits to secretin tests with profile intervals
+	'''
+	def secretin_test(self, variant_adj, noise=0.0, seed=0):
+		minutes = np.arange(0, 11, 1.0)
+		protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		state = integrate_protocol(dict(init_cond, variant_adj=variant_adj), protocol)
+		hco3 = state.sol(minutes*TIME_UNITS_PER_MINUTE)[1] + np.random.default_rng(seed).normal(0, noise, minutes.size)
+		return SecretinData(minutes, hco3, noise or None)
+
+	def test_recovers_cftr_function(self):
+		result = calibrate(init_cond, self.secretin_test(0.3, noise=2.0), n_starts=2, workers=1)
+		self.assertTrue(result.success)
+		self.assertEqual(len(result.starts), 2)
+		low, high = result.intervals['variant_adj']
+		self.assertTrue(low < 0.3 < high)
+		self.assertTrue(low < result.values['variant_adj'] < high)
+		self.assertLess(high - low, 0.1)
+		values, statistic = result.profiles['variant_adj']
+		self.assertTrue(np.all(np.diff(values) > 0))
+		self.assertAlmostEqual(statistic.min(), 0.0, places=6)
+
+	def test_cohort_in_pool(self):
+		patients = {'a': (init_cond, self.secretin_test(0.2)), 'b': (init_cond, self.secretin_test(0.6))}
+		results = calibrate_cohort(patients, n_starts=1, profile=False, workers=2)
+		self.assertAlmostEqual(results['a'].values['variant_adj'], 0.2, places=3)
+		self.assertAlmostEqual(results['b'].values['variant_adj'], 0.6, places=3)
+		self.assertLess(np.abs(results['a'].residuals).max(), 0.05)
+		self.assertEqual(results['b'].intervals, {})
+
+class TestInverseSolver(unittest.TestCase):
+	'''
+		Bracketed root-finding for the CFTR function reaching a target secretion
+	'''
+	def test_round_trip(self):
+		protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		grid = np.unique(protocol.sample_grid(500))
+		cond = dict(init_cond, smoke_adj=5/11, ap_status=True, apb_status=True)
+		result = required_cftr_function(cond, [60, 100, 125])
+		self.assertTrue(np.all(result.status == REACHED))
+		self.assertLessEqual(result.n_solves, 8)
+		forward = solve_ensemble([dict(cond, variant_adj=value) for value in result.variant_adj], protocol, grid,
+								 rtol=1e-10, atol=1e-12)
+		self.assertTrue(np.allclose(report_metrics(forward.y, grid, protocol)['peak_hco3'], [60, 100, 125], atol=0.05))
+
+	def test_cohort_and_range(self):
+		patients = [init_cond, dict(init_cond, smoke_adj=5/11), init_cond, init_cond]
+		result = required_cftr_function(patients, [100, 100, 30, 200])
+		self.assertEqual(list(result.status), [REACHED, REACHED, BELOW_RANGE, UNREACHABLE])
+		# Smoking lowers secretion, so more CFTR function is needed
+		self.assertGreater(result.variant_adj[1], result.variant_adj[0])
+		self.assertTrue(np.isnan(result.variant_adj[3]))
+		plateau = required_cftr_function(init_cond, 160 - result.achieved[0], metric='plateau_cl')
+		self.assertAlmostEqual(plateau.variant_adj[0], result.variant_adj[0], places=3)
+
+class TestContinuation(unittest.TestCase):
+	'''
+		Pseudo-arclength continuation of steady states, with fold and bifurcation detection
+	'''
+	def test_special_points(self):
+		# x**2 + p = 1 turns back at p = 1
+		fold = pseudo_arclength(lambda x, p: x**2 + p - 1, lambda x, p: np.array([[2*x[0]]]), lambda x, p: np.ones(1),
+								[0.5], 0.75, (-1, 2), step=0.05)
+		self.assertEqual([point['type'] for point in fold.special], ['fold'])
+		self.assertAlmostEqual(fold.special[0]['parameter'], 1.0, places=2)
+		self.assertTrue(fold['x0'].min() < 0 < fold['x0'].max())
+		# The trivial branch of p x - x**3 meets the pitchfork at p = 0
+		pitchfork = pseudo_arclength(lambda x, p: p*x - x**3, lambda x, p: np.array([[p - 3*x[0]**2]]),
+									 lambda x, p: x.copy(), [0.0], -1.0, (-1, 1), step=0.1)
+		self.assertEqual([point['type'] for point in pitchfork.special], ['branch point'])
+		self.assertAlmostEqual(pitchfork.special[0]['parameter'], 0.0, places=6)
+		# Hopf normal form: eigenvalues p +- i at the origin
+		hopf = pseudo_arclength(lambda x, p: np.array([p*x[0] - x[1], x[0] + p*x[1]]),
+								lambda x, p: np.array([[p, -1.0], [1.0, p]]), lambda x, p: x.copy(), [0.0, 0.0], -0.5,
+								(-0.5, 0.5), step=0.1)
+		self.assertEqual([point['type'] for point in hopf.special], ['hopf'])
+		self.assertTrue(hopf.stable[0] and not hopf.stable[-1])
+
+	def test_matches_steady_state(self):
+		cond = dict(init_cond, ap_status=True, apb_status=True)
+		branch = continue_steady_state(cond, 'variant_adj')
+		self.assertEqual(branch.stop_reasons, ('bounds', 'bounds'))
+		self.assertAlmostEqual(branch.parameter[0], 1e-3)
+		self.assertAlmostEqual(branch.parameter[-1], 1.5)
+		self.assertTrue(np.all(np.diff(branch['bl']) > 0))
+		self.assertTrue(np.all(branch.stable))
+		for i in (0, len(branch)//2, len(branch) - 1):
+			direct = steady_state(dict(cond, variant_adj=branch.parameter[i]), 'gcftron', cache=None)
+			self.assertTrue(np.allclose(branch.states[i], direct.y[:4], rtol=1e-8))
+		frame = branches_to_frame(steady_state_branches(init_cond, 'gnbc'))
+		self.assertEqual(set(frame['branch']), {'resting', 'stimulated'})
+		self.assertTrue(np.allclose(frame['cl'], 160 - frame['bl']))
+
+class TestPhaseDiagram(unittest.TestCase):
+	'''
+		Quadtree-refined two-parameter maps of the report metrics
+	'''
+	def test_refinement(self):
+		options = dict(initial_cells=4, max_level=2, log_x=True)
+		serial = phase_diagram('variant_adj', (1e-3, 1.5), 'smoke_adj', (5/11, 1), workers=1, **options)
+		parallel = phase_diagram('variant_adj', (1e-3, 1.5), 'smoke_adj', (5/11, 1), workers=2, **options)
+		self.assertTrue(serial.cells.equals(parallel.cells))
+		cells = serial.cells
+		self.assertLess(serial.n_evaluations, serial.uniform_evaluations)
+		self.assertTrue(set(cells['level']) >= {0, 2})
+		# The leaves tile the plane
+		area = np.sum((np.log(cells['right']) - np.log(cells['left']))*(cells['top'] - cells['bottom']))
+		self.assertAlmostEqual(area, np.log(1.5e3)*(1 - 5/11))
+		# Cells across the 80 mM cut-off are refined to the finest level
+		straddling = cells[(cells['low'] < 80) & (cells['high'] >= 80)]
+		self.assertTrue(len(straddling) > 0 and np.all(straddling['level'] == 2))
+		coarse = cells[cells['level'] == 0]
+		self.assertTrue(np.all(coarse['high'] - coarse['low'] <= 5.0))
+		plot = plot_phase_diagram(serial)
+		self.assertEqual(plot.xaxis[0].axis_label, 'variant_adj')
+
+class TestParameterSweep(unittest.TestCase):
+	'''
+		Declarative designs run as one batched ensemble or in a process pool
+	'''
+	def test_designs(self):
+		grid = Sweep.grid(vr=[10, 1, 0.1], ap_status=[True, False])
+		self.assertEqual(len(grid), 6)
+		self.assertEqual(grid.runs[1], {'vr': 10, 'ap_status': False})
+		paired = Sweep.zip(ap_status=[True, False], apb_status=[True, False])
+		self.assertEqual(paired.runs, [{'ap_status': True, 'apb_status': True}, {'ap_status': False, 'apb_status': False}])
+		with self.assertRaises(ValueError):
+			Sweep.zip(vr=[1, 2], gnbc=[1])
+		sampled = Sweep.random(50, seed=3, log=('gnbc',), gnbc=(0.5, 5), ap_status=[True, False])
+		values = [run['gnbc'] for run in sampled]
+		self.assertTrue(min(values) >= 0.5 and max(values) <= 5)
+		self.assertEqual(Sweep.random(50, seed=3, gnbc=(0.5, 5)).runs, Sweep.random(50, seed=3, gnbc=(0.5, 5)).runs)
+		self.assertEqual(len(grid*paired), 12)
+		self.assertEqual(len(grid + paired), 8)
+		self.assertEqual((grid*paired).names, ('vr', 'ap_status', 'apb_status'))
+
+	def test_ensemble_matches_pool(self):
+		sweep = Sweep.zip(vr=[10, 0.1], bi=[15.0, 25.0]) + Sweep([{'variant_adj': 0.2}, {}])
+		batched = run_sweep(sweep, n_points=100).check()
+		pooled = run_sweep(sweep, n_points=100, mode='pool', workers=1).check()
+		self.assertTrue(np.array_equal(batched.t, pooled.t))
+		self.assertLess(np.max(np.abs(batched.y - pooled.y)), 0.5)
+		# Runs that do not set a swept name report its base value
+		self.assertEqual(list(batched.design['vr']), [10, 0.1, init_cond['vr'], init_cond['vr']])
+		self.assertEqual(batched.design['bi'][2], init_cond['bi'])
+		self.assertEqual(batched.run(0)[1][0], 15.0)
+		frame = batched.to_frame()
+		self.assertEqual(len(frame), 4*batched.t.size)
+		self.assertTrue(np.allclose(frame['cl'], 160 - frame['bl']))
+		summary = batched.summary()
+		self.assertLess(summary['peak_hco3'][2], summary['peak_hco3'][3])
+		self.assertTrue(np.all(summary['status'] == 0))
+		with self.assertRaises(ValueError):
+			run_sweep(Sweep([{'not_a_parameter': 1}]))
+
+	def test_retry_keeps_solver_options(self):
+		# Without its time limit the fallback re-run would recover the run
+		result = run_sweep(Sweep([{}]), n_points=50, time_limit=0.0)
+		self.assertFalse(result.success)
+		self.assertEqual(len(result.attempts[0]), 1)
+		with self.assertRaises(SimulationError):
+			result.check()
+
+class TestPeriodicSteadyState(unittest.TestCase):
+	'''
+		Shooting finds the orbit repeated meals settle onto
+	'''
+	def test_matches_repeated_meals(self):
+		cond = dict(init_cond, variant_adj=0.2)
+		cycle = StimulusProtocol.meal_cycle(60000, 20000)
+		orbit = periodic_steady_state(cond, cycle)
+		self.assertTrue(orbit.success)
+		self.assertLess(np.abs(orbit.multipliers).max(), 1)
+		# One more cycle from the orbit returns to it
+		state = integrate_protocol(cond, cycle, y0=orbit.y0, method='Radau', rtol=1e-10, atol=1e-12)
+		self.assertTrue(np.allclose(state.y[:4, -1], orbit.y0[:4], atol=1e-5))
+		# Brute-force cycling from the resting state ends on the same orbit
+		meals = StimulusProtocol.repeated_meals(40, 60000, 20000, t_first=1)
+		brute = integrate_protocol(dict(cond, **dict(zip(STATE_NAMES[:4], orbit.y0[:4] + 5))), meals,
+								   method='LSODA', rtol=1e-9, atol=1e-11)
+		self.assertTrue(np.allclose(brute.y[:4, -1], orbit.y0[:4], atol=1e-3))
+
+	def test_cycle_averages(self):
+		orbit = periodic_steady_state(init_cond, StimulusProtocol.meal_cycle(60000, 20000))
+		self.assertTrue(orbit.y[1].min() <= orbit.mean_hco3 <= orbit.y[1].max())
+		self.assertTrue(orbit.flow.min() <= orbit.mean_flow <= orbit.flow.max())
+		# Time average on a uniform grid
+		t = np.linspace(0, 60000, 6001)[:-1]
+		y = orbit.cycle.sol(t)
+		y[4] = np.where(t < 20000, init_cond['gcftron'], init_cond['gcftrbase'])
+		flow = duct_model_ensemble.ensemble_flow(y, compile_params(init_cond).values[:, None])
+		self.assertAlmostEqual(orbit.hco3_output, np.mean(flow*y[1]), delta=1e-3*orbit.hco3_output)
+		self.assertAlmostEqual(orbit.mean_flow, np.mean(flow), delta=1e-3*orbit.mean_flow)
+
+class TestIntegratorBackends(unittest.TestCase):
+	'''
+		Every backend fills the same result objects with the same answer
+	'''
+	def setUp(self):
+		self.protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+
+	def test_single_run_backends_agree(self):
+		reference = integrate_protocol(init_cond, self.protocol, method='RK45', rtol=1e-10, atol=1e-12)
+		grid = self.protocol.sample_grid(50)
+		for method in ('BDF', 'Radau', 'LSODA', 'odeint', 'rodas3'):
+			result = integrate_protocol(init_cond, self.protocol, method=method)
+			self.assertTrue(result.success, method)
+			self.assertTrue(np.allclose(result.sol(grid)[:4], reference.sol(grid)[:4], atol=0.5), method)
+
+	def test_ensemble_backends_agree(self):
+		conds = [init_cond, dict(init_cond, variant_adj=0.1, ap_status=False), dict(init_cond, vr=0.01)]
+		t_eval = np.unique(self.protocol.sample_grid(20))
+		reference = solve_ensemble(conds, self.protocol, t_eval, rtol=1e-10, atol=1e-12)
+		for method in ('rodas3', 'odeint', 'BDF', 'LSODA'):
+			result = solve_ensemble(conds, self.protocol, t_eval, method=method)
+			self.assertTrue(result.success, method)
+			self.assertEqual(result.y.shape, reference.y.shape)
+			self.assertTrue(np.allclose(result.y[:4], reference.y[:4], atol=0.5), method)
+
+	def test_dense_output_without_private_scipy_class(self):
+		from scipy.integrate import solve_ivp
+		state = solve_ivp(lambda t, y: -y, [0, 2], [1.0, 2.0], dense_output=True)
+		t = np.linspace(0, 2, 9)
+		packed = duct_model_backends.DenseOutput.from_interpolants(state.sol.ts, state.sol.interpolants)
+		previous = duct_model_backends.RkDenseOutput
+		try:
+			# As if SciPy had moved the class: the pieces are wrapped as they are
+			duct_model_backends.RkDenseOutput = None
+			wrapped = duct_model_backends.DenseOutput.from_interpolants(state.sol.ts, state.sol.interpolants)
+		finally:
+			duct_model_backends.RkDenseOutput = previous
+		self.assertIsNotNone(wrapped.pieces)
+		self.assertTrue(np.allclose(wrapped(t), packed(t)))
+		self.assertTrue(np.allclose(wrapped(t), state.sol(t)))
+
+	def test_deployment_default(self):
+		previous = duct_model_backends.default_method()
+		try:
+			duct_model_backends.set_default_method('rodas3')
+			result = integrate_protocol(init_cond, self.protocol)
+			n_steps = duct_model_backends.default_options()['n_steps']
+			self.assertEqual(result.nfev, 3*(3*n_steps + 1))
+		finally:
+			duct_model_backends.set_default_method(previous)
+		with self.assertRaises(ValueError):
+			duct_model_backends.set_default_method('euler')
+
+class TestSolverFallbacks(unittest.TestCase):
+	'''
+		Runs stop within their budget, fall back to other methods and report how they went
+	'''
+	def setUp(self):
+		self.protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		self.grid = self.protocol.sample_grid(50)
+
+	def test_budget_stops_run(self):
+		result = integrate_protocol(init_cond, self.protocol, method='RK45', max_nfev=100, rest_cache=None)
+		self.assertEqual(result.status, duct_model_backends.BUDGET_STATUS)
+		self.assertFalse(result.success)
+		self.assertLessEqual(result.nfev, 101)
+		result = integrate_protocol(init_cond, self.protocol, method='odeint', time_limit=0.0, rest_cache=None)
+		self.assertEqual(result.status, duct_model_backends.BUDGET_STATUS)
+
+	def test_fallback_recovers_run(self):
+		# RK45 needs about 2400 evaluations here, LSODA about 350
+		result = integrate_with_fallbacks(init_cond, self.protocol, method='RK45', max_nfev=1000, rest_cache=None)
+		self.assertTrue(result.success)
+		self.assertEqual([a['method'] for a in result.attempts], ['RK45', 'LSODA'])
+		self.assertEqual([a['status'] for a in result.attempts], [duct_model_backends.BUDGET_STATUS, 0])
+		reference = integrate_protocol(init_cond, self.protocol, method='LSODA', rest_cache=None)
+		self.assertTrue(np.array_equal(result.sol(self.grid), reference.sol(self.grid)))
+		self.assertIn('RK45', result.diagnostics())
+
+	def test_raising_attempt_falls_back(self):
+		import duct_model_protocol
+		integrate = duct_model_protocol.integrate_protocol
+		def overflowing(params, protocol, method=None, **options):
+			# Stands in for a method that blows up on this parameter set
+			if method == 'RK45':
+				raise OverflowError('Numerical result out of range')
+			return integrate(params, protocol, method=method, **options)
+		try:
+			duct_model_protocol.integrate_protocol = overflowing
+			result = integrate_with_fallbacks(init_cond, self.protocol, method='RK45', rest_cache=None)
+			failed = integrate_with_fallbacks(init_cond, self.protocol, method='RK45', fallbacks=(), rest_cache=None)
+		finally:
+			duct_model_protocol.integrate_protocol = integrate
+		self.assertTrue(result.success)
+		self.assertEqual([a['method'] for a in result.attempts], ['RK45', 'LSODA'])
+		self.assertEqual(result.attempts[0]['status'], -1)
+		self.assertIn('OverflowError', result.attempts[0]['message'])
+		self.assertFalse(failed.success)
+		self.assertEqual(failed.y.shape, (5, 1))
+		self.assertIn('OverflowError', failed.diagnostics())
+
+	def test_failure_is_raised(self):
+		with self.assertRaises(SimulationError) as raised:
+			run_protocol(init_cond, 20000, 120000, 200000, fallbacks=(), max_nfev=10, rest_cache=None)
+		self.assertEqual(len(raised.exception.attempts[0]), 1)
+
+	def test_ensemble_members_retried(self):
+		conds = [init_cond, dict(init_cond, variant_adj=0.1, ap_status=False)]
+		t_eval = np.unique(self.grid)
+		result = solve_ensemble(conds, self.protocol, t_eval, time_limit=0.0)
+		self.assertTrue(np.all(result.status == duct_model_backends.BUDGET_STATUS))
+		retry_failed_members(result, conds, self.protocol, rtol=1e-8, atol=1e-10)
+		self.assertTrue(result.success)
+		self.assertEqual(sorted(result.attempts), [0, 1])
+		reference = solve_ensemble(conds, self.protocol, t_eval, rtol=1e-8, atol=1e-10)
+		self.assertTrue(np.allclose(result.y, reference.y, atol=1e-3))
+		# Only the tolerances and the time limit of a batch carry over to its re-runs
+		self.assertEqual(duct_model_ensemble.fallback_options({'method': 'odeint', 'rtol': 1e-8, 'time_limit': 5.0}),
+						 {'rtol': 1e-8, 'time_limit': 5.0})
+
+	def test_ensemble_plots_retry_at_caller_tolerances(self):
+		retry = duct_model_ensemble.integrate_with_fallbacks
+		received = []
+		def recording(params, protocol, **options):
+			received.append(options)
+			return retry(params, protocol, **options)
+		try:
+			duct_model_ensemble.integrate_with_fallbacks = recording
+			with self.assertRaises(SimulationError):
+				duct_model_ensemble.run_ensemble_CFTR([init_cond], 20000, 120000, 200000, n_points=20,
+													  rtol=1e-8, atol=1e-10, time_limit=0.0)
+		finally:
+			duct_model_ensemble.integrate_with_fallbacks = retry
+		self.assertEqual(received, [{'rtol': 1e-8, 'atol': 1e-10, 'time_limit': 0.0}])
+
+class TestProgressiveSolve(unittest.TestCase):
+	'''
+		A provisional coarse answer first, the refined one through a callback
+	'''
+	def setUp(self):
+		self.protocol = StimulusProtocol.secretin_pulse(20000, 120000, 200000)
+		self.conds = [init_cond, dict(init_cond, variant_adj=0.3, ap_status=False)]
+
+	def test_provisional_then_refined(self):
+		import threading
+		delivered, arrived = [], threading.Event()
+		def callback(solve, result):
+			delivered.append((solve, result))
+			arrived.set()
+		handle = progressive_solve(self.conds, self.protocol, n_points=100, callback=callback)
+		self.assertTrue(handle.provisional.provisional)
+		self.assertTrue(handle.provisional.success)
+		refined = handle.result(timeout=30)
+		self.assertFalse(refined.provisional)
+		self.assertGreater(refined.t.size, handle.provisional.t.size)
+		reference = solve_ensemble(self.conds, self.protocol, refined.t, rtol=1e-10, atol=1e-12)
+		self.assertTrue(np.allclose(refined.y[:4], reference.y[:4], atol=1e-4))
+		# The coarse curves stay within about 1 mM of the refined ones
+		coarse = solve_ensemble(self.conds, self.protocol, handle.provisional.t, rtol=1e-10, atol=1e-12)
+		self.assertTrue(np.allclose(handle.provisional.y[:4], coarse.y[:4], atol=1.5))
+		self.assertTrue(arrived.wait(30))
+		self.assertEqual(delivered, [(handle, refined)])
+
+	def test_cancelled_solve_is_not_delivered(self):
+		delivered = []
+		handle = progressive_solve(self.conds, self.protocol, callback=lambda *args: delivered.append(args))
+		handle.cancel()
+		try:
+			handle.result(timeout=30)
+		except Exception:
+			pass
+		self.assertEqual(delivered, [])
+
+	def test_failed_refinement_is_delivered(self):
+		from concurrent.futures import Future
+		class Immediate():
+			# Runs a job on submit, so its future is done before a callback is registered
+			def submit(self, job):
+				future = Future()
+				try:
+					future.set_result(job())
+				except Exception as error:
+					future.set_exception(error)
+				return future
+		delivered = []
+		handle = progressive_solve(self.conds, self.protocol, n_points=50, executor=Immediate(),
+								   callback=lambda *args: delivered.append(args))
+		self.assertEqual(len(delivered), 1)
+		self.assertIs(delivered[0][0], handle)
+		self.assertTrue(delivered[0][1].success)
+		delivered = []
+		handle = progressive_solve(self.conds, self.protocol, executor=Immediate(), refined_options={'method': 'no-such-method'},
+								   callback=lambda *args: delivered.append(args))
+		self.assertIs(delivered[0][0], handle)
+		self.assertIsInstance(delivered[0][1], Exception)
+
+class TestAutotune(unittest.TestCase):
+	'''
+		Solver configurations are chosen on measured error and cost
+	'''
+	def test_picks_cheapest_accurate_configuration(self):
+		cases = {'WT': {}, 'severe variant': {'variant_adj': 0.05}}
+		protocol = StimulusProtocol.secretin_pulse(20000, 60000, 80000)
+		candidates = [{'method': 'RK45', 'rtol': 1e-1, 'atol': 1e-1},
+					  {'method': 'RK45', 'rtol': 1e-6, 'atol': 1e-9},
+					  {'method': 'LSODA', 'rtol': 1e-5, 'atol': 1e-8}]
+		result = autotune(0.05, cases=cases, candidates=candidates, protocol=protocol, repeats=1)
+		self.assertIsNotNone(result['best'])
+		self.assertNotEqual(result['best']['rtol'], 1e-1)
+		chosen = [row for row in result['rows'] if row['passed'] and row['method'] == result['best']['method']]
+		self.assertLessEqual(chosen[0]['max_error'], 0.05)
+
+class TestReducedOrderModel(unittest.TestCase):
+	'''
+		POD model trained on a small grid reproduces full runs and rejects untrained inputs
+	'''
+	@classmethod
+	def setUpClass(cls):
+		cls.protocol = StimulusProtocol.secretin_pulse(20000, 60000, 80000)
+		cls.rom = ReducedOrderModel.train(protocol=cls.protocol, n_points=100, cl_range=(0.05, 1.0),
+										  smoke_range=(0.5, 1.0), cl_nodes=12, smoke_nodes=4,
+										  flag_pairs=((False, False), (True, True)))
+
+	def test_matches_full_model_within_estimate(self):
+		query = dict(init_cond, variant_adj=0.3, smoke_adj=0.7, alcohol_adj=0.8, ap_status=True, apb_status=True)
+		result = self.rom.simulate(query)
+		self.assertTrue(result.success)
+		self.assertEqual(result.y.shape, (5, self.rom.t.size))
+		errors = self.rom.validate(query)
+		self.assertLess(max(errors.values()), 0.5)
+		self.assertLess(errors['bl'], 3*result.error_bound('bl') + 0.01)
+		full = integrate_protocol(query, self.protocol, method='Radau', rtol=1e-8, atol=1e-10)
+		self.assertAlmostEqual(result.trajectory(self.rom.t)['bl'].max(), full.sol(self.rom.t)[1].max(), delta=0.5)
+
+	def test_batch_matches_single_queries(self):
+		members = [dict(init_cond, variant_adj=0.1), dict(init_cond, variant_adj=0.6, smoke_adj=0.55,
+														   ap_status=True, apb_status=True)]
+		batch = self.rom.simulate_batch(members)
+		for i, member in enumerate(members):
+			self.assertTrue(np.allclose(batch.member(i), self.rom.simulate(member).y))
+			self.assertEqual(batch.error_bound()[i], self.rom.simulate(member).error_bound())
+
+	def test_rejects_untrained_parameters(self):
+		with self.assertRaises(ValueError):
+			self.rom.simulate(dict(init_cond, variant_adj=0.01))
+		with self.assertRaises(ValueError):
+			self.rom.simulate(dict(init_cond, vr=0.5))
+		with self.assertRaises(ValueError):
+			self.rom.simulate(dict(init_cond, ap_status=True, apb_status=False))
+
 class TestDuctModelGraphingFunctions(unittest.TestCase):
 	''' 
 		Load Initial Conditions from 
@@ -81,10 +1024,15 @@ class TestDuctModelGraphingFunctions(unittest.TestCase):
 		pass
 
 	def test_vol_rat_calc(self):
-		pass
+		model_results = vol_rat_calc(init_cond, 20000, 120000, 200000, [10, 0.1])
+		self.assertEqual([result[-1] for result in model_results], [10, 0.1])
+		single = run_protocol(dict(init_cond, vr=0.1), 20000, 120000, 200000)
+		self.assertAlmostEqual(model_results[1][0][2].max(), single[2].max(), delta=0.5)
 
 	def test_antiporters_calc(self):
-		pass
+		model_results = antiporters_calc(init_cond, 20000, 120000, 200000)
+		self.assertEqual([result[-1] for result in model_results], [(True, True), (False, False), (True, False)])
+		self.assertEqual(len(model_results[0][0]), 5)
 
 	def test_calc_variant_impact(self):
 		pass
@@ -93,6 +1041,29 @@ class TestDuctModelGraphingFunctions(unittest.TestCase):
 def suite():
 	suite = unittest.TestSuite()
 	suite.addTest(unittest.makeSuite(TestDuctModelLogic))
+	suite.addTest(unittest.makeSuite(TestDuctParams))
+	suite.addTest(unittest.makeSuite(TestDuctEnsemble))
+	suite.addTest(unittest.makeSuite(TestGeneratedModel))
+	suite.addTest(unittest.makeSuite(TestStableKernels))
+	suite.addTest(unittest.makeSuite(TestLogForm))
+	suite.addTest(unittest.makeSuite(TestReducedModel))
+	suite.addTest(unittest.makeSuite(TestSteadyState))
+	suite.addTest(unittest.makeSuite(TestRestingPhaseCache))
+	suite.addTest(unittest.makeSuite(TestStimulusProtocol))
+	suite.addTest(unittest.makeSuite(TestSensitivities))
+	suite.addTest(unittest.makeSuite(TestSobolIndices))
+	suite.addTest(unittest.makeSuite(TestVariantUncertainty))
+	suite.addTest(unittest.makeSuite(TestCalibration))
+	suite.addTest(unittest.makeSuite(TestInverseSolver))
+	suite.addTest(unittest.makeSuite(TestContinuation))
+	suite.addTest(unittest.makeSuite(TestPhaseDiagram))
+	suite.addTest(unittest.makeSuite(TestParameterSweep))
+	suite.addTest(unittest.makeSuite(TestPeriodicSteadyState))
+	suite.addTest(unittest.makeSuite(TestIntegratorBackends))
+	suite.addTest(unittest.makeSuite(TestSolverFallbacks))
+	suite.addTest(unittest.makeSuite(TestProgressiveSolve))
+	suite.addTest(unittest.makeSuite(TestAutotune))
+	suite.addTest(unittest.makeSuite(TestReducedOrderModel))
 	suite.addTest(unittest.makeSuite(TestDuctModelGraphingFunctions))
 	return suite
 